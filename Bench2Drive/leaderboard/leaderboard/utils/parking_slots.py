@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+Packed parking slots of the parked vehicles with a grid index for radius queries.
+
+The slots of every town are stored as one compressed .npz file in utils/parked_vehicles_packed/ (locations,
+rotations, tiles and an index into the list of meshes) and only loaded when a route in that town is created.
+The python source in utils/parked_vehicles.py stays the reference, regenerate the packed files after changing it:
+python leaderboard/utils/parking_slots.py
+"""
+
+from __future__ import print_function
+
+import functools
+import importlib.util
+import os
+
+import numpy as np
+
+PACKED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parked_vehicles_packed')
+SOURCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parked_vehicles.py')
+GRID_CELL_SIZE = 50.0  # m
+
+
+class ParkingSlots(object):
+
+    """
+    Parking slots of one town. Slot i is the i-th entry of the town list in parked_vehicles.py.
+    The slots are sorted into a 2D grid (x, y), a radius query only looks at the cells that overlap the circle.
+    """
+
+    def __init__(self, locations, rotations, mesh_ids, meshes, tiles=None, cell_size=GRID_CELL_SIZE):
+        self.locations = np.asarray(locations, dtype=np.float64)
+        self.rotations = np.asarray(rotations, dtype=np.float64)
+        self.mesh_ids = np.asarray(mesh_ids)
+        self.meshes = [str(mesh) for mesh in meshes]
+        self.tiles = tiles
+        self.cell_size = cell_size
+
+        if len(self.locations) == 0:
+            self._cell_min = np.zeros(2, dtype=np.int64)
+            self._grid_shape = np.zeros(2, dtype=np.int64)
+            self._order = np.zeros(0, dtype=np.int64)
+            self._cell_starts = np.zeros(1, dtype=np.int64)
+            return
+
+        cells = np.floor(self.locations[:, :2] / cell_size).astype(np.int64)
+        self._cell_min = cells.min(axis=0)
+        self._grid_shape = cells.max(axis=0) - self._cell_min + 1
+        cells -= self._cell_min
+        # cell id in column major order, a query rectangle is one contiguous range of ids per x column
+        cell_ids = cells[:, 0] * self._grid_shape[1] + cells[:, 1]
+        self._order = np.argsort(cell_ids, kind='stable')
+        self._cell_starts = np.searchsorted(cell_ids[self._order], np.arange(self._grid_shape.prod() + 1))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _grid_candidates(self, center, radius):
+        low = np.floor((center[:2] - radius) / self.cell_size).astype(np.int64) - self._cell_min
+        high = np.floor((center[:2] + radius) / self.cell_size).astype(np.int64) - self._cell_min
+        low = np.maximum(low, 0)
+        high = np.minimum(high, self._grid_shape - 1)
+        if np.any(low > high):
+            return np.zeros(0, dtype=np.int64)
+
+        ranges = [self._order[self._cell_starts[x * self._grid_shape[1] + low[1]]:
+                              self._cell_starts[x * self._grid_shape[1] + high[1] + 1]]
+                  for x in range(low[0], high[0] + 1)]
+        return np.concatenate(ranges)
+
+    def query_radius(self, center, radius, mask=None):
+        """
+        Indices (ascending, i.e. in the order of parked_vehicles.py) of the slots closer than radius to center.
+        mask: optional boolean array over all slots, only slots with True are returned
+        """
+        center = np.asarray(center, dtype=np.float64)
+        candidates = self._grid_candidates(center, radius)
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        distances = np.linalg.norm(self.locations[candidates] - center, axis=1)
+        return np.sort(candidates[distances < radius])
+
+    def select_route_slots(self, route_locations, max_distance=100, route_step=10):
+        """
+        Mask of the slots that are inside the bounding box of the route (extended by max_distance) and closer
+        than max_distance to any route_step-th route point.
+        """
+        route_locations = np.asarray(route_locations, dtype=np.float64).reshape(-1, 3)
+        selected = np.zeros(len(self), dtype=bool)
+        if len(route_locations) == 0 or len(self) == 0:
+            return selected
+
+        for route_location in route_locations[::route_step]:
+            selected[self.query_radius(route_location, max_distance)] = True
+
+        min_xy = route_locations[:, :2].min(axis=0) - max_distance
+        max_xy = route_locations[:, :2].max(axis=0) + max_distance
+        selected &= np.all((min_xy < self.locations[:, :2]) & (self.locations[:, :2] < max_xy), axis=1)
+        return _keep_like_list_removal(selected)
+
+    def select_spawn_slots(self, ego_location, radius, available, occupied_locations, max_scenario_distance=10):
+        """
+        Indices of the available slots closer than radius to the ego that are at least max_scenario_distance away
+        from the parking slots occupied by scenarios.
+        """
+        slots = self.query_radius(ego_location, radius, mask=available)
+        if len(slots) > 0 and len(occupied_locations) > 0:
+            occupied_locations = np.asarray(occupied_locations, dtype=np.float64).reshape(-1, 3)
+            distances = np.linalg.norm(self.locations[slots, None] - occupied_locations[None], axis=2)
+            slots = slots[np.all(distances >= max_scenario_distance, axis=1)]
+        if len(slots) > 1:
+            # Like the list removal: a slot directly after a spawned one (among the available slots) waits a tick
+            positions = np.cumsum(available)[slots]
+            spawn = np.ones(len(slots), dtype=bool)
+            for i in range(1, len(slots)):
+                spawn[i] = not (spawn[i - 1] and positions[i] == positions[i - 1] + 1)
+            slots = slots[spawn]
+        return slots
+
+    def get_slot(self, index):
+        """location (x, y, z), rotation (pitch, yaw, roll) and mesh path of a slot"""
+        return tuple(self.locations[index].tolist()), tuple(self.rotations[index].tolist()), \
+            self.meshes[self.mesh_ids[index]]
+
+
+def _keep_like_list_removal(selected):
+    """
+    The slots were filtered by removing them from the list while iterating over it, which skipped the slot
+    after every removed one. These slots stay selected, so that the routes spawn the same parked vehicles.
+    """
+    kept = selected.copy()
+    skipped = -1
+    for index in np.flatnonzero(~selected):
+        if index == skipped:
+            kept[index] = True
+        else:
+            skipped = index + 1
+    return kept
+
+
+def get_packed_file(town):
+    return os.path.join(PACKED_DIR, town + '.npz')
+
+
+@functools.lru_cache(maxsize=None)
+def load_parking_slots(town):
+    """ParkingSlots of a town, None if the town has no parked vehicles. Loaded once per process."""
+    packed_file = get_packed_file(town)
+    if not os.path.isfile(packed_file):
+        return None
+    with np.load(packed_file) as data:
+        return ParkingSlots(data['locations'], data['rotations'], data['mesh_ids'], data['meshes'], data['tiles'])
+
+
+def pack_parking_slots(slots):
+    """Arrays of the .npz file from a list of slot dicts of parked_vehicles.py"""
+    meshes = sorted(set(slot['mesh'] for slot in slots))
+    mesh_index = {mesh: index for index, mesh in enumerate(meshes)}
+    return {
+        'locations': np.array([slot['location'] for slot in slots], dtype=np.float64).reshape(-1, 3),
+        'rotations': np.array([slot['rotation'] for slot in slots], dtype=np.float64).reshape(-1, 3),
+        'tiles': np.array([(slot['tilex'], slot['tiley']) for slot in slots], dtype=np.int32).reshape(-1, 2),
+        'mesh_ids': np.array([mesh_index[slot['mesh']] for slot in slots], dtype=np.int32),
+        'meshes': np.array(meshes),
+    }
+
+
+def load_source_module(source_file=SOURCE_FILE):
+    spec = importlib.util.spec_from_file_location('parked_vehicles', source_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    module = load_source_module()
+    os.makedirs(PACKED_DIR, exist_ok=True)
+    for town, slots in sorted(vars(module).items()):
+        if not town.startswith('Town') or not isinstance(slots, list):
+            continue
+        np.savez_compressed(get_packed_file(town), **pack_parking_slots(slots))
+        print('{}: {} parking slots -> {}'.format(town, len(slots), get_packed_file(town)))
+
+
+if __name__ == '__main__':
+    main()
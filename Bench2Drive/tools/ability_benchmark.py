@@ -1,14 +1,21 @@
+"""
+Ability and scenario success rates of a merged Bench2Drive result file (see merge_route_json.py).
+Traffic_Signs needs the completion at which the ego passes the first junction of each route, which is traced with
+the GlobalRoutePlanner in CARLA. With --junction_cache the completions are saved on the first run and later runs
+(and tools/result_parser_new.py --ability) use them. Without CARLA, --offline estimates them from the route file,
+which is not the official metric, the output lists the estimated routes in estimated_junction_completions.
+"""
 import json
-import carla
 import argparse
 import xml.etree.ElementTree as ET
-from agents.navigation.global_route_planner import GlobalRoutePlanner
 import os
 import atexit
 import subprocess
 import time
 import random
 
+import numpy as np
+
 Ability = {
     "Overtaking":['Accident', 'AccidentTwoWays', 'ConstructionObstacle', 'ConstructionObstacleTwoWays', 'HazardAtSideLaneTwoWays', 'HazardAtSideLane', 'ParkedObstacleTwoWays', 'ParkedObstacle', 'VehicleOpensDoorTwoWays'],
     "Merging": ['CrossingBicycleFlow', 'EnterActorFlow', 'HighwayExit', 'InterurbanActorFlow', 'HighwayCutIn', 'InterurbanAdvancedActorFlow', 'MergerIntoSlowTrafficV2', 'MergerIntoSlowTraffic', 'NonSignalizedJunctionLeftTurn', 'NonSignalizedJunctionRightTurn', 'NonSignalizedJunctionLeftTurnEnterFlow', 'ParkingExit', 'SequentialLaneChange', 'SignalizedJunctionLeftTurn', 'SignalizedJunctionRightTurn', 'SignalizedJunctionLeftTurnEnterFlow'],
@@ -46,17 +53,11 @@ def update_Success(scenario_name, Success_Statistic, status):
     pass
 
 def get_position(xml_route):
+    import carla  # pylint: disable=import-outside-toplevel
     waypoints_elem = xml_route.find('waypoints')
     keypoints = waypoints_elem.findall('position')
     return [carla.Location(float(pos.get('x')), float(pos.get('y')), float(pos.get('z'))) for pos in keypoints]
 
-def get_route_result(records, route_id):
-    for record in records:
-        record_route_id = record['route_id'].split('_')[1]
-        if route_id == record_route_id:
-            return record
-    return None
-
 def get_waypoint_route(locs, grp):
     route = []
     for i in range(len(locs) - 1):
@@ -67,24 +68,52 @@ def get_waypoint_route(locs, grp):
             route.append(wp)
     return route
 
-def main(args):
-    routes_file = args.file 
-    result_file = args.result_file
-    Ability_Statistic = {}
-    crash_route_list = []
-    for key in Ability:
-        Ability_Statistic[key] = [0, 0.]
-    Success_Statistic = {}
-    
-    with open(result_file, 'r') as f:
-        data = json.load(f)
-    records = data["_checkpoint"]["records"]
-                    
-    tree = ET.parse(routes_file)
-    root = tree.getroot()
-    routes = root.findall('route')
-    sorted_routes = sorted(routes, key=lambda x: x.get('town'))
-    
+def get_junction_completion(route, grp):
+    """Completion of the route at which the ego has passed the trigger volume of the first junction."""
+    location_list = get_position(route)
+    waypoint_route = get_waypoint_route(location_list, grp)
+    count = 0
+    for wp in waypoint_route:
+        count += 1
+        if wp.is_junction:
+            break
+    if not wp.is_junction:
+        raise RuntimeError("This route does not contain any junction-waypoint!")
+    # +8 to ensure the ego pass the trigger volume
+    return float(count+8) / float(len(waypoint_route))
+
+def estimate_junction_completion(route, turn_threshold=0.1):
+    """
+    Estimate of get_junction_completion from the route file only. The file has no junction information, so the
+    junction is taken as the first point after the trigger point where the route turns (the lanes through a junction
+    are curved) and as the trigger point if the route goes straight through the junction. The positions are meters
+    apart, like the waypoints of the trace. An approximation that is not compared to traced completions, only used
+    with --offline.
+    """
+    keypoints = route.find('waypoints').findall('position')
+    positions = np.array([[float(pos.get('x')), float(pos.get('y'))] for pos in keypoints])
+    steps = np.diff(positions, axis=0)
+    distances = np.concatenate(([0.0], np.cumsum(np.linalg.norm(steps, axis=1))))
+    trigger_point = route.find('scenarios').find('scenario').find('trigger_point')
+    trigger = np.array([float(trigger_point.get('x')), float(trigger_point.get('y'))])
+    start = int(np.argmin(np.linalg.norm(positions - trigger, axis=1)))
+    headings = np.arctan2(steps[:, 1], steps[:, 0])
+    heading_changes = np.abs((np.diff(headings) + np.pi) % (2 * np.pi) - np.pi)
+    # heading_changes[i] is between step i and step i + 1, which starts at position i + 1
+    turns = np.flatnonzero(heading_changes[start:] > turn_threshold)
+    junction = start + int(turns[0]) + 1 if len(turns) > 0 else start
+    # +8 to ensure the ego pass the trigger volume
+    return min(float(distances[junction] + 8) / float(distances[-1]), 1.0)
+
+def estimate_junction_completions(routes):
+    """Junction completions of the Traffic_Signs routes, estimated without CARLA."""
+    return {route.get('id'): estimate_junction_completion(route) for route in routes
+            if route.find('scenarios').find('scenario').get("type") in Ability["Traffic_Signs"]}
+
+def get_junction_completions(routes, args):
+    """Junction completions of the Traffic_Signs routes, traced in CARLA."""
+    import carla  # pylint: disable=import-outside-toplevel
+    from agents.navigation.global_route_planner import GlobalRoutePlanner  # pylint: disable=import-outside-toplevel
     carla_path = os.environ["CARLA_ROOT"]
     cmd1 = f"{os.path.join(carla_path, 'CarlaUE4.sh')} -RenderOffScreen -nosound -carla-rpc-port={args.port}"
     server = subprocess.Popen(cmd1, shell=True, preexec_fn=os.setsid)
@@ -92,16 +121,40 @@ def main(args):
     time.sleep(60)
     client = carla.Client(args.host, args.port)
     client.set_timeout(300)
-    
-    current_town = sorted_routes[0].get('town')
-    world = client.load_world(current_town)
-    carla_map = world.get_map()
-    grp = GlobalRoutePlanner(carla_map, 1.0)
-    for route in sorted_routes:
+
+    junction_completions = {}
+    current_town = None
+    for route in routes:
+        if route.find('scenarios').find('scenario').get("type") not in Ability["Traffic_Signs"]:
+            continue
+        if route.get('town') != current_town:
+            current_town = route.get('town')
+            print("Loading the town:", current_town)
+            world = client.load_world(current_town)
+            print("successfully load the town:", current_town)
+        grp = GlobalRoutePlanner(world.get_map(), 1.0)
+        junction_completions[route.get('id')] = get_junction_completion(route, grp)
+    return junction_completions
+
+def compute_ability(records, routes, junction_completions):
+    """
+    Ability and success rates of the records of the routes (sorted by town). Returns the ability results, the success
+    statistics per scenario and the crashed routes.
+    """
+    Ability_Statistic = {}
+    crash_route_list = []
+    for key in Ability:
+        Ability_Statistic[key] = [0, 0.]
+    Success_Statistic = {}
+    # the first record of every route, route ids look like RouteScenario_<id>_rep0
+    route_records = {}
+    for record in records:
+        route_records.setdefault(record['route_id'].split('_')[1], record)
+    for route in routes:
         scenarios = route.find('scenarios')
         scenario_name = scenarios.find('scenario').get("type")
         route_id = route.get('id')
-        route_record = get_route_result(records, route_id)
+        route_record = route_records.get(route_id)
         if route_record is None:
             crash_route_list.append((scenario_name, route_id))
             print('No result record of route', route_id, "in the result file")
@@ -115,28 +168,9 @@ def main(args):
             record_success_status = False
         update_Ability(scenario_name, Ability_Statistic, record_success_status)
         update_Success(scenario_name, Success_Statistic, record_success_status)
-        # if scenario_name in Ability["Traffic_Signs"] and (scenario_name in Ability["Merging"] or scenario_name in Ability["Emergency_Brake"]):
         # Only these three 'Ability's intersect
         if scenario_name in Ability["Traffic_Signs"]:
-            # Only these three 'Ability's intersect
-            if route.get('town') != current_town:
-                current_town = route.get('town')
-                print("Loading the town:", current_town)
-                world = client.load_world(current_town)
-                print("successfully load the town:", current_town)
-            carla_map = world.get_map()
-            grp = GlobalRoutePlanner(carla_map, 1.0)
-            location_list = get_position(route)
-            waypoint_route = get_waypoint_route(location_list, grp)
-            count = 0
-            for wp in waypoint_route:
-                count += 1
-                if wp.is_junction:
-                    break 
-            if not wp.is_junction:
-                raise RuntimeError("This route does not contain any junction-waypoint!")
-            # +8 to ensure the ego pass the trigger volume
-            junction_completion = float(count+8) / float(len(waypoint_route))
+            junction_completion = junction_completions[route_id]
             record_completion = route_record["scores"]["score_route"] / 100.0
             stop_infraction = route_record["infractions"]["stop_infraction"]
             red_light_infraction = route_record["infractions"]["red_light"]
@@ -145,21 +179,50 @@ def main(args):
                 Ability_Statistic['Traffic_Signs'][1] += 1
             else:
                 Ability_Statistic['Traffic_Signs'][1] += 1
-        else:
-            pass
-        
+
     Ability_Res = {}
     for ability, statis in Ability_Statistic.items():
         Ability_Res[ability] = float(statis[0])/float(statis[1])
-        
-    for key, value in Ability_Res.items():
-        print(key, ": ", value)
-    
     Ability_Res['mean'] = sum(list(Ability_Res.values())) / 5
     Ability_Res['crashed'] = crash_route_list
+    return Ability_Res, Success_Statistic, crash_route_list
+
+def main(args):
+    routes_file = args.file
+    result_file = args.result_file
+
+    with open(result_file, 'r') as f:
+        data = json.load(f)
+    records = data["_checkpoint"]["records"]
+
+    tree = ET.parse(routes_file)
+    root = tree.getroot()
+    routes = root.findall('route')
+    sorted_routes = sorted(routes, key=lambda x: x.get('town'))
+
+    estimated = None
+    if args.junction_cache and os.path.exists(args.junction_cache):
+        with open(args.junction_cache, 'r') as f:
+            junction_completions = json.load(f)
+    elif args.offline:
+        print('Warning: Estimating the junction completions from the route file, not the official metric.')
+        junction_completions = estimate_junction_completions(sorted_routes)
+        estimated = sorted(junction_completions, key=int)
+    else:
+        junction_completions = get_junction_completions(sorted_routes, args)
+        if args.junction_cache:
+            with open(args.junction_cache, 'w') as f:
+                json.dump(junction_completions, f, indent=4)
+
+    Ability_Res, Success_Statistic, crash_route_list = compute_ability(records, sorted_routes, junction_completions)
+    for key, value in Ability_Res.items():
+        if key not in ('mean', 'crashed'):
+            print(key, ": ", value)
+    if estimated is not None:
+        Ability_Res['estimated_junction_completions'] = estimated
     with open(f"{result_file.split('.')[0]}_ability.json", 'w') as file:
         json.dump(Ability_Res, file, indent=4)
-        
+
     Success_Res = {}
     Route_num = 0
     Succ_Route_num = 0
@@ -178,6 +241,8 @@ if __name__=='__main__':
     argparser.add_argument('-r', '--result_file', nargs=None, default="", help='result json file')
     argparser.add_argument('-t', '--host', default='localhost', help='IP of the host server (default: localhost)')
     argparser.add_argument('-p', '--port', nargs=1, default=4000, help='carla rpc port')
+    argparser.add_argument('-j', '--junction_cache', default='', help='json with the junction completion of every route, created if missing')
+    argparser.add_argument('--offline', action='store_true', help='estimate the junction completions from the route file instead of tracing them in CARLA (not the official metric)')
     args = argparser.parse_args()
     main(args)
     
\ No newline at end of file
@@ -0,0 +1,272 @@
+"""
+Columnar HD map format.
+gen_hdmap.py used to save the lane_marking_dict of a town as an object array inside an npz, which needs allow_pickle
+and unpickles the whole town on load. The columnar format is a folder of plain .npy files (memory-mappable) and a
+meta.json:
+
+    points [P, 3], rotations [P, 3]     location and (roll, pitch, yaw) of all lane points, float64
+    point_junction [P]                  is_junction of center points, -1 for lane markings
+    element_offsets [E + 1]             points of element e are points[element_offsets[e]:element_offsets[e + 1]]
+    element_road, element_lane [E]      road and lane id of the element
+    element_type, element_color [E]     index into meta['types'] / meta['colors'] ('Center', 'Broken', ...)
+    element_topology_type [E]           index into meta['topology_types'], -1 for lane markings
+    element_left, element_right [E, 2]  (road, lane) of the neighbour lanes of center lines, NONE_ID for None
+    element_bounds [E, 4]               x_min, y_min, x_max, y_max of the element, used by the spatial queries
+    topology_offsets [E + 1], topology [T, 2]  (road, lane) of the connected lanes of every element
+    lane_keys [L, 2], lane_offsets [L + 1]     the elements of lane l are lane_offsets[l]:lane_offsets[l + 1]
+    trigger_offsets [V + 1], trigger_points [Q, 3], trigger_road [V], trigger_type [V], trigger_parent [V, 3]
+
+Converting an existing npz:
+python tools/columnar_hdmap.py --npz maps/Town12_HD_map.npz maps/Town13_HD_map.npz
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+
+FORMAT_VERSION = 1
+# road / lane id of a missing neighbour lane
+NONE_ID = np.iinfo(np.int32).min
+
+
+def _ids(pair):
+    return [NONE_ID if value is None else value for value in pair]
+
+
+def _pair(row):
+    return tuple(None if value == NONE_ID else int(value) for value in row)
+
+
+def lane_marking_dict_to_columns(lane_marking_dict):
+    """Returns the arrays and the meta data of the columnar format of a lane_marking_dict of gen_hdmap.py."""
+    vocabularies = {'types': [], 'colors': [], 'topology_types': [], 'trigger_types': []}
+
+    def vocabulary_id(name, value):
+        if value not in vocabularies[name]:
+            vocabularies[name].append(value)
+        return vocabularies[name].index(value)
+
+    points, rotations, point_junction, element_offsets = [], [], [], [0]
+    element_road, element_lane, element_type, element_color, element_topology_type = [], [], [], [], []
+    element_left, element_right, topology, topology_offsets = [], [], [], [0]
+    lane_keys, lane_offsets = [], [0]
+    trigger_points, trigger_offsets, trigger_road, trigger_type, trigger_parent = [], [0], [], [], []
+
+    for road_id, road in lane_marking_dict.items():
+        for lane_id, elements in road.items():
+            if lane_id == 'Trigger_Volumes':
+                for volume in elements:
+                    trigger_points.extend(volume['Points'])
+                    trigger_offsets.append(len(trigger_points))
+                    trigger_road.append(road_id)
+                    trigger_type.append(vocabulary_id('trigger_types', volume['Type']))
+                    trigger_parent.append(volume['ParentActor_Location'])
+                continue
+
+            for element in elements:
+                for point in element['Points']:
+                    points.append(point[0])
+                    rotations.append(point[1])
+                    point_junction.append(int(point[2]) if len(point) > 2 else -1)
+                element_offsets.append(len(points))
+                element_road.append(road_id)
+                element_lane.append(lane_id)
+                element_type.append(vocabulary_id('types', element['Type']))
+                element_color.append(vocabulary_id('colors', element['Color']))
+                element_topology_type.append(vocabulary_id('topology_types', element['TopologyType']) if 'TopologyType' in element else -1)
+                element_left.append(_ids(element.get('Left', (None, None))))
+                element_right.append(_ids(element.get('Right', (None, None))))
+                topology.extend(_ids((None, None) if connection is None else connection) for connection in element['Topology'])
+                topology_offsets.append(len(topology))
+            lane_keys.append((road_id, lane_id))
+            lane_offsets.append(len(element_road))
+
+    columns = {
+        'points': np.array(points, dtype=np.float64).reshape(-1, 3),
+        'rotations': np.array(rotations, dtype=np.float64).reshape(-1, 3),
+        'point_junction': np.array(point_junction, dtype=np.int8),
+        'element_offsets': np.array(element_offsets, dtype=np.int64),
+        'element_road': np.array(element_road, dtype=np.int32),
+        'element_lane': np.array(element_lane, dtype=np.int32),
+        'element_type': np.array(element_type, dtype=np.int16),
+        'element_color': np.array(element_color, dtype=np.int16),
+        'element_topology_type': np.array(element_topology_type, dtype=np.int16),
+        'element_left': np.array(element_left, dtype=np.int32).reshape(-1, 2),
+        'element_right': np.array(element_right, dtype=np.int32).reshape(-1, 2),
+        'topology_offsets': np.array(topology_offsets, dtype=np.int64),
+        'topology': np.array(topology, dtype=np.int32).reshape(-1, 2),
+        'lane_keys': np.array(lane_keys, dtype=np.int32).reshape(-1, 2),
+        'lane_offsets': np.array(lane_offsets, dtype=np.int64),
+        'trigger_offsets': np.array(trigger_offsets, dtype=np.int64),
+        'trigger_points': np.array(trigger_points, dtype=np.float64).reshape(-1, 3),
+        'trigger_road': np.array(trigger_road, dtype=np.int32),
+        'trigger_type': np.array(trigger_type, dtype=np.int16),
+        'trigger_parent': np.array(trigger_parent, dtype=np.float64).reshape(-1, 3),
+    }
+    columns['element_bounds'] = segment_bounds(columns['points'], columns['element_offsets'])
+    meta = {'version': FORMAT_VERSION, **vocabularies}
+    return columns, meta
+
+
+def segment_bounds(points, offsets):
+    """x_min, y_min, x_max, y_max of every segment of points, inf for empty segments."""
+    bounds = np.full((len(offsets) - 1, 4), np.inf)
+    bounds[:, 2:] = -np.inf
+    non_empty = offsets[1:] > offsets[:-1]
+    if points.shape[0] > 0 and non_empty.any():
+        starts = offsets[:-1][non_empty]
+        bounds[non_empty, :2] = np.minimum.reduceat(points[:, :2], starts, axis=0)
+        bounds[non_empty, 2:] = np.maximum.reduceat(points[:, :2], starts, axis=0)
+    return bounds
+
+
+def save_columnar_map(map_dir, columns, meta):
+    """Writes the map folder, an existing map is only replaced once the new one is complete."""
+    tmp_dir = f'{map_dir}.tmp_{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in columns.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(map_dir):
+        shutil.rmtree(map_dir)
+    os.replace(tmp_dir, map_dir)
+
+
+def load_legacy_npz(npz_path):
+    """lane_marking_dict of an npz written by the previous gen_hdmap.py."""
+    return dict(np.load(npz_path, allow_pickle=True)['arr'])
+
+
+def columnar_map_dir(map_path):
+    """Folder of the columnar map of a map path, Town12_HD_map.npz -> Town12_HD_map."""
+    return map_path[:-len('.npz')] if map_path.endswith('.npz') else map_path
+
+
+class ColumnarHDMap(object):
+    """Reader of the columnar format, the arrays are memory-mapped by default."""
+
+    def __init__(self, map_dir=None, mmap_mode='r', columns=None, meta=None):
+        if columns is None:
+            with open(os.path.join(map_dir, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            if meta['version'] != FORMAT_VERSION:
+                raise ValueError(f'{map_dir} has version {meta["version"]}, expected {FORMAT_VERSION}.')
+            columns = {file[:-len('.npy')]: np.load(os.path.join(map_dir, file), mmap_mode=mmap_mode)
+                       for file in os.listdir(map_dir) if file.endswith('.npy')}
+        self.meta = meta
+        for name, array in columns.items():
+            setattr(self, name, array)
+        self.lanes = {(int(road_id), int(lane_id)): (int(self.lane_offsets[i]), int(self.lane_offsets[i + 1]))
+                      for i, (road_id, lane_id) in enumerate(np.asarray(self.lane_keys).tolist())}
+
+    @classmethod
+    def from_lane_marking_dict(cls, lane_marking_dict):
+        columns, meta = lane_marking_dict_to_columns(lane_marking_dict)
+        return cls(columns=columns, meta=meta)
+
+    @classmethod
+    def load(cls, map_path):
+        """Loads the columnar map of map_path, an npz without columnar folder is converted in memory."""
+        map_dir = columnar_map_dir(map_path)
+        if os.path.isfile(os.path.join(map_dir, 'meta.json')):
+            return cls(map_dir)
+        return cls.from_lane_marking_dict(load_legacy_npz(map_path))
+
+    def __len__(self):
+        return len(self.element_road)
+
+    def lane_elements(self, road_id, lane_id):
+        """Element ids of a lane, empty if the lane is not in the map."""
+        start, end = self.lanes.get((road_id, lane_id), (0, 0))
+        return np.arange(start, end)
+
+    def element_points(self, element):
+        return self.points[self.element_offsets[element]:self.element_offsets[element + 1]]
+
+    def gather_points(self, elements):
+        """Points of several elements, returns the point indices and the position of their element in elements."""
+        elements = np.asarray(elements, dtype=np.int64)
+        starts = np.asarray(self.element_offsets)[elements]
+        lengths = np.asarray(self.element_offsets)[elements + 1] - starts
+        owner = np.repeat(np.arange(len(elements)), lengths)
+        point_indices = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        return point_indices, owner
+
+    def element_type_name(self, element):
+        return self.meta['types'][self.element_type[element]]
+
+    def element_color_name(self, element):
+        return self.meta['colors'][self.element_color[element]]
+
+    def topology_of(self, element):
+        """Connected (road, lane) of an element, like the 'Topology' entry of the lane_marking_dict."""
+        rows = self.topology[self.topology_offsets[element]:self.topology_offsets[element + 1]]
+        return [None if row[0] == NONE_ID else _pair(row) for row in np.asarray(rows).tolist()]
+
+    def elements_in_box(self, x_min, y_min, x_max, y_max):
+        """Elements whose bounding box intersects the axis aligned box."""
+        bounds = self.element_bounds
+        mask = (bounds[:, 0] <= x_max) & (bounds[:, 2] >= x_min) & (bounds[:, 1] <= y_max) & (bounds[:, 3] >= y_min)
+        return np.flatnonzero(mask)
+
+    def elements_near(self, x, y, radius):
+        """Elements with at least one point within radius of (x, y)."""
+        elements = self.elements_in_box(x - radius, y - radius, x + radius, y + radius)
+        if len(elements) == 0:
+            return elements
+        point_indices, owner = self.gather_points(elements)
+        points = np.asarray(self.points)[point_indices]
+        close = (points[:, 0] - x)**2 + (points[:, 1] - y)**2 <= radius**2
+        return elements[np.unique(owner[close])]
+
+    def to_lane_marking_dict(self):
+        """The lane_marking_dict of gen_hdmap.py, used to check the conversion."""
+        lane_marking_dict = {}
+        points = np.asarray(self.points).tolist()
+        rotations = np.asarray(self.rotations).tolist()
+        point_junction = np.asarray(self.point_junction).tolist()
+        offsets = np.asarray(self.element_offsets).tolist()
+        for (road_id, lane_id), (start, end) in self.lanes.items():
+            elements = []
+            for element in range(start, end):
+                element_points = []
+                for i in range(offsets[element], offsets[element + 1]):
+                    point = (tuple(points[i]), tuple(rotations[i]))
+                    element_points.append(point if point_junction[i] < 0 else point + (bool(point_junction[i]),))
+                element_dict = {'Points': element_points, 'Type': self.element_type_name(element),
+                                'Color': self.element_color_name(element), 'Topology': self.topology_of(element)}
+                if self.element_topology_type[element] >= 0:
+                    element_dict['TopologyType'] = self.meta['topology_types'][self.element_topology_type[element]]
+                    element_dict['Left'] = _pair(self.element_left[element])
+                    element_dict['Right'] = _pair(self.element_right[element])
+                elements.append(element_dict)
+            lane_marking_dict.setdefault(road_id, {})[lane_id] = elements
+
+        trigger_offsets = np.asarray(self.trigger_offsets).tolist()
+        trigger_points = np.asarray(self.trigger_points).tolist()
+        for volume, road_id in enumerate(np.asarray(self.trigger_road).tolist()):
+            lane_marking_dict.setdefault(road_id, {}).setdefault('Trigger_Volumes', []).append({
+                'Points': trigger_points[trigger_offsets[volume]:trigger_offsets[volume + 1]],
+                'Type': self.meta['trigger_types'][self.trigger_type[volume]],
+                'ParentActor_Location': np.asarray(self.trigger_parent[volume]).tolist(),
+            })
+        return lane_marking_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts HD map npz files of gen_hdmap.py to the columnar format.')
+    parser.add_argument('--npz', type=str, nargs='+', required=True)
+    args = parser.parse_args()
+
+    for npz_path in args.npz:
+        columns, meta = lane_marking_dict_to_columns(load_legacy_npz(npz_path))
+        save_columnar_map(columnar_map_dir(npz_path), columns, meta)
+        print(f'{npz_path} -> {columnar_map_dir(npz_path)}: {len(columns["element_road"])} elements, '
+              f'{len(columns["points"])} points, {len(columns["trigger_road"])} trigger volumes')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import argparse
 import time
 import subprocess
 import json
+from columnar_hdmap import columnar_map_dir, lane_marking_dict_to_columns, save_columnar_map
 
 def check_waypoints_status(waypoints_list):
     first_wp = waypoints_list[0]
@@ -333,6 +334,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--save_dir', default='/maps')
     parser.add_argument('--carla_town', default='Town12')
+    parser.add_argument('--legacy_npz', action='store_true', default=False, help='Also save the pickled npz of older versions.')
 
     args = parser.parse_args()
     carla_town = args.carla_town
@@ -361,5 +363,8 @@ if __name__ == '__main__':
     TriggerVolumeGettor.get_traffic_light_trigger_volume(all_traffic_light_actors, lane_marking_dict, carla_map)
     print("******* Have get all trigger volumes ! *********")
     
-    arr = np.array(list(lane_marking_dict.items()), dtype=object)
-    np.savez_compressed(args.save_dir+"/"+args.carla_town+"_HD_map.npz", arr=arr)
+    map_path = args.save_dir+"/"+args.carla_town+"_HD_map.npz"
+    save_columnar_map(columnar_map_dir(map_path), *lane_marking_dict_to_columns(lane_marking_dict))
+    if args.legacy_npz:
+        arr = np.array(list(lane_marking_dict.items()), dtype=object)
+        np.savez_compressed(map_path, arr=arr)
@@ -1,409 +1,443 @@
 import json
 import gzip
 import os
+import multiprocessing
 import numpy as np
 import cv2
 import pathlib
 import random
 import laspy
 import matplotlib.cm as cm
-from tqdm import trange
-from utils import get_image_point, point_in_canvas_wh, edges, world_to_ego, get_forward_vector, calculate_cube_vertices, draw_dashed_line, vector_angle, get_weather_id
+from tqdm import tqdm
+from utils import WINDOW_HEIGHT, WINDOW_WIDTH, edges, get_forward_vector, calculate_cube_vertices, vector_angle
+from columnar_hdmap import ColumnarHDMap, columnar_map_dir, lane_marking_dict_to_columns, load_legacy_npz, save_columnar_map
 
-def visualize_data(file_path, map_path, vis_bbox=True,  vis_top_down=True, vis_road=True, vis_lidar_bev=True, vis_lidar_to_back_image=True, vis_lidar_to_front_image=True, vis_lidar_to_front_left_image=True):
-    print(f'file_path={file_path}')
-    print(f'map_path={map_path}')
+cam_map = {
+    'CAM_FRONT': 'rgb_front',
+    'CAM_FRONT_LEFT': 'rgb_front_left',
+    'CAM_FRONT_RIGHT': 'rgb_front_right',
+    'CAM_BACK': 'rgb_back',
+    'CAM_BACK_LEFT': 'rgb_back_left',
+    'CAM_BACK_RIGHT': 'rgb_back_right',
+    'TOP_DOWN': 'rgb_top_down'
+}
+BBOX_CAMERAS = ['CAM_FRONT','CAM_FRONT_LEFT','CAM_FRONT_RIGHT','CAM_BACK', 'CAM_BACK_LEFT', 'CAM_BACK_RIGHT']
+# view -> (folder, file name suffix) of the rendered frames
+VIEWS = {f'{cam_map[key]}_3d_bbox': (f'camera/{cam_map[key]}_3d_bbox', '.jpg') for key in BBOX_CAMERAS + ['TOP_DOWN']}
+VIEWS.update({
+    'rgb_front_landmark': ('camera/rgb_front_landmark', '.png'),
+    'lidar_bev': ('lidar/bev', '.png'),
+    'lidar_front': ('lidar/front', '_front.png'),
+    'lidar_back': ('lidar/back', '_back.png'),
+    'lidar_front_left': ('lidar/front_left', '_front_left.png'),
+})
+EDGES = np.array(edges)
+FONT = cv2.FONT_HERSHEY_COMPLEX
+LIDAR_RANGE = 85.0
 
-    save_path = pathlib.Path(file_path.replace('v0','v0-vis'))
-    (save_path / 'camera' / 'rgb_front_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_front_landmark').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_front_left_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_front_right_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_back_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_back_left_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_back_right_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'camera' / 'rgb_top_down_3d_bbox').mkdir(parents=True, exist_ok=True)
-    (save_path / 'lidar'  / 'bev').mkdir(parents=True, exist_ok=True)
-    (save_path / 'lidar'  / 'front').mkdir(parents=True, exist_ok=True)
-    (save_path / 'lidar'  / 'front_left').mkdir(parents=True, exist_ok=True)
-    (save_path / 'lidar'  / 'back').mkdir(parents=True, exist_ok=True)
-
-    cam_map = {
-        'CAM_FRONT': 'rgb_front',
-        'CAM_FRONT_LEFT': 'rgb_front_left',
-        'CAM_FRONT_RIGHT': 'rgb_front_right',
-        'CAM_BACK': 'rgb_back', 
-        'CAM_BACK_LEFT': 'rgb_back_left', 
-        'CAM_BACK_RIGHT': 'rgb_back_right',
-        'TOP_DOWN': 'rgb_top_down'
-    }
+_footprints = {}
 
-    folder_path = os.path.join(file_path, 'anno')
-    file_count = len([name for name in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, name))])
-    map_info = dict(np.load(map_path, allow_pickle=True)['arr'])
 
-    for step in trange(file_count):
-        with gzip.open(os.path.join(file_path, f'anno/{step:05}.json.gz'), 'rt', encoding='utf-8') as gz_file:
+def circle_footprint(radius):
+    """Pixel offsets of a filled cv2.circle."""
+    if radius not in _footprints:
+        canvas = np.zeros((2 * radius + 3, 2 * radius + 3), np.uint8)
+        cv2.circle(canvas, (radius + 1, radius + 1), radius=radius, color=1, thickness=-1)
+        ys, xs = np.nonzero(canvas)
+        _footprints[radius] = np.stack((xs - radius - 1, ys - radius - 1), axis=1)
+    return _footprints[radius]
+
+
+def draw_points(img, pixels, colors, radius):
+    """Same as cv2.circle(img, pixel, radius, color, thickness=-1) for every pixel in order, but with one array write."""
+    if len(pixels) == 0:
+        return
+    footprint = circle_footprint(radius)
+    stamped = (pixels[:, None, :] + footprint[None]).reshape(-1, 2)
+    colors = np.repeat(np.broadcast_to(np.asarray(colors), (len(pixels), 3)), len(footprint), axis=0)
+    height, width = img.shape[:2]
+    inside = (stamped[:, 0] >= 0) & (stamped[:, 0] < width) & (stamped[:, 1] >= 0) & (stamped[:, 1] < height)
+    flat = stamped[inside, 1] * width + stamped[inside, 0]
+    colors = colors[inside]
+    # later circles overwrite earlier ones
+    _, last = np.unique(flat[::-1], return_index=True)
+    last = len(flat) - 1 - last
+    img.reshape(-1, img.shape[2])[flat[last]] = colors[last]
+
+
+def project(points, K, world2cam):
+    """get_image_point of utils.py for points [N, 3], returns the image points [N, 2] and the depths [N]."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    point_camera = np.concatenate((points, np.ones((len(points), 1))), axis=1) @ np.asarray(world2cam, dtype=np.float64).T
+    point_camera = np.stack((point_camera[:, 1], -point_camera[:, 2], point_camera[:, 0]), axis=1)
+    point_img = point_camera @ np.asarray(K, dtype=np.float64).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return point_img[:, :2] / point_img[:, 2:3], point_camera[:, 2]
+
+
+def visible_pixels(point_img, depth):
+    """Mask of the points in front of the camera and inside the canvas, like point_in_canvas_wh of utils.py."""
+    with np.errstate(invalid='ignore'):
+        return (depth > 0) & (point_img[:, 0] >= 0) & (point_img[:, 0] < WINDOW_WIDTH) & (point_img[:, 1] >= 0) & (point_img[:, 1] < WINDOW_HEIGHT)
+
+
+def dashed_segments(start_point, end_point, dash_length=5):
+    """The segments of draw_dashed_line of utils.py."""
+    segments = []
+    d = np.sqrt((end_point[0] - start_point[0])**2 + (end_point[1] - start_point[1])**2)
+    if d < dash_length:
+        return segments
+    dx = (end_point[0] - start_point[0]) / d
+    dy = (end_point[1] - start_point[1]) / d
+    x, y = start_point[0], start_point[1]
+    while d >= dash_length:
+        x_end = x + dx * dash_length
+        y_end = y + dy * dash_length
+        segments.append(np.array([[int(x), int(y)], [int(x_end), int(y_end)]], dtype=np.int32))
+        x = x_end + dx * dash_length
+        y = y_end + dy * dash_length
+        d -= 2 * dash_length
+    return segments
+
+
+def draw_box(img, verts, K, world2cam, color):
+    """Dashed 3d box with one cv2.polylines call, returns the image point of the text."""
+    point_img, _ = project(verts, K, world2cam)
+    pixels = point_img.astype(np.int64)
+    segments = []
+    for edge in edges:
+        segments.extend(dashed_segments(tuple(pixels[edge[0]]), tuple(pixels[edge[1]])))
+    if segments:
+        cv2.polylines(img, segments, False, color, 2)
+    return pixels[edges[-1][0]]
+
+
+def lane_colors(hd_map, elements):
+    """White lane markings are white, white center lines green and everything else yellow."""
+    white = np.array([color == 'White' for color in hd_map.meta['colors']] + [False])[hd_map.element_color[elements]]
+    center = np.array([road_type == 'Center' for road_type in hd_map.meta['types']] + [False])[hd_map.element_type[elements]]
+    return np.where(white[:, None], np.where(center[:, None], [0, 255, 0], [255, 255, 255]), [0, 255, 255])
+
+
+def draw_lanes(img, hd_map, elements, K, world2cam):
+    elements = np.asarray(elements, dtype=np.int64)
+    if len(elements) == 0:
+        return
+    point_indices, owner = hd_map.gather_points(elements)
+    point_img, depth = project(np.asarray(hd_map.points)[point_indices], K, world2cam)
+    visible = visible_pixels(point_img, depth)
+    draw_points(img, point_img[visible].astype(np.int64), lane_colors(hd_map, elements)[owner[visible]], radius=1)
+
+
+def draw_lidar(img, lidars, K, cam2ego):
+    ego2cam = np.matrix(cam2ego).I.tolist()
+    point_img, depth = project(lidars, K, ego2cam)
+    visible = visible_pixels(point_img, depth)
+    color_scale = depth[visible] / 80
+    colors = cm.rainbow(np.minimum(color_scale, 1))
+    # min(depth / 80, 1) of the per point loop is the integer 1 beyond 80 m, which the colormap reads as lut index 1
+    colors[color_scale > 1] = cm.rainbow(1)
+    colors = (colors[:, :3] * 255).astype(np.int64)
+    draw_points(img, point_img[visible].astype(np.int64), colors, radius=2)
+
+
+class Overlay(object):
+    """
+    Replaces cv2.addWeighted(img, 1.0, blk, alpha, 1) with one full image blk per polygon. Only the pixels of the
+    polygon are updated, the gamma of 1 that every call adds to the whole image is counted in offset and added in
+    image(). Everything drawn in between is stored relative to offset. Gives the same pixels as before.
+    """
+
+    def __init__(self, img):
+        self.values = img.astype(np.int32)
+        self.offset = 0
+        self.mask = np.zeros(img.shape[:2], np.uint8)
+
+    def add_polygon(self, points, color, alpha):
+        cv2.fillConvexPoly(self.mask, points, 1)
+        height, width = self.mask.shape
+        x0, y0 = np.maximum(points.min(axis=0), 0)
+        x1, y1 = np.minimum(points.max(axis=0) + 1, (width, height))
+        if x0 < x1 and y0 < y1:
+            region = self.mask[y0:y1, x0:x1]
+            inside = region > 0
+            increment = np.rint(alpha * np.asarray(color[:3], dtype=np.float64) + 1).astype(np.int32) - 1
+            self.values[y0:y1, x0:x1][inside] += increment
+            region[:] = 0
+        self.offset += 1
+
+    def line(self, p1, p2, color, thickness):
+        cv2.line(self.values, p1, p2, tuple(int(c) - self.offset for c in color[:3]), thickness)
+
+    def put_text(self, text, org, color):
+        # putText blends with the image, so it draws on the current pixels around the text
+        (text_width, text_height), baseline = cv2.getTextSize(text, FONT, 0.5, 1)
+        height, width = self.mask.shape
+        x0, y0 = max(org[0] - 8, 0), max(org[1] - text_height - 8, 0)
+        x1, y1 = min(org[0] + text_width + 8, width), min(org[1] + baseline + 8, height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        crop = np.clip(self.values[y0:y1, x0:x1] + self.offset, 0, 255).astype(np.uint8)
+        cv2.putText(crop, text, (org[0] - x0, org[1] - y0), FONT, 0.5, color, 1)
+        self.values[y0:y1, x0:x1] = crop.astype(np.int32) - self.offset
+
+    def image(self):
+        return np.clip(self.values + self.offset, 0, 255).astype(np.uint8)
+
+
+class FrameRenderer(object):
+    """Renders and saves the views of one step of a route."""
+
+    def __init__(self, file_path, save_path, map_path, views, video_views=()):
+        self.file_path = file_path
+        self.save_path = save_path
+        self.views = views
+        self.video_views = video_views
+        self.hd_map = ColumnarHDMap.load(map_path) if {'rgb_top_down_3d_bbox', 'rgb_front_landmark'} & set(views) else None
+
+    def read_image(self, key, step):
+        return cv2.imread(os.path.join(self.file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
+
+    def __call__(self, step):
+        with gzip.open(os.path.join(self.file_path, f'anno/{step:05}.json.gz'), 'rt', encoding='utf-8') as gz_file:
             anno = json.load(gz_file)
-        weather_id = get_weather_id(anno['weather'])
+        frames = {}
+        # ========================== bbox ==========================
+        for key in BBOX_CAMERAS:
+            if f'{cam_map[key]}_3d_bbox' in self.views:
+                frames[f'{cam_map[key]}_3d_bbox'] = self.render_bbox(anno, key, step)
+        if 'rgb_top_down_3d_bbox' in self.views:
+            frames['rgb_top_down_3d_bbox'] = self.render_top_down(anno, step)
+        # ========================== road ==========================
+        if 'rgb_front_landmark' in self.views:
+            frames['rgb_front_landmark'] = self.render_road(anno)
+        # ========================== lidar =========================
+        if {'lidar_bev', 'lidar_front', 'lidar_back', 'lidar_front_left'} & set(self.views):
+            lidars = laspy.read(os.path.join(self.file_path, f'lidar/{step:05}.laz')).xyz
+            if 'lidar_bev' in self.views:
+                frames['lidar_bev'] = self.render_lidar_bev(anno, lidars)
+            for view, key in (('lidar_front', 'CAM_FRONT'), ('lidar_back', 'CAM_BACK'), ('lidar_front_left', 'CAM_FRONT_LEFT')):
+                if view in self.views:
+                    visulize_img = self.read_image(key, step)
+                    draw_lidar(visulize_img, lidars, anno['sensors'][key]['intrinsic'], anno['sensors'][key]['cam2ego'])
+                    frames[view] = visulize_img
+
+        for view, img in frames.items():
+            folder, suffix = VIEWS[view]
+            cv2.imwrite(os.path.join(self.save_path, folder, f'{step:05}{suffix}'), img)
+        return step, {view: frames[view] for view in self.video_views if view in frames}
+
+    def render_bbox(self, anno, key, step):
         bounding_boxes = anno['bounding_boxes']
         sensors_anno = anno['sensors']
-        # ========================== bbox ==========================
-        if vis_bbox:            
-            for key in ['CAM_FRONT','CAM_FRONT_LEFT','CAM_FRONT_RIGHT','CAM_BACK', 'CAM_BACK_LEFT', 'CAM_BACK_RIGHT']:
-                K = sensors_anno[key]['intrinsic']
-                world2cam = sensors_anno[key]['world2cam']
-                visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
-                for npc in bounding_boxes:
-                    if npc['class'] == 'ego_vehicle': continue
-                    if npc['distance'] > 75: continue
-                    if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue # car in sky and underground
-                    if 'vehicle' in npc['class']: # vehicle
-                        forward_vec = get_forward_vector(sensors_anno[key]['rotation'][2])
-                        ray = np.array(npc['location']) - np.array(sensors_anno[key]['location'])
-                        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-                        if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray)<45:
-                            verts = np.array(npc['world_cord'])
-                            for edge in edges:
-                                p1, p1_depth = get_image_point(verts[edge[0]], K, world2cam)
-                                p2, p2_depth = get_image_point(verts[edge[1]],  K, world2cam)
-                                draw_dashed_line(visulize_img, (int(p1[0]),int(p1[1])), (int(p2[0]),int(p2[1])), color, 2)
-                            cv2.putText(visulize_img, npc['class']+npc['id'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                    else: # sign, light, pedestrians
-                        if npc['class'] == 'traffic_sign': 
-                            npc['extent'][1] = 0.5 # traffic_sign origin y is too small
-                        
-                        forward_vec = get_forward_vector(sensors_anno[key]['rotation'][2])
-                        ray = np.array(npc['location']) - np.array(sensors_anno[key]['location'])
-                        if 'affects_ego' in npc.keys() and str(npc['affects_ego']) == 'True':
-                            color = (0, 0, 255)
-                        else:
-                            color = (255, 255, 255)
-                        if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray)<45:
-                            if 'world_cord' in npc.keys():
-                                if 'dirtdebris' in npc['type_id']:
-                                    local_verts = calculate_cube_vertices(npc['bbx_loc'], [npc['extent'][1], npc['extent'][0], npc['extent'][2]])
-                                    verts = []
-                                    for l_v in local_verts:
-                                        g_v = np.dot(np.matrix(npc['world2sign']).I, [l_v[0], l_v[1], l_v[2],1])
-                                        verts.append(g_v.tolist()[0][:-1])
-                                else:
-                                    verts = np.array(npc['world_cord'])
-                            else:
-                                verts = calculate_cube_vertices(npc['center'], npc['extent'])
-                            for edge in edges:
-                                p1, p1_depth = get_image_point(verts[edge[0]], K, world2cam)
-                                p2, p2_depth = get_image_point(verts[edge[1]],  K, world2cam)
-                                draw_dashed_line(visulize_img, (int(p1[0]),int(p1[1])), (int(p2[0]),int(p2[1])), color, 2)
-                            if 'affects_ego' in npc.keys():
-                                cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                            else:
-                                cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_3d_bbox/{step:05}.jpg'), visulize_img)
-        
-        if vis_top_down:        
-            for key in ['TOP_DOWN']:
-                K = sensors_anno[key]['intrinsic']
-                world2cam = sensors_anno[key]['world2cam']
-                visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
-                road_points = map_info[anno['bounding_boxes'][0]['road_id']]
-                # draw lane
-                for r_p in road_points[anno['bounding_boxes'][0]['lane_id']]:
-                    road_point = r_p['Points']
-                    road_type = r_p['Type']
-                    road_color = r_p['Color']
-                    road_topology = r_p['Topology']
-                    for point in road_point:
-                        point = np.array([point[0][0], point[0][1], point[0][2], 1])
-                        point_camera = np.dot(world2cam, point)
-                        point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                        depth = point_camera[2]
-                        point_img = np.dot(K, point_camera)
-                        if depth >0:
-                            point_img[0] /= point_img[2]
-                            point_img[1] /= point_img[2]
-                            point_img = point_img[0:2]
-                            if point_in_canvas_wh(point_img):
-                                if road_color == 'White':
-                                    cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=1, color=(255, 255, 255), thickness=-1)
-                                    if road_type == 'Center':
-                                        cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 0), thickness=-1)
-                                else:
-                                    cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 255), thickness=-1)                      
-                # draw vehicle
-                for npc in bounding_boxes:
-                    if 'vehicle' in npc['class']:
-                        if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue # car in sky and underground
-                        if npc['class'] == 'ego_vehicle':
-                            color = (255, 255, 255, 255)
-                        else:
-                            color = (255, 0, 0, 255)
-                        verts = np.array(npc['world_cord'])
-                        p1, p1_depth = get_image_point(verts[0], K, world2cam)
-                        p2, p2_depth = get_image_point(verts[2],  K, world2cam)
-                        p3, p3_depth = get_image_point(verts[4],  K, world2cam)
-                        p4, p4_depth = get_image_point(verts[6],  K, world2cam)
-                        points = np.array([p1, p2, p4, p3])
-                        height, width = visulize_img.shape[:2]
-                        blk = np.zeros((height, width, 4), np.uint8)
-                        cv2.fillConvexPoly(blk, np.round(points).astype(np.int32), color)
-                        if npc['class'] == 'ego_vehicle':
-                            visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:,:,:3], 1, 1)
-                        else:
-                            visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:,:,:3], 0.25, 1)
-                        if npc['class'] == 'ego_vehicle':
-                            cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0,0,0), 1)
+        K = sensors_anno[key]['intrinsic']
+        world2cam = sensors_anno[key]['world2cam']
+        visulize_img = self.read_image(key, step)
+        forward_vec = get_forward_vector(sensors_anno[key]['rotation'][2])
+        for npc in bounding_boxes:
+            if npc['class'] == 'ego_vehicle': continue
+            if npc['distance'] > 75: continue
+            if abs(npc['location'][2] - bounding_boxes[0]['location'][2]) > 10: continue # car in sky and underground
+            ray = np.array(npc['location']) - np.array(sensors_anno[key]['location'])
+            if 'vehicle' in npc['class']: # vehicle
+                color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+                if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray)<45:
+                    p1 = draw_box(visulize_img, np.array(npc['world_cord']), K, world2cam, color)
+                    cv2.putText(visulize_img, npc['class']+npc['id'], (int(p1[0])+2,int(p1[1])+2), FONT, 0.5, color, 1)
+            else: # sign, light, pedestrians
+                if npc['class'] == 'traffic_sign':
+                    npc['extent'][1] = 0.5 # traffic_sign origin y is too small
+                if 'affects_ego' in npc.keys() and str(npc['affects_ego']) == 'True':
+                    color = (0, 0, 255)
+                else:
+                    color = (255, 255, 255)
+                if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray)<45:
+                    if 'world_cord' in npc.keys():
+                        if 'dirtdebris' in npc['type_id']:
+                            local_verts = np.array(calculate_cube_vertices(npc['bbx_loc'], [npc['extent'][1], npc['extent'][0], npc['extent'][2]]))
+                            sign2world = np.asarray(np.matrix(npc['world2sign']).I)
+                            verts = (np.concatenate((local_verts, np.ones((8, 1))), axis=1) @ sign2world.T)[:, :3]
                         else:
-                            cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                # draw sign
-                for npc in bounding_boxes:
-                    if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue # car in sky and underground
-                    # traffic_sign
-                    if 'traffic_sign' in npc['class']:
-                        color = (0, 0, 255, 255)
-                        if 'world_cord' in npc.keys():
                             verts = np.array(npc['world_cord'])
-                        else:
-                            verts = calculate_cube_vertices(npc['center'], npc['extent'])
-                        p1, p1_depth = get_image_point(verts[0], K, world2cam)
-                        p2, p2_depth = get_image_point(verts[2],  K, world2cam)
-                        p3, p3_depth = get_image_point(verts[4],  K, world2cam)
-                        p4, p4_depth = get_image_point(verts[6],  K, world2cam)
-                        points = np.array([p1, p2, p4, p3])
-                        height, width = visulize_img.shape[:2]
-                        blk = np.zeros((height, width, 4), np.uint8)
-                        cv2.fillConvexPoly(blk, np.round(points).astype(np.int32), color)
-                        visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:,:,:3], 0.25, 1)
-                        cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                    # traffic_light
-                    if 'traffic_light' in npc['class']:
-                        color = (255, 0, 0)
-                        verts = calculate_cube_vertices(npc['center'], npc['extent'])
-                        for edge in edges:
-                            p1, p1_depth = get_image_point(verts[edge[0]], K, world2cam)
-                            p2, p2_depth = get_image_point(verts[edge[1]],  K, world2cam)
-                            cv2.line(visulize_img, (int(p1[0]),int(p1[1])), (int(p2[0]),int(p2[1])), color, 2)
-                        cv2.putText(visulize_img, 'traffic_light', (int(p1[0])+2,int(p1[1])+2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
-                cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_3d_bbox/{step:05}.jpg'), visulize_img)
-        # ==========================================================
+                    else:
+                        verts = np.array(calculate_cube_vertices(npc['center'], npc['extent']))
+                    p1 = draw_box(visulize_img, verts, K, world2cam, color)
+                    cv2.putText(visulize_img, npc['class'], (int(p1[0])+2,int(p1[1])+2), FONT, 0.5, color, 1)
+        return visulize_img
 
-        # ========================== road ==========================
-        if vis_road:
-            key = 'CAM_FRONT'
-            K = sensors_anno[key]['intrinsic']
-            world2cam = sensors_anno[key]['world2cam']
-            road_points = map_info[anno['bounding_boxes'][0]['road_id']]
-            road_seg = np.zeros((900, 1600, 3), dtype=np.uint8)
-            all_road_topology = set()
-            # draw current road
-            for r_p in road_points[anno['bounding_boxes'][0]['lane_id']]:
-                road_point = r_p['Points']
-                road_type = r_p['Type']
-                road_color = r_p['Color']
-                road_topology = r_p['Topology']
-                for r_t in road_topology:
-                    all_road_topology.add(r_t)
-                for point in road_point:
-                    point = np.array([point[0][0], point[0][1], point[0][2], 1])
-                    point_camera = np.dot(world2cam, point)
-                    point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                    depth = point_camera[2]
-                    point_img = np.dot(K, point_camera)
-                    if depth >0:
-                        point_img[0] /= point_img[2]
-                        point_img[1] /= point_img[2]
-                        point_img = point_img[0:2]
-                        if point_in_canvas_wh(point_img):
-                            if road_color == 'White':
-                                cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(255, 255, 255), thickness=-1)
-                                if road_type == 'Center':
-                                    cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 0), thickness=-1)
-                            else:
-                                cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 255), thickness=-1)
-            # draw road topology
-            for r_t in all_road_topology:
-                road_points = map_info[r_t[0]][r_t[1]]
-                for r_p in road_points:
-                    road_point = r_p['Points']
-                    road_type = r_p['Type']
-                    road_color = r_p['Color']
-                    road_topology = r_p['Topology']
-                    for point in road_point:
-                        point = np.array([point[0][0], point[0][1], point[0][2], 1])
-                        point_camera = np.dot(world2cam, point)
-                        point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                        depth = point_camera[2]
-                        point_img = np.dot(K, point_camera)
-                        if depth >0:
-                            point_img[0] /= point_img[2]
-                            point_img[1] /= point_img[2]
-                            point_img = point_img[0:2]
-                            if point_in_canvas_wh(point_img):
-                                if road_color == 'White':
-                                    cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(255, 255, 255), thickness=-1)
-                                    if road_type == 'Center':
-                                        cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 0), thickness=-1)
-                                else:
-                                    cv2.circle(road_seg, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 255), thickness=-1)
-            cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_landmark/{step:05}.png'), road_seg)
-        # # ===========================================================
-
-        # ========================== lidar to bev =====================
-        if vis_lidar_bev:
-            lidar_path = os.path.join(file_path, f'lidar/{step:05}.laz')
-            lidars = laspy.read(lidar_path).xyz
-
-            lidar_image = np.zeros((900, 1600, 3), dtype=np.uint8)
-            header = laspy.LasHeader(point_format=0)  # LARS point format used for storing
-            header.offsets = np.min(lidars, axis=0)
-            point_precision = 0.001
-            header.scales = np.array([point_precision, point_precision, point_precision])
-            point_record = laspy.ScaleAwarePointRecord.zeros(lidars.shape[0], header=header)
-
-            point_record.x = lidars[:, 0]
-            point_record.y = lidars[:, 1]
-            point_record.z = lidars[:, 2]
-            # (x, y,z) -> (y, -x, z), the x,y plane of the lidar system is different from that of the ego-car
-            point_record.x = lidars[:, 1]
-            point_record.y = - lidars[:, 0]
-            point_record.z = lidars[:, 2]
-
-            range_x = 85.0
-            range_y = 85.0
-            range_z = 85.0
-
-            # Normalized point cloud data
-            x_normalized = (point_record.x + range_x) / (2 * range_x)
-            y_normalized = (point_record.y + range_y) / (2 * range_y)
-            z_normalized = (point_record.z + range_z) / (2 * range_z)
-
-            # Convert normalized coordinates to image pixel index
-            x_pixels = x_normalized * (lidar_image.shape[1] - 1)
-            y_pixels = y_normalized * (lidar_image.shape[0] - 1)
-
-            for x, y, z in zip(x_pixels, y_pixels, z_normalized):
-                rgb_color = (255, 255, 255)
-                cv2.circle(lidar_image, (int(x), int(y)), radius=2, color=(int(rgb_color[0]), int(rgb_color[1]), int(rgb_color[2])), thickness=-1)
-
-            cv2.imwrite(os.path.join(save_path, f'lidar_bev/{step:05}.png'), lidar_image)
-            for npc in bounding_boxes:
-                if npc['class'] not in ['vehicle', 'ego_vehicle']: continue
-                if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue # car in sky and underground
-                verts = calculate_cube_vertices(npc['center'], npc['extent'])
-                verts = np.array(npc['world_cord'])
-                # verts[:, 2] = verts[:, 2] - npc['extent'][2] # carla bbox need minus z 
+    def render_top_down(self, anno, step):
+        bounding_boxes = anno['bounding_boxes']
+        ego = bounding_boxes[0]
+        K = anno['sensors']['TOP_DOWN']['intrinsic']
+        world2cam = anno['sensors']['TOP_DOWN']['world2cam']
+        visulize_img = self.read_image('TOP_DOWN', step)
+        # draw lane
+        draw_lanes(visulize_img, self.hd_map, self.hd_map.lane_elements(ego['road_id'], ego['lane_id']), K, world2cam)
+
+        def footprint(verts):
+            point_img, _ = project(np.asarray(verts)[[0, 2, 6, 4]], K, world2cam)
+            return point_img
+
+        overlay = Overlay(visulize_img)
+        # draw vehicle
+        for npc in bounding_boxes:
+            if 'vehicle' in npc['class']:
+                if abs(npc['location'][2] - ego['location'][2]) > 10: continue # car in sky and underground
+                points = footprint(npc['world_cord'])
                 if npc['class'] == 'ego_vehicle':
-                    color = (0, 255, 0)
+                    overlay.add_polygon(np.round(points).astype(np.int32), (255, 255, 255, 255), 1)
+                    overlay.put_text(npc['class'], (int(points[0, 0])+2,int(points[0, 1])+2), (0,0,0))
                 else:
-                    color = (0, 128, 255)
+                    color = (255, 0, 0, 255)
+                    overlay.add_polygon(np.round(points).astype(np.int32), color, 0.25)
+                    overlay.put_text(npc['class'], (int(points[0, 0])+2,int(points[0, 1])+2), color)
+        # draw sign
+        for npc in bounding_boxes:
+            if abs(npc['location'][2] - ego['location'][2]) > 10: continue # car in sky and underground
+            # traffic_sign
+            if 'traffic_sign' in npc['class']:
+                color = (0, 0, 255, 255)
+                if 'world_cord' in npc.keys():
+                    points = footprint(npc['world_cord'])
+                else:
+                    points = footprint(calculate_cube_vertices(npc['center'], npc['extent']))
+                overlay.add_polygon(np.round(points).astype(np.int32), color, 0.25)
+                overlay.put_text(npc['class'], (int(points[0, 0])+2,int(points[0, 1])+2), color)
+            # traffic_light
+            if 'traffic_light' in npc['class']:
+                color = (255, 0, 0)
+                point_img, _ = project(calculate_cube_vertices(npc['center'], npc['extent']), K, world2cam)
+                pixels = point_img.astype(np.int64)
                 for edge in edges:
-                    p1 = verts[edge[0]]
-                    p1 = world_to_ego(p1, anno['bounding_boxes'][0]['world2ego'])
-                    p1_x = (p1[0] + range_x) / (2 * range_x) * (lidar_image.shape[1] - 1)
-                    p1_y = (p1[1] + range_y) / (2 * range_y) * (lidar_image.shape[0] - 1)
-
-                    p2 = verts[edge[1]]
-                    p2 = world_to_ego(p2, anno['bounding_boxes'][0]['world2ego'])
-                    p2_x = (p2[0] + range_x) / (2 * range_x) * (lidar_image.shape[1] - 1)
-                    p2_y = (p2[1] + range_y) / (2 * range_y) * (lidar_image.shape[0] - 1)
-                    cv2.line(lidar_image, (int(p1_x), int(p1_y)), (int(p2_x), int(p2_y)), color, 2)
-
-            cv2.imwrite(os.path.join(save_path, f'lidar/bev/{step:05}.png'), lidar_image)
-        # ===========================================================
-        
-        # ================ lidar to front image =====================
-        if vis_lidar_to_front_image:
-            key = 'CAM_FRONT'
-            K = sensors_anno[key]['intrinsic']
-            visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
-            ego2cam = np.matrix(sensors_anno[key]['cam2ego']).I.tolist()
-
-            # lidar in ego coordinate
-            lidar_path = os.path.join(file_path, f'lidar/{step:05}.laz')
-            lidars = laspy.read(lidar_path).xyz
-
-            for lidar in lidars:
-                lidar = np.array([lidar[0], lidar[1], lidar[2], 1])
-                point_camera = np.dot(ego2cam, lidar)
-                point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                depth = point_camera[2]
-                point_img = np.dot(K, point_camera)
-                if depth > 0:
-                    point_img[0] /= point_img[2]
-                    point_img[1] /= point_img[2]
-                    point_img = point_img[0:2]
-                    if point_in_canvas_wh(point_img):
-                        color_scale = min(depth / 80, 1)
-                        color = cm.rainbow(color_scale)
-                        color = tuple([int(x*255) for x in color[:3]])
-                        cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=2, color=color, thickness=-1)
-            cv2.imwrite(os.path.join(save_path, f'lidar/front/{step:05}_front.png'), visulize_img)
-            # ==========================================================
-
-        # ================ lidar to back image =====================
-        if vis_lidar_to_back_image:
-            key = 'CAM_BACK'
-            K = sensors_anno[key]['intrinsic']
-            visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
-            ego2cam = np.matrix(sensors_anno[key]['cam2ego']).I.tolist()
-
-            # lidar in ego coordinate
-            lidar_path = os.path.join(file_path, f'lidar/{step:05}.laz')
-            lidars = laspy.read(lidar_path).xyz
-
-            for lidar in lidars:
-                lidar = np.array([lidar[0], lidar[1], lidar[2], 1])
-                point_camera = np.dot(ego2cam, lidar)
-                point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                depth = point_camera[2]
-                point_img = np.dot(K, point_camera)
-                if depth > 0:
-                    point_img[0] /= point_img[2]
-                    point_img[1] /= point_img[2]
-                    point_img = point_img[0:2]
-                    if point_in_canvas_wh(point_img):
-                        color_scale = min(depth / 80, 1)
-                        color = cm.rainbow(color_scale)
-                        color = tuple([int(x*255) for x in color[:3]])
-                        cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=2, color=color, thickness=-1)
-            cv2.imwrite(os.path.join(save_path, f'lidar/back/{step:05}_back.png'), visulize_img)
-        # ===========================================================
-
-        # ================ lidar to fomr left image =====================
-        if vis_lidar_to_front_left_image:
-            key = 'CAM_FRONT_LEFT'
-            K = sensors_anno[key]['intrinsic']
-            visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
-            ego2cam = np.matrix(sensors_anno[key]['cam2ego']).I.tolist()
-
-            # lidar in ego coordinate
-            lidar_path = os.path.join(file_path, f'lidar/{step:05}.laz')
-            lidars = laspy.read(lidar_path).xyz
-
-            for lidar in lidars:
-                lidar = np.array([lidar[0], lidar[1], lidar[2], 1])
-                point_camera = np.dot(ego2cam, lidar)
-                point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
-                depth = point_camera[2]
-                point_img = np.dot(K, point_camera)
-                if depth > 0:
-                    point_img[0] /= point_img[2]
-                    point_img[1] /= point_img[2]
-                    point_img = point_img[0:2]
-                    if point_in_canvas_wh(point_img):
-                        color_scale = min(depth / 80, 1)
-                        color = cm.rainbow(color_scale)
-                        color = tuple([int(x*255) for x in color[:3]])
-                        cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=2, color=color, thickness=-1)
-            cv2.imwrite(os.path.join(save_path, f'lidar/front_left/{step:05}_front_left.png'), visulize_img)
-        # ===========================================================
+                    overlay.line(tuple(pixels[edge[0]].tolist()), tuple(pixels[edge[1]].tolist()), color, 2)
+                p1 = pixels[edges[-1][0]]
+                overlay.put_text('traffic_light', (int(p1[0])+2,int(p1[1])+2), color)
+        return overlay.image()
+
+    def render_road(self, anno):
+        ego = anno['bounding_boxes'][0]
+        K = anno['sensors']['CAM_FRONT']['intrinsic']
+        world2cam = anno['sensors']['CAM_FRONT']['world2cam']
+        road_seg = np.zeros((900, 1600, 3), dtype=np.uint8)
+        # current lane, then the lanes it is connected to
+        elements = self.hd_map.lane_elements(ego['road_id'], ego['lane_id'])
+        all_road_topology = set()
+        for element in elements:
+            for r_t in self.hd_map.topology_of(element):
+                all_road_topology.add(r_t)
+        elements = [elements] + [self.hd_map.lane_elements(*r_t) for r_t in all_road_topology if r_t is not None]
+        draw_lanes(road_seg, self.hd_map, np.concatenate(elements), K, world2cam)
+        return road_seg
+
+    def render_lidar_bev(self, anno, lidars):
+        lidar_image = np.zeros((900, 1600, 3), dtype=np.uint8)
+        header = laspy.LasHeader(point_format=0)  # LARS point format used for storing
+        header.offsets = np.min(lidars, axis=0)
+        point_precision = 0.001
+        header.scales = np.array([point_precision, point_precision, point_precision])
+        point_record = laspy.ScaleAwarePointRecord.zeros(lidars.shape[0], header=header)
+        # (x, y,z) -> (y, -x, z), the x,y plane of the lidar system is different from that of the ego-car
+        point_record.x = lidars[:, 1]
+        point_record.y = - lidars[:, 0]
+
+        # Convert normalized coordinates to image pixel index
+        x_pixels = (np.asarray(point_record.x) + LIDAR_RANGE) / (2 * LIDAR_RANGE) * (lidar_image.shape[1] - 1)
+        y_pixels = (np.asarray(point_record.y) + LIDAR_RANGE) / (2 * LIDAR_RANGE) * (lidar_image.shape[0] - 1)
+        draw_points(lidar_image, np.stack((x_pixels, y_pixels), axis=1).astype(np.int64), (255, 255, 255), radius=2)
+
+        ego = anno['bounding_boxes'][0]
+        world2ego = np.asarray(ego['world2ego'], dtype=np.float64)
+        for npc in anno['bounding_boxes']:
+            if npc['class'] not in ['vehicle', 'ego_vehicle']: continue
+            if abs(npc['location'][2] - ego['location'][2]) > 10: continue # car in sky and underground
+            verts = np.array(npc['world_cord'], dtype=np.float64)
+            verts = np.concatenate((verts, np.ones((len(verts), 1))), axis=1) @ world2ego.T
+            x_pixels = (verts[:, 1] + LIDAR_RANGE) / (2 * LIDAR_RANGE) * (lidar_image.shape[1] - 1)
+            y_pixels = (-verts[:, 0] + LIDAR_RANGE) / (2 * LIDAR_RANGE) * (lidar_image.shape[0] - 1)
+            pixels = np.stack((x_pixels, y_pixels), axis=1).astype(np.int32)
+            color = (0, 255, 0) if npc['class'] == 'ego_vehicle' else (0, 128, 255)
+            cv2.polylines(lidar_image, list(pixels[EDGES]), False, color, 2)
+        return lidar_image
+
+
+_renderer = None
+
+
+def _init_worker(renderer_args):
+    global _renderer
+    _renderer = FrameRenderer(*renderer_args)
+
+
+def _render_step(step):
+    return _renderer(step)
+
+
+def visualize_data(file_path, map_path, vis_bbox=True,  vis_top_down=True, vis_road=True, vis_lidar_bev=True, vis_lidar_to_back_image=True, vis_lidar_to_front_image=True, vis_lidar_to_front_left_image=True,
+                   num_workers=1, video_views=(), fps=10):
+    """
+    Renders all steps of a route, with num_workers processes in parallel. The views in video_views are also written
+    to {view}.mp4 in the order of the steps.
+    """
+    print(f'file_path={file_path}')
+    print(f'map_path={map_path}')
+
+    views = []
+    if vis_bbox:
+        views += [f'{cam_map[key]}_3d_bbox' for key in BBOX_CAMERAS]
+    if vis_top_down:
+        views.append('rgb_top_down_3d_bbox')
+    if vis_road:
+        views.append('rgb_front_landmark')
+    for flag, view in ((vis_lidar_bev, 'lidar_bev'), (vis_lidar_to_front_image, 'lidar_front'), (vis_lidar_to_back_image, 'lidar_back'), (vis_lidar_to_front_left_image, 'lidar_front_left')):
+        if flag:
+            views.append(view)
+    video_views = [view for view in video_views if view in views]
+
+    save_path = pathlib.Path(file_path.replace('v0','v0-vis'))
+    for view in views:
+        (save_path / VIEWS[view][0]).mkdir(parents=True, exist_ok=True)
+
+    map_dir = columnar_map_dir(map_path)
+    if map_path.endswith('.npz') and not os.path.isdir(map_dir) and {'rgb_top_down_3d_bbox', 'rgb_front_landmark'} & set(views):
+        # converted once, the workers memory-map the columnar map
+        print(f'Converting {map_path} to {map_dir}')
+        save_columnar_map(map_dir, *lane_marking_dict_to_columns(load_legacy_npz(map_path)))
+
+    folder_path = os.path.join(file_path, 'anno')
+    file_count = len([name for name in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, name))])
+    renderer_args = (file_path, save_path, map_dir, views, video_views)
+
+    videos = {}
+    if num_workers > 1:
+        # OpenCV and the parallel laz decoder start threads, which can deadlock forked workers
+        pool = multiprocessing.get_context('spawn').Pool(processes=num_workers, initializer=_init_worker, initargs=(renderer_args,))
+        results = pool.imap(_render_step, range(file_count))
+    else:
+        pool = None
+        results = map(FrameRenderer(*renderer_args), range(file_count))
+    try:
+        for _, frames in tqdm(results, total=file_count):
+            for view, img in frames.items():
+                if view not in videos:
+                    videos[view] = cv2.VideoWriter(os.path.join(save_path, f'{view}.mp4'), cv2.VideoWriter_fourcc(*'mp4v'), fps, (img.shape[1], img.shape[0]))
+                videos[view].write(img)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for video in videos.values():
+            video.release()
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='argparse')
     parser.add_argument('--file_path','-f', type=str)
-    parser.add_argument('--map_path','-m', type=str)
+    parser.add_argument('--map_path','-m', type=str, help='Town number, e.g. 13 for ./maps/Town13_HD_map (columnar) or ./maps/Town13_HD_map.npz.')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--video', type=str, nargs='*', default=[], choices=list(VIEWS.keys()), help='Views that are also exported as mp4.')
+    parser.add_argument('--fps', type=int, default=10)
 
     args = parser.parse_args()
     map_path = f'./maps/Town{args.map_path}_HD_map.npz'
-    visualize_data(args.file_path, map_path, vis_bbox=True, vis_top_down=True, vis_road=True, vis_lidar_bev=True, vis_lidar_to_back_image=True, vis_lidar_to_front_image=True, vis_lidar_to_front_left_image=True)
\ No newline at end of file
+    visualize_data(args.file_path, map_path, vis_bbox=True, vis_top_down=True, vis_road=True, vis_lidar_bev=True, vis_lidar_to_back_image=True, vis_lidar_to_front_image=True, vis_lidar_to_front_left_image=True,
+                   num_workers=args.num_workers, video_views=args.video, fps=args.fps)
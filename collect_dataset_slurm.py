@@ -1,20 +1,21 @@
 """
 Generates a dataset for training on a SLURM cluster.
 Each route file is parallelized on its own machine.
-Monitors the data collection and continues crashed processes.
+Monitors the data collection and continues crashed processes, see job_orchestrator.py.
 Best run inside a tmux terminal.
 """
 
 from datetime import datetime
 import os
-import subprocess
+import shutil
 import time
 import glob
-import json
 from pathlib import Path
 import random
 import re
 
+from job_orchestrator import CRASH_PATTERNS, Orchestrator, SlurmBackend, read_max_num_jobs
+
 
 def make_bash(code_dir, route_file_number, agent_name, route_file, ckeckpoint_endpoint, save_pth, seed, carla_root, town, repetition):
     save_slurm = save_pth.replace("data/", "slurm/")
@@ -73,78 +74,24 @@ sleep 180
         f.write(qsub_template)
     return jobfile
 
-def get_running_jobs(jobname, user_name):
-    job_list = subprocess.check_output(
-            (
-                f"SQUEUE_FORMAT2='jobid:10,username:{len(username)},name:130' squeue --sort V | grep {user_name} | \
-                    grep {jobname} || true"
-            ),
-            shell=True,
-        ).decode("utf-8").splitlines()
-    currently_num_running_jobs = len(job_list)
-    #  line is sth like "4767364   gwb791 eval_julian_4170_0   "
-    routefile_number_list = [line.split("_")[-2] + "_" + line.split("_")[-1].strip() for line in job_list]
-    pid_list = [line.split(" ")[0] for line in job_list]
-    return currently_num_running_jobs, routefile_number_list, pid_list
-
-def get_last_line_from_file(filepath): # this is used to check log files for errors
-    try:
-        with open(filepath, "rb", encoding="utf-8") as f:
-            try:
-                f.seek(-2, os.SEEK_END)
-                while f.read(1) != b"\n":
-                    f.seek(-2, os.SEEK_CUR)
-            except OSError:
-                f.seek(0)
-            last_line = f.readline().decode()
-    except:
-        last_line=""
-    return last_line
-
-def cancel_jobs_with_err_in_log(logroot, jobname, user_name):
-    # check if the log file contains certain error messages, then terminate the job
-    print("Checking logs for errors...")
-    _, routefile_number_list, pid_list = get_running_jobs(jobname, user_name)
-    for i, rf_num in enumerate(routefile_number_list):
-        logfile_path = os.path.join(logroot, f"run_files/logs/qsub_out{rf_num}.log")
-        last_line = get_last_line_from_file(logfile_path)
-        terminate = False
-        if "Actor" in last_line and "not found!" in last_line:
-            terminate = True
-        if "Watchdog exception - Timeout" in last_line:
-            terminate = True
-        if "Engine crash handling finished; re-raising signal 11" in last_line:
-            terminate = True
-        if terminate:
-            print(f"Terminating route {rf_num} with pid {pid_list[i]} due to error in logfile.")
-            subprocess.check_output(f"scancel {pid_list[i]}", shell=True)
-
-def wait_for_jobs_to_finish(logroot, jobname, user_name, max_n_parallel_jobs):
-    currently_running_jobs, _, _ = get_running_jobs(jobname, user_name)
-    print(f"{currently_running_jobs}/{max_n_parallel_jobs} jobs are running...")
-    counter = 0
-    while currently_running_jobs >= max_n_parallel_jobs:
-        if counter == 0:
-            cancel_jobs_with_err_in_log(logroot, jobname, user_name)
-        time.sleep(5)
-        currently_running_jobs, _, _ = get_running_jobs(jobname, user_name)
-        counter = (counter + 1) % 4
-
-def get_num_jobs(job_name, username):
-    len_usrn = len(username)
-    num_running_jobs = int(
-        subprocess.check_output(
-            f"SQUEUE_FORMAT2='username:{len_usrn},name:130' squeue --sort V | grep {username} | grep {job_name} | wc -l",
-            shell=True,
-        ).decode('utf-8').replace('\n', ''))
-
-    try:
-        with open('max_num_jobs.txt', 'r', encoding='utf-8') as f:
-            max_num_parallel_jobs = int(f.read())
-    except:
-        max_num_parallel_jobs = 1
-
-    return num_running_jobs, max_num_parallel_jobs
+def backup_logs(job):
+    """Keeps the logs of the previous attempt of a resubmitted job."""
+    if job["attempts"] == 0:
+        return None
+    backup_dir = f"{os.path.dirname(job['log_file'])}_{Path(job['job_file']).stem}_{time.time()}"
+    os.makedirs(backup_dir, exist_ok=True)
+    for log_file in (job["log_file"], job["err_file"]):
+        if os.path.exists(log_file):
+            shutil.copy(log_file, backup_dir)
+    return None
+
+def prepare_job(job):
+    """Called before every submission, writes the job file again so that partition.txt is read for every submission."""
+    backup_logs(job)
+    meta = job["meta"]
+    make_jobsub_file(meta["save_path"], meta["job_name"], meta["routefile_number"],
+                     get_which_partition(meta["default_partition"]), meta["repetition"], meta["timeout"])
+    return None
 
 def get_which_partition(default):
     try:
@@ -160,17 +107,24 @@ def get_which_partition(default):
 
 
 
+def get_jobsub_paths(save_path_data, route_file_number, repetition):
+    """job file, stdout log and stderr log of a route and repetition"""
+    save_slurm = save_path_data.replace("data/", "slurm/")
+    return (f"{save_slurm}/run_files/job_files/{route_file_number}_Rep{repetition}.sh",
+            f"{save_slurm}/run_files/logs/qsub_out{route_file_number}_Rep{repetition}.log",
+            f"{save_slurm}/run_files/logs/qsub_err{route_file_number}_Rep{repetition}.log")
+
 def make_jobsub_file(save_path_data, jobname, route_file_number, partition_name, repetition, timeout="0-02:00"):
     save_slurm = save_path_data.replace("data/", "slurm/")
     os.makedirs(f"{save_slurm}/run_files/logs", exist_ok=True)
     os.makedirs(f"{save_slurm}/run_files/job_files", exist_ok=True)
     os.makedirs(f"{save_slurm}/run_files/start_files", exist_ok=True)
-    jobfile = f"{save_slurm}/run_files/job_files/{route_file_number}_Rep{repetition}.sh"
+    jobfile, log_file, err_file = get_jobsub_paths(save_path_data, route_file_number, repetition)
     qsub_template = f"""#!/bin/bash
 #SBATCH --job-name={jobname}_{route_file_number}
 #SBATCH --partition={partition_name}
-#SBATCH -o {save_slurm}/run_files/logs/qsub_out{route_file_number}.log
-#SBATCH -e {save_slurm}/run_files/logs/qsub_err{route_file_number}.log
+#SBATCH -o {log_file}
+#SBATCH -e {err_file}
 #SBATCH --nodes=1
 #SBATCH --ntasks-per-node=1
 #SBATCH --cpus-per-task=8
@@ -214,7 +168,6 @@ if __name__ == "__main__":
     repetition_start = 0
     default_partition = "YOUR_PARTITION" 
     job_name = "collect"
-    username = "YOUR_USER"
     code_root = r"/path/to/simlingo"
     carla_root = "/path/to/CARLA/root"
     date = datetime.today().strftime("%Y_%m_%d")
@@ -231,16 +184,17 @@ if __name__ == "__main__":
 
     routes = routes + routes_lb1
 
-    port_offset = 0
-    job_number = 1
-    meta_jobs = {}
+    # the journal keeps track of the submitted jobs, restarting the script continues the collection
+    # the collection is done once every result file is complete, routes that did not start are also resubmitted
+    orchestrator = Orchestrator(os.path.join(log_root, "jobs.sqlite"), SlurmBackend(), max_jobs=read_max_num_jobs,
+                                crash_patterns=CRASH_PATTERNS + (r"Actor .* not found!",), resubmit_not_started=True,
+                                prepare=prepare_job)
 
     #shuffle routes
     random.seed(42)
     random.shuffle(routes)
     seed_counter = 1000000 * repetition_start - 1  # for the traffic manager, which is incremented so that we get different traffic each time
 
-    num_routes = len(routes)
     for repetition in range(repetition_start, repetitions):
         for route in routes:
             seed_counter += 1
@@ -260,99 +214,22 @@ if __name__ == "__main__":
             scenario_type = route.split("/")[-5:-1]
             scenario_type = "/".join(scenario_type)
             routefile_number = route.split("/")[-1].split(".")[0]  # this is the number in the xml file name, e.g. 22_0.xml
-            ckpt_endpoint = f"{code_root}/{data_save_directory}/results/{scenario_type}/{routefile_number}_result.json"
+            # one result file per repetition, otherwise a finished repetition marks the others as done
+            ckpt_endpoint = f"{code_root}/{data_save_directory}/results/{scenario_type}/{routefile_number}_Rep{repetition}_result.json"
 
             save_path = f"{code_root}/{data_save_directory}/data/{scenario_type}"
             Path(save_path).mkdir(parents=True, exist_ok=True)
             agent = f"{code_root}/team_code/data_agent.py"
 
-            partition_name = get_which_partition(default_partition)
-
             bash_file = make_bash(code_root, routefile_number, agent, route,
                                   ckpt_endpoint, save_path, seed_counter, carla_root, town, repetition)
-            job_file = make_jobsub_file(save_path, job_name, routefile_number, partition_name, repetition, "0-04:00")
-
-            # Wait until submitting new jobs that the #jobs are at below max
-            num_running_jobs, max_num_parallel_jobs = get_num_jobs(job_name=job_name, username=username)
-            print(f'{num_running_jobs}/{max_num_parallel_jobs} jobs are running...')
-            while num_running_jobs >= max_num_parallel_jobs:
-                num_running_jobs, max_num_parallel_jobs = get_num_jobs(job_name=job_name, username=username)
-                time.sleep(0.05)
-
-            print(f"Submitting job {job_number}/{num_routes}: {job_name}_{routefile_number}. ", end="")
-            time.sleep(1)
-            jobid = subprocess.check_output(f"sbatch {job_file}", shell=True).decode("utf-8") \
-                                                            .strip().rsplit(" ", maxsplit=1)[-1]
-            print(f"Jobid: {jobid}")
-            meta_jobs[jobid] = (False, job_file, ckpt_endpoint, 0)  # job_finished, job_file, result_file, resubmitted
-            job_number += 1
-
-    time.sleep(1)
-    training_finished = False
-    while not training_finished:
-        num_running_jobs, _, _ = get_running_jobs(job_name, username)
-        print(f"{num_running_jobs} jobs are running... Job: {job_name}")
-        cancel_jobs_with_err_in_log(log_root, job_name, username)
-        time.sleep(20)
-
-        # resubmit unfinished jobs
-        for k in list(meta_jobs.keys()):
-            job_finished, job_file, result_file, resubmitted = meta_jobs[k]
-            need_to_resubmit = False
-            if not job_finished and resubmitted < 3:
-                # check whether job is running
-                if int(subprocess.check_output(f"squeue | grep {k} | wc -l", shell=True).decode("utf-8").strip()) == 0:
-                    # check whether result file is finished?
-                    if os.path.exists(result_file):
-                        with open(result_file, "r", encoding="utf-8") as f_result:
-                            evaluation_data = json.load(f_result)
-                        progress = evaluation_data["_checkpoint"]["progress"]
-                        if len(progress) < 2 or progress[0] < progress[1]:
-                            need_to_resubmit = True
-                        else:
-                            for record in evaluation_data["_checkpoint"]["records"]:
-                                if record["scores"]["score_route"] <= 0.00000000001:
-                                    need_to_resubmit = True
-                                if record["status"] == "Failed - Agent couldn\'t be set up":
-                                    need_to_resubmit = True
-                                if record["status"] == "Failed":
-                                    need_to_resubmit = True
-                                if record["status"] == "Failed - Simulation crashed":
-                                    need_to_resubmit = True
-                                if record["status"] == "Failed - Agent crashed":
-                                    need_to_resubmit = True
-
-                        if not need_to_resubmit:
-                            # delete old job
-                            print(f"Finished job {job_file}")
-                            meta_jobs[k] = (True, None, None, 0)
-
-                    else:
-                        need_to_resubmit = True
-
-            if need_to_resubmit:
-                # rename old error files to still access it
-                routefile_number = Path(job_file).stem
-                print(f"Resubmit job {routefile_number} (previous id: {k}). Waiting for jobs to finish...")
-
-                with open('max_num_jobs.txt', 'r', encoding='utf-8') as f:
-                    max_num_parallel_jobs = int(f.read())
-                wait_for_jobs_to_finish(log_root, job_name, username, max_num_parallel_jobs)
-
-                time_now_log = time.time()
-                os.system(f'mkdir -p "{log_root}/run_files/logs_{routefile_number}_{time_now_log}"')
-                os.system(f"cp {log_root}/run_files/logs/qsub_err{routefile_number}.log {log_root}/ \
-                          run_files/logs_{routefile_number}_{time_now_log}")
-                os.system(f"cp {log_root}/run_files/logs/qsub_out{routefile_number}.log {log_root}/ \
-                          run_files/logs_{routefile_number}_{time_now_log}")
-
-                jobid = subprocess.check_output(f"sbatch {job_file}", shell=True).decode("utf-8").strip() \
-                                                                                .rsplit(" ", maxsplit=1)[-1]
-                meta_jobs[jobid] = (False, job_file, result_file, resubmitted + 1)
-                meta_jobs[k] = (True, None, None, 0)
-                print(f"resubmitted job {routefile_number}. (new id: {jobid})")
-
-        time.sleep(10)
-
-        if num_running_jobs == 0:
-            training_finished = True
+            # the job file itself is written by prepare_job before each submission
+            job_file, log_file, err_file = get_jobsub_paths(save_path, routefile_number, repetition)
+            meta = {"save_path": save_path, "job_name": job_name, "routefile_number": routefile_number,
+                    "repetition": repetition, "default_partition": default_partition, "timeout": "0-04:00"}
+
+            # one submission and up to 3 resubmissions
+            orchestrator.add(f"{job_name}_{scenario_type}/{routefile_number}_Rep{repetition}", job_file, ckpt_endpoint,
+                             log_file, err_file, max_tries=4, meta=meta)
+
+    orchestrator.run()
@@ -0,0 +1,92 @@
+"""
+Converts the rgb (and rgb_augmented) jpgs of every route into one memory-mappable uint8 shard per camera folder
+(see simlingo_training/dataloader/image_shards.py). The frames are decoded and cropped like in BaseDataset.load_images
+but keep their resolution, the image augmentation and the resize to the tile grid still run during training.
+Set image_backend: shards in the dataset config to train from the shards.
+
+Example:
+python dataset_generation/create_image_shards.py --data_path database/simlingo --num_workers 32
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+from functools import partial
+
+import cv2
+import numpy as np
+import tqdm
+
+from simlingo_training.dataloader.image_shards import crop_bottom, get_shard_paths
+from simlingo_training.dataloader.sample_index import ROUTE_GLOB
+
+CAMERA_FOLDERS = ['rgb', 'rgb_augmented']
+
+
+def convert_camera_folder(route_dir, camera_folder, cropped, overwrite):
+    shard_path, meta_path = get_shard_paths(route_dir, camera_folder)
+    camera_dir = os.path.join(route_dir, camera_folder)
+    if not os.path.isdir(camera_dir):
+        return 0
+    if os.path.isfile(meta_path) and not overwrite:
+        return 0
+
+    frames = sorted(file for file in os.listdir(camera_dir) if file.endswith('.jpg'))
+    if len(frames) == 0:
+        return 0
+    # shard index == frame number, the dataset relies on that
+    assert [int(frame.split('.')[0]) for frame in frames] == list(range(len(frames))), f'Frames missing in {camera_dir}'
+
+    shard = None
+    tmp_path = shard_path + '.tmp'
+    for i, frame in enumerate(frames):
+        image = cv2.imread(os.path.join(camera_dir, frame), cv2.IMREAD_COLOR)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if cropped:
+            image = crop_bottom(image)
+
+        if shard is None:
+            shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(frames),) + image.shape)
+        shard[i] = image
+
+    height, width = shard.shape[1:3]
+    shard.flush()
+    del shard
+    # rename last, so an interrupted conversion never leaves a shard that looks complete
+    os.replace(tmp_path, shard_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'num_frames': len(frames), 'cropped': cropped, 'height': height, 'width': width}, f)
+    return len(frames)
+
+
+def convert_route(route_dir, cropped, overwrite):
+    num_frames = 0
+    for camera_folder in CAMERA_FOLDERS:
+        try:
+            num_frames += convert_camera_folder(route_dir, camera_folder, cropped, overwrite)
+        except Exception as e:
+            print(f'Error in {route_dir}/{camera_folder}: {e}')
+    return num_frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default='database/simlingo', help='Same as data_path in the dataset config.')
+    parser.add_argument('--no_crop', action='store_true', default=False, help='Do not cut the bottom (cut_bottom_quarter and img_shift_augmentation are off).')
+    parser.add_argument('--overwrite', action='store_true', default=False)
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    route_dirs = sorted(glob.glob(args.data_path + ROUTE_GLOB))
+    print(f'Found {len(route_dirs)} routes')
+
+    convert = partial(convert_route, cropped=not args.no_crop, overwrite=args.overwrite)
+    with multiprocessing.Pool(processes=args.num_workers) as pool:
+        num_frames = list(tqdm.tqdm(pool.imap_unordered(convert, route_dirs), total=len(route_dirs)))
+
+    print(f'Converted {sum(num_frames)} frames')
+
+
+if __name__ == '__main__':
+    main()
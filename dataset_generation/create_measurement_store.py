@@ -0,0 +1,95 @@
+"""
+Packs the measurements/XXXX.json.gz files of every route into one memory-mappable column store per route
+(see simlingo_training/dataloader/measurement_store.py). Only the fields used by the datasets are kept.
+Set measurement_backend: packed in the dataset config to train from the stores.
+
+Example:
+python dataset_generation/create_measurement_store.py --data_path database/simlingo --num_workers 32
+"""
+import argparse
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import shutil
+from functools import partial
+
+import numpy as np
+import tqdm
+import ujson
+
+from simlingo_training.dataloader.measurement_store import (STORE_META, MeasurementStoreReader, get_store_dir,
+                                                             pack_measurements)
+from simlingo_training.dataloader.sample_index import ROUTE_GLOB
+
+
+def convert_route(route_dir, overwrite, check):
+    measurement_dir = os.path.join(route_dir, 'measurements')
+    store_dir = get_store_dir(measurement_dir)
+    if not os.path.isdir(measurement_dir):
+        return 0
+    if os.path.isfile(os.path.join(store_dir, STORE_META)) and not overwrite:
+        return 0
+
+    try:
+        frames = sorted(file for file in os.listdir(measurement_dir) if file.endswith('.json.gz'))
+        if len(frames) == 0:
+            return 0
+        # store index == frame number, the dataset relies on that
+        assert [int(frame.split('.')[0]) for frame in frames] == list(range(len(frames))), f'Frames missing in {measurement_dir}'
+
+        measurements = []
+        for frame in frames:
+            with gzip.open(os.path.join(measurement_dir, frame), 'rt') as f:
+                measurements.append(ujson.load(f))
+        arrays = pack_measurements(measurements)
+
+        tmp_dir = store_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        with open(os.path.join(tmp_dir, STORE_META), 'w') as f:
+            json.dump({'num_frames': len(frames), 'arrays': list(arrays.keys())}, f)
+        # rename last, so an interrupted conversion never leaves a store that looks complete
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.rename(tmp_dir, store_dir)
+
+        if check:
+            check_route(measurement_dir, measurements)
+    except Exception as e:
+        print(f'Error in {route_dir}: {e}')
+        return 0
+    return len(frames)
+
+
+def check_route(measurement_dir, measurements):
+    """Compares the packed store with the json files."""
+    packed = MeasurementStoreReader().load(measurement_dir, 0, len(measurements))
+    for frame, (measurement, measurement_packed) in enumerate(zip(measurements, packed)):
+        for key, value in measurement_packed.items():
+            assert np.array_equal(np.array(measurement[key], dtype=np.float64).reshape(np.shape(value)), value), \
+                f'{measurement_dir} frame {frame}: {key} differs'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default='database/simlingo', help='Same as data_path in the dataset config.')
+    parser.add_argument('--overwrite', action='store_true', default=False)
+    parser.add_argument('--check', action='store_true', default=False, help='Compare every converted route with its json files.')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    route_dirs = sorted(glob.glob(args.data_path + ROUTE_GLOB))
+    print(f'Found {len(route_dirs)} routes')
+
+    convert = partial(convert_route, overwrite=args.overwrite, check=args.check)
+    with multiprocessing.Pool(processes=args.num_workers) as pool:
+        num_frames = list(tqdm.tqdm(pool.imap_unordered(convert, route_dirs), total=len(route_dirs)))
+
+    print(f'Converted {sum(num_frames)} frames')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Declarative data buckets of the CARLA dataset.
+Every sample (current frame of the driving dataset) is described by a flat dict of fields that are computed from the
+measurements and boxes of the frame and its future frames (frame_fields). The buckets are predicates over these fields:
+
+    BUCKET_RULES:           (bucket name, conditions), the name is formatted with the fields, e.g. speed_limit_{speed_limit}
+    BUCKET_BINS:            (field, upper bin edges), the sample is in {field}_{edge} of the first edge above the value
+    EXCLUSIVE_BUCKET_RULES: samples in these buckets are in no other bucket
+
+A condition is (field, operator, value) and all conditions of a rule have to hold, they are checked in order.
+The rules are the ones of carla_get_buckets.py, change RULES_VERSION when frame_fields changes, the bucket index is
+rebuilt when the rules or their version change.
+"""
+import hashlib
+import math
+import operator
+
+import numpy as np
+
+RULES_VERSION = 1
+
+# sample layout of the driving dataset (DataModule of carla_get_buckets.py)
+HIST_LEN = 3
+PRED_LEN = 11
+SKIP_FIRST_N_FRAMES = 10
+# frames after the current one that the leading vehicle has to be visible in
+LEADING_VEHICLE_FRAMES = 4
+
+BIKES = ['vehicle.bh.crossbike', 'vehicle.diamondback.century', 'vehicle.gazelle.omafiets']
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+EXCLUSIVE_BUCKET_RULES = [
+    # the name is kept as in the existing bucket files
+    ('vehicle_dissapears', [('leading_vehicle_disappears', '==', True)]),
+]
+
+BUCKET_RULES = [
+    ('speed_limit_{speed_limit}', []),
+    ('start_from_stop_old', [('speed', '<', 0.5), ('waypoint_distance', '>', 0.1)]),
+    ('start_from_stop', [('speed', '<', 0.5), ('target_speed', '>', 0.8)]),
+    ('leading_object_{leading_object}', [('leading_object', '!=', None)]),
+    ('junction', [('distance_to_junction', '<', 10)]),
+    ('red_light', [('red_light_ahead', '==', True)]),
+    ('green_light', [('traffic_light_state', '==', 'Green'), ('distance_to_junction', '<', 20)]),
+    ('changed_route', [('changed_route', '==', True)]),
+    # hazards, a vehicle hazard only counts if the affecting vehicle is in the boxes
+    ('vehicle', [('vehicle_hazard', '==', True)]),
+    ('vehicle_front', [('vehicle_hazard', '==', True), ('vehicle_from_front', '==', True), ('red_light_ahead', '==', False)]),
+    ('vehicle_side', [('vehicle_hazard', '==', True), ('vehicle_from_front', '==', False),
+                      ('vehicle_affecting_abs_yaw', '>', 0.5), ('red_light_ahead', '==', False)]),
+    ('light', [('light_hazard', '==', True)]),
+    ('walker', [('walker_hazard', '==', True), ('walker_affecting', '==', True)]),
+    ('walker_hazard', [('walker_hazard', '==', True), ('walker_affecting', '==', False)]),
+    ('stop_sign', [('stop_sign_hazard', '==', True)]),
+    ('brake', [('brake', '==', True)]),
+    ('stop_sign_close', [('stop_sign_close', '==', True)]),
+    ('parkinglane', [('parking_lane_route', '==', True), ('lateral_control', '>', 0.2)]),
+]
+
+BUCKET_BINS = [
+    ('target_speed', [0.5, 5, 10, 15, 20, 25, 1000000]),
+    ('lateral_control', [0.1, 1, 2, 5, 1000000]),
+    ('acceleration', [-40, -20, -5, -1, 1, 5, 20, 40, 1000000]),
+]
+
+
+def rules_hash():
+    """Changes with the rules, the sample layout and RULES_VERSION."""
+    rules = (RULES_VERSION, HIST_LEN, PRED_LEN, SKIP_FIRST_N_FRAMES, LEADING_VEHICLE_FRAMES, EXCLUSIVE_BUCKET_RULES,
+             BUCKET_RULES, BUCKET_BINS)
+    return hashlib.sha1(repr(rules).encode('utf-8')).hexdigest()[:16]
+
+
+def sample_frames(num_seq):
+    """Current frames of the samples of a route with num_seq frames."""
+    return range(SKIP_FIRST_N_FRAMES + HIST_LEN - 1, num_seq - PRED_LEN - 1)
+
+
+def get_waypoints(measurements):
+    """Positions of the ego_matrix of the measurements in the frame of the first one, [N, 2]."""
+    origin_matrix = np.array(measurements[0]['ego_matrix'])[:3]
+    origin_translation = origin_matrix[:, 3:4]
+    origin_rotation = origin_matrix[:, :3]
+    # one product per waypoint like CARLA_Data.get_waypoints, so the bin edges see the same floats
+    waypoints = []
+    for measurement in measurements:
+        waypoint = np.array(measurement['ego_matrix'])[:3, 3:4]
+        waypoints.append((origin_rotation.T @ (waypoint - origin_translation))[:2, 0])
+    return np.array(waypoints)
+
+
+def frame_fields(measurements, boxes, box_ids, frame, measurement_folder):
+    """
+    Fields of the sample with the current frame, measurements, boxes and box_ids (set of the box ids) are indexed by
+    frame and have to contain the frames up to frame + PRED_LEN (measurements) and frame + LEADING_VEHICLE_FRAMES - 1.
+    """
+    current_measurement = measurements[frame]
+    future_measurements = measurements[frame:frame + PRED_LEN + 1]
+
+    waypoints = get_waypoints(future_measurements)[:-1]
+    future_speeds = [measurement['speed'] for measurement in future_measurements]
+    acceleration = np.mean((np.diff(future_speeds) / 0.2)[:4])
+    lateral_control = np.abs(np.mean(waypoints[:, 1]))
+
+    ego_info = {}
+    walker_affecting = None
+    vehicle_affecting = None
+    stop_sign_close = False
+    for box in boxes[frame]:
+        if box['class'] == 'ego_info':
+            ego_info = box
+        if box['class'] == 'walker' and current_measurement['walker_affecting_id'] is not None:
+            if box['id'] == current_measurement['walker_affecting_id']:
+                walker_affecting = box
+        if box['class'] == 'car' and current_measurement['vehicle_affecting_id'] is not None:
+            if box['id'] == current_measurement['vehicle_affecting_id']:
+                vehicle_affecting = box
+        if 'stop_sign' in box['class'] and box['affects_ego'] and box['distance'] < 15:
+            stop_sign_close = True
+
+    distance_to_junction = ego_info['distance_to_junction']
+    if distance_to_junction is None:
+        distance_to_junction = 10000
+
+    leading_object = current_measurement['speed_reduced_by_obj_type']
+    leading_object_distance = current_measurement['speed_reduced_by_obj_distance']
+    leading_vehicle_disappears = False
+    if leading_object is not None and leading_object.split('.')[0] == 'vehicle' and leading_object_distance < 10 \
+            and leading_object not in BIKES:
+        leading_vehicle_id = current_measurement['speed_reduced_by_obj_id']
+        leading_vehicle_disappears = any(leading_vehicle_id not in box_ids[future_frame]
+                                         for future_frame in range(frame, frame + LEADING_VEHICLE_FRAMES))
+    if leading_object is not None and leading_object_distance < 30:
+        if leading_object.split('.')[0] in ('vehicle', 'walker'):
+            leading_object = leading_object.split('.')[0]
+    else:
+        leading_object = None
+
+    vehicle_affecting_yaw = vehicle_affecting['yaw'] if vehicle_affecting is not None else None
+    return {
+        'speed_limit': current_measurement['speed_limit'],
+        'target_speed': current_measurement['target_speed'],
+        'speed': current_measurement['speed'],
+        'brake': bool(current_measurement['brake'] or current_measurement['control_brake']),
+        'changed_route': bool(current_measurement['changed_route']),
+        'lateral_control': lateral_control,
+        'waypoint_distance': np.mean(np.linalg.norm(waypoints[1:] - waypoints[:-1], axis=1)),
+        'acceleration': acceleration,
+        'leading_object': leading_object,
+        'leading_vehicle_disappears': leading_vehicle_disappears,
+        'distance_to_junction': distance_to_junction,
+        'traffic_light_state': ego_info['traffic_light_state'],
+        'red_light_ahead': ego_info['traffic_light_state'] == 'Red' and distance_to_junction < 20,
+        'vehicle_hazard': bool(current_measurement['vehicle_hazard']) and vehicle_affecting is not None,
+        'vehicle_from_front': vehicle_affecting_yaw is not None and math.pi - 0.6 < vehicle_affecting_yaw < math.pi + 0.6,
+        'vehicle_affecting_abs_yaw': abs(vehicle_affecting_yaw) if vehicle_affecting_yaw is not None else None,
+        'light_hazard': bool(current_measurement['light_hazard']),
+        'walker_hazard': bool(current_measurement['walker_hazard']),
+        'walker_affecting': walker_affecting is not None,
+        'stop_sign_hazard': bool(current_measurement['stop_sign_hazard']),
+        'stop_sign_close': stop_sign_close,
+        'parking_lane_route': 'parking_lane' in measurement_folder,
+    }
+
+
+def matches(fields, conditions):
+    return all(OPERATORS[op](fields[field], value) for field, op, value in conditions)
+
+
+def frame_buckets(fields):
+    """Names of the buckets of a sample."""
+    for name, conditions in EXCLUSIVE_BUCKET_RULES:
+        if matches(fields, conditions):
+            return [name.format(**fields)]
+
+    buckets = [name.format(**fields) for name, conditions in BUCKET_RULES if matches(fields, conditions)]
+    for field, edges in BUCKET_BINS:
+        for edge in edges:
+            if fields[field] < edge:
+                buckets.append(f'{field}_{edge}')
+                break
+    return buckets
@@ -0,0 +1,218 @@
+"""
+Incremental bucket builder, replaces the DataLoader pass of carla_get_buckets.py.
+The buckets are the declarative rules of bucket_rules.py, every route is processed by one worker that reads each
+measurements and boxes file once. The result is the memory-mapped bucket index that the datasets load
+({save_path}/bucket_index, see simlingo_training/dataloader/sample_index.py) plus buckets_stats.json.
+
+Every route of the index has a fingerprint of the stats (name, size, mtime) of its measurements and boxes files and
+of its number of rgb frames. On the next run only new routes and routes with a different fingerprint are processed,
+the buckets of the unchanged routes are taken from the existing index and removed routes are dropped. Changing the
+rules (bucket_rules.rules_hash) rebuilds everything.
+
+Example:
+python dataset_generation/data_buckets/build_buckets.py --data_path database/simlingo --save_path database/bucketsv2_simlingo --num_workers 32
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import multiprocessing
+import os
+import pickle as pkl
+import time
+from pathlib import Path
+
+import numpy as np
+import tqdm
+import ujson
+
+from dataset_generation.data_buckets import bucket_rules
+from simlingo_training.dataloader.sample_index import (BUCKET_INDEX_FOLDER, INDEX_VERSION, ROUTE_GLOB, BucketIndex,
+                                                       _IndexLock)
+
+
+def route_fingerprint(route_dir):
+    """Fingerprint of the files the buckets of a route depend on, None if the route is incomplete."""
+    digest = hashlib.sha1()
+    try:
+        for folder in ('measurements', 'boxes'):
+            with os.scandir(os.path.join(route_dir, folder)) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    stat = entry.stat()
+                    digest.update(f'{folder}/{entry.name}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+        digest.update(f"rgb:{len(os.listdir(os.path.join(route_dir, 'rgb')))}".encode('utf-8'))
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def load_json_gz(path):
+    with gzip.open(path, 'r') as f:
+        return ujson.load(f)
+
+
+def process_route(route_dir):
+    """Returns the measurement folder, the number of samples and {bucket: frames} of a route, None on errors."""
+    measurement_folder = route_dir + '/measurements'
+    try:
+        frames = bucket_rules.sample_frames(len(os.listdir(route_dir + '/rgb')))
+        buckets = {}
+        if len(frames) > 0:
+            # indexed by frame, frames before the first sample are not needed
+            last_measurement = frames[-1] + bucket_rules.PRED_LEN
+            last_boxes = frames[-1] + bucket_rules.LEADING_VEHICLE_FRAMES - 1
+            measurements = [None] * frames[0]
+            boxes = [None] * frames[0]
+            box_ids = [None] * frames[0]
+            for frame in range(frames[0], last_measurement + 1):
+                measurements.append(load_json_gz(f'{measurement_folder}/{frame:04}.json.gz'))
+            for frame in range(frames[0], last_boxes + 1):
+                boxes.append(load_json_gz(f'{route_dir}/boxes/{frame:04}.json.gz'))
+                box_ids.append({box['id'] for box in boxes[-1] if 'id' in box})
+
+            for frame in frames:
+                fields = bucket_rules.frame_fields(measurements, boxes, box_ids, frame, measurement_folder)
+                for bucket in bucket_rules.frame_buckets(fields):
+                    buckets.setdefault(bucket, []).append(frame)
+    except Exception as e:  # pylint: disable=broad-except
+        print(f'Error in {route_dir}')
+        print(e)
+        return measurement_folder, 0, None
+    return measurement_folder, len(frames), {bucket: np.array(frames, dtype=np.int32) for bucket, frames in buckets.items()}
+
+
+def load_previous_index(index_dir, rules_hash):
+    """Existing index of the builder if it can be updated, otherwise None."""
+    if not os.path.isfile(os.path.join(index_dir, 'meta.json')):
+        return None
+    index = BucketIndex(index_dir)
+    if index.meta.get('version') != INDEX_VERSION or index.meta.get('rules_hash') != rules_hash:
+        print('Bucket rules or index version changed, rebuilding all routes.')
+        return None
+    return index
+
+
+def load_generation(index_dir):
+    try:
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            return ujson.load(f).get('generation', 0)
+    except FileNotFoundError:
+        return -1
+
+
+def build_bucket_index(data_path, save_path, num_workers, rebuild=False, legacy_pkl=False):
+    """Updates the bucket index in save_path, returns a summary dict."""
+    index_dir = os.path.join(save_path, BUCKET_INDEX_FOLDER)
+    with _IndexLock(f'{index_dir}.lock'):
+        return _build_bucket_index(data_path, save_path, index_dir, num_workers, rebuild, legacy_pkl)
+
+
+def _build_bucket_index(data_path, save_path, index_dir, num_workers, rebuild, legacy_pkl):
+    rules_hash = bucket_rules.rules_hash()
+    route_dirs = sorted(route_dir for route_dir in glob.glob(data_path + ROUTE_GLOB) if os.path.isdir(route_dir + '/rgb'))
+    print(f'Found {len(route_dirs)} routes in {data_path}')
+
+    with multiprocessing.Pool(processes=num_workers) as pool:
+        previous = None if rebuild else load_previous_index(index_dir, rules_hash)
+        previous_fingerprints = {}
+        if previous is not None:
+            previous_routes = [str(route, encoding='utf-8') for route in previous.routes]
+            previous_fingerprints = np.load(os.path.join(index_dir, 'fingerprints.npy'))
+            previous_fingerprints = {route: str(fingerprint, encoding='utf-8')
+                                     for route, fingerprint in zip(previous_routes, previous_fingerprints)}
+
+        fingerprints = dict(zip(route_dirs, tqdm.tqdm(pool.imap(route_fingerprint, route_dirs, chunksize=16),
+                                                      total=len(route_dirs), desc='fingerprints')))
+        unchanged = [route_dir for route_dir in route_dirs if fingerprints[route_dir] is not None
+                     and previous_fingerprints.get(route_dir + '/measurements') == fingerprints[route_dir]]
+        unchanged_set = set(unchanged)
+        to_process = [route_dir for route_dir in route_dirs if fingerprints[route_dir] is not None
+                      and route_dir not in unchanged_set]
+        print(f'{len(unchanged)} routes unchanged, processing {len(to_process)} routes')
+
+        results = {}
+        for measurement_folder, num_samples, buckets in tqdm.tqdm(pool.imap_unordered(process_route, to_process),
+                                                                   total=len(to_process), desc='buckets'):
+            if buckets is not None:
+                results[measurement_folder] = (num_samples, buckets)
+
+    # routes that failed are left out and processed again in the next run
+    routes = sorted([route_dir + '/measurements' for route_dir in unchanged] + list(results.keys()))
+    route_ids = {route: i for i, route in enumerate(routes)}
+    num_samples = np.zeros(len(routes), dtype=np.int64)
+    parts = {}
+    if previous is not None:
+        # route ids of the previous index -> new route ids, -1 for changed and removed routes
+        previous_num_samples = np.load(os.path.join(index_dir, 'num_samples.npy'))
+        remap = np.full(len(previous_routes), -1, dtype=np.int64)
+        for previous_id, route in enumerate(previous_routes):
+            if route in route_ids and route not in results:
+                remap[previous_id] = route_ids[route]
+                num_samples[route_ids[route]] = previous_num_samples[previous_id]
+        for key in previous.keys():
+            key_routes, key_frames = previous.key_arrays(key)
+            key_routes = remap[key_routes]
+            keep = key_routes >= 0
+            parts.setdefault(key, []).append((key_routes[keep], np.asarray(key_frames)[keep]))
+
+    for route, (route_num_samples, buckets) in results.items():
+        num_samples[route_ids[route]] = route_num_samples
+        for key, frames in buckets.items():
+            parts.setdefault(key, []).append((np.full(len(frames), route_ids[route], dtype=np.int64), frames))
+
+    per_key = {}
+    for key in sorted(parts.keys()):
+        key_routes = np.concatenate([part[0] for part in parts[key]])
+        key_frames = np.concatenate([part[1] for part in parts[key]])
+        if len(key_routes) == 0:
+            continue
+        order = np.lexsort((key_frames, key_routes))
+        per_key[key] = (key_routes[order], key_frames[order])
+
+    del previous  # the memory-mapped arrays of the old index
+    meta = {
+        'rules_hash': rules_hash,
+        'generation': load_generation(index_dir) + 1,
+        'data_path': data_path,
+        'created': time.time(),
+    }
+    arrays = {
+        'fingerprints': np.array([fingerprints[route[:-len('/measurements')]] for route in routes], dtype=np.bytes_),
+        'num_samples': num_samples,
+    }
+    Path(save_path).mkdir(parents=True, exist_ok=True)
+    BucketIndex.write(index_dir, routes, per_key, meta, arrays=arrays)
+
+    buckets_stats = {'total': int(num_samples.sum())}
+    buckets_stats.update({key: len(key_routes) for key, (key_routes, _) in per_key.items()})
+    with open(f'{save_path}/buckets_stats.json', 'w') as f:
+        ujson.dump(dict(sorted(buckets_stats.items())), f, indent=4)
+
+    if legacy_pkl:
+        buckets_paths = {key: [f'{routes[route_id]}/{frame:04}.json.gz' for route_id, frame in zip(key_routes.tolist(), key_frames.tolist())]
+                         for key, (key_routes, key_frames) in per_key.items()}
+        with open(f'{save_path}/buckets_paths.pkl', 'wb') as f:
+            pkl.dump(buckets_paths, f)
+
+    summary = {'routes': len(routes), 'unchanged': len(unchanged), 'processed': len(results),
+               'failed': len(to_process) - len(results), 'samples': buckets_stats['total']}
+    print(f"Bucket index {index_dir}: {summary['routes']} routes ({summary['unchanged']} unchanged, "
+          f"{summary['processed']} processed, {summary['failed']} failed), {summary['samples']} samples")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', type=str, default='database/simlingo', help='Same as data_path in the dataset config.')
+    parser.add_argument('--save_path', type=str, default='database/bucketsv2_simlingo', help='Same as bucket_path in the dataset config.')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--rebuild', action='store_true', default=False, help='Process all routes again.')
+    parser.add_argument('--legacy_pkl', action='store_true', default=False,
+                        help='Also write buckets_paths.pkl for bucket_size_stats.py and older checkouts.')
+    args = parser.parse_args()
+
+    build_bucket_index(args.data_path, args.save_path, args.num_workers, rebuild=args.rebuild, legacy_pkl=args.legacy_pkl)
+
+
+if __name__ == '__main__':
+    main()
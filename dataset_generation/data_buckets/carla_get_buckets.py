@@ -2,6 +2,8 @@
 This script generates buckets for the CARLA dataset.
 partially taken from https://github.com/autonomousvision/carla_garage/blob/main/team_code/data.py
 (MIT licence)
+build_buckets.py computes the same buckets incrementally (only new or changed routes) and writes the bucket index
+that the datasets load.
 """
 
 # Standard library imports
@@ -13,14 +13,12 @@ import random
 import time
 from pathlib import Path
 
-import carla
 import cv2
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
-import simlingo_training.utils.transfuser_utils as t_u
 from dataset_generation.dreamer_data.dreamer_utils import *
 from dataset_generation.dreamer_data.kinematic_bicycle_model import KinematicBicycleModel
 from dataset_generation.language_labels.utils import *
@@ -92,6 +90,39 @@ class CarlaAlternativeCreator():
         if self.sample_uniform_interval > 1:
             self.data_boxes_paths = self.data_boxes_paths[::self.sample_uniform_interval]
 
+        # frames of the current route by boxes path, every frame is a future frame of the FUTURE_LEN - 1 frames before
+        self.frame_cache = {}
+
+    def load_frame(self, path_boxes):
+        """
+        Boxes (with an index by actor id) and measurements of a frame, None if a file does not exist.
+        Cached, the frames are only modified by adding the ego actions which are the same for every frame using them.
+        """
+        if path_boxes not in self.frame_cache:
+            path_measurement = path_boxes.replace('boxes', 'measurements')
+            if not os.path.exists(path_boxes) or not os.path.exists(path_measurement):
+                self.frame_cache[path_boxes] = None
+                return None
+
+            with gzip.open(path_boxes, 'rb') as f:
+                boxes = json.loads(f.read().decode('utf-8'))
+            with gzip.open(path_measurement, 'rb') as f:
+                measurements = json.loads(f.read().decode('utf-8'))
+
+            boxes_by_id = {}
+            for box in boxes:
+                if 'id' in box:
+                    boxes_by_id.setdefault(box['id'], box)
+            changed_route = measurements['changed_route'] or \
+                np.any(np.asarray(measurements['route']) != np.asarray(measurements['route_original']))
+            self.frame_cache[path_boxes] = {
+                'boxes': boxes,
+                'boxes_by_id': boxes_by_id,
+                'measurements': measurements,
+                'changed_route': changed_route,
+            }
+        return self.frame_cache[path_boxes]
+
     def process_data(self, path_id):
         path_boxes = self.data_boxes_paths[path_id]
 
@@ -108,62 +139,41 @@ class CarlaAlternativeCreator():
         if not os.access(path_rgb_image, os.F_OK) or not os.access(path_boxes, os.F_OK) or not os.access(path_measurement, os.F_OK):
             return
         
-        # Read results file
+        # Skip data where the expert did not achieve perfect driving score, read once per route
         if self.filter_routes_by_result:
             results_file = path_boxes.split('boxes')[0] + 'results.json.gz'
-            try:
-                with gzip.open(results_file, 'rb') as f:
-                    route_results = json.loads(f.read().decode('utf-8'))
-            except Exception as e:
-                print(f"Error reading {results_file}: {e}")
-                return
-
-            other_infractions_than_min_speed_infractions_exist = False
-            for key in route_results['infractions'].keys():
-                if len(route_results['infractions'][key]) > 0 and key != 'min_speed_infractions':
-                    other_infractions_than_min_speed_infractions_exist = True
-                    break
-
-            # Skip data where the expert did not achieve perfect driving score
-            if other_infractions_than_min_speed_infractions_exist and \
-                        (route_results['scores']['score_composed'] < 98.0 or
-                        route_results['scores']['score_route'] < 98.0):
-                return
-            elif not other_infractions_than_min_speed_infractions_exist and \
-                                (route_results['scores']['score_route'] < 98.0):
+            if not expert_route_passed(load_route_results(results_file)):
                 return
-            
-        # Read data and measurements files
-        with gzip.open(path_boxes, 'rb') as f:
-            file_content = f.read()
-            current_boxes = json.loads(file_content.decode('utf-8'))
-
-        with gzip.open(path_measurement, 'rb') as f:
-            file_content = f.read()
-            current_measurements = json.loads(file_content.decode('utf-8'))
 
         time_stamp = path_boxes.split('/')[-1].split('_')[-1].replace('.json.gz', '')
         time_stamp_int = int(time_stamp)
         next_10_time_stamps = [str(time_stamp_int + i).zfill(4) for i in range(1, self.FUTURE_LEN)] # 4 digits string
 
         future_boxes_paths = [os.path.join(path_boxes.replace(time_stamp, i)) for i in next_10_time_stamps]
-        future_measurement_paths = [i.replace('boxes', 'measurements') for i in future_boxes_paths]
 
+        # keep the frames that are used by this frame and the next ones
+        self.frame_cache = {path: self.frame_cache[path] for path in [path_boxes] + future_boxes_paths if path in self.frame_cache}
+
+        # Read data and measurements files
+        current_frame = self.load_frame(path_boxes)
+        if current_frame is None:
+            return
+        current_boxes = current_frame['boxes']
+        current_measurements = current_frame['measurements']
+
+        future_frames = []
         future_boxes = []
         future_measurements = []
         changed_route = False
-        for path_box, path_measure in zip(future_boxes_paths, future_measurement_paths):
-            if os.path.exists(path_box) and os.path.exists(path_measure):
-                with gzip.open(path_box, 'rb') as f:
-                    file_content = f.read()
-                    future_boxes.append(json.loads(file_content.decode('utf-8')))
-                with gzip.open(path_measure, 'rb') as f:
-                    file_content = f.read()
-                    future_measurements.append(json.loads(file_content.decode('utf-8')))
-                    if future_measurements[-1]['changed_route'] or np.any(np.asarray(future_measurements[-1]['route']) != np.asarray(future_measurements[-1]['route_original'])):
-                        changed_route = True
-            else:
+        for path_box in future_boxes_paths:
+            future_frame = self.load_frame(path_box)
+            if future_frame is None:
                 return
+            future_frames.append(future_frame)
+            future_boxes.append(future_frame['boxes'])
+            future_measurements.append(future_frame['measurements'])
+            if future_frame['changed_route']:
+                changed_route = True
 
         # load data
         target_point = current_measurements['target_point']
@@ -195,8 +205,8 @@ class CarlaAlternativeCreator():
         brake = current_measurements['brake']
         
         route = current_measurements['route']
-        route_global = np.asarray([t_u.conversion_2d(rout, ego_position, -ego_yaw) for rout in route])
-        route_local = np.asarray([t_u.inverse_conversion_2d(rout, ego_position, ego_yaw) for rout in route_global])
+        route_global = conversion_2d_batch(route, ego_position, -ego_yaw)
+        route_local = inverse_conversion_2d_batch(route_global, ego_position, ego_yaw)
 
         route_adjusted = np.array(current_measurements['route'])
         route_adjusted = equal_spacing_route(route_adjusted)
@@ -218,57 +228,10 @@ class CarlaAlternativeCreator():
                 walker_close = True
                 break
 
-        ids_all = ids + ids_walkers
-
-
         # load data for future frames, if not available repeat the last available frame
         # this is not ideal but works for good enough
-        future_nearby_actors = []
-        future_nearby_walkers = []
-        future_nearby_actors_by_id = {id: [] for id in ids}
-        future_nearby_actors_used_time_stamps_by_id = {id: [] for id in ids}
-        future_nearby_walkers_by_id = {id: [] for id in ids_walkers}
-        future_nearby_walkers_used_time_stamps_by_id = {id: [] for id in ids_walkers}
-
-        for i, future in enumerate(future_boxes):
-            tmp_actors = []
-            tmp_walkers = []
-            for id in ids_all:
-                tmp_box = [box for box in future if 'id' in box and box['id'] == id]
-                if tmp_box:
-                    if tmp_box[0]['class'] == 'car':
-                        tmp_actors.append(tmp_box[0])
-                    elif tmp_box[0]['class'] == 'walker':
-                        tmp_walkers.append(tmp_box[0])
-                    else:
-                        raise ValueError('Unknown class')
-                else:
-                    if id in future_nearby_actors_by_id:
-                        # if actor is not present at a future frame, we assume reuse the last frame
-                        if len(future_nearby_actors_by_id[id]) > 0:
-                            tmp_actors.append(future_nearby_actors_by_id[id][-1])
-                            future_nearby_actors_used_time_stamps_by_id[id].append(future_nearby_actors_used_time_stamps_by_id[id][-1])
-                        else:
-                            tmp_actors.append(nearby_actors_by_id[id])
-                            future_nearby_actors_used_time_stamps_by_id[id].append(0)
-                    # following is commented out because we dont want to keep the old position of pedestrians in case they despawn!
-                    # elif id in future_nearby_walkers_by_id:
-                    #     if len(future_nearby_walkers_by_id[id]) > 0:
-                    #         tmp_walkers.append(future_nearby_walkers_by_id[id][-1])
-                    #     else:
-                    #         tmp_walkers.append(nearby_walkers_by_id[id])
-                if id in future_nearby_actors_by_id:
-                    future_nearby_actors_by_id[id].append(tmp_actors[-1])
-                    if tmp_box:
-                        future_nearby_actors_used_time_stamps_by_id[id].append(i)
-                elif id in future_nearby_walkers_by_id and len(tmp_walkers) > 0:
-                    future_nearby_walkers_by_id[id].append(tmp_walkers[-1])
-                    future_nearby_walkers_used_time_stamps_by_id[id].append(i)
-
-            if len(tmp_actors) > 0:
-                future_nearby_actors.append(tmp_actors)
-            if len(tmp_walkers) > 0:
-                future_nearby_walkers.append(tmp_walkers)
+        future_nearby_actors_by_id, future_nearby_actors_used_time_stamps_by_id, future_nearby_walkers_by_id, \
+            future_nearby_walkers_used_time_stamps_by_id = self.get_future_actors(ids, ids_walkers, nearby_actors_by_id, future_frames)
 
         ego_actor = [box for box in current_boxes if box['class'] == 'ego_car'][0]
         ego_info = [box for box in current_boxes if box['class'] == 'ego_info'][0]
@@ -308,7 +271,7 @@ class CarlaAlternativeCreator():
         forecast_ego_org, gt_speeds = self.forecast_vehicles(ego_actor, next_ego_by_id, ego_position=ego_position, ego_yaw=ego_yaw, route=route_global, use_wps_speed_controller=True, return_gt_speeds=True)
         # self.viz_forecastings_new(path_rgb_image, forecast_ego_org, bbs_ego)
 
-        forecast_ego_org_wps = [[f.location.x, f.location.y] for f in forecast_ego_org[0]]
+        forecast_ego_org_wps = forecast_ego_org[0].location[:, :2].tolist()
         forecasts_ego_adjusted = []
         forecasts_ego_adjusted_route = []
         forecasts_ego_adjusted_allowed = []
@@ -465,11 +428,9 @@ class CarlaAlternativeCreator():
                 for i, box in enumerate(actor):
                     if i < 2: # skip the first 2 frames as it is not enough reaction time for the ego vehicle
                         continue
-                    try:
-                        position = actor_future_bbs[i].location
-                    except:
+                    if i >= len(actor_future_bbs):
                         return
-                    position = np.array([position.x, position.y, position.z])
+                    position = actor_future_bbs.location[i].copy()
                     distance = np.linalg.norm(position[:2])
                     if position[0] > 3:
                         positions.append(position)
@@ -565,14 +526,14 @@ class CarlaAlternativeCreator():
             # make sure that point are one meter apart and remove duplicate points
             crash_route = equal_spacing_route(crash_route)
 
-            crash_route_global = np.array([t_u.conversion_2d(rout, ego_position, -ego_yaw) for rout in crash_route])
+            crash_route_global = conversion_2d_batch(crash_route, ego_position, -ego_yaw)
             crash_routes_global.append(crash_route_global)
         
         # get forecast for the crash routes
         for i, crash_route in enumerate(crash_routes_global):
             crash_bounding_boxes = self.forecast_vehicles(ego_actor, next_ego_by_id, ego_position=ego_position, ego_yaw=ego_yaw, route=crash_route, target_speed=crash_target_speeds[i])
             forecasts_ego_adjusted.append(crash_bounding_boxes)
-            crash_route_local = np.asarray([t_u.inverse_conversion_2d(rout, ego_position, ego_yaw) for rout in crash_route])
+            crash_route_local = inverse_conversion_2d_batch(crash_route, ego_position, ego_yaw)
             forecasts_ego_adjusted_route.append(np.round(crash_route_local, 2).tolist())
             forecasts_ego_adjusted_allowed.append(True)
             if 'mesh' in crash_type_str[i]:
@@ -676,8 +637,8 @@ class CarlaAlternativeCreator():
                     # breakpoint()
                     continue
                 
-                route_global_lc = np.asarray([t_u.conversion_2d(rout, ego_position, -ego_yaw) for rout in route_lc_shifted])
-                route_local_lc = np.asarray([t_u.inverse_conversion_2d(rout, ego_position, ego_yaw) for rout in route_global_lc])
+                route_global_lc = conversion_2d_batch(route_lc_shifted, ego_position, -ego_yaw)
+                route_local_lc = inverse_conversion_2d_batch(route_global_lc, ego_position, ego_yaw)
 
                 forecasts_ego_adjusted.append(self.forecast_vehicles(ego_actor, next_ego_by_id, ego_position=ego_position, ego_yaw=ego_yaw, route=route_global_lc))
                 forecasts_ego_adjusted_route.append(np.round(route_local_lc, 2).tolist())
@@ -701,29 +662,11 @@ class CarlaAlternativeCreator():
         # # Collision Checks
         # ############################################################
         # # check if new ego trajectories intersect with other actors
-        intersection_bb = []
-        intersection_timesteps = []
-        if bbs_other_actors is not None:
-            for j, ego_bounding_boxes_route_new_single in enumerate(forecasts_ego_adjusted):
-                if len(intersection_bb) < j+1:
-                    intersection_bb.append([])
-                    intersection_timesteps.append([])
-                for i, ego_bounding_box in enumerate(ego_bounding_boxes_route_new_single[0]):
-                    intersects_with_ego = False
-                    for vehicle_id, bounding_boxes in bbs_other_actors.items():
-                        if i >= len(bounding_boxes):
-                            continue
-                        ego_bounding_box.location.z = 0
-                        bounding_boxes[i].location.z = 0
-                        intersects_with_ego = self.check_obb_intersection(ego_bounding_box, bounding_boxes[i])
-                        if intersects_with_ego:
-                            intersection_bb[j].append(bounding_boxes[i])
-                            intersection_timesteps[j].append(i)
-                            intersects_with_ego = False
+        intersection_bb, intersection_timesteps = self.get_intersections(forecasts_ego_adjusted, bbs_other_actors)
 
         forecasts_ego_adjusted_wps = []
         for forecast_adjusted in forecasts_ego_adjusted:
-            forecasts_ego_adjusted_wps.append([[f.location.x, f.location.y] for f in forecast_adjusted[0]])
+            forecasts_ego_adjusted_wps.append(forecast_adjusted[0].location[:, :2].tolist())
         intersection_bb_bool = [len(intersection_bb[i])>0 for i in range(len(intersection_bb))]
         
         # add intersection to forecasts_ego_adjusted_info
@@ -787,26 +730,26 @@ class CarlaAlternativeCreator():
         idx = 0
         if forecasts_other_actors is not None:
             for actor_id, bounding_boxes in forecasts_other_actors.items():
-                for bounding_box in bounding_boxes:
-                    bounding_box.location.z = 0
+                for location, yaw, extent in bounding_boxes:
+                    location = np.array([location[0], location[1], 0.0])
                     color = (0, 0, 255-50*(idx))
-                    if bounding_box.location.x > 0:
-                        image_coords = project_center_corners(bounding_box, camera_intrinsics)
+                    if location[0] > 0:
+                        image_coords = project_center_corners({'position': location, 'extent': extent, 'yaw': yaw}, camera_intrinsics)
                     else:
                         image_coords = None
-                    self.draw_bounding_box_center_new(draw, draw_white, bounding_box, image_coords, color=color, pixels_per_meter=pixels_per_meter)
+                    self.draw_bounding_box_center_new(draw, draw_white, location, yaw, extent, image_coords, color=color, pixels_per_meter=pixels_per_meter)
                 idx += 1
         
         if bbs is not None:
             for actor_id, bounding_boxes in bbs.items():
-                for bounding_box in bounding_boxes:
-                    bounding_box.location.z = 0
+                for location, yaw, extent in bounding_boxes:
+                    location = np.array([location[0], location[1], 0.0])
                     color = (0, 255-50*(idx), 0)
-                    if bounding_box.location.x > 0:
-                        image_coords = project_center_corners(bounding_box, camera_intrinsics)
+                    if location[0] > 0:
+                        image_coords = project_center_corners({'position': location, 'extent': extent, 'yaw': yaw}, camera_intrinsics)
                     else:
                         image_coords = None
-                    self.draw_bounding_box_center_new(draw, draw_white, bounding_box, image_coords, color=color, pixels_per_meter=pixels_per_meter)
+                    self.draw_bounding_box_center_new(draw, draw_white, location, yaw, extent, image_coords, color=color, pixels_per_meter=pixels_per_meter)
                 idx += 1
 
 
@@ -866,20 +809,20 @@ class CarlaAlternativeCreator():
                 idx = 0
                 if forecasts_other_actors is not None:
                     for actor_id, bounding_boxes in forecasts_other_actors.items():
-                        for bounding_box in bounding_boxes:
+                        for location, yaw, extent in bounding_boxes:
                             color = (0, 0, 50*(idx+1))
-                            self.draw_bounding_box_center(draw, draw_white[viz_id], bounding_box, camera_intrinsics, color=color, pixels_per_meter=pixels_per_meter)
+                            self.draw_bounding_box_center(draw, draw_white[viz_id], location, yaw, extent, camera_intrinsics, color=color, pixels_per_meter=pixels_per_meter)
                         idx += 1
 
             if viz_id >= len(ego_bounding_boxes_news):
                 # Draw the predicted bounding boxes for the ego vehicle
                 if not viz_for_video or viz_only_expert:
 
-                    for bounding_box in ego_bounding_boxes[0]:
-                        self.draw_bounding_box_center(draw, draw_white[viz_id], bounding_box, camera_intrinsics, color=(0, 255, 0), pixels_per_meter=pixels_per_meter)
+                    for location, yaw, extent in ego_bounding_boxes[0]:
+                        self.draw_bounding_box_center(draw, draw_white[viz_id], location, yaw, extent, camera_intrinsics, color=(0, 255, 0), pixels_per_meter=pixels_per_meter)
 
                     # get speeds from bounding boxes
-                    ego_locs = np.array([[bb.location.x, bb.location.y] for bb in ego_bounding_boxes[0]])
+                    ego_locs = ego_bounding_boxes[0].location[:, :2]
                     ego_speeds = np.linalg.norm(ego_locs[1:] - ego_locs[:-1], axis=1) * self.dataset_frame_rate
                     # ego_speeds = np.append(ego_speeds, ego_speeds[-1])
                     ax.plot(ego_speeds, color='g', label='ego speed')
@@ -910,19 +853,19 @@ class CarlaAlternativeCreator():
                         color = (255, 0, 0)
 
                 if not viz_only_expert:
-                    for bounding_box in ego_bounding_boxes_news[viz_id][0]:
-                        self.draw_bounding_box_center(draw, draw_white[viz_id], bounding_box, camera_intrinsics, color=color, pixels_per_meter=pixels_per_meter)
+                    for location, yaw, extent in ego_bounding_boxes_news[viz_id][0]:
+                        self.draw_bounding_box_center(draw, draw_white[viz_id], location, yaw, extent, camera_intrinsics, color=color, pixels_per_meter=pixels_per_meter)
 
                 if not viz_for_video and not viz_only_expert:
                     if len(intersection_bb)>0 and intersection_bb[viz_id]:
-                        for bounding_box in intersection_bb[viz_id]:
-                            self.draw_bounding_box_center(draw, draw_white[viz_id], bounding_box, camera_intrinsics, color=(255, 0, 0), collide=True, pixels_per_meter=pixels_per_meter)
+                        for location, yaw, extent in intersection_bb[viz_id]:
+                            self.draw_bounding_box_center(draw, draw_white[viz_id], location, yaw, extent, camera_intrinsics, color=(255, 0, 0), collide=True, pixels_per_meter=pixels_per_meter)
 
                 # write the mode on top of the draw white
                 font = ImageFont.truetype("arial.ttf", 20)
                 draw_white[viz_id].text((10, 10), forecasts_ego_adjusted_mode[viz_id], font=font, fill=(0, 0, 0))
                 # get speeds from bounding boxes
-                ego_locs = np.array([[bb.location.x, bb.location.y] for bb in ego_bounding_boxes_news[viz_id][0]])
+                ego_locs = ego_bounding_boxes_news[viz_id][0].location[:, :2]
                 ego_speeds = np.linalg.norm(ego_locs[1:] - ego_locs[:-1], axis=1) * self.dataset_frame_rate
                 # ego_speeds = np.append(ego_speeds, ego_speeds[-1])
                 ax.plot(ego_speeds, color='g', label='ego speed')
@@ -987,23 +930,23 @@ class CarlaAlternativeCreator():
         full_img.save('forecasting.png')
         # white_img_concat.save('forecasting_white.png')
 
-    def draw_bounding_box_center_new(self, draw, draw_white, bounding_box, image_coords, color=(255, 0, 0), collide=False, pixels_per_meter=5.0):
+    def draw_bounding_box_center_new(self, draw, draw_white, location, yaw, extent, image_coords, color=(255, 0, 0), collide=False, pixels_per_meter=5.0):
         """
         Draw a bounding box on the image.
 
         Args:
             draw (PIL.ImageDraw): The drawing context.
-            bounding_box (carla.BoundingBox): The bounding box to draw.
+            location (np.ndarray): Center of the bounding box (x, y, z).
+            yaw (float): Yaw of the bounding box in degrees.
+            extent (np.ndarray): Half sizes of the bounding box (x, y, z).
             color (tuple): The color of the bounding box.
         """
         # Get the bounding box corners
-        center = bounding_box.location
-        center = [[center.x, center.y, center.z]]
+        center = [[location[0], location[1], location[2]]]
 
         pos = center
-        extent = bounding_box.extent
-        extent = [extent.x, extent.y, extent.z]
-        yaw = -bounding_box.rotation.yaw # + np.pi / 2
+        extent = [extent[0], extent[1], extent[2]]
+        yaw = -yaw # + np.pi / 2
         yaw = np.deg2rad(yaw)
             
         # get bbox corners coordinates
@@ -1031,25 +974,25 @@ class CarlaAlternativeCreator():
         
         return draw
 
-    def draw_bounding_box_center(self, draw, draw_white, bounding_box, camera_intrinsics, color=(255, 0, 0), collide=False, pixels_per_meter=5.0):
+    def draw_bounding_box_center(self, draw, draw_white, location, yaw, extent, camera_intrinsics, color=(255, 0, 0), collide=False, pixels_per_meter=5.0):
         """
         Draw a bounding box on the image.
 
         Args:
             draw (PIL.ImageDraw): The drawing context.
-            bounding_box (carla.BoundingBox): The bounding box to draw.
+            location (np.ndarray): Center of the bounding box (x, y, z).
+            yaw (float): Yaw of the bounding box in degrees.
+            extent (np.ndarray): Half sizes of the bounding box (x, y, z).
             color (tuple): The color of the bounding box.
         """
 
         # Get the bounding box corners
-        center = bounding_box.location
-        center = [[center.x, center.y, center.z]]
+        center = [[location[0], location[1], location[2]]]
 
 
         pos = center
-        extent = bounding_box.extent
-        extent = [extent.x, extent.y, extent.z]
-        yaw = -bounding_box.rotation.yaw # + np.pi / 2
+        extent = [extent[0], extent[1], extent[2]]
+        yaw = -yaw # + np.pi / 2
         yaw = np.deg2rad(yaw)
             
         # get bbox corners coordinates
@@ -1090,50 +1033,80 @@ class CarlaAlternativeCreator():
         
         return draw
     
+    def get_future_actors(self, ids, ids_walkers, nearby_actors_by_id, future_frames):
+        """
+        Boxes of the current vehicles and walkers in the future frames and the future frame each box is from.
+        A vehicle that is not present in a future frame keeps its last box, walkers are skipped.
+        """
+        future_nearby_actors_by_id = {id: [] for id in ids}
+        future_nearby_actors_used_time_stamps_by_id = {id: [] for id in ids}
+        future_nearby_walkers_by_id = {id: [] for id in ids_walkers}
+        future_nearby_walkers_used_time_stamps_by_id = {id: [] for id in ids_walkers}
+
+        for i, future_frame in enumerate(future_frames):
+            tmp_actors = []
+            tmp_walkers = []
+            for id in ids + ids_walkers:
+                tmp_box = future_frame['boxes_by_id'].get(id)
+                if tmp_box:
+                    if tmp_box['class'] == 'car':
+                        tmp_actors.append(tmp_box)
+                    elif tmp_box['class'] == 'walker':
+                        tmp_walkers.append(tmp_box)
+                    else:
+                        raise ValueError('Unknown class')
+                else:
+                    if id in future_nearby_actors_by_id:
+                        # if actor is not present at a future frame, we assume reuse the last frame
+                        if len(future_nearby_actors_by_id[id]) > 0:
+                            tmp_actors.append(future_nearby_actors_by_id[id][-1])
+                            future_nearby_actors_used_time_stamps_by_id[id].append(future_nearby_actors_used_time_stamps_by_id[id][-1])
+                        else:
+                            tmp_actors.append(nearby_actors_by_id[id])
+                            future_nearby_actors_used_time_stamps_by_id[id].append(0)
+                    # we dont want to keep the old position of pedestrians in case they despawn!
+                if id in future_nearby_actors_by_id:
+                    future_nearby_actors_by_id[id].append(tmp_actors[-1])
+                    if tmp_box:
+                        future_nearby_actors_used_time_stamps_by_id[id].append(i)
+                elif id in future_nearby_walkers_by_id and len(tmp_walkers) > 0:
+                    future_nearby_walkers_by_id[id].append(tmp_walkers[-1])
+                    future_nearby_walkers_used_time_stamps_by_id[id].append(i)
+
+        return future_nearby_actors_by_id, future_nearby_actors_used_time_stamps_by_id, future_nearby_walkers_by_id, \
+            future_nearby_walkers_used_time_stamps_by_id
+
     def get_bbs(self, actors, future_nearby_actors_by_id, future_nearby_actors_used_time_stamps_by_id, all_ego_positions, all_ego_yaws):
         if not actors:
             return  {}
         
+        all_ego_positions = np.asarray(all_ego_positions, dtype=np.float64)
+        all_ego_yaws = np.asarray(all_ego_yaws, dtype=np.float64)
         all_bbs_by_id = {}
         for actor in actors:
-            # if actor['class'] == 'ego_car':
-            #     ego_actor = actor
-            #     pass
-            # else:
-                future_actor = future_nearby_actors_by_id[actor['id']]
-                future_nearby_actors_used_time_stamps = [0] + [t+1 for t in future_nearby_actors_used_time_stamps_by_id[actor['id']]]
-                actor_all_times = [actor] + future_actor
-                all_positions = np.array([actor['position'] for actor in actor_all_times])
-                all_yaws = np.array([actor['yaw'] for actor in actor_all_times])
-                # convert all positions (current and future) (actor_all_times[i]['position']) first to global and then back to local of the current ego frame
-                all_positions_global = np.array([t_u.conversion_2d(pos[:2], all_ego_positions[future_nearby_actors_used_time_stamps[t]], -all_ego_yaws[future_nearby_actors_used_time_stamps[t]]) for t, pos in enumerate(all_positions)])
-                all_positions_local = np.array([t_u.inverse_conversion_2d(pos, all_ego_positions[0], all_ego_yaws[0]) for pos in all_positions_global])
-
-                all_yaws_global = np.array([yaw + all_ego_yaws[t] for t, yaw in enumerate(all_yaws)])
-                all_yaws_local = np.array([t_u.normalize_angle(yaw - all_ego_yaws[0]) for yaw in all_yaws_global])
-
-                # get the bounding box for each actor for each timestep
-                all_bbs = []
-                extent_add_safety = 0
-                if actor['class'] == 'walker':
-                    extent_add_safety = 0.5
-                
-                for t in range(len(actor_all_times)):
-                    location = carla.Location(
-                        x=all_positions_local[t][0],
-                        y=all_positions_local[t][1],
-                        z=all_positions[t][2]
-                    )
-                    rotation = carla.Rotation(
-                        pitch=0,
-                        yaw=np.rad2deg(all_yaws_local[t]),
-                        roll=0
-                    )
-                    extent = carla.Vector3D(x=actor_all_times[t]['extent'][0]+extent_add_safety, y=actor_all_times[t]['extent'][1]+extent_add_safety, z=actor_all_times[t]['extent'][2])
-                    bounding_box = carla.BoundingBox(location, extent)
-                    bounding_box.rotation = rotation
-                    all_bbs.append(bounding_box)
-                all_bbs_by_id[actor['id']] = all_bbs
+            future_actor = future_nearby_actors_by_id[actor['id']]
+            future_nearby_actors_used_time_stamps = np.array([0] + [t+1 for t in future_nearby_actors_used_time_stamps_by_id[actor['id']]])
+            actor_all_times = [actor] + future_actor
+            all_positions = np.array([actor['position'] for actor in actor_all_times])
+            all_yaws = np.array([actor['yaw'] for actor in actor_all_times])
+            # convert all positions (current and future) (actor_all_times[i]['position']) first to global and then back to local of the current ego frame
+            all_positions_global = conversion_2d_batch(all_positions[:, :2],
+                                                       all_ego_positions[future_nearby_actors_used_time_stamps],
+                                                       -all_ego_yaws[future_nearby_actors_used_time_stamps])
+            all_positions_local = inverse_conversion_2d_batch(all_positions_global, all_ego_positions[0], all_ego_yaws[0])
+
+            all_yaws_global = all_yaws + all_ego_yaws[:len(all_yaws)]
+            all_yaws_local = normalize_angles(all_yaws_global - all_ego_yaws[0])
+
+            # get the bounding box for each actor for each timestep
+            extent_add_safety = 0
+            if actor['class'] == 'walker':
+                extent_add_safety = 0.5
+            extents = np.array([actor['extent'] for actor in actor_all_times], dtype=np.float64)
+            extents[:, :2] += extent_add_safety
+
+            locations = np.concatenate((all_positions_local, all_positions[:, 2:3]), axis=1)
+            all_bbs_by_id[actor['id']] = OrientedBoxes(locations, np.rad2deg(all_yaws_local), extents)
 
         return all_bbs_by_id
 
@@ -1162,7 +1135,6 @@ class CarlaAlternativeCreator():
         actions_future = np.array([[actor["steer"], actor["throttle"], actor["brake"]] for actor in next_ego_actor])
         all_actions = np.concatenate([current_actions, actions_future])
         all_locations_global = np.concatenate([np.array([np.array(ego_actor["matrix"])[:3, 3]]), np.array([np.array(actor["matrix"])[:3, 3] for actor in next_ego_actor])])
-        all_locations_local = np.array([t_u.inverse_conversion_2d(pos[:2], ego_position, ego_yaw) for pos in all_locations_global])
         all_yaws = np.concatenate([np.array([ego_actor["yaw"]]), np.array([actor["yaw"] for actor in next_ego_actor])])
         all_speeds = np.concatenate([np.array([ego_actor["speed"]]), np.array([actor["speed"] for actor in next_ego_actor])])
 
@@ -1219,9 +1191,9 @@ class CarlaAlternativeCreator():
                     previous_actions[0] = steering
             
             if use_wps_speed_controller:
-                wps_global = interp_location_global[i:]
-                # wps = np.array([t_u.inverse_conversion_2d(wp[:2], ego_position, ego_yaw) for wp in wps_global])[::(self.carla_frame_rate//self.dataset_frame_rate)]
-                wps = np.array([t_u.inverse_conversion_2d(wp[:2], locations[:2], headings) for wp in wps_global])[::(self.carla_frame_rate//self.dataset_frame_rate)]
+                # only every 4th interpolated location is used, so only those are converted
+                wps_global = interp_location_global[i::(self.carla_frame_rate//self.dataset_frame_rate)]
+                wps = inverse_conversion_2d_batch(wps_global[:, :2], locations[:2], headings[0])
                 one_second = self.dataset_frame_rate
                 half_second = one_second // 2
                 one_half_second = one_second + half_second
@@ -1262,44 +1234,13 @@ class CarlaAlternativeCreator():
         future_headings = np.rad2deg(future_headings)
 
         # Convert global coordinates to egocentric coordinates
-        ego_position = np.array(ego_position)
-        ego_orientation = np.array(ego_yaw)
-        for time_step in range(future_locations.shape[0]):
-            target_point_2d = future_locations[time_step, :2]
-
-            ego_target_point = t_u.inverse_conversion_2d(target_point_2d, ego_position, ego_orientation).tolist()
-            future_locations[time_step, :2] = ego_target_point
-            future_headings[time_step] -= np.rad2deg(ego_yaw)
-
-
-            # Calculate the predicted bounding boxes for each future frame
-            predicted_actor_boxes = []
-            for i in range(self.num_future_frames_carla_fps):         
-                location = carla.Location(
-                    x=future_locations[i, 0].item(),
-                    y=future_locations[i, 1].item(),
-                    z=future_locations[i, 2].item()
-                )
-                rotation = carla.Rotation(
-                    pitch=0,
-                    yaw=future_headings[i],
-                    roll=0
-                )
-                extent = ego_actor["extent"]
-                extent = carla.Vector3D(x=extent[0], y=extent[1], z=extent[2])
-
-                # Create the bounding box for the future frame
-                bounding_box = carla.BoundingBox(location, extent)
-                bounding_box.rotation = rotation
-
-                # Append the bounding box to the list of predicted bounding boxes for this actor
-                predicted_actor_boxes.append(bounding_box)
-
-            # Store the predicted bounding boxes for this actor in the dictionary
-            # sample the bounding boxes every 4 frames
-            predicted_actor_boxes = predicted_actor_boxes[::(self.carla_frame_rate//self.dataset_frame_rate)]
-
-            predicted_bounding_boxes[ego_actor["id"]] = predicted_actor_boxes
+        future_locations[:, :2] = inverse_conversion_2d_batch(future_locations[:, :2], np.array(ego_position), np.array(ego_yaw))
+        future_headings -= np.rad2deg(ego_yaw)
+
+        # Calculate the predicted bounding boxes, sampled every 4 frames
+        sampling = self.carla_frame_rate // self.dataset_frame_rate
+        extents = np.repeat(np.array([ego_actor["extent"]], dtype=np.float64), self.num_future_frames_carla_fps, axis=0)
+        predicted_bounding_boxes[ego_actor["id"]] = OrientedBoxes(future_locations[::sampling], future_headings[::sampling], extents[::sampling])
         self._turn_controller.load_state()
 
         return_tuple = (predicted_bounding_boxes,)
@@ -1360,107 +1301,50 @@ class CarlaAlternativeCreator():
         
         return np.array(new_trajectory)
     
-    def _dot_product(self, vector1, vector2):
-        """
-        Calculate the dot product of two vectors.
-
-        Args:
-            vector1 (carla.Vector3D): The first vector.
-            vector2 (carla.Vector3D): The second vector.
-
-        Returns:
-            float: The dot product of the two vectors.
-        """
-        return vector1.x * vector2.x + vector1.y * vector2.y + vector1.z * vector2.z
-
-    def cross_product(self, vector1, vector2):
-        """
-        Calculate the cross product of two vectors.
-
-        Args:
-            vector1 (carla.Vector3D): The first vector.
-            vector2 (carla.Vector3D): The second vector.
-
-        Returns:
-            carla.Vector3D: The cross product of the two vectors.
+    def get_intersections(self, forecasts_ego, bbs_other_actors):
         """
-        x = vector1.y * vector2.z - vector1.z * vector2.y
-        y = vector1.z * vector2.x - vector1.x * vector2.z
-        z = vector1.x * vector2.y - vector1.y * vector2.x
-
-        return carla.Vector3D(x=x, y=y, z=z)
-
-    def get_separating_plane(self, relative_position, plane_normal, obb1, obb2):
-        """
-        Check if there is a separating plane between two oriented bounding boxes (OBBs).
+        Check if the ego forecasts intersect with the boxes of the other actors at the same time step.
 
         Args:
-            relative_position (carla.Vector3D): The relative position between the two OBBs.
-            plane_normal (carla.Vector3D): The normal vector of the plane.
-            obb1 (carla.BoundingBox): The first oriented bounding box.
-            obb2 (carla.BoundingBox): The second oriented bounding box.
+            forecasts_ego (list): Forecasts of forecast_vehicles, the ego boxes are under id 0.
+            bbs_other_actors (dict): Boxes (OrientedBoxes) of each other actor for the current and future frames.
 
         Returns:
-            bool: True if there is a separating plane, False otherwise.
-        """
-        # Calculate the projection of the relative position onto the plane normal
-        projection_distance = abs(self._dot_product(relative_position, plane_normal))
-
-        # Calculate the sum of the projections of the OBB extents onto the plane normal
-        obb1_projection = (
-            abs(self._dot_product(obb1.rotation.get_forward_vector() * obb1.extent.x, plane_normal)) +
-            abs(self._dot_product(obb1.rotation.get_right_vector() * obb1.extent.y, plane_normal)) +
-            abs(self._dot_product(obb1.rotation.get_up_vector() * obb1.extent.z, plane_normal))
-        )
-
-        obb2_projection = (
-            abs(self._dot_product(obb2.rotation.get_forward_vector() * obb2.extent.x, plane_normal)) +
-            abs(self._dot_product(obb2.rotation.get_right_vector() * obb2.extent.y, plane_normal)) +
-            abs(self._dot_product(obb2.rotation.get_up_vector() * obb2.extent.z, plane_normal))
-        )
-
-        # Check if the projection distance is greater than the sum of the OBB projections
-        return projection_distance > obb1_projection + obb2_projection
-
-    def check_obb_intersection(self, obb1, obb2):
+            tuple: For each forecast the intersecting boxes of the other actors (OrientedBoxes, ordered by time step
+                   and actor) and their time steps.
         """
-        Check if two 3D oriented bounding boxes (OBBs) intersect.
+        if not forecasts_ego:
+            return [], []
+
+        ego_boxes = [forecast[0] for forecast in forecasts_ego]
+        num_steps = len(ego_boxes[0])
+        ego_locations = np.stack([boxes.location for boxes in ego_boxes])[:, :, None]
+        ego_yaws = np.stack([boxes.yaw for boxes in ego_boxes])[:, :, None]
+        ego_extents = np.stack([boxes.extent for boxes in ego_boxes])[:, :, None]
+
+        # boxes of the other actors [steps, actors], actors with fewer boxes are padded and masked
+        num_actors = len(bbs_other_actors)
+        locations = np.zeros((num_steps, num_actors, 3))
+        yaws = np.zeros((num_steps, num_actors))
+        extents = np.zeros((num_steps, num_actors, 3))
+        valid = np.zeros((num_steps, num_actors), dtype=bool)
+        for j, bounding_boxes in enumerate(bbs_other_actors.values()):
+            num_valid = min(len(bounding_boxes), num_steps)
+            locations[:num_valid, j] = bounding_boxes.location[:num_valid]
+            yaws[:num_valid, j] = bounding_boxes.yaw[:num_valid]
+            extents[:num_valid, j] = bounding_boxes.extent[:num_valid]
+            valid[:num_valid, j] = True
+
+        intersections = check_obb_intersections(ego_locations, ego_yaws, ego_extents, locations, yaws, extents) & valid
 
-        Args:
-            obb1 (carla.BoundingBox): The first oriented bounding box.
-            obb2 (carla.BoundingBox): The second oriented bounding box.
-
-        Returns:
-            bool: True if the two OBBs intersect, False otherwise.
-        """
-        relative_position = obb2.location - obb1.location
-
-        # Check for separating planes along the axes of both OBBs
-        if (self.get_separating_plane(relative_position, obb1.rotation.get_forward_vector(), obb1, obb2) or
-            self.get_separating_plane(relative_position, obb1.rotation.get_right_vector(), obb1, obb2) or
-            self.get_separating_plane(relative_position, obb1.rotation.get_up_vector(), obb1, obb2) or
-            self.get_separating_plane(relative_position, obb2.rotation.get_forward_vector(), obb1, obb2) or
-            self.get_separating_plane(relative_position, obb2.rotation.get_right_vector(), obb1, obb2) or
-            self.get_separating_plane(relative_position, obb2.rotation.get_up_vector(), obb1, obb2)):
-            
-            return False
-
-        # Check for separating planes along the cross products of the axes of both OBBs
-        if (self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_forward_vector(), obb2.rotation.get_forward_vector()), obb1,obb2) or 
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_forward_vector(), obb2.rotation.get_right_vector()), obb1,obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_forward_vector(), obb2.rotation.get_up_vector()), obb1,obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_right_vector(), obb2.rotation.get_forward_vector()), obb1,obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_right_vector(), obb2.rotation.get_right_vector()), obb1, obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_right_vector(), obb2.rotation.get_up_vector()), obb1, obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_up_vector(), obb2.rotation.get_forward_vector()), obb1,obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_up_vector(), obb2.rotation.get_right_vector()), obb1,obb2) or
-            self.get_separating_plane(relative_position, self.cross_product(obb1.rotation.get_up_vector(),obb2.rotation.get_up_vector()), obb1, obb2)):
-            
-            return False
+        intersection_bb = []
+        intersection_timesteps = []
+        for intersection in intersections:
+            timesteps, actors = np.nonzero(intersection)
+            intersection_bb.append(OrientedBoxes(locations[timesteps, actors], yaws[timesteps, actors], extents[timesteps, actors]))
+            intersection_timesteps.append(timesteps.tolist())
+        return intersection_bb, intersection_timesteps
 
-        # If no separating plane is found, the OBBs intersect
-        return True
-    
     def get_min_max_pos_given_speed_and_deltaT(self, pos, speed, time_steps):
         """
         Get the minimum and maximum position given the speed and deltaT.
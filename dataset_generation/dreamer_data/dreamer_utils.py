@@ -13,4 +13,93 @@ def equal_spacing_route(points):
     x = np.arange(0, 20, 1)
     interp_points = np.array([np.interp(x, dists, route[:, 0]), np.interp(x, dists, route[:, 1])]).T
 
-    return interp_points
\ No newline at end of file
+    return interp_points
+
+def rotation_matrices_2d(yaws):
+    """
+    Rotation matrices [..., 2, 2] of yaws in radian, as in the conversions of transfuser_utils.
+    """
+    cos, sin = np.cos(yaws), np.sin(yaws)
+    return np.stack((np.stack((cos, -sin), axis=-1), np.stack((sin, cos), axis=-1)), axis=-2)
+
+
+def conversion_2d_batch(points, translation, yaw):
+    """
+    transfuser_utils.conversion_2d of points [N, 2], the translation and yaw are shared or given per point.
+    Stacked matrix products, so the results are identical to the conversion of single points. numpy computes the
+    products of contiguous and transposed matrices differently, the layouts are the ones of transfuser_utils.
+    """
+    inv_rotation_matrices = np.ascontiguousarray(np.swapaxes(rotation_matrices_2d(yaw), -1, -2))
+    return (inv_rotation_matrices @ np.asarray(points, dtype=np.float64)[..., None])[..., 0] + translation
+
+
+def inverse_conversion_2d_batch(points, translation, yaw):
+    """
+    transfuser_utils.inverse_conversion_2d of points [N, 2], the translation and yaw are shared or given per point.
+    """
+    rotation_matrices_t = np.swapaxes(rotation_matrices_2d(yaw), -1, -2)
+    return (rotation_matrices_t @ (np.asarray(points, dtype=np.float64) - translation)[..., None])[..., 0]
+
+
+def normalize_angles(x):
+    """
+    transfuser_utils.normalize_angle of an array, to [-pi, pi).
+    """
+    x = np.mod(x, 2 * np.pi)
+    return np.where(x > np.pi, x - 2 * np.pi, x)
+
+
+class OrientedBoxes():
+    """
+    Bounding boxes that are only rotated around the vertical axis, e.g. the time steps of one actor.
+    location [N, 3] in m, yaw [N] in degrees, extent [N, 3] half sizes in m.
+    The values are rounded to float32 like in the carla.BoundingBox they replace.
+    """
+
+    def __init__(self, location, yaw, extent):
+        self.location = np.asarray(location, dtype=np.float32).astype(np.float64).reshape(-1, 3)
+        self.yaw = np.asarray(yaw, dtype=np.float32).astype(np.float64).reshape(-1)
+        self.extent = np.asarray(extent, dtype=np.float32).astype(np.float64).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.yaw)
+
+    def __iter__(self):
+        return zip(self.location, self.yaw, self.extent)
+
+    def __getitem__(self, index):
+        return OrientedBoxes(self.location[index], self.yaw[index], self.extent[index])
+
+
+def box_axes(yaw):
+    """
+    Forward and right unit vectors [..., 2, 2] of boxes with yaw in degrees (carla.Rotation without pitch and roll).
+    """
+    yaw = np.radians(yaw)
+    cos, sin = np.cos(yaw), np.sin(yaw)
+    return np.stack((np.stack((cos, sin), axis=-1), np.stack((-sin, cos), axis=-1)), axis=-2)
+
+
+def check_obb_intersections(location1, yaw1, extent1, location2, yaw2, extent2):
+    """
+    Separating axis test of boxes on the ground (z = 0) that are only rotated around the vertical axis, broadcast over
+    the leading dimensions. location [..., 3], yaw [...] in degrees, extent [..., 3].
+    The vertical axis and the cross products of the 3D test can't separate such boxes (or are parallel to the forward
+    and right axes), so this is the same as the 3D check_obb_intersection of the carla.BoundingBox.
+    """
+    relative_position = (location2[..., :2] - location1[..., :2])[..., None, :]
+    axes1, axes2 = box_axes(yaw1), box_axes(yaw2)
+    axes1, axes2 = np.broadcast_arrays(axes1, axes2)
+    plane_normals = np.concatenate((axes1, axes2), axis=-2)
+
+    def projection(vector, plane_normals):
+        return np.abs(vector[..., 0] * plane_normals[..., 0] + vector[..., 1] * plane_normals[..., 1])
+
+    def obb_projection(axes, extent):
+        forward = axes[..., 0, :] * extent[..., 0, None]
+        right = axes[..., 1, :] * extent[..., 1, None]
+        return projection(forward[..., None, :], plane_normals) + projection(right[..., None, :], plane_normals)
+
+    projection_distance = projection(relative_position, plane_normals)
+    separated = projection_distance > obb_projection(axes1, extent1) + obb_projection(axes2, extent2)
+    return ~np.any(separated, axis=-1)
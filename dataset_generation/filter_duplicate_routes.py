@@ -1,189 +1,211 @@
-import matplotlib.pyplot as plt
-import numpy as np
-import xml.etree.ElementTree as ET
-import carla
+"""
+This scipt is used to filter duplicate routes from our dataset
+such that all routes have their start and end points at least min_dist meters apart.
+The routes are kept greedily in the order they are read, a route is a duplicate of a kept route if its
+first and its last waypoint are both closer than min_dist, the town is not compared. Kept routes are stored in a
+spatial hash of their first waypoint with cell size min_dist, so a route is only compared with the kept routes of
+the neighbouring cells instead of all of them. With --frechet_dist a duplicate additionally has to follow the same path, measured by the
+discrete Frechet distance of the waypoint polylines resampled to --num_points points.
+
+Every sub folder of main_dir is filtered independently, the folders are processed in parallel.
+CARLA is only needed for --plot, which draws the routes traced by the GlobalRoutePlanner on the map.
+To start CARLA, cd $CARLA_ROOT and use ./CarlaUE4.sh --world-port=2500 -RenderOffScreen -nosound
+Use the garage environment to execute the script.
+
+Example:
+python dataset_generation/filter_duplicate_routes.py --main_dir data/longxall_val/routes_validation --destination data/benchmarks/longxall_train_filtered --num_workers 8
+"""
+import argparse
+import glob
+import multiprocessing
 import os
 import shutil
-import glob
-import pathlib
-from agents.navigation.global_route_planner import GlobalRoutePlanner
-import argparse
-import time
+import xml.etree.ElementTree as ET
+from functools import partial
 from pathlib import Path
-from IPython.display import display, clear_output
-import tqdm
 
-#
-# This scipt is used to filter duplicate routes from our dataset
-# such that all routes have their start and end points at least min_dist meters apart
-# You need to have CARLA running on the port given below.
-# To start CARLA, cd $CARLA_ROOT and use ./CarlaUE4.sh --world-port=4542 -RenderOffScreen -nosound
-# Use the garage environment to execute the script.
-#
-
-TOWN = 'Town13'
-MAIN_DIR = 'data/longxall_val/routes_validation'   # without trailing slash
-MAIN_DESTINATION = 'data/benchmarks/longxall_train_filtered'
-Path(MAIN_DESTINATION).mkdir(parents=True, exist_ok=True)
-min_dist = 0.2
-
-client=carla.Client('localhost', 2500)
-client.set_timeout(240)
-world = client.load_world(TOWN)
-
-carla_map = world.get_map()
-grp_1 = GlobalRoutePlanner(carla_map, 1.0)
-print('loaded.')
+import numpy as np
+import tqdm
 
-# **Classes that are handy later**
+# the vectorized distances can differ from np.linalg.norm of a single pair in the last bit,
+# pairs within this margin of min_dist are decided with np.linalg.norm like before
+DISTANCE_MARGIN = 1e-9
 
 
 class Route():
-    weather_params = ["route_percentage", "cloudiness", "precipitation", "precipitation_deposits", "wetness", "wind_intensity", "sun_azimuth_angle", "sun_altitude_angle", "fog_density"]
-    weather_values_begin = [0, 5.0, 0.0, 0.0, 0.0, 10.0, -1.0, 45.0, 2.0]
-    weather_values_end = [100, 5.0, 0.0, 0.0, 0.0, 10.0, -1.0, 45.0, 2.0]
-    
-    def __init__(self, route_tree):
-        self.parse_route_tree(route_tree)
-        self.create_trace()
-        self.sort_scenarios_in()
-        
-    def parse_route_tree(self, route_tree):
+
+    def __init__(self, route_tree, route_idx):
+        self.route_idx = route_idx
         self.route_town = route_tree.attrib['town']
+        self.route_tree = route_tree
+
         self.waypoints = []
-        
         for waypoint in route_tree.find('waypoints').iter('position'):
             loc = [waypoint.attrib['x'], waypoint.attrib['y'], waypoint.attrib['z']]
             self.waypoints.append(loc)
-            
         self.waypoints = np.array(self.waypoints).astype('float')
 
-        self.scenarios = []
-        self.scenario_locations = []
-        for scenario in route_tree.find('scenarios').iter('scenario'):
-            p = scenario.find('trigger_point')
-            loc = [p.attrib['x'], p.attrib['y'], p.attrib['z']]
-            
-            self.scenario_locations.append(loc)
-            self.scenarios.append(scenario)   
-            
-        self.scenario_locations = np.array(self.scenario_locations).astype('float')
-        
-    def create_trace(self):
-        self.trace = []
-        self.trace_type = []
-        self.trace_elem = []
-        
-        for i in range(len(self.waypoints)-1):
-            p = self.waypoints[i]
-            p_next = self.waypoints[i+1]
-            
-            waypoint = carla.Location(x=p[0], y=p[1], z=p[2])
-            waypoint_next = carla.Location(x=p_next[0], y=p_next[1], z=p_next[2])
-            interpolated_trace = grp_1.trace_route(waypoint, waypoint_next)
-
-            interpolated_trace = [x[0].transform.location for x in interpolated_trace]
-            interpolated_trace = [[x.x, x.y, x.z] for x in interpolated_trace]
-            
-            self.trace += [p] + interpolated_trace
-            self.trace_type += ['waypoint'] + ['trace'] * len(interpolated_trace)
-            self.trace_elem += [None] + [None] * len(interpolated_trace)
-            
-        self.trace.append(p_next)
-        self.trace_type.append('waypoint')
-        self.trace_elem.append(None)
-        
-        self.trace = np.array(self.trace)
-        self.trace_type = np.array(self.trace_type)
-        
-    def sort_scenarios_in(self):
-        for scenario, scenario_location in zip(self.scenarios, self.scenario_locations):
-            diff = self.trace - scenario_location[None]
-            diff = np.linalg.norm(diff, axis=1)
-            diff[self.trace_type == 'waypoint'] = 1e9
-            min_idx = np.argmin(diff)
-
-            self.trace = np.concatenate([self.trace[:min_idx], [scenario_location], self.trace[min_idx:]])
-            self.trace_type = np.concatenate([self.trace_type[:min_idx], ['scenario'], self.trace_type[min_idx:]])
-            self.trace_elem = self.trace_elem[:min_idx] + [scenario] + self.trace_elem[min_idx:]
-
-# generate map backgroudn waypoints
-waypoint_list = carla_map.generate_waypoints(5.0)
-waypoint_list = [x.transform.location for x in waypoint_list]
-waypoint_list = [[x.x, x.y, x.z] for x in waypoint_list]
-waypoint_list = np.array(waypoint_list)
-
-dirs = glob.glob(MAIN_DIR + '/*/')
-for DIR in  dirs:
-    if "allroutes" in DIR:
-        continue
-    destination = MAIN_DESTINATION + '/' + DIR.split("/")[-2]
-    Path(destination).mkdir(parents=True, exist_ok=True)
 
-    l_routes = []
-    l_routes_idx = []
+def load_routes(route_dir):
+    """Routes of all xml files in route_dir, in the order of the previous script."""
+    routes = []
+    for pth in glob.glob(f'{route_dir}/**/*.xml', recursive=True):
+        tree = ET.parse(pth)
+        for route_tree in tree.iter("route"):
+            routes.append(Route(route_tree, pth.split('/')[-1].split('.')[0]))
+    return routes
+
+
+def resample_polyline(points, num_points):
+    """num_points points with equal arc length spacing along the polyline."""
+    segment_lengths = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    arc_length = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+    if arc_length[-1] == 0.0:
+        return np.repeat(points[:1], num_points, axis=0)
+    samples = np.linspace(0.0, arc_length[-1], num_points)
+    return np.stack([np.interp(samples, arc_length, points[:, axis]) for axis in range(points.shape[1])], axis=1)
+
+
+def discrete_frechet(polyline, candidates):
+    """Discrete Frechet distance of polyline [N, 3] to every candidate polyline [C, M, 3], returns [C]."""
+    distances = np.linalg.norm(candidates[:, None] - polyline[None, :, None], axis=3)  # [C, N, M]
+    num_rows, num_cols = distances.shape[1:]
+    # the coupling of a cell only depends on the two previous anti-diagonals, so every anti-diagonal is one step
+    coupling = np.full((distances.shape[0], num_rows + 1, num_cols + 1), np.inf)
+    coupling[:, 0, 0] = 0.0
+    for diagonal in range(num_rows + num_cols - 1):
+        rows = np.arange(max(0, diagonal - num_cols + 1), min(num_rows, diagonal + 1))
+        cols = diagonal - rows
+        best = np.minimum(np.minimum(coupling[:, rows, cols + 1], coupling[:, rows, cols]), coupling[:, rows + 1, cols])
+        coupling[:, rows + 1, cols + 1] = np.maximum(best, distances[:, rows, cols])
+    return coupling[:, -1, -1]
+
+
+def close(points, point, min_dist):
+    """Mask of the points [C, 3] that are closer than min_dist to point."""
+    distances = np.linalg.norm(points - point[None], axis=1)
+    result = distances < min_dist - DISTANCE_MARGIN
+    for i in np.flatnonzero(np.abs(distances - min_dist) <= DISTANCE_MARGIN):
+        result[i] = np.linalg.norm(points[i] - point) < min_dist
+    return result
+
+
+def filter_routes(routes, min_dist, frechet_dist=None, num_points=32):
+    """Indices of the routes that are kept."""
+    if min_dist <= 0:
+        return list(range(len(routes)))
+
+    starts = np.array([route.waypoints[0] for route in routes]).reshape(-1, 3)
+    ends = np.array([route.waypoints[-1] for route in routes]).reshape(-1, 3)
+    cells = np.floor(starts / min_dist).astype(np.int64)
+    offsets = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+    grid = {}
+    polylines = {}
+
+    kept = []
+    for i, route in enumerate(routes):
+        cell = cells[i]
+        candidates = []
+        for dx, dy, dz in offsets:
+            candidates.extend(grid.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), []))
+
+        duplicate = False
+        if candidates:
+            candidates = np.array(candidates)
+            candidates = candidates[close(starts[candidates], starts[i], min_dist)]
+            candidates = candidates[close(ends[candidates], ends[i], min_dist)]
+            if len(candidates) > 0 and frechet_dist is not None:
+                # resampled only for the routes that have candidates
+                for j in [i] + candidates.tolist():
+                    if j not in polylines:
+                        polylines[j] = resample_polyline(routes[j].waypoints, num_points)
+                candidate_polylines = np.stack([polylines[candidate] for candidate in candidates])
+                candidates = candidates[discrete_frechet(polylines[i], candidate_polylines) < frechet_dist]
+            duplicate = len(candidates) > 0
+        if duplicate:
+            continue
 
-    all_xml_paths = glob.glob(f'{DIR}/**/*.xml', recursive=True)
+        kept.append(i)
+        grid.setdefault((cell[0], cell[1], cell[2]), []).append(i)
+    return kept
 
-    for pth in tqdm.tqdm(all_xml_paths):
-        tree = ET.parse(pth)
 
-        for i, route_tree in enumerate(tree.iter("route")):
-            l_routes.append(Route(route_tree))
-            l_routes_idx.append(pth.split('/')[-1].split('.')[0])
+def plot_routes(routes, save_file, port):
+    """Map with the kept routes, their traces and scenarios, needs CARLA."""
+    import carla  # pylint: disable=import-outside-toplevel
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+    from agents.navigation.global_route_planner import GlobalRoutePlanner  # pylint: disable=import-outside-toplevel
+
+    client = carla.Client('localhost', port)
+    client.set_timeout(240)
+    world = client.get_world()
+    if routes and routes[0].route_town not in world.get_map().name:
+        world = client.load_world(routes[0].route_town)
+    carla_map = world.get_map()
+    grp_1 = GlobalRoutePlanner(carla_map, 1.0)
+
+    # generate map background waypoints
+    waypoint_list = carla_map.generate_waypoints(5.0)
+    waypoint_list = np.array([[x.transform.location.x, x.transform.location.y, x.transform.location.z] for x in waypoint_list])
 
-    # plot map
     fig, ax = plt.subplots(figsize=(15, 15))
     ax.scatter(waypoint_list[:, 0], waypoint_list[:, 1], c='lightgray', s=1)
+    for route in routes:
+        trace = []
+        for p, p_next in zip(route.waypoints[:-1], route.waypoints[1:]):
+            interpolated_trace = grp_1.trace_route(carla.Location(x=p[0], y=p[1], z=p[2]),
+                                                   carla.Location(x=p_next[0], y=p_next[1], z=p_next[2]))
+            trace += [[x[0].transform.location.x, x[0].transform.location.y] for x in interpolated_trace]
+        trace = np.array(trace).reshape(-1, 2)
+        scenario_locations = np.array([[float(scenario.find('trigger_point').attrib[axis]) for axis in ('x', 'y')]
+                                       for scenario in route.route_tree.find('scenarios').iter('scenario')]).reshape(-1, 2)
 
-    saved_wps = []
-    saved_wps_idx = []
+        ax.scatter(trace[:, 0], trace[:, 1], c='black', s=1)
+        ax.scatter(scenario_locations[:, 0], scenario_locations[:, 1], c='orange', s=20)
+        ax.scatter(route.waypoints[:, 0], route.waypoints[:, 1], c='green', s=40, marker='x')
+        ax.annotate(str(route.route_idx), (route.waypoints[0, 0] + 40, route.waypoints[0, 1] + 40))
+    plt.savefig(save_file)
+    plt.close(fig)
 
-    for i, route in tqdm.tqdm(enumerate(l_routes)):
-        trace = route.trace[route.trace_type == 'trace']
-        scenario = route.trace[route.trace_type == 'scenario']
-        waypoint = route.trace[route.trace_type == 'waypoint']
 
-        # check if route at similar location already exists
-        # check 1. wp with 1. wp, last wp with last wp, 1. wp with last wp, last wp with 1. wp
-        duplicate = False
-        for saved_route in saved_wps:
-            if np.linalg.norm(saved_route[0] - waypoint[0]) < min_dist and np.linalg.norm(saved_route[-1] - waypoint[-1]) < min_dist:
-                duplicate = True
-                break
-            #elif np.linalg.norm(saved_route[-1] - waypoint[-1]) < min_dist:
-            #    duplicate = True
-            #    break
-            # elif np.linalg.norm(saved_route[0] - waypoint[-1]) < min_dist:
-            #     duplicate = True
-            #     break
-            # elif np.linalg.norm(saved_route[-1] - waypoint[0]) < min_dist:
-            #     duplicate = True
-            #     break
-        if duplicate:
-            continue
-        saved_wps.append(waypoint)
-        saved_wps_idx.append(l_routes_idx[i])
-        # ax.cla()
-        ax.scatter(trace[:, 0], trace[:, 1], c='black', s=1)
-        ax.scatter(scenario[:, 0], scenario[:, 1], c='orange', s=20)
-        ax.scatter(waypoint[:, 0], waypoint[:, 1], c='green', s=40, marker='x')
-        ax.annotate(str(l_routes_idx[i]), (waypoint[0, 0]+40, waypoint[0, 1]+40))
-        
-        #display(fig)    
-        clear_output(wait = True)
-        # plt.pause(0.1)
-        # plt.waitforbuttonpress()
-    plt.savefig(f"{destination}/{DIR.split('/')[-2]}_{min_dist}.png")
-    #plt.waitforbuttonpress()   
-    #plt.show()
-
-    # copy routes to new folder
-    for routes in saved_wps_idx:
-        # shutil.copy(os.path.join(DIR, routes+'.xml'), os.path.join(destination, DIR.split('/')[-1]))
-        shutil.copy(os.path.join(DIR, routes+'.xml'), destination)
-
-    print(f"Number of selected routes: {len(saved_wps_idx)}")
-    print(f"Number of scenarios: {len(l_routes_idx)}")
-
-    plt.clf()
\ No newline at end of file
+def filter_directory(route_dir, main_destination, min_dist, frechet_dist, num_points):
+    """Filters one sub folder of main_dir and copies the kept route files, returns the kept routes."""
+    destination = main_destination + '/' + route_dir.split("/")[-2]
+    Path(destination).mkdir(parents=True, exist_ok=True)
+
+    routes = load_routes(route_dir)
+    kept_routes = [routes[i] for i in filter_routes(routes, min_dist, frechet_dist=frechet_dist, num_points=num_points)]
+
+    # copy routes to new folder, a file is copied once even if several of its routes are kept
+    for route_idx in dict.fromkeys(route.route_idx for route in kept_routes):
+        shutil.copy(os.path.join(route_dir, route_idx + '.xml'), destination)
+    return route_dir, destination, kept_routes, len(routes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--main_dir', type=str, default='data/longxall_val/routes_validation', help='Without trailing slash.')
+    parser.add_argument('--destination', type=str, default='data/benchmarks/longxall_train_filtered')
+    parser.add_argument('--min_dist', type=float, default=0.2)
+    parser.add_argument('--frechet_dist', type=float, default=None,
+                        help='Also require the paths of duplicates to be this close (discrete Frechet distance).')
+    parser.add_argument('--num_points', type=int, default=32, help='Resampled points per route for --frechet_dist.')
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--plot', action='store_true', default=False, help='Plot the kept routes, needs CARLA.')
+    parser.add_argument('--port', type=int, default=2500)
+    args = parser.parse_args()
+
+    dirs = [route_dir for route_dir in glob.glob(args.main_dir + '/*/') if "allroutes" not in route_dir]
+    process = partial(filter_directory, main_destination=args.destination, min_dist=args.min_dist,
+                      frechet_dist=args.frechet_dist, num_points=args.num_points)
+    with multiprocessing.Pool(processes=max(1, min(args.num_workers, len(dirs)))) as pool:
+        for route_dir, destination, kept_routes, num_routes in tqdm.tqdm(pool.imap(process, dirs), total=len(dirs)):
+            print(f"{route_dir}")
+            print(f"Number of selected routes: {len(kept_routes)}")
+            print(f"Number of scenarios: {num_routes}")
+            if args.plot:
+                plot_routes(kept_routes, f"{destination}/{route_dir.split('/')[-2]}_{args.min_dist}.png", args.port)
+
+
+if __name__ == '__main__':
+    main()
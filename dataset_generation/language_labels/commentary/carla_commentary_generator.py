@@ -68,7 +68,7 @@ class COMsGenerator():
         # all the paths to the boxes in the data
         # self.data_boxes_paths = glob.glob(os.path.join(self.data_directory, '**/boxes/*.json.gz'), recursive=True)
         # all the paths to the boxes in the data
-        self.data_boxes_paths_all = glob.glob(os.path.join(self.data_directory, 'data/simlingo/*/*/*/*/boxes/*.json.gz'))
+        self.data_boxes_paths_all = glob.glob(os.path.join(self.data_directory, args.boxes_glob))
         print(f"Number of boxes paths: {len(self.data_boxes_paths_all)}")
         # if self.skip_existing:
         #     self.data_boxes_paths = []
@@ -115,13 +115,11 @@ class COMsGenerator():
         self.list_next_junction_id_minus_one = []
 
         self.all_labels = []
-        self.stats = {
-            'total_frames': 0,
-            'frames_per_scenario': {},
-            'num_visible_objects': 0,
-            'num_not_visible_objects': 0
-        }
-        self.all_templates = []
+        self.reset_stats()
+
+        # measurements of the current route, every frame uses the measurements of its neighbouring frames
+        self.measurements_route_dir = None
+        self.measurements_cache = {}
 
         # Load keyframes list if sampling keyframes
         if self.sample_frame_mode == 'keyframes':
@@ -131,40 +129,71 @@ class COMsGenerator():
             self.keyframes_list = [x.strip() for x in self.keyframes_list]
             self.keyframes_list = [x.replace('rgb', 'boxes').replace('.jpg', '.json.gz') for x in self.keyframes_list]
 
-    def create_commentary(self, path_id):
+    def reset_stats(self):
+        self.stats = {
+            'total_frames': 0,
+            'frames_per_scenario': {},
+            'num_visible_objects': 0,
+            'num_not_visible_objects': 0
+        }
+        self.all_templates = []
+
+    def get_stats(self):
         """
-        Create all commentary in llava format, convert them to NuScenes afterwards and finally save them
+        Statistics of the frames processed since the last reset, can be merged with merge_stats (e.g. from workers).
+        """
+        return {'stats': self.stats, 'all_templates': self.all_templates}
+
+    def merge_stats(self, stats):
+        for key in ('total_frames', 'num_visible_objects', 'num_not_visible_objects'):
+            self.stats[key] += stats['stats'][key]
+        for scenario_name, num_frames in stats['stats']['frames_per_scenario'].items():
+            self.stats['frames_per_scenario'][scenario_name] = \
+                                            self.stats['frames_per_scenario'].get(scenario_name, 0) + num_frames
+        known_templates = set(self.all_templates)
+        for template in stats['all_templates']:
+            if template not in known_templates:
+                known_templates.add(template)
+                self.all_templates.append(template)
+
+    def output_path(self, path):
         """
+        Output file of the frame of a boxes file.
+        """
+        return (self.output_directory + "/" + path.split("/data/")[1]).replace('boxes', 'commentary')
 
+    def load_measurement(self, path_measurement):
+        """
+        Measurement file of the current route, each file is read once per route. None if it does not exist.
+        """
+        route_dir = os.path.dirname(os.path.dirname(path_measurement))
+        if route_dir != self.measurements_route_dir:
+            self.measurements_route_dir = route_dir
+            self.measurements_cache = {}
+        if path_measurement not in self.measurements_cache:
+            if os.path.exists(path_measurement):
+                with gzip.open(path_measurement, 'rb') as f:
+                    self.measurements_cache[path_measurement] = json.loads(f.read().decode('utf-8'))
+            else:
+                self.measurements_cache[path_measurement] = None
+        return self.measurements_cache[path_measurement]
 
-        # Process each frame
-        # for path in tqdm.tqdm(self.data_boxes_paths):
+    def create_commentary(self, path_id):
+        """
+        Create all commentary in llava format, convert them to NuScenes afterwards and finally save them
+        """
         path = self.data_boxes_paths[path_id]
+        if self.skip_existing and os.access(self.output_path(path), os.F_OK):
+            return
+        self.process_frame(path)
 
-        if self.skip_existing:
-            save_dir = (self.output_directory + "/" + path.split("/data/")[1]).replace('boxes', 'commentary')
-            if os.access(save_dir, os.F_OK):
-                return
-
+    def process_frame(self, path):
+        """
+        Create and save the commentary of the frame of a boxes file. Data that is the same for all frames of a route
+        (results, route numbers, route file, measurements) is cached.
+        """
         path_measurements = path.replace('boxes', 'measurements')
-        if 'lb1_split' in path_measurements:
-            # database/simlingo/data/simlingo/lb1_split/routes_training/ControlLoss/Town01_Rep0_Town01_Scenario1_0_route0_01_11_14_15_07/measurements/0000.json.gz
-            scenario_name = path_measurements.split('lb1_split/')[-1].split('/')[1]
-            if scenario_name == 'noScenarios':
-                scenario_name = None
-            route_file_number = re.search(rf'Rep*(\d+)_Town[\d\w]*_[\d\w]*_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_Town[\d\w]*_[\d\w]*_*(\d+)_route_*(\d+)', path_measurements).group(3)
-        elif 'parking_lane' in path_measurements:
-            scenario_name = None
-            route_file_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(3)
-        else:
-            scenario_name = get_scenario_name(path_measurements)
-            route_file_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(3)
-
-        route_folder = path_measurements.split('simlingo/')[-1].split('/Town')[0].split('/')
-        route_folder = '_'.join(route_folder)
+        route_dir = '/'.join(path.split('/')[:-2])
 
         # Skip frames if RGB image does not exist
         if not os.path.isfile(path.replace('boxes', 'rgb').replace('.json.gz', '.jpg')):
@@ -188,44 +217,35 @@ class COMsGenerator():
         # Check if files exist
         if not os.path.exists(path):
             return
-        if not os.path.exists(path_measurements):
+        current_measurements = self.load_measurement(path_measurements)
+        if current_measurements is None:
             return
 
-        # Read results file
+        # Skip data where the expert did not achieve perfect driving score, read once per route
         if self.filter_routes_by_result:
             results_file = path.split('boxes')[0] + 'results.json.gz'
-
-            try:
-                with gzip.open(results_file, 'rb') as f:
-                    route_results = json.loads(f.read().decode('utf-8'))
-            except:
-                print(f"Error reading {results_file}")
+            if not expert_route_passed(load_route_results(results_file)):
                 return
 
-            other_infractions_than_min_speed_infractions_exist = False
-            for key in route_results['infractions'].keys():
-                if len(route_results['infractions'][key]) > 0 and key != 'min_speed_infractions':
-                    other_infractions_than_min_speed_infractions_exist = True
-                    break
+        if 'lb1_split' in path_measurements:
+            # database/simlingo/data/simlingo/lb1_split/routes_training/ControlLoss/Town01_Rep0_Town01_Scenario1_0_route0_01_11_14_15_07/measurements/0000.json.gz
+            scenario_name = path_measurements.split('lb1_split/')[-1].split('/')[1]
+            if scenario_name == 'noScenarios':
+                scenario_name = None
+        elif 'parking_lane' in path_measurements:
+            scenario_name = None
+        else:
+            scenario_name = get_scenario_name(path_measurements, current_measurements)
+        route_file_number, route_number = get_route_numbers(route_dir)
 
-            # Skip data where the expert did not achieve perfect driving score
-            if other_infractions_than_min_speed_infractions_exist and \
-                        (route_results['scores']['score_composed'] < 98.0 or
-                        route_results['scores']['score_route'] < 98.0):
-                return
-            elif not other_infractions_than_min_speed_infractions_exist and \
-                                (route_results['scores']['score_route'] < 98.0):
-                return
+        route_folder = path_measurements.split('simlingo/')[-1].split('/Town')[0].split('/')
+        route_folder = '_'.join(route_folder)
 
-        # Read data and measurements files
+        # Read data file
         with gzip.open(path, 'rb') as f:
             file_content = f.read()
             current_boxes = json.loads(file_content.decode('utf-8'))
 
-        with gzip.open(path_measurements, 'rb') as f:
-            file_content = f.read()
-            current_measurements = json.loads(file_content.decode('utf-8'))
-
         # load self.HISTORY_LEN frames of measurements
         last_measurement_paths = [path_measurements]
         last_measurements = [current_measurements]
@@ -235,9 +255,10 @@ class COMsGenerator():
             frame_number_org_str = str(frame_number).zfill(4)
             last_measurement_paths.append(path_measurements.replace(f'{frame_number_org_str}.json', f'{frame_number_minus_i}.json'))
 
-            with gzip.open(last_measurement_paths[-1], 'rb') as f:
-                file_content = f.read()
-                last_measurements.append(json.loads(file_content.decode('utf-8')))
+            last_measurement = self.load_measurement(last_measurement_paths[-1])
+            if last_measurement is None:
+                raise FileNotFoundError(last_measurement_paths[-1])
+            last_measurements.append(last_measurement)
 
         last_measurements_oldest_first = last_measurements[::-1]
 
@@ -249,12 +270,11 @@ class COMsGenerator():
             frame_number_org_str = str(frame_number).zfill(4)
             future_measurement_paths.append(path_measurements.replace(f'{frame_number_org_str}.json', f'{frame_number_plus_i}.json'))
 
-            if not os.path.exists(future_measurement_paths[-1]):
+            future_measurement = self.load_measurement(future_measurement_paths[-1])
+            if future_measurement is None:
                 skip = True
                 break
-            with gzip.open(future_measurement_paths[-1], 'rb') as f:
-                file_content = f.read()
-                future_measurements.append(json.loads(file_content.decode('utf-8')))
+            future_measurements.append(future_measurement)
         if skip:
             return
 
@@ -373,13 +393,11 @@ class COMsGenerator():
         commentary_data['placeholder'] = placeholder
 
         # easier to debug:
-        save_dir = (self.output_directory + "/" + path.split("/data/")[1]).replace('boxes', 'commentary')
+        save_dir = self.output_path(path)
         # final version
         # save_dir = path.replace('/rgb/', '/commentary/').replace('.jpg', '.json')
         Path(save_dir).parent.mkdir(exist_ok=True, parents=True)
-        # json.gz
-        with gzip.open(save_dir, 'wt', encoding='utf-8') as f:
-            json.dump(commentary_data, f, indent=4)
+        save_json_gz(save_dir, commentary_data)
 
         # with open(save_dir, 'w', encoding='utf-8') as f:
             # json.dump(commentary_data, f, indent=4)
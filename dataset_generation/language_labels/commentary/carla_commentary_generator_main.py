@@ -1,11 +1,11 @@
 import argparse
 from carla_commentary_generator import COMsGenerator
+from dataset_generation.language_labels.generator_driver import run_generator
 import string
 import random
 import pathlib
 import json
 import os
-from tqdm import tqdm
 
 RANDOM_SEED = 42
 random.seed(RANDOM_SEED)
@@ -25,6 +25,8 @@ def parse_arguments():
                             help='Output directory for the vqa-graph')
     path_group.add_argument('--output-examples-directory', type=str, default='database/simlingo/commentary',
                             help='Output directory for examples of the vqa-graph')
+    path_group.add_argument('--boxes-glob', type=str, default='data/simlingo/*/*/*/*/boxes/*.json.gz',
+                            help='Glob of the boxes files of all frames, relative to the data directory')
 
     # Image and camera parameters
     img_group = parser.add_argument_group('Image and Camera Parameters')
@@ -62,6 +64,11 @@ def parse_arguments():
     viz_group.add_argument('--skip-existing', action='store_true', default=True,
                            help='Skip existing files when saving examples')
 
+    # Parallelization
+    parallel_group = parser.add_argument_group('Parallelization')
+    parallel_group.add_argument('--num-workers', type=int, default=64,
+                                help='Processes that the routes are distributed to (1 runs in this process)')
+
     args = parser.parse_args()
 
     # Compute derived parameters
@@ -75,15 +82,7 @@ def parse_arguments():
 
 if __name__ == '__main__':
     args = parse_arguments()
-    multi_processing = True
 
     com_generator = COMsGenerator(args)
-    len_data_boxes = len(com_generator.data_boxes_paths)
-    if multi_processing:
-        from tqdm.contrib.concurrent import process_map
-        r = process_map(com_generator.create_commentary, range(0, len_data_boxes), max_workers=64, chunksize=10000)
-    else:
-        for i in tqdm(range(len_data_boxes)):
-            com_generator.create_commentary(i)
-
-    com_generator.save_stats()
\ No newline at end of file
+    # grouped by route, the statistics of the workers are merged before saving them
+    run_generator(com_generator, num_workers=args.num_workers, skip_existing=args.skip_existing)
\ No newline at end of file
@@ -13,7 +13,6 @@ from collections import Counter
 import carla
 import string
 import pathlib
-import re
 
 
 from dataset_generation.language_labels.utils import *
@@ -63,7 +62,7 @@ class QAsGenerator():
         Path(self.output_directory).mkdir(parents=True, exist_ok=True)
 
         # all the paths to the boxes in the data
-        self.data_boxes_paths_all = glob.glob(os.path.join(self.data_directory, 'data/simlingo/*/*/*/*/boxes/*.json.gz'))[:30]
+        self.data_boxes_paths_all = glob.glob(os.path.join(self.data_directory, args.boxes_glob))
         print(f"Number of boxes paths: {len(self.data_boxes_paths_all)}")
 
         self.data_boxes_paths = self.data_boxes_paths_all
@@ -107,42 +106,57 @@ class QAsGenerator():
         self.frame_num = 0
         self.skipped_frames = 0
 
+    def reset_stats(self):
+        self.reset_qa_stats()
+
+    def get_stats(self):
+        """
+        Statistics of the frames processed since the last reset, can be merged with merge_stats (e.g. from workers).
+        """
+        return {
+            'frame_num': self.frame_num,
+            'skipped_frames': self.skipped_frames,
+            'min_num_questions': self.min_num_questions,
+            'total_num_questions': self.total_num_questions,
+            'total_num_objects': self.total_num_objects,
+            'num_questions_per_category': dict(self.num_questions_per_category),
+            'stats_p3': dict(self.stats_p3),
+        }
+
+    def merge_stats(self, stats):
+        self.frame_num += stats['frame_num']
+        self.skipped_frames += stats['skipped_frames']
+        self.min_num_questions = min(self.min_num_questions, stats['min_num_questions'])
+        self.total_num_questions += stats['total_num_questions']
+        self.total_num_objects += stats['total_num_objects']
+        for key, value in stats['num_questions_per_category'].items():
+            self.num_questions_per_category[key] += value
+        for key, value in stats['stats_p3'].items():
+            self.stats_p3[key] += value
+
+    def output_path(self, path):
+        """
+        Output file of the frame of a boxes file.
+        """
+        return (self.output_directory + "/" + path.split("/data/")[1]).replace('boxes', 'vqa')
+
     def create_qa_pairs(self, path_id):
         """
         Create all question answer pairs in llava format, convert them to NuScenes afterwards and finally save them
         """
-        # Process each frame
-        # for path in tqdm.tqdm(self.data_boxes_paths):
         path = self.data_boxes_paths[path_id]
+        if self.skip_existing and os.access(self.output_path(path), os.F_OK):
+            return
+        self.process_frame(path)
+
+    def process_frame(self, path):
+        """
+        Create and save the question answer pairs of the frame of a boxes file. Data that is the same for all frames of
+        a route (results, route numbers, route file) is cached.
+        """
         path_measurements = path.replace('boxes', 'measurements')
         route_dir = '/'.join(path.split('/')[:-2])
 
-        if self.skip_existing:
-            save_dir = (self.output_directory + "/" + path.split("/data/")[1]).replace('boxes', 'vqa')
-            if os.access(save_dir, os.F_OK):
-                return
-
-        if 'lb1_split' in path_measurements:
-            scenario_name = path_measurements.split('lb1_split/')[-1].split('/')[1]
-            route_file_number = re.search(rf'Rep*(\d+)_Town[\d\w]*_[\d\w]*_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_Town[\d\w]*_[\d\w]*_*(\d+)_route_*(\d+)', path_measurements).group(3)
-        elif 'parking_lane' in path_measurements:
-            scenario_name = 'noScenario'
-            route_file_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(3)
-        else:
-            try:
-                scenario_name = get_scenario_name(path_measurements)
-            except Exception as e:
-                print(f"Error in {path_measurements}: {e}")
-                return
-            route_file_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(2)
-            route_number = re.search(rf'Rep*(\d+)_*(\d+)_route_*(\d+)', path_measurements).group(3)
-
-        route_folder = path_measurements.split('simlingo/')[-1].split('/Town')[0].split('/')
-        route_folder = '_'.join(route_folder)
-
-
         # Skip this scenario because it is not annotated correctly
         if 'InterurbanAdvancedActorFlow' in route_dir:
             return
@@ -191,41 +205,36 @@ class QAsGenerator():
         if not os.path.exists(path_measurements):
             return
 
-        # Read results file
+        # Skip data where the expert did not achieve perfect driving score, read once per route
         if self.filter_routes_by_result:
             results_file = path.split('boxes')[0] + 'results.json.gz'
-
-            try:
-                with gzip.open(results_file, 'rb') as f:
-                    route_results = json.loads(f.read().decode('utf-8'))
-            except:
-                print(f"Error reading {results_file}")
+            if not expert_route_passed(load_route_results(results_file)):
                 return
 
-            other_infractions_than_min_speed_infractions_exist = False
-            for key in route_results['infractions'].keys():
-                if len(route_results['infractions'][key]) > 0 and key != 'min_speed_infractions':
-                    other_infractions_than_min_speed_infractions_exist = True
-                    break
+        with gzip.open(path_measurements, 'rb') as f:
+            file_content = f.read()
+            measurements = json.loads(file_content.decode('utf-8'))
 
-            # Skip data where the expert did not achieve perfect driving score
-            if other_infractions_than_min_speed_infractions_exist and \
-                        (route_results['scores']['score_composed'] < 98.0 or
-                        route_results['scores']['score_route'] < 98.0):
-                return
-            elif not other_infractions_than_min_speed_infractions_exist and \
-                                (route_results['scores']['score_route'] < 98.0):
+        if 'lb1_split' in path_measurements:
+            scenario_name = path_measurements.split('lb1_split/')[-1].split('/')[1]
+        elif 'parking_lane' in path_measurements:
+            scenario_name = 'noScenario'
+        else:
+            try:
+                scenario_name = get_scenario_name(path_measurements, measurements)
+            except Exception as e:
+                print(f"Error in {path_measurements}: {e}")
                 return
+        route_file_number, route_number = get_route_numbers(route_dir)
 
-        # Read data and measurements files
+        route_folder = path_measurements.split('simlingo/')[-1].split('/Town')[0].split('/')
+        route_folder = '_'.join(route_folder)
+
+        # Read data file
         with gzip.open(path, 'rb') as f:
             file_content = f.read()
             data = json.loads(file_content.decode('utf-8'))
 
-        with gzip.open(path_measurements, 'rb') as f:
-            file_content = f.read()
-            measurements = json.loads(file_content.decode('utf-8'))
-
         # Get perception questions
         image_path = path.replace('boxes', 'rgb').replace('.json.gz', '.jpg')
         relative_image_path = image_path
@@ -323,7 +332,7 @@ class QAsGenerator():
             json.dump({
                 'num_frames': self.frame_num,
                 'min_num_questions': self.min_num_questions,
-                'avg_num_questions': self.total_num_questions / self.frame_num,
+                'avg_num_questions': self.total_num_questions / max(self.frame_num, 1),
                 'num_questions': self.total_num_questions, 
                 'num_objects': self.total_num_objects, 
                 'num_questions_per_category': self.num_questions_per_category,
@@ -400,8 +409,7 @@ class QAsGenerator():
         
         # save_dir = os.path.join(args.output_directory, scenario_name, route_number)
         pathlib.Path(save_dir).parent.mkdir(exist_ok=True, parents=True)
-        with gzip.open(save_dir, 'wt', encoding='utf-8') as f:
-            json.dump(tick_data, f, indent=4)
+        save_json_gz(save_dir, tick_data)
 
 
     def generate_2d_box_from_projected_points(self, projected_points):
@@ -1,5 +1,6 @@
 import argparse
 from carla_vqa_generator import QAsGenerator
+from dataset_generation.language_labels.generator_driver import run_generator
 import string
 import random
 import pathlib
@@ -24,6 +25,8 @@ def parse_arguments():
                             help='Output directory for the vqa-graph')
     path_group.add_argument('--output-graph-examples-directory', type=str, default='database/simlingo/drivelm',
                             help='Output directory for examples of the vqa-graph')
+    path_group.add_argument('--boxes-glob', type=str, default='data/simlingo/*/*/*/*/boxes/*.json.gz',
+                            help='Glob of the boxes files of all frames, relative to the data directory')
 
     # Image and camera parameters
     img_group = parser.add_argument_group('Image and Camera Parameters')
@@ -63,6 +66,11 @@ def parse_arguments():
     viz_group.add_argument('--skip-existing', action='store_true', default=True,
                            help='Skip existing files when saving examples')
 
+    # Parallelization
+    parallel_group = parser.add_argument_group('Parallelization')
+    parallel_group.add_argument('--num-workers', type=int, default=1,
+                                help='Processes that the routes are distributed to (1 runs in this process)')
+
     args = parser.parse_args()
 
     # Compute derived parameters
@@ -158,17 +166,7 @@ def convert_carla_to_nuscenes_and_save(args, carla_file_content):
 
 if __name__ == '__main__':
     args = parse_arguments()
-    multi_processing = False
 
     qas_generator = QAsGenerator(args)
-    len_data_boxes = len(qas_generator.data_boxes_paths)
-
-    if multi_processing:
-        from tqdm.contrib.concurrent import process_map
-        r = process_map(qas_generator.create_qa_pairs, range(0,len_data_boxes), max_workers=64, chunksize=10000)
-    else:
-
-        for i in range(len_data_boxes):
-            qas_generator.create_qa_pairs(i)
-
-    # qas_generator.save_stats() # does not work with multi_processing
+    # Routes are processed as a whole (route data is loaded once) and the statistics of the workers are merged
+    run_generator(qas_generator, num_workers=args.num_workers, skip_existing=args.skip_existing)
@@ -0,0 +1,83 @@
+"""
+Runs a language label generator (QAsGenerator of drivelm, COMsGenerator of commentary) over the dataset.
+The frames are grouped by route, so route level data (results.json.gz, route numbers, route file, measurements that
+neighbouring frames share) is loaded once per route by the generator. Routes are sharded over a process pool, every
+worker returns the statistics of its routes and they are merged into the generator before save_stats, so the
+statistics are complete with multiprocessing too. Frames whose output file already exists are skipped (resume).
+
+A generator has to provide:
+    data_boxes_paths: list of the boxes files of all frames
+    output_path(path): output file of the frame of a boxes file
+    process_frame(path): generates and saves the labels of a frame
+    reset_stats(), get_stats(), merge_stats(stats), save_stats()
+"""
+
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import tqdm
+
+# the generator of the worker processes, set once per worker instead of being pickled with every task
+_generator = None
+
+
+def group_paths_by_route(paths):
+    """Returns an OrderedDict route folder -> sorted boxes paths of the route."""
+    routes = OrderedDict()
+    for path in sorted(paths):
+        route_dir = os.path.dirname(os.path.dirname(path))
+        routes.setdefault(route_dir, []).append(path)
+    return routes
+
+
+def remove_existing_frames(generator, paths):
+    """Frames of a route without output file, the output folder is listed once instead of a stat per frame."""
+    if not paths:
+        return paths
+    output_dir = os.path.dirname(generator.output_path(paths[0]))
+    if not os.path.isdir(output_dir):
+        return paths
+    existing = set(os.listdir(output_dir))
+    return [path for path in paths if os.path.basename(generator.output_path(path)) not in existing]
+
+
+def process_route(generator, paths):
+    generator.reset_stats()
+    for path in paths:
+        generator.process_frame(path)
+    return generator.get_stats()
+
+
+def _init_worker(generator):
+    global _generator  # pylint: disable=global-statement
+    _generator = generator
+
+
+def _process_route_in_worker(paths):
+    return process_route(_generator, paths)
+
+
+def run_generator(generator, num_workers=1, skip_existing=True):
+    """Processes all frames of generator.data_boxes_paths and saves the merged statistics."""
+    routes = group_paths_by_route(generator.data_boxes_paths)
+    if skip_existing:
+        routes = OrderedDict((route_dir, remove_existing_frames(generator, paths)) for route_dir, paths in routes.items())
+    routes = [paths for paths in routes.values() if paths]
+    print(f"Frames to process: {sum(len(paths) for paths in routes)} in {len(routes)} routes")
+
+    route_stats = []
+    if num_workers <= 1:
+        for paths in tqdm.tqdm(routes):
+            route_stats.append(process_route(generator, paths))
+    else:
+        # longest routes first, so one long route does not end up alone at the end
+        routes = sorted(routes, key=len, reverse=True)
+        with Pool(num_workers, initializer=_init_worker, initargs=(generator,)) as pool:
+            for stats in tqdm.tqdm(pool.imap_unordered(_process_route_in_worker, routes), total=len(routes)):
+                route_stats.append(stats)
+
+    generator.reset_stats()
+    for stats in route_stats:
+        generator.merge_stats(stats)
+    generator.save_stats()
@@ -1,6 +1,8 @@
 import numpy as np
 import cv2
 import re
+import os
+import functools
 import xml.etree.ElementTree as ET
 import json
 import gzip
@@ -257,11 +259,12 @@ def number_to_word(number):
                    6: 'six', 7: 'seven', 8: 'eight', 9: 'nine', 10: 'ten'}
     return number_dict[number]
 
-def get_scenario_name(measurement_file_current):
+def get_scenario_name(measurement_file_current, current_measurement=None):
     """
     Extracts the scenario name from a given measurement file.
     Args:
         measurement_file_current (str): The path to the measurement file. (json or json.gz)
+        current_measurement (dict, optional): The already loaded measurement file.
     Returns:
         str: The name of the scenario.
     The function performs the following steps:
@@ -277,12 +280,13 @@ def get_scenario_name(measurement_file_current):
     10. Returns the name of the closest scenario.
     """
 
-    if measurement_file_current.endswith('.gz'):
-        with gzip.open(measurement_file_current, 'r') as f:
-            current_measurement = json.load(f)
-    elif measurement_file_current.endswith('.json'):
-        with open(measurement_file_current, 'r') as f:
-            current_measurement = json.load(f)
+    if current_measurement is None:
+        if measurement_file_current.endswith('.gz'):
+            with gzip.open(measurement_file_current, 'r') as f:
+                current_measurement = json.load(f)
+        elif measurement_file_current.endswith('.json'):
+            with open(measurement_file_current, 'r') as f:
+                current_measurement = json.load(f)
 
     route_folder = measurement_file_current.split('simlingo/')[-1].split('/Town')[0]
     if route_folder is None:
@@ -316,24 +320,13 @@ def get_scenario_name(measurement_file_current):
     elif route_folder == 'OpensDoor':
         scenario_name = 'VehicleOpensDoor'
     else:
-        tree = ET.parse(routefile_path)
-        # get route id=route_number
-        root = tree.getroot()
-        route_id = root.find(f'./route[@id="{route_number}"]')
-        # get all information as dict
-        route_info = {}
         locs = []
         scenarios = []
-        for scenario in route_id.find('scenarios').iter('scenario'):
-            p = scenario.find('trigger_point')
-            loc = [float(p.attrib['x']), float(p.attrib['y']), float(p.attrib['z'])]
+        for scenario_name, loc in load_route_scenarios(routefile_path, route_number):
             loc_ego_coords = t_u.inverse_conversion_2d(np.array(loc[:2]), current_measurement['pos_global'], current_measurement['theta'])
             locs.append(loc_ego_coords)
-            scenario_name = scenario.attrib['type']
             scenarios.append(scenario_name)
 
-            route_info[scenario_name] = loc
-
         # current_loc = current_measurement['pos_global']
         # find the closest scenario
         # distances = [np.linalg.norm(np.array(loc[:2]) - np.array(current_loc)) for loc in locs]
@@ -345,6 +338,85 @@ def get_scenario_name(measurement_file_current):
     return scenario_name
 
 
+@functools.lru_cache(maxsize=64)
+def load_route_scenarios(routefile_path, route_number):
+    """
+    Scenario types and trigger points [x, y, z] of a route in a route file. Cached, all frames of a route share them.
+    """
+    tree = ET.parse(routefile_path)
+    # get route id=route_number
+    root = tree.getroot()
+    route_id = root.find(f'./route[@id="{route_number}"]')
+    scenarios = []
+    for scenario in route_id.find('scenarios').iter('scenario'):
+        p = scenario.find('trigger_point')
+        loc = [float(p.attrib['x']), float(p.attrib['y']), float(p.attrib['z'])]
+        scenarios.append((scenario.attrib['type'], loc))
+    return tuple(scenarios)
+
+
+ROUTE_NUMBERS_LB1_PATTERN = re.compile(r'Rep*(\d+)_Town[\d\w]*_[\d\w]*_*(\d+)_route_*(\d+)')
+ROUTE_NUMBERS_PATTERN = re.compile(r'Rep*(\d+)_*(\d+)_route_*(\d+)')
+
+
+@functools.lru_cache(maxsize=64)
+def get_route_numbers(route_dir):
+    """
+    Route file number and route number of a route folder of the dataset.
+    """
+    pattern = ROUTE_NUMBERS_LB1_PATTERN if 'lb1_split' in route_dir else ROUTE_NUMBERS_PATTERN
+    match = pattern.search(route_dir)
+    return match.group(2), match.group(3)
+
+
+@functools.lru_cache(maxsize=64)
+def load_route_results(results_file):
+    """
+    Content of the results.json.gz of a route, read once per route. None if it can't be read.
+    """
+    try:
+        with gzip.open(results_file, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except Exception:
+        print(f"Error reading {results_file}")
+        return None
+
+
+def expert_route_passed(route_results):
+    """
+    Whether the expert achieved a (close to) perfect driving score on the route, min speed infractions are ignored.
+    """
+    if route_results is None:
+        return False
+
+    other_infractions_than_min_speed_infractions_exist = False
+    for key in route_results['infractions'].keys():
+        if len(route_results['infractions'][key]) > 0 and key != 'min_speed_infractions':
+            other_infractions_than_min_speed_infractions_exist = True
+            break
+
+    # Skip data where the expert did not achieve perfect driving score
+    if other_infractions_than_min_speed_infractions_exist and \
+                (route_results['scores']['score_composed'] < 98.0 or
+                route_results['scores']['score_route'] < 98.0):
+        return False
+    elif not other_infractions_than_min_speed_infractions_exist and \
+                        (route_results['scores']['score_route'] < 98.0):
+        return False
+    return True
+
+
+def save_json_gz(path, data):
+    """
+    Writes compact (not indented) gzip compressed JSON. Written to a temporary file first, so an interrupted run never
+    leaves a truncated file that would be skipped when resuming.
+    """
+    tmp_path = f'{path}.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
 def is_pointing_towards_junction(ego, vehicle):
     orientation_relative_to_ego = vehicle['yaw']
     orientation_relative_to_ego = orientation_relative_to_ego * 180 / np.pi
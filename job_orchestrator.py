@@ -0,0 +1,360 @@
+"""
+Runs CARLA jobs (evaluation routes, data collection routes) with a bounded number of parallel jobs.
+The state of every job is kept in a SQLite journal, so the orchestrator can be stopped and restarted at any time
+without losing track of submitted jobs. A route is finished as soon as its result file (the leaderboard checkpoint)
+is complete, a crashed job is detected from its exit code or from crash messages in its log. Free slots are filled
+right away and failed jobs are resubmitted with an exponential backoff until they run out of tries. The scheduler
+itself is only queried every poll_interval seconds of the backend, the result files and logs are checked in between.
+
+Backends:
+SlurmBackend submits the job files with sbatch and queries squeue and sacct once for all jobs.
+LocalBackend runs the job files as local processes, for single machines and for testing.
+
+Example:
+orchestrator = Orchestrator('eval_results/jobs.sqlite', SlurmBackend(), max_jobs=read_max_num_jobs)
+orchestrator.add('simlingo_1_bench2drive_001', job_file, result_file, log_file, err_file, max_tries=2)
+orchestrator.run()
+"""
+
+import json
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import time
+
+from tqdm import tqdm
+
+FAILED_STATUSES = (
+    'Failed - Agent couldn\'t be set up',
+    'Failed',
+    'Failed - Simulation crashed',
+    'Failed - Agent crashed',
+)
+# messages in the log of a job whose CARLA server or agent crashed, the job is cancelled and resubmitted
+CRASH_PATTERNS = (
+    r'Watchdog exception',
+    r'Engine crash handling finished; re-raising signal 11',
+    r'Stopping the route, the agent has crashed',
+)
+
+
+def read_max_num_jobs(path='max_num_jobs.txt', default=1):
+    """Number of parallel jobs, read again in every step so it can be changed while running."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return default
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def result_status(result_file, resubmit_not_started=False):
+    """
+    'complete' if all routes of the result file finished, 'failed' if they finished but one of them failed and
+    None if the file does not exist or is still being written.
+    """
+    try:
+        with open(result_file, 'r', encoding='utf-8') as f:
+            evaluation_data = json.load(f)
+        progress = evaluation_data['_checkpoint']['progress']
+        records = evaluation_data['_checkpoint']['records']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if len(progress) < 2 or progress[0] < progress[1]:
+        return None
+    for record in records:
+        if record['status'] in FAILED_STATUSES:
+            return 'failed'
+        if resubmit_not_started and record['scores']['score_route'] <= 0.00000000001:
+            return 'failed'
+    return 'complete'
+
+
+class JobJournal():
+    """Persistent state of the jobs and their attempts."""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            name TEXT PRIMARY KEY,
+            job_file TEXT,
+            result_file TEXT,
+            log_file TEXT,
+            err_file TEXT,
+            state TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            max_tries INTEGER,
+            backend_id TEXT,
+            next_submit REAL DEFAULT 0,
+            result_stamp TEXT,
+            meta TEXT DEFAULT '{}')''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS attempts (
+            name TEXT,
+            attempt INTEGER,
+            backend_id TEXT,
+            submitted REAL,
+            ended REAL,
+            exit_code INTEGER,
+            outcome TEXT)''')
+
+    def add(self, name, job_file, result_file, log_file, err_file, max_tries, meta=None):
+        """Adds a job, jobs that are already in the journal keep their state."""
+        self.connection.execute(
+            'INSERT OR IGNORE INTO jobs (name, job_file, result_file, log_file, err_file, max_tries, meta) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', (name, job_file, result_file, log_file, err_file, max_tries, json.dumps(meta or {})))
+
+    def jobs(self, state=None):
+        if state is None:
+            rows = self.connection.execute('SELECT * FROM jobs ORDER BY rowid')
+        else:
+            rows = self.connection.execute('SELECT * FROM jobs WHERE state = ? ORDER BY rowid', (state,))
+        return [dict(row, meta=json.loads(row['meta'])) for row in rows]
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def update(self, name, **fields):
+        if 'meta' in fields:
+            fields['meta'] = json.dumps(fields['meta'])
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        self.connection.execute(f'UPDATE jobs SET {assignments} WHERE name = ?', (*fields.values(), name))
+
+    def start_attempt(self, job, backend_id, submitted):
+        self.connection.execute('INSERT INTO attempts (name, attempt, backend_id, submitted) VALUES (?, ?, ?, ?)',
+                                (job['name'], job['attempts'] + 1, backend_id, submitted))
+
+    def end_attempt(self, job, ended, exit_code, outcome):
+        self.connection.execute('UPDATE attempts SET ended = ?, exit_code = ?, outcome = ? WHERE name = ? AND attempt = ?',
+                                (ended, exit_code, outcome, job['name'], job['attempts']))
+
+    def attempts(self, name=None):
+        if name is None:
+            rows = self.connection.execute('SELECT * FROM attempts ORDER BY rowid')
+        else:
+            rows = self.connection.execute('SELECT * FROM attempts WHERE name = ? ORDER BY rowid', (name,))
+        return [dict(row) for row in rows]
+
+
+class LocalBackend():
+    """Runs the job files with bash on this machine, the SBATCH lines are ignored."""
+    poll_interval = 0.0
+
+    def __init__(self):
+        self.processes = {}
+
+    def submit(self, job):
+        # truncated like the output files of sbatch
+        with open(job['log_file'], 'wb') as log, open(job['err_file'], 'wb') as err:
+            process = subprocess.Popen(['bash', job['job_file']], stdout=log, stderr=err, start_new_session=True)
+        self.processes[str(process.pid)] = process
+        return str(process.pid)
+
+    def poll(self, backend_ids):
+        """Exit codes of the ended jobs, None if the job was started by a previous orchestrator."""
+        ended = {}
+        # also reaps the processes of jobs that were already done from their result file
+        for backend_id, process in list(self.processes.items()):
+            if process.poll() is not None:
+                ended[backend_id] = process.returncode
+                del self.processes[backend_id]
+        for backend_id in backend_ids:
+            if backend_id not in self.processes and backend_id not in ended:
+                try:
+                    # a child of an earlier backend of this process
+                    pid, status = os.waitpid(int(backend_id), os.WNOHANG)
+                    if pid != 0:
+                        ended[backend_id] = os.waitstatus_to_exitcode(status)
+                    continue
+                except ChildProcessError:
+                    pass
+                try:
+                    os.kill(int(backend_id), 0)
+                except OSError:
+                    ended[backend_id] = None
+        return ended
+
+    def cancel(self, backend_id):
+        try:
+            os.killpg(int(backend_id), signal.SIGTERM)
+        except OSError:
+            pass
+        process = self.processes.pop(backend_id, None)
+        if process is not None:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+
+
+class SlurmBackend():
+    """Submits the job files with sbatch, one squeue (and sacct for the ended jobs) call per poll for all jobs."""
+
+    def __init__(self, poll_interval=60.0, sbatch_args=()):
+        self.poll_interval = poll_interval
+        self.sbatch_args = list(sbatch_args)
+
+    def submit(self, job):
+        output = subprocess.check_output(['sbatch', '--parsable', *self.sbatch_args, job['job_file']]).decode('utf-8')
+        return output.strip().split(';')[0]
+
+    def poll(self, backend_ids):
+        queued = set(subprocess.check_output(['squeue', '--me', '--noheader', '--format=%i']).decode('utf-8').split())
+        ended = {backend_id: None for backend_id in backend_ids if backend_id not in queued}
+        if ended:
+            # sacct is not available on every cluster, the result file decides in that case
+            accounting = subprocess.run(['sacct', '--noheader', '--parsable2', '--format=JobID,ExitCode', '--jobs', ','.join(ended)],
+                                        capture_output=True, check=False)
+            for line in accounting.stdout.decode('utf-8').splitlines():
+                fields = line.split('|')
+                if len(fields) == 2 and fields[0] in ended:
+                    ended[fields[0]] = int(fields[1].split(':')[0])
+        return ended
+
+    def cancel(self, backend_id):
+        subprocess.run(['scancel', backend_id], check=False)
+
+
+class Orchestrator():
+    """
+    Keeps up to max_jobs jobs of the journal running. max_jobs is a number or a function that returns it,
+    prepare(job) is called before every submission (e.g. to write the job file) and can return new meta data of the job.
+    """
+
+    def __init__(self, journal, backend, max_jobs=1, backoff=30.0, max_backoff=600.0, poll_interval=2.0,
+                 crash_patterns=CRASH_PATTERNS, resubmit_not_started=False, prepare=None):
+        self.journal = journal if isinstance(journal, JobJournal) else JobJournal(journal)
+        self.backend = backend
+        self.max_jobs = max_jobs if callable(max_jobs) else lambda: max_jobs
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.crash_pattern = re.compile('|'.join(crash_patterns)) if crash_patterns else None
+        self.resubmit_not_started = resubmit_not_started
+        self.prepare = prepare
+        self.last_poll = -float('inf')
+        self.log_offsets = {}
+
+    def add(self, name, job_file, result_file, log_file, err_file, max_tries, meta=None):
+        self.journal.add(name, job_file, result_file, log_file, err_file, max_tries, meta)
+
+    def result(self, job):
+        """Status of the result file of a running job, files that were not written since the submission are ignored."""
+        if file_stamp(job['result_file']) == job['result_stamp']:
+            return None
+        return result_status(job['result_file'], self.resubmit_not_started)
+
+    def crashed(self, job):
+        """Whether the new lines of the log of a running job contain a crash message."""
+        if self.crash_pattern is None:
+            return False
+        offset = self.log_offsets.get(job['name'], 0)
+        try:
+            with open(job['log_file'], 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset:
+                    # the log of the previous attempt was replaced
+                    offset = 0
+                f.seek(offset)
+                text = f.read()
+        except OSError:
+            return False
+        if not text:
+            return False
+        # only complete lines are searched, the rest is read again in the next step
+        complete = text.rfind(b'\n') + 1
+        self.log_offsets[job['name']] = offset + complete
+        return self.crash_pattern.search(text[:complete].decode('utf-8', errors='replace')) is not None
+
+    def finish(self, job, outcome, exit_code=None):
+        """Ends the current attempt, the job is done, resubmitted after the backoff or failed if it has no tries left."""
+        now = time.time()
+        self.journal.end_attempt(job, now, exit_code, outcome)
+        self.log_offsets.pop(job['name'], None)
+        if outcome == 'done':
+            self.journal.update(job['name'], state='done')
+            print(f"Finished job {job['name']}")
+        elif job['attempts'] >= job['max_tries']:
+            self.journal.update(job['name'], state='failed')
+            print(f"Job {job['name']} failed ({outcome}, exit code {exit_code}), no tries left.")
+        else:
+            delay = min(self.backoff * 2 ** (job['attempts'] - 1), self.max_backoff)
+            self.journal.update(job['name'], state='pending', next_submit=now + delay)
+            print(f"Job {job['name']} failed ({outcome}, exit code {exit_code}), resubmitting in {delay:.0f} s.")
+
+    def step(self):
+        """One round of checks and submissions, returns whether jobs are left."""
+        # finished routes and crash messages are read from the file system without asking the scheduler
+        for job in self.journal.jobs('running'):
+            status = self.result(job)
+            if status == 'complete':
+                self.finish(job, 'done')
+            elif status == 'failed' or self.crashed(job):
+                self.backend.cancel(job['backend_id'])
+                self.finish(job, 'crashed' if status is None else 'failed')
+
+        if time.monotonic() - self.last_poll >= self.backend.poll_interval:
+            self.last_poll = time.monotonic()
+            running = self.journal.jobs('running')
+            ended = self.backend.poll([job['backend_id'] for job in running])
+            for job in running:
+                if job['backend_id'] in ended:
+                    status = self.result(job)
+                    self.finish(job, 'done' if status == 'complete' else 'exited', exit_code=ended[job['backend_id']])
+
+        free_slots = self.max_jobs() - len(self.journal.jobs('running'))
+        now = time.time()
+        for job in self.journal.jobs('pending'):
+            if free_slots <= 0:
+                break
+            if job['next_submit'] > now:
+                continue
+            if job['attempts'] == 0 and result_status(job['result_file'], self.resubmit_not_started) == 'complete':
+                # finished in an earlier run of the script
+                self.journal.update(job['name'], state='done')
+                continue
+            if self.prepare is not None:
+                meta = self.prepare(job)
+                if meta is not None:
+                    job['meta'] = meta
+            # the result file and the log of the previous attempt are not read again
+            result_stamp = file_stamp(job['result_file'])
+            try:
+                self.log_offsets[job['name']] = os.path.getsize(job['log_file'])
+            except OSError:
+                self.log_offsets[job['name']] = 0
+            backend_id = self.backend.submit(job)
+            self.journal.start_attempt(job, backend_id, now)
+            self.journal.update(job['name'], state='running', attempts=job['attempts'] + 1, backend_id=backend_id,
+                                result_stamp=result_stamp, meta=job['meta'])
+            free_slots -= 1
+            print(f"Submitted job {job['name']} (attempt {job['attempts'] + 1}, id {backend_id})")
+
+        counts = self.journal.counts()
+        return counts.get('pending', 0) + counts.get('running', 0) > 0
+
+    def run(self):
+        """Runs until every job is done or failed, returns the number of jobs per state."""
+        counts = self.journal.counts()
+        progress = tqdm(total=sum(counts.values()), initial=counts.get('done', 0) + counts.get('failed', 0))
+        while self.step():
+            counts = self.journal.counts()
+            progress.update(counts.get('done', 0) + counts.get('failed', 0) - progress.n)
+            time.sleep(self.poll_interval)
+        counts = self.journal.counts()
+        progress.update(counts.get('done', 0) + counts.get('failed', 0) - progress.n)
+        progress.close()
+        print(f"{counts.get('done', 0)} jobs done, {counts.get('failed', 0)} failed.")
+        return counts
@@ -10,6 +10,7 @@ This module provides mocked CARLA classes for unittesting
 """
 
 import copy
+import math
 
 
 class command:
@@ -74,29 +75,62 @@ class GeoLocation:
     latitude = 0
 
 
+class Color:
+
+    def __init__(self, r=0, g=0, b=0, a=255):
+        self.r = r
+        self.g = g
+        self.b = b
+        self.a = a
+
+
 class Vector3D:
     x = 0
     y = 0
     z = 0
 
     def __init__(self, x=0, y=0, z=0):
+        if isinstance(x, Vector3D):
+            x, y, z = x.x, x.y, x.z
         self.x = x
         self.y = y
         self.z = z
 
+    def __add__(self, other):
+        return self.__class__(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return self.__class__(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __mul__(self, scalar):
+        return self.__class__(self.x * scalar, self.y * scalar, self.z * scalar)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, scalar):
+        return self.__class__(self.x / scalar, self.y / scalar, self.z / scalar)
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def length(self):
+        return math.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
+
 
-class Location():
+class Location(Vector3D):
     x = 0
     y = 0
     z = 0
 
     def __init__(self, x=0, y=0, z=0):
+        if isinstance(x, Vector3D):
+            x, y, z = x.x, x.y, x.z
         self.x = x
         self.y = y
         self.z = z
 
     def distance(self, other):
-        return 0
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
 
 
 class Rotation():
@@ -109,8 +143,21 @@ class Rotation():
         self.roll = roll
         self.yaw = yaw
 
+    def _get_sin_cos(self):
+        pitch, yaw, roll = (math.radians(angle) for angle in (self.pitch, self.yaw, self.roll))
+        return math.sin(pitch), math.cos(pitch), math.sin(yaw), math.cos(yaw), math.sin(roll), math.cos(roll)
+
     def get_forward_vector(self):
-        return Vector3D()
+        sp, cp, sy, cy, _, _ = self._get_sin_cos()
+        return Vector3D(cy * cp, sy * cp, sp)
+
+    def get_right_vector(self):
+        sp, cp, sy, cy, sr, cr = self._get_sin_cos()
+        return Vector3D(cy * sp * sr - sy * cr, sy * sp * sr + cy * cr, -cp * sr)
+
+    def get_up_vector(self):
+        sp, cp, sy, cy, sr, cr = self._get_sin_cos()
+        return Vector3D(-cy * sp * cr - sy * sr, -sy * sp * cr + cy * sr, cp * cr)
 
 
 class Transform:
@@ -121,6 +168,43 @@ class Transform:
         self.location = location
         self.rotation = rotation
 
+    def get_forward_vector(self):
+        return self.rotation.get_forward_vector()
+
+    def transform(self, in_point):
+        forward = self.rotation.get_forward_vector()
+        right = self.rotation.get_right_vector()
+        up = self.rotation.get_up_vector()
+        return Location(self.location.x + in_point.x * forward.x + in_point.y * right.x + in_point.z * up.x,
+                        self.location.y + in_point.x * forward.y + in_point.y * right.y + in_point.z * up.y,
+                        self.location.z + in_point.x * forward.z + in_point.y * right.z + in_point.z * up.z)
+
+
+class BoundingBox:
+    location = Location(0, 0, 0)
+    extent = Vector3D(0, 0, 0)
+    rotation = Rotation(0, 0, 0)
+
+    def __init__(self, location=Location(0, 0, 0), extent=Vector3D(0, 0, 0)):
+        self.location = location
+        self.extent = extent
+        self.rotation = Rotation(0, 0, 0)
+
+
+class LaneType:
+    NONE = 1
+    Driving = 2
+    Stop = 4
+    Shoulder = 8
+    Biking = 16
+    Sidewalk = 32
+    Border = 64
+    Restricted = 128
+    Parking = 256
+    Bidirectional = 512
+    Median = 1024
+    Any = -2
+
 
 class Waypoint():
     transform = Transform(Location(), Rotation())
@@ -128,6 +212,8 @@ class Waypoint():
     lane_id = 0
     s = 0
     lane_width = 0
+    lane_type = LaneType.Driving
+    is_junction = False
 
 
 class Map:
@@ -139,7 +225,7 @@ class Map:
     def transform_to_geolocation(self, transform):
         return GeoLocation()
 
-    def get_waypoint(self, transform):
+    def get_waypoint(self, location, project_to_road=True, lane_type=LaneType.Driving):
         return Waypoint()
 
     def get_waypoint_xodr(self, a, b, c):
@@ -214,11 +300,15 @@ class Actor:
         self.location = Location()
         self.rotation = Rotation()
         self.transform = Transform(self.location, self.rotation)
+        self.velocity = Vector3D()
         self.is_alive = True
 
     def get_transform(self):
         return self.transform
 
+    def get_velocity(self):
+        return self.velocity
+
     def get_location(self):
         return self.location
 
@@ -243,9 +333,41 @@ class Vehicle(Actor):
     is_vehicle = True
 
 
+class ActorSnapshot:
+
+    def __init__(self, actor):
+        self.id = actor.id
+        self.transform = actor.get_transform()
+        self.velocity = actor.get_velocity()
+
+    def get_transform(self):
+        return self.transform
+
+    def get_velocity(self):
+        return self.velocity
+
+
+class WorldSnapshot:
+
+    def __init__(self, actors):
+        self.actor_snapshots = {actor.id: ActorSnapshot(actor) for actor in actors if actor.is_alive}
+
+    def find(self, actor_id):
+        return self.actor_snapshots.get(actor_id)
+
+    def __len__(self):
+        return len(self.actor_snapshots)
+
+    def __iter__(self):
+        return iter(self.actor_snapshots.values())
+
+
 class World:
     actors = []
 
+    def get_snapshot(self):
+        return WorldSnapshot(self.actors)
+
     def get_settings(self):
         return WorldSettings()
 
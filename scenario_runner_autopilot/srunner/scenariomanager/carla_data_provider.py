@@ -51,6 +51,8 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
     # the key saves the scenario type and the value all relevant data
     active_scenarios = []
 
+    # Buffers of the registered actors, keyed by the actor id
+    _registered_actor_map = {}
     _actor_velocity_map = {}
     _actor_location_map = {}
     _actor_transform_map = {}
@@ -65,6 +67,7 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
     _spawn_index = 0
     _blueprint_library = None
     _all_actors = None
+    _waypoint_cache = {}
     _ego_vehicle_route = None
     _traffic_manager_port = 8000
     _random_seed = 2000
@@ -80,24 +83,14 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         If actor already exists, throw an exception
         """
         with CarlaDataProvider._lock:
-            if actor in CarlaDataProvider._actor_velocity_map:
+            if actor.id in CarlaDataProvider._registered_actor_map:
                 raise KeyError(
                     "Vehicle '{}' already registered. Cannot register twice!".format(actor.id))
-            else:
-                CarlaDataProvider._actor_velocity_map[actor] = 0.0
-            if actor in CarlaDataProvider._actor_location_map:
-                raise KeyError(
-                    "Vehicle '{}' already registered. Cannot register twice!".format(actor.id))
-            elif transform:
-                CarlaDataProvider._actor_location_map[actor] = transform.location
-            else:
-                CarlaDataProvider._actor_location_map[actor] = None
 
-            if actor in CarlaDataProvider._actor_transform_map:
-                raise KeyError(
-                    "Vehicle '{}' already registered. Cannot register twice!".format(actor.id))
-            else:
-                CarlaDataProvider._actor_transform_map[actor] = transform
+            CarlaDataProvider._registered_actor_map[actor.id] = actor
+            CarlaDataProvider._actor_velocity_map[actor.id] = 0.0
+            CarlaDataProvider._actor_location_map[actor.id] = transform.location if transform else None
+            CarlaDataProvider._actor_transform_map[actor.id] = transform
 
     @staticmethod
     def update_osc_global_params(parameters):
@@ -130,32 +123,41 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         Callback from CARLA
         """
         with CarlaDataProvider._lock:
-            for actor in CarlaDataProvider._actor_velocity_map:
-                if actor is not None and actor.is_alive:
-                    CarlaDataProvider._actor_velocity_map[actor] = calculate_velocity(actor)
-
-            for actor in CarlaDataProvider._actor_location_map:
-                if actor is not None and actor.is_alive:
-                    CarlaDataProvider._actor_location_map[actor] = actor.get_location()
-
-            for actor in CarlaDataProvider._actor_transform_map:
-                if actor is not None and actor.is_alive:
-                    CarlaDataProvider._actor_transform_map[actor] = actor.get_transform()
-
             world = CarlaDataProvider._world
             if world is None:
                 print("WARNING: CarlaDataProvider couldn't find the world")
+                snapshot = None
+            else:
+                snapshot = world.get_snapshot()
+
+            for actor_id, actor in CarlaDataProvider._registered_actor_map.items():
+                if snapshot is not None:
+                    # One lookup in the snapshot of this tick, destroyed actors are not part of it
+                    actor_snapshot = snapshot.find(actor_id)
+                    if actor_snapshot is None:
+                        continue
+                    transform = actor_snapshot.get_transform()
+                    velocity = actor_snapshot.get_velocity()
+                elif actor is not None and actor.is_alive:
+                    transform = actor.get_transform()
+                    velocity = actor.get_velocity()
+                else:
+                    continue
+
+                CarlaDataProvider._actor_velocity_map[actor_id] = math.sqrt(velocity.x**2 + velocity.y**2)
+                CarlaDataProvider._actor_location_map[actor_id] = transform.location
+                CarlaDataProvider._actor_transform_map[actor_id] = transform
 
             CarlaDataProvider._all_actors = None
+            CarlaDataProvider._waypoint_cache.clear()
 
     @staticmethod
     def get_velocity(actor):
         """
         returns the absolute velocity for the given actor
         """
-        for key in CarlaDataProvider._actor_velocity_map:
-            if key.id == actor.id:
-                return CarlaDataProvider._actor_velocity_map[key]
+        if actor.id in CarlaDataProvider._actor_velocity_map:
+            return CarlaDataProvider._actor_velocity_map[actor.id]
 
         # We are intentionally not throwing here
         # This may cause exception loops in py_trees
@@ -167,9 +169,8 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         """
         returns the location for the given actor
         """
-        for key in CarlaDataProvider._actor_location_map:
-            if key.id == actor.id:
-                return CarlaDataProvider._actor_location_map[key]
+        if actor.id in CarlaDataProvider._actor_location_map:
+            return CarlaDataProvider._actor_location_map[actor.id]
 
         # We are intentionally not throwing here
         # This may cause exception loops in py_trees
@@ -181,9 +182,8 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         """
         returns the transform for the given actor
         """
-        for key in CarlaDataProvider._actor_transform_map:
-            if key.id == actor.id:
-                return CarlaDataProvider._actor_transform_map[key]
+        if actor.id in CarlaDataProvider._actor_transform_map:
+            return CarlaDataProvider._actor_transform_map[actor.id]
 
         # We are intentionally not throwing here
         # This may cause exception loops in py_trees
@@ -261,6 +261,23 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         """
         return CarlaDataProvider._grp
 
+    @staticmethod
+    def get_waypoint(location, project_to_road=True, lane_type=None):
+        """
+        Returns map.get_waypoint(location, project_to_road, lane_type), lane_type defaults to Driving as in CARLA.
+        The result is memoized until the next tick, so that all criteria querying the same location
+        share one map lookup. 'CarlaDataProvider._waypoint_cache' is reset each tick.
+        """
+        if lane_type is None:
+            lane_type = carla.LaneType.Driving
+        key = (location.x, location.y, location.z, project_to_road, lane_type)
+        try:
+            return CarlaDataProvider._waypoint_cache[key]
+        except KeyError:
+            waypoint = CarlaDataProvider.get_map().get_waypoint(location, project_to_road, lane_type)
+            CarlaDataProvider._waypoint_cache[key] = waypoint
+            return waypoint
+
     @staticmethod
     def get_all_actors():
         """
@@ -873,6 +890,7 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
                 else:
                     raise e
 
+        CarlaDataProvider._registered_actor_map.clear()
         CarlaDataProvider._actor_velocity_map.clear()
         CarlaDataProvider._actor_location_map.clear()
         CarlaDataProvider._actor_transform_map.clear()
@@ -882,6 +900,7 @@ class CarlaDataProvider(object):  # pylint: disable=too-many-public-methods
         CarlaDataProvider._sync_flag = False
         CarlaDataProvider._ego_vehicle_route = None
         CarlaDataProvider._all_actors = None
+        CarlaDataProvider._waypoint_cache.clear()
         CarlaDataProvider._carla_actor_pool = {}
         CarlaDataProvider._client = None
         CarlaDataProvider._spawn_points = None
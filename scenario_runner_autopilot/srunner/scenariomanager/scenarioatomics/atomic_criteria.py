@@ -85,6 +85,60 @@ class Criterion(py_trees.behaviour.Behaviour):
         self.logger.debug("%s.terminate()[%s->%s]" % (self.__class__.__name__, self.status, new_status))
 
 
+class RouteWindow(object):
+
+    """
+    Route data of the criteria that check a window of route points every tick, computed once per route.
+    The locations and forward vectors are plain floats, so checking the window needs no CARLA calls.
+    The data of the last route is shared by all criteria of that route (see RouteWindow.get).
+    """
+
+    _last_route = None
+    _last_window = None
+
+    def __init__(self, route):
+        route_transforms, _ = zip(*route)
+        self.locations = [(tran.location.x, tran.location.y, tran.location.z) for tran in route_transforms]
+        self.forward_vectors = []
+        for tran in route_transforms:
+            forward = tran.get_forward_vector()
+            self.forward_vectors.append((forward.x, forward.y, forward.z))
+
+        self.accum_meters = []
+        prev_loc = route_transforms[0].location
+        for i, tran in enumerate(route_transforms):
+            d = tran.location.distance(prev_loc)
+            accum = 0 if i == 0 else self.accum_meters[i - 1]
+
+            self.accum_meters.append(d + accum)
+            prev_loc = tran.location
+
+    @staticmethod
+    def get(route):
+        """
+        Returns the RouteWindow of the route, reusing the one of the previous call for the same route object
+        """
+        if RouteWindow._last_route is not route:
+            RouteWindow._last_window = RouteWindow(route)
+            RouteWindow._last_route = route
+        return RouteWindow._last_window
+
+    def has_passed(self, index, location):
+        """
+        Checks if the location is ahead of the route point (positive dot product with its forward vector)
+        """
+        x, y, z = self.locations[index]
+        forward_x, forward_y, forward_z = self.forward_vectors[index]
+        return (location.x - x) * forward_x + (location.y - y) * forward_y + (location.z - z) * forward_z > 0
+
+    def distance_2d(self, index, location):
+        """
+        2D distance between the location and the route point
+        """
+        x, y, _ = self.locations[index]
+        return math.sqrt(((location.x - x) ** 2) + ((location.y - y) ** 2))
+
+
 class MaxVelocityTest(Criterion):
 
     """
@@ -623,11 +677,11 @@ class OffRoadTest(Criterion):
         current_location = CarlaDataProvider.get_location(self.actor)
 
         # Get the waypoint at the current location to see if the actor is offroad
-        drive_waypoint = self._map.get_waypoint(
+        drive_waypoint = CarlaDataProvider.get_waypoint(
             current_location,
             project_to_road=False
         )
-        park_waypoint = self._map.get_waypoint(
+        park_waypoint = CarlaDataProvider.get_waypoint(
             current_location,
             project_to_road=False,
             lane_type=carla.LaneType.Parking
@@ -699,7 +753,7 @@ class EndofRoadTest(Criterion):
         new_status = py_trees.common.Status.RUNNING
 
         current_location = CarlaDataProvider.get_location(self.actor)
-        current_waypoint = self._map.get_waypoint(current_location)
+        current_waypoint = CarlaDataProvider.get_waypoint(current_location)
 
         # Get the current road id
         if self._road_id is None:
@@ -779,7 +833,7 @@ class OnSidewalkTest(Criterion):
         # Some of the vehicle parameters
         current_tra = CarlaDataProvider.get_transform(self.actor)
         current_loc = current_tra.location
-        current_wp = self._map.get_waypoint(current_loc, lane_type=carla.LaneType.Any)
+        current_wp = CarlaDataProvider.get_waypoint(current_loc, lane_type=carla.LaneType.Any)
 
         # Case 1) Car center is at a sidewalk
         if current_wp.lane_type == carla.LaneType.Sidewalk:
@@ -807,10 +861,10 @@ class OnSidewalkTest(Criterion):
                 current_loc + carla.Location(-1 * x_boundary_vector + y_boundary_vector)]
 
             bbox_wp = [
-                self._map.get_waypoint(bbox[0], lane_type=carla.LaneType.Any),
-                self._map.get_waypoint(bbox[1], lane_type=carla.LaneType.Any),
-                self._map.get_waypoint(bbox[2], lane_type=carla.LaneType.Any),
-                self._map.get_waypoint(bbox[3], lane_type=carla.LaneType.Any)]
+                CarlaDataProvider.get_waypoint(bbox[0], lane_type=carla.LaneType.Any),
+                CarlaDataProvider.get_waypoint(bbox[1], lane_type=carla.LaneType.Any),
+                CarlaDataProvider.get_waypoint(bbox[2], lane_type=carla.LaneType.Any),
+                CarlaDataProvider.get_waypoint(bbox[3], lane_type=carla.LaneType.Any)]
 
             lane_type_list = [bbox_wp[0].lane_type, bbox_wp[1].lane_type, bbox_wp[2].lane_type, bbox_wp[3].lane_type]
 
@@ -1010,6 +1064,7 @@ class OutsideRouteLanesTest(Criterion):
         self._current_index = 0
         self._route_length = len(self._route)
         self._route_transforms, _ = zip(*self._route)
+        self._route_window = RouteWindow.get(self._route)
 
         self._map = CarlaDataProvider.get_map()
         self._last_ego_waypoint = self._map.get_waypoint(self.actor.get_location())
@@ -1056,14 +1111,9 @@ class OutsideRouteLanesTest(Criterion):
         for index in range(self._current_index + 1,
                            min(self._current_index + self.WINDOWS_SIZE + 1, self._route_length)):
             # Get the dot product to know if it has passed this location
-            route_transform = self._route_transforms[index]
-            route_location = route_transform.location
-
-            wp_dir = route_transform.get_forward_vector()  # Waypoint's forward vector
-            wp_veh = location - route_location  # vector waypoint - vehicle
-
-            if wp_veh.dot(wp_dir) > 0:
+            if self._route_window.has_passed(index, location):
                 # Get the distance traveled and add it to the total distance
+                route_location = self._route_transforms[index].location
                 prev_route_location = self._route_transforms[self._current_index].location
                 new_dist = prev_route_location.distance(route_location)
                 self._total_distance += new_dist
@@ -1108,8 +1158,8 @@ class OutsideRouteLanesTest(Criterion):
         """
         Detects if the ego_vehicle is outside driving lanes
         """
-        driving_wp = self._map.get_waypoint(location, lane_type=carla.LaneType.Driving)
-        parking_wp = self._map.get_waypoint(location, lane_type=carla.LaneType.Parking)
+        driving_wp = CarlaDataProvider.get_waypoint(location, lane_type=carla.LaneType.Driving)
+        parking_wp = CarlaDataProvider.get_waypoint(location, lane_type=carla.LaneType.Parking)
 
         driving_distance = location.distance(driving_wp.transform.location)
         if parking_wp is not None:  # Some towns have no parking
@@ -1130,7 +1180,7 @@ class OutsideRouteLanesTest(Criterion):
         """
         Detects if the ego_vehicle has invaded a wrong lane
         """
-        waypoint = self._map.get_waypoint(location, lane_type=carla.LaneType.Driving)
+        waypoint = CarlaDataProvider.get_waypoint(location, lane_type=carla.LaneType.Driving)
         lane_id = waypoint.lane_id
         road_id = waypoint.road_id
 
@@ -1206,7 +1256,7 @@ class WrongLaneTest(Criterion):
         if self._terminate_on_failure and (self.test_status == "FAILURE"):
             new_status = py_trees.common.Status.FAILURE
 
-        lane_waypoint = self._map.get_waypoint(self.actor.get_location())
+        lane_waypoint = CarlaDataProvider.get_waypoint(self.actor.get_location())
         current_lane_id = lane_waypoint.lane_id
         current_road_id = lane_waypoint.road_id
 
@@ -1422,15 +1472,8 @@ class InRouteTest(Criterion):
         self._out_route_distance = 0
         self._in_safe_route = True
 
-        self._accum_meters = []
-        prev_loc = self._route_transforms[0].location
-        for i, tran in enumerate(self._route_transforms):
-            loc = tran.location
-            d = loc.distance(prev_loc)
-            accum = 0 if i == 0 else self._accum_meters[i - 1]
-
-            self._accum_meters.append(d + accum)
-            prev_loc = loc
+        self._route_window = RouteWindow.get(self._route)
+        self._accum_meters = self._route_window.accum_meters
 
         # Blackboard variable
         blackv = py_trees.blackboard.Blackboard()
@@ -1459,8 +1502,7 @@ class InRouteTest(Criterion):
             # Get the closest distance
             for index in range(self._current_index,
                                min(self._current_index + self.WINDOWS_SIZE + 1, self._route_length)):
-                ref_location = self._route_transforms[index].location
-                distance = math.sqrt(((location.x - ref_location.x) ** 2) + ((location.y - ref_location.y) ** 2))
+                distance = self._route_window.distance_2d(index, location)
                 if distance <= shortest_distance:
                     closest_index = index
                     shortest_distance = distance
@@ -1543,6 +1585,7 @@ class RouteCompletionTest(Criterion):
         self._index = 0
         self._route_length = len(self._route)
         self._route_transforms, _ = zip(*self._route)
+        self._route_window = RouteWindow.get(self._route)
         self._route_accum_perc = self._get_acummulated_percentages()
 
         self.target_location = self._route_transforms[-1].location
@@ -1554,15 +1597,7 @@ class RouteCompletionTest(Criterion):
 
     def _get_acummulated_percentages(self):
         """Gets the accumulated percentage of each of the route transforms"""
-        accum_meters = []
-        prev_loc = self._route_transforms[0].location
-        for i, tran in enumerate(self._route_transforms):
-            d = tran.location.distance(prev_loc)
-            new_d = 0 if i == 0 else accum_meters[i - 1]
-
-            accum_meters.append(d + new_d)
-            prev_loc = tran.location
-
+        accum_meters = self._route_window.accum_meters
         max_dist = accum_meters[-1]
         return [x / max_dist * 100 for x in accum_meters]
 
@@ -1583,12 +1618,7 @@ class RouteCompletionTest(Criterion):
 
             for index in range(self._index, min(self._index + self.WINDOWS_SIZE + 1, self._route_length)):
                 # Get the dot product to know if it has passed this location
-                route_transform = self._route_transforms[index]
-                route_location = route_transform.location
-                wp_dir = route_transform.get_forward_vector()          # Waypoint's forward vector
-                wp_veh = location - route_location                     # vector route - vehicle
-
-                if wp_veh.dot(wp_dir) > 0:
+                if self._route_window.has_passed(index, location):
                     self._index = index
                     self.actual_value = self._route_accum_perc[self._index]
 
@@ -1709,7 +1739,7 @@ class RunningRedLightTest(Criterion):
 
             for wp in waypoints:
 
-                tail_wp = self._map.get_waypoint(tail_far_pt)
+                tail_wp = CarlaDataProvider.get_waypoint(tail_far_pt)
 
                 # Calculate the dot product (Might be unscaled, as only its sign is important)
                 ve_dir = CarlaDataProvider.get_transform(self.actor).get_forward_vector()
@@ -1898,7 +1928,7 @@ class RunningStopTest(Criterion):
         steps = int(self.PROXIMITY_THRESHOLD / self.WAYPOINT_STEP)
 
         # Add the actor location
-        wp = self._map.get_waypoint(actor.get_location())
+        wp = CarlaDataProvider.get_waypoint(actor.get_location())
         wp_list.append(wp)
 
         # And its forward waypoints
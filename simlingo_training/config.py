@@ -44,8 +44,18 @@ class DrivingModelConfig:
 class DatasetBaseConfig:
     data_path: str = "/home/katrinrenz/coding/wayve_carla/database/expertv3_2*"
     bucket_path: str = "data/buckets"
+    # persistent route/bucket index, built once and memory-mapped by all datasets and ranks
+    sample_index_dir: str = "database/sample_index"
+    rebuild_sample_index: bool = False
+    # also stat the files of every route at startup, routes that are regenerated in place are only noticed with this
+    validate_sample_index: bool = False
 
     cut_bottom_quarter: bool = False
+    # jpg: decode the jpgs of the dataset, shards: memory-mapped decoded frames (dataset_generation/create_image_shards.py),
+    # augments the cropped instead of the full frame and does not load rgb_org_size (see image_shards.py)
+    image_backend: str = 'jpg'
+    # json: one measurements/XXXX.json.gz per frame, packed: memory-mapped per-route arrays (dataset_generation/create_measurement_store.py)
+    measurement_backend: str = 'json'
     use_1d_wps: bool = False
 
     use_commentary: bool = False
@@ -109,6 +119,8 @@ class DrivingDataModuleConfig:
     train_partitions: Optional[Dict[str, float]] = None
     train_partitions_dreamer: Optional[Dict[str, float]] = None
     use_global_img: bool = False
+    # resize/split/normalize the images on the GPU after the batch transfer instead of in the collate function
+    preprocess_images_on_gpu: bool = False
     
     _target_: str = "simlingo_training.dataloader.datamodule.DataModule"
 
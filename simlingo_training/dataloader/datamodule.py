@@ -15,7 +15,7 @@ from transformers import AutoProcessor
 # from simlingo_training.dataloader.dataset_driving import Data_Driving # is called directly by hydra.utils.instantiate, keeping here to make it easier to find
 # from simlingo_training.dataloader.dataset_dreamer import Data_Dreamer # is called directly by hydra.utils.instantiate, keeping here to make it easier to find
 from simlingo_training.utils.custom_types import DrivingExample, DrivingInput, DrivingLabel, LanguageLabel
-from simlingo_training.utils.internvl2_utils import preprocess_image_batch, get_custom_chat_template, get_num_image_tokens_per_patch
+from simlingo_training.utils.internvl2_utils import preprocess_image_batch_tensor, get_custom_chat_template, get_num_image_tokens_per_patch
 from simlingo_training.utils.projection import get_camera_intrinsics, get_camera_extrinsics
 
 def encode_uint8(strings: List[str], common_length: int) -> torch.Tensor:
@@ -233,25 +233,31 @@ class DataModule(LightningDataModule):
         grid_nums = [self.NUM_IMAGE_PATCHES] # we split the front forward into two patches (1x2)
 
         image_ff_pixel, image_ff_sizes = None, None
-        image_ff_org = torch.tensor(np.asarray([data[i].image_ff_org_size for i in range(BS)]))
+        # None with image_backend shards, the uncropped frames are not loaded for training
+        image_ff_org = None
+        if data[0].image_ff_org_size is not None:
+            image_ff_org = torch.tensor(np.asarray([data[i].image_ff_org_size for i in range(BS)]))
             
         for idx, img_to_consider in enumerate(self.IMAGES_TO_CONSIDER):
             img_tmp = getattr(data[0], img_to_consider)
             T, C, H, W = img_tmp.shape
             assert T == 1, "Only one timestep as input supported"
             
-            images_batch_tensor = torch.tensor(np.asarray([getattr(data[i], img_to_consider) if getattr(data[i], img_to_consider) is not None else np.zeros_like(img_tmp) for i in range(len(data))])).float()
+            images_batch_tensor = torch.tensor(np.asarray([getattr(data[i], img_to_consider) if getattr(data[i], img_to_consider) is not None else np.zeros_like(img_tmp) for i in range(len(data))]))
             images_batch_tensor = images_batch_tensor.view(BS*T, C, H, W)
-            images_batch_list = list(images_batch_tensor)
 
             if 'internvl2' in self.encoder_variant.lower():
-                # get image patches
-                images_processed = preprocess_image_batch(images_batch_list, input_size=448, use_global_img=self.use_global_img, max_num_grid=grid_nums[idx])    
+                if self.preprocess_images_on_gpu:
+                    # keep the raw uint8 images (4x less to transfer), the patches are created in on_after_batch_transfer
+                    images_pixel = images_batch_tensor.unsqueeze(1)
+                    image_sizes = torch.tensor([[H, W]] * (BS*T))
+                else:
+                    # get image patches
+                    images_processed = preprocess_image_batch_tensor(images_batch_tensor, input_size=448, use_global_img=self.use_global_img, max_num_grid=grid_nums[idx])
+                    images_pixel = images_processed['pixel_values']
+                    image_sizes = images_processed['image_sizes']
             else:
                 raise ValueError(f"Image preprocessing for {self.encoder_variant} not implemented")
-                
-            images_pixel = images_processed['pixel_values']
-            image_sizes = images_processed['image_sizes']
             
             assert images_pixel.shape[0] == BS * T
             num_patches = images_pixel.shape[1]
@@ -342,6 +348,20 @@ class DataModule(LightningDataModule):
             qa_templates=qa_templates,
         )
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if not self.preprocess_images_on_gpu:
+            return batch
+
+        # the batch is already on the GPU -> resize, split into patches and normalize there
+        images = batch.driving_input.camera_images # [B, T, 1, C, H, W] uint8
+        B, T, _, C, H, W = images.shape
+        images_processed = preprocess_image_batch_tensor(images.view(B*T, C, H, W), input_size=448, use_global_img=self.use_global_img, max_num_grid=self.NUM_IMAGE_PATCHES)
+        pixel_values = images_processed['pixel_values']
+        pixel_values = pixel_values.view(B, T, *pixel_values.shape[1:])
+
+        driving_input = batch.driving_input._replace(camera_images=pixel_values)
+        return batch._replace(driving_input=driving_input)
+
     def dl_collate_fn_val(self, data):
         pass
 
@@ -4,10 +4,8 @@ partially taken from https://github.com/autonomousvision/carla_garage/blob/main/
 (MIT licence)
 """
 import datetime
-import glob
 import gzip
 import os
-import pickle as pkl
 import random
 import sys
 from pathlib import Path
@@ -23,7 +21,12 @@ from scipy.interpolate import interp1d
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
+import simlingo_training.utils.route_geometry as route_geometry
 import simlingo_training.utils.transfuser_utils as t_u
+from simlingo_training.dataloader.image_shards import ImageShardReader, crop_bottom
+from simlingo_training.dataloader.measurement_store import MeasurementStoreReader
+from simlingo_training.dataloader.sample_index import (ROUTE_OK, ROUTE_RESULTS_LOAD_ERROR, ROUTE_STATUS_NAMES,
+                                                       load_bucket_index, load_sample_index)
 from simlingo_training.utils.custom_types import DatasetOutput
 from simlingo_training.utils.projection import get_camera_intrinsics, project_points
 
@@ -48,6 +51,16 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
         self.rgb_folder = 'rgb'
         self.dreamer_folder = 'dreamer'
+
+        if self.image_backend == 'shards':
+            self.image_shard_reader = ImageShardReader(cropped=self.cut_bottom_quarter or self.img_shift_augmentation)
+        elif self.image_backend != 'jpg':
+            raise ValueError(f"Image backend {self.image_backend} not supported.")
+
+        if self.measurement_backend == 'packed':
+            self.measurement_store_reader = MeasurementStoreReader()
+        elif self.measurement_backend != 'json':
+            raise ValueError(f"Measurement backend {self.measurement_backend} not supported.")
         
         self.images = []
         self.boxes = []
@@ -140,54 +153,27 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
 
 
+        # route level information (infraction filter, number of frames, dreamer files) and the bucket membership
+        # come from a persistent index that is built once and memory-mapped afterwards
+        sample_index = load_sample_index(repo_path, self.data_path, self.sample_index_dir,
+                                         rgb_folder=self.rgb_folder, dreamer_folder=self.dreamer_folder,
+                                         rebuild=self.rebuild_sample_index,
+                                         validate_routes=self.validate_sample_index)
+
         if not self.bucket_name == "all":
-            with open(f"{repo_path}/" + self.bucket_path + '/buckets_paths.pkl', 'rb') as f:
-                bucket_dict = pkl.load(f)
-
-            bucket_run_ids = None
-
-            # TODO: this is stupid that its manual, should change bucket names to match the saved dict with pathes
-            if self.bucket_name == "all":
-                pass
-            elif self.bucket_name == 'acceleration_negative_5':
-                bucket_run_ids = bucket_dict['acceleration_-5']# + bucket_dict['acceleration_-20'] + bucket_dict['acceleration_-40']
-            elif self.bucket_name == "acceleration_negative_1":
-                bucket_run_ids = bucket_dict['acceleration_-1']
-            elif self.bucket_name == "acceleration_positive_1":
-                bucket_run_ids = bucket_dict['acceleration_5']
-            elif self.bucket_name == "acceleration_positive_5":
-                bucket_run_ids = bucket_dict['acceleration_20']# + bucket_dict['acceleration_40'] + bucket_dict['acceleration_1000000']
-            elif self.bucket_name == "lateral_control_1":
-                bucket_run_ids = bucket_dict['lateral_control_1']
-            elif self.bucket_name == "lateral_control_1_2":
-                bucket_run_ids = bucket_dict['lateral_control_1'] + bucket_dict['lateral_control_2']
-            elif self.bucket_name == "lateral_control_high":
-                bucket_run_ids = bucket_dict['lateral_control_2'] + bucket_dict['lateral_control_5'] + bucket_dict['lateral_control_1000000']
-            elif self.bucket_name == "lateral_control_higher_5":
-                bucket_run_ids = bucket_dict['lateral_control_5'] + bucket_dict['lateral_control_1000000']
-            elif self.bucket_name == "recovery":
-                bucket_run_ids = bucket_dict['recovery_data_small'] + bucket_dict['recovery_data_large']
-            else:
-                if self.bucket_name not in bucket_dict:
-                    raise ValueError(f"Bucket name {self.bucket_name} not found.")
-                bucket_run_ids = bucket_dict[self.bucket_name]
-
-            run_id_dict = {}
-            if bucket_run_ids is not None:
-                for run_id in bucket_run_ids:
-                    run_id = run_id.replace('database/simlingo_v2_2025_01_10', self.bucket_path)
-                    run_id_path = Path(run_id)
-                    run_id_parent = run_id_path.parent
-                    run_id_name = run_id_path.name
-                    run_id_absolut = str(run_id_parent)
-                    run_id_absolut = f"{repo_path}/{str(run_id_parent)}"
-                    if run_id_absolut not in run_id_dict:
-                        run_id_dict[run_id_absolut] = [run_id_name]
-                    else:
-                        run_id_dict[run_id_absolut].append(run_id_name)
+            bucket_index = load_bucket_index(repo_path, self.bucket_path, self.sample_index_dir,
+                                             rebuild=self.rebuild_sample_index)
+
+            # the bucket names of the config can be unions of saved buckets (BUCKET_GROUPS)
+            bucket_keys = bucket_index.bucket_keys(self.bucket_name)
+            run_id_dict = bucket_index.run_id_dict(bucket_keys, repo_path)
 
+        if evaluation:
+            # set lookup instead of scanning the list for every frame
+            all_eval_samples = set(self.all_eval_samples)
 
-        route_dirs = glob.glob(f"{repo_path}/" + self.data_path + '/data/simlingo/*/*/*/Town*')
+        route_dirs = sample_index.route_dirs(repo_path)
+        route_ids = {route_dir: i for i, route_dir in enumerate(route_dirs)}
         print(f'Found {len(route_dirs)} routes in {repo_path + self.data_path}')
         
         if not self.use_old_towns:
@@ -224,55 +210,29 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         for sub_root in tqdm(route_dirs, file=sys.stdout):
 
             route_dir = sub_root # + '/' + route
+            route_id = route_ids[route_dir]
             if dreamer:
-                dreamer_dir = route_dir.replace('data/', f'{self.dreamer_folder}/')
-                if not os.path.exists(dreamer_dir):
+                if not sample_index.has_dreamer[route_id]:
                     continue
+                dreamer_frames = sample_index.dreamer_frame_set(route_id)
 
             if filter_infractions_per_route:
-                if not os.path.isfile(route_dir + '/results.json.gz'):
+                route_status = int(sample_index.status[route_id])
+                if route_status != ROUTE_OK:
                     total_routes += 1
-                    crashed_routes += 1
-                    if "no_results.json" not in fail_reasons:
-                        fail_reasons["no_results.json"] = 1
+                    if route_status != ROUTE_RESULTS_LOAD_ERROR:
+                        crashed_routes += 1
+                    fail_reason = ROUTE_STATUS_NAMES[route_status]
+                    if fail_reason not in fail_reasons:
+                        fail_reasons[fail_reason] = 1
                     else:
-                        fail_reasons["no_results.json"] += 1
+                        fail_reasons[fail_reason] += 1
                     continue
-
-                with gzip.open(route_dir + '/results.json.gz', 'rt') as f:
-                    total_routes += 1
-                    try:
-                        results_route = ujson.load(f)
-                    except Exception as e:
-                        print(f"Error in {route_dir}")
-                        print(e)
-                        if "results.json_load_error" not in fail_reasons:
-                            fail_reasons["results.json_load_error"] = 1
-                        else:
-                            fail_reasons["results.json_load_error"] += 1
-                        continue
-
-                if results_route['scores']['score_composed'] < 100.0:  # we also count imperfect runs as failed (except minspeedinfractions)
-                    cond1 = results_route['scores']['score_route'] > 94.0  # we allow 6% of the route score to be missing
-                    cond2 = results_route['num_infractions'] == (len(results_route['infractions']['min_speed_infractions']) + len(results_route['infractions']['outside_route_lanes']))
-                    if not (cond1 and cond2):  # if the only problem is minspeedinfractions, keep it
-                        crashed_routes += 1
-                        if "route_crashed" not in fail_reasons:
-                            fail_reasons["route_crashed"] = 1
-                        else:
-                            fail_reasons["route_crashed"] += 1
-                        continue
+                total_routes += 1
 
             perfect_routes += 1
 
-            # if not os.path.exists(route_dir + f'/{self.rgb_folder}'):
-            #     if "no_rgb_folder" not in fail_reasons:
-            #         fail_reasons["no_rgb_folder"] = 1
-            #     else:
-            #         fail_reasons["no_rgb_folder"] += 1
-            #     continue
-
-            num_seq = len(os.listdir(route_dir + f'/{self.rgb_folder}'))
+            num_seq = int(sample_index.num_seq[route_id])
 
             for seq in range(self.skip_first_n_frames, num_seq - self.pred_len - self.hist_len - 1):
                 image = []
@@ -282,13 +242,13 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
                 measurement_file = route_dir + '/measurements' + f'/{(seq + self.hist_len-1):04}.json.gz'
 
-                if evaluation and measurement_file not in self.all_eval_samples:
+                if evaluation and measurement_file not in all_eval_samples:
                     continue
                 
                 if dreamer:
-                    dreamer_file_path = measurement_file.replace('measurements', f'{self.dreamer_folder}').replace('data/', f'{self.dreamer_folder}/')
-                    if not os.path.exists(dreamer_file_path):
+                    if (seq + self.hist_len - 1) not in dreamer_frames:
                         continue
+                    dreamer_file_path = measurement_file.replace('measurements', f'{self.dreamer_folder}').replace('data/', f'{self.dreamer_folder}/')
                  
                 if self.bucket_name is not None and self.bucket_name != "all":
                     measurement_file_path = Path(measurement_file)
@@ -357,12 +317,18 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
     
 
     def load_current_and_future_measurements(self, measurements, sample_start):
-        loaded_measurements = []
-
         ######################################################
         ######## load current and future measurements ########
         ######################################################
 
+        if self.measurement_backend == 'packed':
+            measurement_dir = str(measurements[0], encoding='utf-8')
+            loaded_measurements = self.measurement_store_reader.load(measurement_dir, sample_start, self.hist_len + self.pred_len)
+            current_measurement = loaded_measurements[self.hist_len - 1]
+            measurement_file_current = measurement_dir + (f'/{(sample_start + self.hist_len-1):04}.json.gz')
+            return loaded_measurements, current_measurement, measurement_file_current
+
+        loaded_measurements = []
         # Since we load measurements for future time steps, we load and store them separately
         for i in range(self.hist_len):
             measurement_file = str(measurements[0], encoding='utf-8') + (f'/{(sample_start + i):04}.json.gz')
@@ -390,49 +356,20 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         return loaded_measurements, current_measurement, measurement_file_current
 
     def load_waypoints(self, data, loaded_measurements, aug_translation=0.0, aug_rotation=0.0):
-
-        waypoints = self.get_waypoints(loaded_measurements[self.hist_len - 1:],
-                                                                        y_augmentation=aug_translation,
-                                                                        yaw_augmentation=aug_rotation)
-        data['waypoints'] = np.array(waypoints[1:-1])
-
-        waypoints_org = self.get_waypoints(loaded_measurements[self.hist_len - 1:],
-                                                                        y_augmentation=0,
-                                                                        yaw_augmentation=0)
-        data['waypoints_org'] = np.array(waypoints_org[1:-1])
-
-        # 1D waypoints: only consider distance between waypoints
-        waypoints_1d = [np.linalg.norm(waypoints_org[i+1] - waypoints_org[i]) for i in range(len(waypoints_org)-1)]
-        # cumsum to get the distance from the start
-        waypoints_1d = np.cumsum(waypoints_1d)
-        waypoints_1d = [[x, 0] for x in waypoints_1d]
-        data['waypoints_1d'] = np.array(waypoints_1d[:-1]).reshape(-1, 2)
-
-        waypoints = [np.array([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, 0], [0, 0, 0, 1]]) for x, y in waypoints]
-        data['ego_waypoints'] = np.array(waypoints[:-1])
-        
-        waypoints_org = [np.array([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, 0], [0, 0, 0, 1]]) for x, y in waypoints_org]
-        data['ego_waypoints_org'] = np.array(waypoints_org[:-1])
+        ego_matrices = np.stack([measurement['ego_matrix'] for measurement in loaded_measurements[self.hist_len - 1:]])
+        data.update(route_geometry.get_waypoint_targets(ego_matrices, y_augmentation=aug_translation, yaw_augmentation=aug_rotation))
 
         return data
     
     def load_route(self, data, current_measurement, aug_translation=0.0, aug_rotation=0.0):
-        route = current_measurement['route_original']
-        route = self.augment_route(route, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
-
-        route_adjusted = np.array(current_measurement['route'])
-        route_adjusted_org = self.augment_route(route_adjusted, y_augmentation=0, yaw_augmentation=0)
-        route_adjusted = self.augment_route(route_adjusted, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
-        if len(route) < self.num_route_points:
-            num_missing = self.num_route_points - len(route)
-            route = np.array(route)
-            # Fill the empty spots by repeating the last point.
-            route = np.vstack((route, np.tile(route[-1], (num_missing, 1))))
-        else:
-            route = np.array(route[:self.num_route_points])
-            
-        route_adjusted = self.equal_spacing_route(route_adjusted)
-        route_adjusted_org = self.equal_spacing_route(route_adjusted_org)
+        route = route_geometry.augment_points(current_measurement['route_original'], y_augmentation=aug_translation, yaw_augmentation=aug_rotation)
+        route = route_geometry.pad_route(route, self.num_route_points)
+
+        # the original and the augmented adjusted route have the same length and are resampled together
+        route_adjusted = np.asarray(current_measurement['route'], dtype=np.float64)
+        route_adjusted = np.stack((route_geometry.augment_points(route_adjusted, y_augmentation=0, yaw_augmentation=0),
+                                   route_geometry.augment_points(route_adjusted, y_augmentation=aug_translation, yaw_augmentation=aug_rotation)))
+        route_adjusted_org, route_adjusted = self.equal_spacing_route(route_adjusted)
         route = self.equal_spacing_route(route)
         
         data['route'] = route
@@ -444,40 +381,51 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
     def load_images(self, data, images, augment_sample=False):
         loaded_images = []
         loaded_images_org_size = []
+        image_paths = []
         for i in range(self.hist_len):
             images_i = None
             images_path = str(images[i], encoding='utf-8')
             if augment_sample:
                 images_path = images_path.replace('rgb', 'rgb_augmented')
+            image_paths.append(images_path)
 
-            if not os.path.isfile(images_path):
-                print(f"File not found: {images_path}")
-                raise FileNotFoundError
+            if self.image_backend == 'shards':
+                # decoded and already cropped, the uncropped frame is not stored (see image_shards.py)
+                images_i = self.image_shard_reader.load(images_path)
+                if self.img_augmentation: # and random.random() <= self.img_augmentation_prob:
+                    images_i = self.tfs(image=images_i)
+            else:
+                if not os.path.isfile(images_path):
+                    print(f"File not found: {images_path}")
+                    raise FileNotFoundError
 
-            images_i = cv2.imread(images_path, cv2.IMREAD_COLOR)
-            images_i = cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB)
+                images_i = cv2.imread(images_path, cv2.IMREAD_COLOR)
+                images_i = cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB)
 
-            if self.img_augmentation: # and random.random() <= self.img_augmentation_prob:
-                images_i = self.tfs(image=images_i)
-            
-            image_org = images_i.copy()
-            if self.cut_bottom_quarter or self.img_shift_augmentation:
-                # to remove the bonnet whih is important for the shifted camera augmentation
-                # we need to remove 4.8/16 of the bottomf of the image (empirical value)
-                images_i = images_i[:int(images_i.shape[0] - (images_i.shape[0] * 4.8) // 16), :, :]
+                if self.img_augmentation: # and random.random() <= self.img_augmentation_prob:
+                    images_i = self.tfs(image=images_i)
+                
+                image_org = images_i.copy()
+                if self.cut_bottom_quarter or self.img_shift_augmentation:
+                    images_i = crop_bottom(images_i)
+                loaded_images_org_size.append(image_org)
 
             loaded_images.append(images_i)
-            loaded_images_org_size.append(image_org)
         
         processed_image = np.asarray(loaded_images)
-        processed_image_org_size = np.asarray(loaded_images_org_size)
 
         # we want [T, N, C, H, W], T is the number of temporal frames, N is the number of cam views, C is the number of channels, H is the height and W is the width
         processed_image = np.transpose(processed_image, (0, 3, 1, 2)) # (T, C, H, W)
-        processed_image_org_size = np.transpose(processed_image_org_size, (0, 3, 1, 2)) # (T, C, H, W)
 
         data['rgb'] = processed_image
-        data['rgb_org_size'] = processed_image_org_size
+        data['rgb_paths'] = image_paths
+        if self.image_backend == 'shards':
+            # only the camera visualisation needs it, visualise_cameras decodes the jpgs of rgb_paths
+            data['rgb_org_size'] = None
+        else:
+            processed_image_org_size = np.asarray(loaded_images_org_size)
+            processed_image_org_size = np.transpose(processed_image_org_size, (0, 3, 1, 2)) # (T, C, H, W)
+            data['rgb_org_size'] = processed_image_org_size
 
         return data
 
@@ -540,18 +488,7 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         return target_options, placeholder_values
 
     def equal_spacing_route(self, points):
-        route = np.concatenate((np.zeros_like(points[:1]),  points)) # Add 0 to front
-        shift = np.roll(route, 1, axis=0) # Shift by 1
-        shift[0] = shift[1] # Set wraparound value to 0
-
-        dists = np.linalg.norm(route-shift, axis=1)
-        dists = np.cumsum(dists)
-        dists += np.arange(0, len(dists))*1e-4 # Prevents dists not being strictly increasing
-
-        x = np.arange(0, 20, 1)
-        interp_points = np.array([np.interp(x, dists, route[:, 0]), np.interp(x, dists, route[:, 1])]).T
-
-        return interp_points
+        return route_geometry.equal_spacing_route(points)
     
     def visualise_cameras(
         self,
@@ -561,12 +498,17 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         name: str = "img",
         prompt=None,
         answer=None,
+        image_paths=None,
     ) -> np.ndarray:
         
         fov = 110
 
-        img_front_np = batch.image_ff_org_size #[0, ...]
-        img_front_np = img_front_np.transpose(0, 2, 3, 1)
+        if batch.image_ff_org_size is None:
+            # image_backend shards, the uncropped frames are decoded here
+            img_front_np = np.asarray([cv2.cvtColor(cv2.imread(path, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB) for path in image_paths])
+        else:
+            img_front_np = batch.image_ff_org_size #[0, ...]
+            img_front_np = img_front_np.transpose(0, 2, 3, 1)
         # two patches..dim 1 of img_front is 2 (left and right patches)
         # concatenate them to get a single image
         # img_front_1 = img_front[:, 0, ...]
@@ -678,23 +620,10 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
         return target_speed_index
 
     def augment_route(self, route, y_augmentation=0.0, yaw_augmentation=0.0):
-        aug_yaw_rad = np.deg2rad(yaw_augmentation)
-        rotation_matrix = np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad),
-                                                                                    np.cos(aug_yaw_rad)]])
-
-        translation = np.array([[0.0, y_augmentation]])
-        route_aug = (rotation_matrix.T @ (route - translation).T).T
-        return route_aug
+        return route_geometry.augment_points(route, y_augmentation=y_augmentation, yaw_augmentation=yaw_augmentation)
 
     def augment_target_point(self, target_point, y_augmentation=0.0, yaw_augmentation=0.0):
-        aug_yaw_rad = np.deg2rad(yaw_augmentation)
-        rotation_matrix = np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad),
-                                                                                np.cos(aug_yaw_rad)]])
-
-        translation = np.array([[0.0], [y_augmentation]])
-        pos = np.expand_dims(target_point, axis=1)
-        target_point_aug = rotation_matrix.T @ (pos - translation)
-        return np.squeeze(target_point_aug)
+        return route_geometry.augment_points(target_point, y_augmentation=y_augmentation, yaw_augmentation=yaw_augmentation)
 
     def parse_bounding_boxes(self, boxes, future_boxes=None, y_augmentation=0.0, yaw_augmentation=0):
 
@@ -784,31 +713,9 @@ class BaseDataset(Dataset):  # pylint: disable=locally-disabled, invalid-name
 
     def get_waypoints(self, measurements, y_augmentation=0.0, yaw_augmentation=0.0):
         """transform waypoints to be origin at ego_matrix"""
-        origin = measurements[0]
-        origin_matrix = np.array(origin['ego_matrix'])[:3]
-        origin_translation = origin_matrix[:, 3:4]
-        origin_rotation = origin_matrix[:, :3]
-
-        waypoints = []
-        for index in range(len(measurements)):
-            waypoint = np.array(measurements[index]['ego_matrix'])[:3, 3:4]
-            waypoint_ego_frame = origin_rotation.T @ (waypoint - origin_translation)
-            # Drop the height dimension because we predict waypoints in BEV
-            waypoints.append(waypoint_ego_frame[:2, 0])
-
-        # Data augmentation
-        waypoints_aug = []
-        aug_yaw_rad = np.deg2rad(yaw_augmentation)
-        rotation_matrix = np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad),
-                                                                                                                                                            np.cos(aug_yaw_rad)]])
-
-        translation = np.array([[0.0], [y_augmentation]])
-        for waypoint in waypoints:
-            pos = np.expand_dims(waypoint, axis=1)
-            waypoint_aug = rotation_matrix.T @ (pos - translation)
-            waypoints_aug.append(np.squeeze(waypoint_aug))
-
-        return waypoints_aug
+        ego_matrices = np.stack([measurement['ego_matrix'] for measurement in measurements])
+        waypoints = route_geometry.ego_matrices_to_local(ego_matrices)
+        return route_geometry.augment_points(waypoints, y_augmentation=y_augmentation, yaw_augmentation=yaw_augmentation)
 
 def image_augmenter(prob=0.2, cutout=False):
     augmentations = [
@@ -320,7 +320,7 @@ class Data_Driving(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         
         if VIZ_DATA:
             # front image with path and waypoints and commentary
-            self.visualise_cameras(data_new, commentary, data['route_adjusted'], data['waypoints'], options=None, prompt=prompt, answer=answer, name="img")
+            self.visualise_cameras(data_new, commentary, data['route_adjusted'], data['waypoints'], options=None, prompt=prompt, answer=answer, name="img", image_paths=data['rgb_paths'])
         return data_new
 
 
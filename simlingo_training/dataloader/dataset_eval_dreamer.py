@@ -214,5 +214,5 @@ class Eval_Dreamer(BaseDataset):  # pylint: disable=locally-disabled, invalid-na
         
         if VIZ_DATA:
             # front image with path and waypoints and commentary
-            self.visualise_cameras(data_new, None, path, waypoints, options, name="dreamer_", prompt=prompt, answer=answer)
+            self.visualise_cameras(data_new, None, path, waypoints, options, name="dreamer_", prompt=prompt, answer=answer, image_paths=data['rgb_paths'])
         return data_new
\ No newline at end of file
@@ -0,0 +1,87 @@
+"""
+Pre-decoded image shards.
+Every camera folder of a route (rgb, rgb_augmented) is stored as one uint8 .npy array of shape [N, H, W, 3] with the
+decoded RGB frames in their original resolution, already cropped (bonnet removed) if the dataset crops. The resize to
+the InternVL2 tile grid stays in the collate function, like for the jpgs.
+The shards are written by dataset_generation/create_image_shards.py and memory-mapped during training,
+which removes the JPEG decoding and color conversion from the data loader workers.
+The image augmentation runs on the cropped frame instead of the full frame. The augmenters work per pixel or on a
+small neighbourhood, only the blur and elastic transformation at the bottom border differ from the jpg backend.
+The uncropped frames (rgb_org_size) are not stored, the camera visualisation decodes the jpg.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import ujson
+
+SHARD_SUFFIX = '_frames.npy'
+SHARD_META_SUFFIX = '_frames.json'
+
+
+def crop_bottom(image):
+    # to remove the bonnet whih is important for the shifted camera augmentation
+    # we need to remove 4.8/16 of the bottomf of the image (empirical value)
+    return image[:int(image.shape[0] - (image.shape[0] * 4.8) // 16), :, :]
+
+
+def get_shard_paths(route_dir, camera_folder):
+    return (os.path.join(route_dir, camera_folder + SHARD_SUFFIX),
+            os.path.join(route_dir, camera_folder + SHARD_META_SUFFIX))
+
+
+def split_image_path(image_path):
+    """.../<route>/<camera_folder>/0005.jpg -> (<route>, <camera_folder>, 5)"""
+    camera_dir, file_name = os.path.split(image_path)
+    route_dir, camera_folder = os.path.split(camera_dir)
+    return route_dir, camera_folder, int(file_name.split('.')[0])
+
+
+class ImageShardReader:
+    """
+    Reads frames from the memory-mapped shards. Each data loader worker keeps a small LRU cache of open
+    shards, because a memory map holds a file descriptor and we have tens of thousands of routes.
+    """
+
+    def __init__(self, cropped=True, max_open_shards=64):
+        self.cropped = cropped
+        self.max_open_shards = max_open_shards
+        self.shards = OrderedDict()
+
+    def get_shard(self, route_dir, camera_folder):
+        key = (route_dir, camera_folder)
+        if key in self.shards:
+            self.shards.move_to_end(key)
+            return self.shards[key]
+
+        shard_path, meta_path = get_shard_paths(route_dir, camera_folder)
+        if not os.path.isfile(shard_path):
+            print(f"File not found: {shard_path}")
+            raise FileNotFoundError
+        with open(meta_path, 'r') as f:
+            meta = ujson.load(f)
+        if meta['cropped'] != self.cropped:
+            raise ValueError(f"Image shard {shard_path} was created with cropped={meta['cropped']} "
+                             f"but the dataset uses cropped={self.cropped}.")
+
+        return self.open_shard(key, shard_path)
+
+    def open_shard(self, key, shard_path):
+        shard = np.load(shard_path, mmap_mode='r')
+        self.shards[key] = shard
+        if len(self.shards) > self.max_open_shards:
+            self.shards.popitem(last=False)
+        return shard
+
+    def load(self, image_path):
+        """Returns the frame belonging to the given jpg path as [H, W, 3] uint8 RGB array."""
+        route_dir, camera_folder, frame = split_image_path(image_path)
+        shard = self.get_shard(route_dir, camera_folder)
+        # copy out of the memory map, the augmentations work in place
+        return np.array(shard[frame])
+
+    def __getstate__(self):
+        # memory maps are not send to the data loader workers, every worker opens its own
+        state = self.__dict__.copy()
+        state['shards'] = OrderedDict()
+        return state
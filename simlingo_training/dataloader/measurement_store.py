@@ -0,0 +1,116 @@
+"""
+Packed measurement store.
+The measurements of a route (one measurements/XXXX.json.gz per frame) are stored column wise in
+<route>/measurements_packed/: one .npy array per field with the frame as first dimension, the variable length
+routes as one flat [M, 2] array plus offsets. The store is written by dataset_generation/create_measurement_store.py
+and memory-mapped during training, so loading the hist_len + pred_len measurements of a sample is an array slice
+instead of one gunzip + json parse per frame.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import ujson
+
+STORE_FOLDER = 'measurements_packed'
+STORE_META = 'meta.json'
+
+# the fields used by the datasets, all other fields of the json files are not stored
+SCALAR_FIELDS = {
+    'speed': np.float64,
+    'augmentation_translation': np.float64,
+    'augmentation_rotation': np.float64,
+    'command': np.int64,
+    'next_command': np.int64,
+}
+ARRAY_FIELDS = {
+    'ego_matrix': np.float64,
+    'target_point': np.float64,
+    'target_point_next': np.float64,
+}
+ROUTE_FIELDS = ['route', 'route_original']
+
+
+def get_store_dir(measurement_dir):
+    """.../<route>/measurements -> .../<route>/measurements_packed"""
+    return os.path.join(os.path.dirname(measurement_dir), STORE_FOLDER)
+
+
+def pack_measurements(measurements):
+    """Converts the list of measurement dicts of one route (ordered by frame) into the arrays of the store."""
+    arrays = {}
+    for field, dtype in {**SCALAR_FIELDS, **ARRAY_FIELDS}.items():
+        if field in measurements[0]:
+            arrays[field] = np.array([m[field] for m in measurements], dtype=dtype)
+    for field in ROUTE_FIELDS:
+        if field in measurements[0]:
+            routes = [np.array(m[field], dtype=np.float64).reshape(-1, 2) for m in measurements]
+            arrays[field] = np.concatenate(routes, axis=0)
+            arrays[field + '_offsets'] = np.cumsum([0] + [len(route) for route in routes], dtype=np.int64)
+    return arrays
+
+
+class MeasurementStore:
+    """Memory-mapped measurements of one route."""
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, STORE_META), 'r') as f:
+            meta = ujson.load(f)
+        self.num_frames = meta['num_frames']
+        self.arrays = {name: np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+        self.fields = [field for field in meta['arrays'] if not field.endswith('_offsets')]
+
+    def get(self, frame):
+        """Returns the measurement of a frame as dict with the same keys as the json file."""
+        measurement = {}
+        for field in self.fields:
+            values = self.arrays[field]
+            if field in ROUTE_FIELDS:
+                offsets = self.arrays[field + '_offsets']
+                measurement[field] = values[offsets[frame]:offsets[frame + 1]]
+            elif field in SCALAR_FIELDS:
+                measurement[field] = values[frame].item()
+            else:
+                measurement[field] = values[frame]
+        return measurement
+
+
+class MeasurementStoreReader:
+    """
+    Reads measurements from the packed stores. Like the ImageShardReader every data loader worker keeps a small
+    LRU cache of open stores.
+    """
+
+    def __init__(self, max_open_stores=64):
+        self.max_open_stores = max_open_stores
+        self.stores = OrderedDict()
+
+    def get_store(self, measurement_dir):
+        if measurement_dir in self.stores:
+            self.stores.move_to_end(measurement_dir)
+            return self.stores[measurement_dir]
+
+        store_dir = get_store_dir(measurement_dir)
+        if not os.path.isfile(os.path.join(store_dir, STORE_META)):
+            print(f"File not found: {store_dir}")
+            raise FileNotFoundError
+        store = MeasurementStore(store_dir)
+        self.stores[measurement_dir] = store
+        if len(self.stores) > self.max_open_stores:
+            self.stores.popitem(last=False)
+        return store
+
+    def load(self, measurement_dir, sample_start, num_frames):
+        """
+        Returns the measurements of the frames sample_start ... sample_start + num_frames - 1.
+        Frames after the end of the route repeat the last frame (same as the fallback for missing json files).
+        """
+        store = self.get_store(measurement_dir)
+        frames = np.minimum(np.arange(sample_start, sample_start + num_frames), store.num_frames - 1)
+        return [store.get(frame) for frame in frames]
+
+    def __getstate__(self):
+        # memory maps are not send to the data loader workers, every worker opens its own
+        state = self.__dict__.copy()
+        state['stores'] = OrderedDict()
+        return state
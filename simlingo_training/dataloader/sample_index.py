@@ -0,0 +1,368 @@
+"""
+Persistent on-disk sample index for the CARLA datasets.
+BaseDataset used to glob all routes, gunzip every results.json.gz and list every rgb folder at startup,
+which is repeated for every bucket, for train and val and on every DDP rank. The index below is built once
+from the route folders, stored as plain .npy files and memory-mapped by every dataset instance afterwards.
+"""
+import fcntl
+import glob
+import gzip
+import hashlib
+import os
+import pickle as pkl
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import ujson
+from tqdm import tqdm
+
+INDEX_VERSION = 1
+
+# route status codes, the names match the fail reasons reported by BaseDataset
+ROUTE_OK = 0
+ROUTE_NO_RESULTS = 1
+ROUTE_RESULTS_LOAD_ERROR = 2
+ROUTE_CRASHED = 3
+ROUTE_STATUS_NAMES = {
+    ROUTE_NO_RESULTS: 'no_results.json',
+    ROUTE_RESULTS_LOAD_ERROR: 'results.json_load_error',
+    ROUTE_CRASHED: 'route_crashed',
+}
+
+ROUTE_GLOB = '/data/simlingo/*/*/*/Town*'
+
+# watch_mtimes entry of a watched path that did not exist when the index was built
+MISSING_MTIME = -1
+
+# folder of the bucket index that dataset_generation/data_buckets/build_buckets.py writes next to buckets_paths.pkl
+BUCKET_INDEX_FOLDER = 'bucket_index'
+
+# bucket names of the dataset config that are unions of the saved buckets
+BUCKET_GROUPS = {
+    'acceleration_negative_5': ['acceleration_-5'],
+    'acceleration_negative_1': ['acceleration_-1'],
+    'acceleration_positive_1': ['acceleration_5'],
+    'acceleration_positive_5': ['acceleration_20'],
+    'lateral_control_1': ['lateral_control_1'],
+    'lateral_control_1_2': ['lateral_control_1', 'lateral_control_2'],
+    'lateral_control_high': ['lateral_control_2', 'lateral_control_5', 'lateral_control_1000000'],
+    'lateral_control_higher_5': ['lateral_control_5', 'lateral_control_1000000'],
+    'recovery': ['recovery_data_small', 'recovery_data_large'],
+}
+
+
+def _hash_key(*parts):
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _to_relative(path, repo_path):
+    return os.path.relpath(path, repo_path)
+
+
+def _atomic_save_dir(tmp_dir, final_dir):
+    # os.replace can not overwrite a non-empty directory -> move the old index out of the way first
+    if os.path.exists(final_dir):
+        old_dir = f'{final_dir}.old_{os.getpid()}'
+        os.replace(final_dir, old_dir)
+        os.replace(tmp_dir, final_dir)
+        for file in os.listdir(old_dir):
+            os.remove(os.path.join(old_dir, file))
+        os.rmdir(old_dir)
+    else:
+        os.replace(tmp_dir, final_dir)
+
+
+class _IndexLock:
+    """File lock so that only one DDP rank / process builds an index, the others wait and load it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'w')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def route_is_valid(results_route):
+    """Infraction filter applied per route (same rule that was used inside BaseDataset)."""
+    if results_route['scores']['score_composed'] < 100.0:  # we also count imperfect runs as failed (except minspeedinfractions)
+        cond1 = results_route['scores']['score_route'] > 94.0  # we allow 6% of the route score to be missing
+        cond2 = results_route['num_infractions'] == (len(results_route['infractions']['min_speed_infractions']) + len(results_route['infractions']['outside_route_lanes']))
+        if not (cond1 and cond2):  # if the only problem is minspeedinfractions, keep it
+            return False
+    return True
+
+
+class SampleIndex:
+    """
+    Route level index of a dataset root.
+    All arrays are memory-mapped, so the index can be shared by all dataset instances and DDP ranks
+    without copying it into every process.
+
+    routes:           [R] bytes, route folder relative to the repo path
+    status:           [R] int8, one of the ROUTE_* codes (infraction filter result)
+    num_seq:          [R] int32, number of rgb frames of the route
+    has_dreamer:      [R] bool, whether the dreamer folder of the route exists
+    dreamer_offsets:  [R+1] int64, CSR offsets into dreamer_frames
+    dreamer_frames:   [D] int32, frame ids with an existing dreamer file
+    """
+    ARRAYS = ['routes', 'status', 'num_seq', 'has_dreamer', 'dreamer_offsets', 'dreamer_frames', 'watch_dirs', 'watch_mtimes']
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = ujson.load(f)
+
+    def __len__(self):
+        return self.routes.shape[0]
+
+    def route_dirs(self, repo_path):
+        return [f"{repo_path}/{str(route, encoding='utf-8')}" for route in self.routes]
+
+    def dreamer_frame_set(self, route_idx):
+        start, end = self.dreamer_offsets[route_idx], self.dreamer_offsets[route_idx + 1]
+        return set(self.dreamer_frames[start:end].tolist())
+
+    def is_up_to_date(self, validate_routes=False):
+        """
+        Cheap validation: the data roots matched by the data_path glob have to be the same and the folders that
+        contain the routes must not have changed their mtime, which catches added and removed routes.
+        With validate_routes the watched paths of every route (rgb and dreamer folders, results files) are checked
+        too, a route that is regenerated in place is only noticed then. Watched paths that did not exist when the
+        index was built must still be missing.
+        """
+        if self.meta.get('version') != INDEX_VERSION or 'num_watch_folders' not in self.meta:
+            return False
+        if sorted(glob.glob(self.meta['data_glob'])) != self.meta['data_roots']:
+            return False
+        num_watched = len(self.watch_dirs) if validate_routes else self.meta['num_watch_folders']
+        for watch_path, mtime in zip(self.watch_dirs[:num_watched], self.watch_mtimes[:num_watched]):
+            try:
+                if os.stat(str(watch_path, encoding='utf-8')).st_mtime_ns != mtime:
+                    return False
+            except FileNotFoundError:
+                if mtime != MISSING_MTIME:
+                    return False
+        return True
+
+    @staticmethod
+    def build(repo_path, data_path, index_dir, rgb_folder='rgb', dreamer_folder='dreamer'):
+        data_glob = f"{repo_path}/" + data_path
+        data_roots = sorted(glob.glob(data_glob))
+        route_dirs = sorted(glob.glob(data_glob + ROUTE_GLOB))
+        print(f'Building sample index for {len(route_dirs)} routes in {repo_path + data_path}')
+
+        status = np.zeros(len(route_dirs), dtype=np.int8)
+        num_seq = np.zeros(len(route_dirs), dtype=np.int32)
+        has_dreamer = np.zeros(len(route_dirs), dtype=bool)
+        dreamer_offsets = np.zeros(len(route_dirs) + 1, dtype=np.int64)
+        dreamer_frames = []
+
+        for i, route_dir in enumerate(tqdm(route_dirs, file=sys.stdout)):
+            dreamer_dir = route_dir.replace('data/', f'{dreamer_folder}/')
+            has_dreamer[i] = os.path.exists(dreamer_dir)
+            if has_dreamer[i] and os.path.isdir(f'{dreamer_dir}/{dreamer_folder}'):
+                frames = sorted(int(file.split('.')[0]) for file in os.listdir(f'{dreamer_dir}/{dreamer_folder}') if file.endswith('.json.gz'))
+                dreamer_frames.extend(frames)
+            dreamer_offsets[i + 1] = len(dreamer_frames)
+
+            if not os.path.isfile(route_dir + '/results.json.gz'):
+                status[i] = ROUTE_NO_RESULTS
+                continue
+            with gzip.open(route_dir + '/results.json.gz', 'rt') as f:
+                try:
+                    results_route = ujson.load(f)
+                except Exception as e:
+                    print(f"Error in {route_dir}")
+                    print(e)
+                    status[i] = ROUTE_RESULTS_LOAD_ERROR
+                    continue
+            if not route_is_valid(results_route):
+                status[i] = ROUTE_CRASHED
+                continue
+
+            num_seq[i] = len(os.listdir(route_dir + f'/{rgb_folder}'))
+
+        # the data roots and all folders between them and the routes, their mtime changes when routes are added or
+        # removed, followed by the files and folders of every route the index was built from
+        num_parents = len(Path(ROUTE_GLOB).parts) - 1
+        watch_folders = set(data_roots)
+        watch_route_paths = set()
+        for route_dir in route_dirs:
+            watch_folders.update(str(parent) for parent in list(Path(route_dir).parents)[:num_parents])
+            dreamer_dir = route_dir.replace('data/', f'{dreamer_folder}/')
+            watch_route_paths.update([f'{route_dir}/results.json.gz', f'{route_dir}/{rgb_folder}',
+                                      dreamer_dir, f'{dreamer_dir}/{dreamer_folder}'])
+        watch_dirs = sorted(watch_folders) + sorted(watch_route_paths - watch_folders)
+        watch_mtimes = np.array([os.stat(watch_dir).st_mtime_ns if os.path.exists(watch_dir) else MISSING_MTIME
+                                 for watch_dir in watch_dirs], dtype=np.int64)
+
+        arrays = {
+            'routes': np.array([_to_relative(route_dir, repo_path) for route_dir in route_dirs]).astype(np.string_),
+            'status': status,
+            'num_seq': num_seq,
+            'has_dreamer': has_dreamer,
+            'dreamer_offsets': dreamer_offsets,
+            'dreamer_frames': np.array(dreamer_frames, dtype=np.int32),
+            'watch_dirs': np.array(watch_dirs).astype(np.string_),
+            'watch_mtimes': watch_mtimes,
+        }
+        meta = {'version': INDEX_VERSION, 'data_path': data_path, 'data_glob': data_glob, 'data_roots': data_roots,
+                'rgb_folder': rgb_folder, 'num_watch_folders': len(watch_folders), 'created': time.time()}
+
+        tmp_dir = f'{index_dir}.tmp_{os.getpid()}'
+        Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            ujson.dump(meta, f)
+        _atomic_save_dir(tmp_dir, index_dir)
+
+
+class BucketIndex:
+    """
+    Bucket membership, converted from buckets_paths.pkl or written by build_buckets.py.
+    Per bucket key we store the (route, frame) pairs of the samples in two memory-mapped arrays,
+    so a dataset only touches the buckets it uses instead of unpickling all of them.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = ujson.load(f)
+        self.routes = np.load(os.path.join(index_dir, 'routes.npy'), mmap_mode='r')
+
+    def __contains__(self, key):
+        return key in self.meta['keys']
+
+    def keys(self):
+        return list(self.meta['keys'].keys())
+
+    def bucket_keys(self, bucket_name):
+        """Saved bucket keys of a bucket name of the dataset config, see BUCKET_GROUPS."""
+        group = BUCKET_GROUPS.get(bucket_name, [bucket_name])
+        keys = [key for key in group if key in self]
+        if not keys:
+            raise ValueError(f"Bucket name {bucket_name} not found.")
+        missing = [key for key in group if key not in self]
+        if missing:
+            # empty buckets are not saved, the group is smaller than configured
+            print(f"WARNING: Bucket {bucket_name}: the index {self.index_dir} has no bucket {', '.join(missing)}, "
+                  f"using only {', '.join(keys)}.")
+        return keys
+
+    def key_arrays(self, key):
+        """Route ids and frames of the samples of a bucket key."""
+        file_key = self.meta['keys'][key]
+        route_ids = np.load(os.path.join(self.index_dir, f'{file_key}_route.npy'), mmap_mode='r')
+        frames = np.load(os.path.join(self.index_dir, f'{file_key}_frame.npy'), mmap_mode='r')
+        return route_ids, frames
+
+    def run_id_dict(self, keys, repo_path):
+        """Returns {measurement folder: set of frame file names} for the union of the given bucket keys."""
+        run_id_dict = {}
+        for key in keys:
+            route_ids, frames = self.key_arrays(key)
+            for route_id, frame in zip(route_ids.tolist(), frames.tolist()):
+                route = f"{repo_path}/{str(self.routes[route_id], encoding='utf-8')}"
+                if route not in run_id_dict:
+                    run_id_dict[route] = set()
+                run_id_dict[route].add(f'{frame:04}.json.gz')
+        return run_id_dict
+
+    def is_up_to_date(self, bucket_file):
+        return self.meta.get('version') == INDEX_VERSION and os.stat(bucket_file).st_mtime_ns == self.meta['bucket_file_mtime']
+
+    @staticmethod
+    def write(index_dir, routes, per_key, meta, arrays=None):
+        """
+        Atomically writes an index, routes are the measurement folders, per_key maps a bucket key to its
+        (route ids, frames) and arrays are additional per route arrays (saved as {name}.npy).
+        """
+        tmp_dir = f'{index_dir}.tmp_{os.getpid()}'
+        Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+        keys = {}
+        for i, (key, (key_routes, key_frames)) in enumerate(per_key.items()):
+            # bucket names contain dots and minus signs, use a running number as file name
+            keys[key] = f'bucket_{i:03}'
+            np.save(os.path.join(tmp_dir, f'bucket_{i:03}_route.npy'), np.asarray(key_routes, dtype=np.int32))
+            np.save(os.path.join(tmp_dir, f'bucket_{i:03}_frame.npy'), np.asarray(key_frames, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, 'routes.npy'), np.array(list(routes), dtype=np.bytes_).reshape(-1))
+        for name, array in (arrays or {}).items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            ujson.dump({'version': INDEX_VERSION, **meta, 'keys': keys}, f)
+        _atomic_save_dir(tmp_dir, index_dir)
+
+    @staticmethod
+    def build(bucket_file, bucket_path, index_dir):
+        with open(bucket_file, 'rb') as f:
+            bucket_dict = pkl.load(f)
+
+        route_ids = {}
+        per_key = {}
+        for key, run_ids in bucket_dict.items():
+            key_routes = []
+            key_frames = []
+            for run_id in run_ids:
+                run_id = run_id.replace('database/simlingo_v2_2025_01_10', bucket_path)
+                run_id_path = Path(run_id)
+                parent = str(run_id_path.parent)
+                if parent not in route_ids:
+                    route_ids[parent] = len(route_ids)
+                key_routes.append(route_ids[parent])
+                key_frames.append(int(run_id_path.name.split('.')[0]))
+            per_key[key] = (key_routes, key_frames)
+
+        BucketIndex.write(index_dir, route_ids.keys(), per_key, {'bucket_file_mtime': os.stat(bucket_file).st_mtime_ns})
+
+
+def load_sample_index(repo_path, data_path, index_root, rgb_folder='rgb', dreamer_folder='dreamer', rebuild=False,
+                      validate_routes=False):
+    """
+    Loads the sample index of data_path, (re)builds it if it does not exist or is outdated.
+    validate_routes also checks the files of every route, see SampleIndex.is_up_to_date.
+    """
+    index_dir = f'{repo_path}/{index_root}/samples_{_hash_key(data_path, rgb_folder, dreamer_folder)}'
+    with _IndexLock(f'{index_dir}.lock'):
+        if not rebuild and os.path.exists(os.path.join(index_dir, 'meta.json')):
+            index = SampleIndex(index_dir)
+            if index.is_up_to_date(validate_routes=validate_routes):
+                return index
+            print(f'Sample index {index_dir} is outdated, rebuilding it.')
+        SampleIndex.build(repo_path, data_path, index_dir, rgb_folder=rgb_folder, dreamer_folder=dreamer_folder)
+    return SampleIndex(index_dir)
+
+
+def load_bucket_index(repo_path, bucket_path, index_root, rebuild=False):
+    """
+    Loads the bucket index of bucket_path. The index of build_buckets.py in bucket_path/bucket_index is used as is,
+    otherwise bucket_path/buckets_paths.pkl is converted (again if it changed).
+    """
+    built_index_dir = f"{repo_path}/{bucket_path}/{BUCKET_INDEX_FOLDER}"
+    if os.path.isfile(os.path.join(built_index_dir, 'meta.json')):
+        index = BucketIndex(built_index_dir)
+        if index.meta.get('version') == INDEX_VERSION:
+            return index
+        print(f'Bucket index {built_index_dir} has an old version, using buckets_paths.pkl.')
+
+    bucket_file = f"{repo_path}/" + bucket_path + '/buckets_paths.pkl'
+    index_dir = f'{repo_path}/{index_root}/buckets_{_hash_key(bucket_path)}'
+    with _IndexLock(f'{index_dir}.lock'):
+        if not rebuild and os.path.exists(os.path.join(index_dir, 'meta.json')):
+            index = BucketIndex(index_dir)
+            if index.is_up_to_date(bucket_file):
+                return index
+        BucketIndex.build(bucket_file, bucket_path, index_dir)
+    return BucketIndex(index_dir)
@@ -129,51 +129,59 @@ class DrivingModel(pl.LightningModule):
 
 
         if self.predict_language:
-            # per batch item because of padding
-            for b_idx, (input_embed, attention_mask) in enumerate(zip(input_embeds_all, attention_masks)):
-                input_embed = input_embed.unsqueeze(0)
-                attention_mask = attention_mask.unsqueeze(0)
-                if self.language_model.variant == 'OpenGVLab/InternVL2-4B':
-                    eos = self.tokenizer.added_tokens_encoder['<|end|>']
-                elif self.language_model.variant == 'OpenGVLab/InternVL2-2B':
-                    eos = self.tokenizer.added_tokens_encoder['<|im_end|>']
-                else:
-                    eos = self.tokenizer.eos_token_id
-
-                # BUG: input_embeds, cot
-                sampled_tokens, input_embeds = self.language_model.greedy_sample(
-                    input_embed,
-                    eos_token_id=eos,
-                    max_new_tokens=100,
-                    input_embed_matrix=self.adaptors.language.embed_tokens.weight,
-                    logit_matrix=self.adaptors.language.lm_head.weight,
-                    attention_mask=attention_mask,
-                    # position_ids=position_ids,
-                )
-                
-                inputs_driving = self.adaptors.driving(driving_input)
-                input_embed_concat = torch.cat((input_embeds, inputs_driving["inputs"][b_idx].unsqueeze(0)), dim=1)
-                features, logits = self.language_model.forward(input_embed_concat)
+            if self.language_model.variant == 'OpenGVLab/InternVL2-4B':
+                eos = self.tokenizer.added_tokens_encoder['<|end|>']
+            elif self.language_model.variant == 'OpenGVLab/InternVL2-2B':
+                eos = self.tokenizer.added_tokens_encoder['<|im_end|>']
+            else:
+                eos = self.tokenizer.eos_token_id
+
+            # the prompts are left padded: padding is masked out and the position ids start at 0 for the
+            # first valid token of every sequence. This intentionally differs from training, where the LLM
+            # is called with position_ids=None and padded sequences get positions shifted by their padding
+            attention_masks = attention_masks.long()
+            position_ids = (attention_masks.cumsum(-1) - 1).clamp(min=0)
+
+            sampled_tokens, input_embeds, cache = self.language_model.greedy_sample(
+                input_embeds_all,
+                eos_token_id=eos,
+                max_new_tokens=100,
+                input_embed_matrix=self.adaptors.language.embed_tokens.weight,
+                logit_matrix=self.adaptors.language.lm_head.weight,
+                attention_mask=attention_masks,
+                position_ids=position_ids,
+                return_cache=True,
+            )
+
+            # driving queries are appended to prompt + answer, the prompt and answer are taken from the
+            # kv cache so only the last sampled token and the queries are fed through the model
+            inputs_driving = self.adaptors.driving(driving_input)["inputs"].to(input_embeds.dtype)
+            len_driving = inputs_driving.size(1)
+            driving_embeds = torch.cat((cache["pending_embeds"], inputs_driving), dim=1)
+            attention_mask_driving = torch.cat((cache["attention_mask"], torch.ones_like(cache["attention_mask"][:, :len_driving])), dim=1)
+            position_ids_driving = (attention_mask_driving.cumsum(-1) - 1).clamp(min=0)[:, -(len_driving + 1):]
+
+            features, logits, _ = self.language_model.forward_cached(
+                driving_embeds,
+                attention_mask=attention_mask_driving,
+                position_ids=position_ids_driving,
+                past_key_values=cache["past_key_values"],
+            )
+
+            driving_features = features[:, -len_driving:]
+            driving_logits = logits[:, -len_driving:]
+            predictions = self.adaptors.driving.get_predictions(driving_features, driving_logits)
 
-                len_driving = inputs_driving["inputs"].size(1)
+            for k, v in predictions.items():
+                if v is not None:
+                    setattr(self, k, v)
 
-                driving_features = features[:, -len_driving:]
-                driving_logits = logits[:, -len_driving:]
-                predictions = self.adaptors.driving.get_predictions(driving_features, driving_logits)
-                    
-                for k, v in predictions.items():
-                    if v is not None:
-                        if hasattr(self, k) and getattr(self, k) is not None:
-                            if isinstance(v, torch.Tensor):
-                                setattr(self, k, torch.cat((getattr(self, k), v), dim=0))
-                            elif isinstance(v, list):
-                                getattr(self, k).append(v)
-                            else:
-                                raise NotImplementedError(f"Type of {k} not supported")
-                        else:
-                            setattr(self, k, v)
-                                
-                self.language.append(self.tokenizer.batch_decode(sampled_tokens, skip_special_tokens=True)[0])
+            # cut every sequence after its own eos token (finished sequences are padded with eos)
+            for tokens in sampled_tokens:
+                eos_positions = (tokens == eos).nonzero()
+                if len(eos_positions) > 0:
+                    tokens = tokens[: eos_positions[0, 0] + 1]
+                self.language.append(self.tokenizer.decode(tokens, skip_special_tokens=True))
         else:
             # single forward pass same as during training so we can use the same function
             features = self.forward_model(driving_input, adaptor_dict)
@@ -142,6 +142,31 @@ class LLM(nn.Module):
 
         return features, logits
 
+    def forward_cached(self,
+        embeddings: Tensor,
+        attention_mask: Tensor = None,
+        position_ids: Optional[Tensor] = None,
+        past_key_values: Optional[Any] = None,
+    ) -> Tuple[Tensor, Tensor, Any]:
+        """
+        Same as forward but uses and returns the per-layer key/value cache, so that only the new
+        embeddings have to be fed in the next call. attention_mask covers the cached and the new tokens.
+        Works for the plain and the LoRA wrapped model since peft forwards all kwargs to the base model.
+        """
+        outputs = self.model(
+            inputs_embeds=embeddings,
+            attention_mask=attention_mask,
+            output_hidden_states=True,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True
+        )
+        features = outputs.hidden_states[-1]
+        logits = outputs[0]
+
+        return features, logits, outputs.past_key_values
+
     def sample_categorical(
         self,
         logits: Tensor,
@@ -190,8 +215,23 @@ class LLM(nn.Module):
         restrict_tokens: Optional[Tuple[int, int]] = None,
         attention_mask = None,
         position_ids = None,
+        use_cache: bool = True,
+        return_cache: bool = False,
     ) -> Tuple[Tensor, int]:
-        
+        """
+        Autoregressive sampling of up to max_new_tokens tokens for a (left padded) batch.
+        With use_cache the prompt is processed once and every step only feeds the embedding of the
+        last sampled token together with the key/value cache, instead of recomputing the full sequence
+        (prompt incl. all image tokens + generated tokens) in every step.
+        Tokens sampled after a sequence emitted eos_token_id are masked out in the attention mask.
+        Returns the sampled tokens and the embeddings of prompt + sampled tokens. With return_cache
+        additionally a dict with the key/value cache, the attention mask and position ids of the full sequence
+        and the embedding of the last sampled token which is not yet part of the cache, so that the caller can
+        continue the sequence (e.g. with the driving queries) without recomputing it.
+        """
+        if return_cache and not use_cache:
+            raise ValueError("return_cache=True requires use_cache=True, there is no cache without it.")
+
         if input_embed_matrix is None:
             if self.embed_tokens is None:
                 raise ValueError(
@@ -214,12 +254,26 @@ class LLM(nn.Module):
 
         # we start with all sequences left to complete
         incomplete_seq_mask = torch.ones(input_embeds.size(0), dtype=torch.bool, device=input_embeds.device)
+        if attention_mask is None:
+            attention_mask = torch.ones(input_embeds.shape[:2], device=input_embeds.device, dtype=torch.long)
+        attention_mask = attention_mask.long()
+        past_key_values = None
+        step_embeds = input_embeds
+        step_position_ids = position_ids
         for i in range(max_new_tokens):
-            features, logits = self.forward(
-                embeddings=input_embeds, 
-                attention_mask=attention_mask,
-                position_ids=position_ids,
-            )
+            if use_cache:
+                features, logits, past_key_values = self.forward_cached(
+                    embeddings=step_embeds,
+                    attention_mask=attention_mask,
+                    position_ids=step_position_ids,
+                    past_key_values=past_key_values,
+                )
+            else:
+                features, logits = self.forward(
+                    embeddings=input_embeds, 
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                )
 
             last_hidden_state = features[:, -1]
 
@@ -230,9 +284,15 @@ class LLM(nn.Module):
                 logits, temperature=temperature, top_k=top_k, top_p=top_p, restrict_tokens=restrict_tokens
             )
             x = F.embedding(next_token.unsqueeze(1), input_embed_matrix)
+            step_embeds = x.to(input_embeds.dtype)
 
-            input_embeds = torch.cat([input_embeds, x], dim=1)
-            attention_mask = torch.cat([attention_mask, torch.ones((input_embeds.size(0), 1), device=input_embeds.device)], dim=1)
+            input_embeds = torch.cat([input_embeds, step_embeds], dim=1)
+            # tokens of sequences that are already finished are not attended to
+            attention_mask = torch.cat([attention_mask, incomplete_seq_mask.long().unsqueeze(1)], dim=1)
+            if position_ids is not None:
+                # explicit (padding aware) position ids: continue counting from the last position of every sequence
+                step_position_ids = position_ids[:, -1:] + 1
+                position_ids = torch.cat([position_ids, step_position_ids], dim=1)
 
             # only update sequences where we haven't predicted the eos token before
             sampled_tokens[incomplete_seq_mask, i] = next_token[incomplete_seq_mask]
@@ -247,8 +307,16 @@ class LLM(nn.Module):
                     sampled_tokens = sampled_tokens[:, : i + 1]
                     break
 
-        return sampled_tokens, input_embeds
+        if return_cache:
+            cache = {
+                "past_key_values": past_key_values,
+                "attention_mask": attention_mask,
+                "position_ids": position_ids,
+                "pending_embeds": step_embeds,
+            }
+            return sampled_tokens, input_embeds, cache
 
+        return sampled_tokens, input_embeds
 
 if __name__ == "__main__":
     model = LLM("x-small", False)
@@ -54,7 +54,7 @@ class DrivingLabel(NamedTuple):
     waypoints: Tensor  # [B, F, 2] 11 future waypoints 0.2s apart
     path: Tensor 
     answer: LanguageLabel
-    image_ff_org: Tensor
+    image_ff_org: Optional[Tensor]
     eval_infos: Optional[Dict] = None
 
 class DrivingExample(NamedTuple):
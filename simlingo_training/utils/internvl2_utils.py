@@ -3,11 +3,14 @@
 
 import importlib.util
 import os
+import re
 import sys
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 from hydra.utils import to_absolute_path
 from PIL import Image
@@ -26,25 +29,52 @@ def get_num_image_tokens_per_patch(encoder_variant: str) -> int:
     num_image_tokens = int((image_size // patch_size) ** 2 * (tmp_config.downsample_ratio ** 2))
     return num_image_tokens
 
-def get_assistant_loss_mask(user_starts, assistant_starts, prompt_tokenized_ids):
-    # assistant_start_end = []
-    seq_length = prompt_tokenized_ids.shape[1]
-    loss_mask = torch.zeros(prompt_tokenized_ids.shape, dtype=torch.bool) # loss is calculated where this mask is True
-    
-    for batch_id, (user_list, assistant_list) in enumerate(zip(user_starts, assistant_starts)):
-        # batch_pairs = []
-        # assume we start with user always:
-        assert user_list[0] < assistant_list[0], "First user start should be before first assistant start"
-        assert len(user_list) == len(assistant_list), "Number of user and assistant starts should be the same"
-        
-        for i, start in enumerate(assistant_list):
-            # End is the start of the next user sequence OR the last index if it's the final sequence
-            end = user_list[i + 1] - 1 if i < len(user_list) - 1 else seq_length - 1  # updated variable name to seq_length
-            # batch_pairs.append((start, end))
-            loss_mask[batch_id, start:end+1] = True
-
-        # assistant_start_end.append(batch_pairs)
-    return loss_mask
+# taken from:
+# https://github.com/OpenGVLab/InternVL/blob/9d3a709b16874e73ffdd38b9cf53296fae4589b9/internvl_chat/internvl/train/constants.py#L7
+# https://github.com/OpenGVLab/InternVL/blob/9d3a709b16874e73ffdd38b9cf53296fae4589b9/internvl_chat/internvl/model/internvl_chat/modeling_internvl_chat.py#L294
+IMG_START_TOKEN='<img>'
+IMG_END_TOKEN='</img>'
+IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
+IMG_TOKEN = '<image>'
+
+
+@lru_cache(maxsize=None)
+def load_conversation_module(encoder_variant: str, cache_root_dir: str = 'pretrained'):
+    # conversation.py of the pretrained model, imported once per process
+    cache_dir = f"{cache_root_dir}/{(encoder_variant.split('/')[1])}"
+    # get absolute path from workspace dir not wokring dir
+    cache_dir = to_absolute_path(cache_dir)
+    model_path = f"{cache_dir}/conversation.py"
+    if not os.path.exists(model_path):
+        from huggingface_hub import snapshot_download
+        snapshot_download(repo_id=encoder_variant, local_dir=cache_dir)
+
+    #import from file from model_path
+    spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
+    conv_module = importlib.util.module_from_spec(spec)
+    sys.modules['get_conv_template'] = conv_module
+    spec.loader.exec_module(conv_module)
+    return conv_module
+
+
+def get_assistant_loss_mask(prompt_tokenized_ids, user_start_token_ids, assistant_start_token_ids):
+    # loss is calculated where this mask is True: from every assistant start up to the next user start
+    # (or the end of the sequence for the last answer)
+    def find_starts(token_ids):
+        # Create a mask by sliding the sequence across the original tensor
+        matches = (prompt_tokenized_ids.unfold(1, token_ids.shape[0], 1) == token_ids).all(dim=2)
+        padding = torch.zeros((matches.shape[0], token_ids.shape[0] - 1), dtype=torch.bool)
+        return torch.cat((matches, padding), dim=1)
+
+    # number of user/assistant turns started up to each position
+    num_user_starts = find_starts(user_start_token_ids).cumsum(dim=1)
+    num_assistant_starts = find_starts(assistant_start_token_ids).cumsum(dim=1)
+
+    # assume we start with user always:
+    assert (num_assistant_starts <= num_user_starts).all(), "First user start should be before first assistant start"
+    assert (num_user_starts[:, -1] == num_assistant_starts[:, -1]).all(), "Number of user and assistant starts should be the same"
+
+    return (num_assistant_starts == num_user_starts) & (num_assistant_starts > 0)
 
 
 def get_chat_tokens(tokenizer, prompts: List[str], user_start_token_str: str, assistant_start_token_str: str) -> Dict:
@@ -56,31 +86,9 @@ def get_chat_tokens(tokenizer, prompts: List[str], user_start_token_str: str, as
     prompt_tokenized_mask = prompt_tokenized_valid
 
     # mask user prompt (question) to calculate loss only on assistant tokens (answer)
-
     user_start_token_ids = torch.tensor(tokenizer(user_start_token_str)["input_ids"])
     assistant_start_token_ids = torch.tensor(tokenizer(assistant_start_token_str)["input_ids"])
-
-    seq_len_to_find = user_start_token_ids.shape[0]
-    seq_len_to_find_assistant = assistant_start_token_ids.shape[0]
-    # Create a mask by sliding the sequence across the original tensor
-    matches_user = (prompt_tokenized_ids.unfold(1, seq_len_to_find, 1) == user_start_token_ids).all(dim=2)
-    matches_assistant = (prompt_tokenized_ids.unfold(1, seq_len_to_find_assistant, 1) == assistant_start_token_ids).all(dim=2)
-    # Get all matches
-    match_indices_user = torch.nonzero(matches_user, as_tuple=True)
-    match_indices_assistant = torch.nonzero(matches_assistant, as_tuple=True)
-    
-    # tuple(batch id), tuple(start index) -> dict key: batch id, value: list of start indices
-    position_user_start_indices = [[] for _ in range(len(match_indices_user[0]))]
-    position_assistant_start_indices = [[] for _ in range(len(match_indices_assistant[0]))]
-    for i in range(len(match_indices_user[0])):
-        batch_id = match_indices_user[0][i].item()
-        position_user_start_indices[batch_id].append(match_indices_user[1][i].item())
-    for i in range(len(match_indices_assistant[0])):
-        batch_id = match_indices_assistant[0][i].item()
-        position_assistant_start_indices[batch_id].append(match_indices_assistant[1][i].item())
-
-    # get the start and end of the assistant
-    loss_mask = get_assistant_loss_mask(position_user_start_indices, position_assistant_start_indices, prompt_tokenized_ids)
+    loss_mask = get_assistant_loss_mask(prompt_tokenized_ids, user_start_token_ids, assistant_start_token_ids)
 
     return {
         'phrase_ids': prompt_tokenized_ids,
@@ -91,88 +99,184 @@ def get_chat_tokens(tokenizer, prompts: List[str], user_start_token_str: str, as
     }
 
 
-def get_custom_chat_template(conversations: List[Dict], tokenizer, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained') -> Optional[Dict]:
-    # get the custom chat template
-    # for full conversation, question only
-    # https://huggingface.co/docs/transformers/main/en/chat_templating#can-i-use-chat-templates-in-training
-    # this adds special tokens and bring it in the right format for the pretrained LLM
-        
-    # taken from:
-    # https://github.com/OpenGVLab/InternVL/blob/9d3a709b16874e73ffdd38b9cf53296fae4589b9/internvl_chat/internvl/train/constants.py#L7
-    # https://github.com/OpenGVLab/InternVL/blob/9d3a709b16874e73ffdd38b9cf53296fae4589b9/internvl_chat/internvl/model/internvl_chat/modeling_internvl_chat.py#L294
-    IMG_START_TOKEN='<img>'
-    IMG_END_TOKEN='</img>'
-    IMG_CONTEXT_TOKEN='<IMG_CONTEXT>'
-    IMG_TOKEN = '<image>'
-
-    cache_dir = f"{cache_root_dir}/{(encoder_variant.split('/')[1])}"
-    # get absolute path from workspace dir not wokring dir
-    cache_dir = to_absolute_path(cache_dir)
-    model_path = f"{cache_dir}/conversation.py"
-    if not os.path.exists(model_path):
-        from huggingface_hub import snapshot_download
-        snapshot_download(repo_id=encoder_variant, local_dir=cache_dir)
-        
-    #import from file from model_path
-    spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
-    conv_module = importlib.util.module_from_spec(spec)
-    sys.modules['get_conv_template'] = conv_module
-    spec.loader.exec_module(conv_module)
+class ChatTemplate:
+    """
+    Builds and tokenizes the InternVL2 chat prompts of a batch.
+    The tokenizer splits the text at its added (special) tokens and tokenizes the pieces in between independently,
+    so we do the same: the ids of the image block (<img> + num_image_tokens_total * <IMG_CONTEXT> + </img>) and of
+    the special tokens are computed once and only the text pieces that were not seen before are tokenized.
+    The spliced ids are compared with the full tokenization the first time a prompt template (the sequence of special
+    tokens and the image placeholder) is seen; prompts of templates whose ids differ are always tokenized in full.
+    """
+
+    def __init__(self, tokenizer, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained', max_cached_texts: int = 100000):
+        self.tokenizer = tokenizer
+        self.conv_module = load_conversation_module(encoder_variant, cache_root_dir)
+        self.max_cached_texts = max_cached_texts
+
+        template = self.conv_module.get_conv_template('internlm2-chat')
+        self.user_start_token_str = template.roles[0]
+        self.assistant_start_token_str = template.roles[1]
+        # template_conv.system_template -> '<|im_start|>system\n{system_message}'
+        self.system_prompt = template.system_template.replace('{system_message}', template.system_message) + template.sep
+
+        self.image_tokens_template = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * num_image_tokens_total + IMG_END_TOKEN
+        self.image_token_ids = tokenizer(self.image_tokens_template, add_special_tokens=False)["input_ids"]
+        self.user_start_token_ids = torch.tensor(tokenizer(self.user_start_token_str)["input_ids"])
+        self.assistant_start_token_ids = torch.tensor(tokenizer(self.assistant_start_token_str)["input_ids"])
+
+        self.special_token_ids = tokenizer.get_added_vocab()
+        special_tokens = sorted(self.special_token_ids.keys(), key=len, reverse=True)
+        self.special_token_pattern = re.compile('(' + '|'.join(re.escape(token) for token in special_tokens) + ')')
+        self.text_token_ids = {}
+        # prompt template -> whether the spliced ids match the tokenizer, templates that are not in here were not checked yet
+        self.use_splicing = {}
+
+    def get_prompts(self, conversations: List[Dict]):
+        prompts_conv = []
+        prompts_question = []
+        for conv in conversations:
+            assert len(conv) == 2, "For question and answer templates only two turn conversation (user + assistant) is supported. During training is should work but is not checked!!"
+            template_conv = self.conv_module.get_conv_template('internlm2-chat')
+            template_question = self.conv_module.get_conv_template('internlm2-chat')
+
+            # add full conversation
+            for conv_part_idx, conv_part in enumerate(conv):
+                content_str = conv_part['content'][0]['text']
+                if conv_part['role'] == 'assistant':
+                    template_conv.append_message(template_conv.roles[1], content_str)
+                elif conv_part['role'] == 'user':
+                    if conv_part_idx == 0 and IMG_TOKEN not in content_str:
+                        content_str = f"{IMG_TOKEN}\n" + content_str
+                    template_conv.append_message(template_conv.roles[0], content_str)
+                else:
+                    raise ValueError(f"Role {conv_part['role']} not supported")
+
+            assert conv[0]['role'] == 'user', "First turn should be user as this should be the question."
+            content_str_user = conv[0]['content'][0]['text']
+            if IMG_TOKEN not in content_str_user:
+                content_str_user = f"{IMG_TOKEN}\n" + content_str_user
+            template_question.append_message(template_question.roles[0], content_str_user)
+            template_question.append_message(template_question.roles[1], None)
+
+            # replace system prompt to reduce tokens and save memory
+            prompts_conv.append(template_conv.get_prompt().replace(self.system_prompt, ''))
+            prompts_question.append(template_question.get_prompt().replace(self.system_prompt, ''))
+
+        return prompts_conv, prompts_question
+
+    def split_text(self, text: str) -> List[str]:
+        # text pieces and special tokens, like the tokenizer splits the text
+        return [piece for piece in self.special_token_pattern.split(text) if piece]
+
+    def tokenize(self, prompts: List[str]) -> List[List[int]]:
+        """Token ids of prompts that still contain the <image> placeholder."""
+        split_prompts = []
+        for prompt in prompts:
+            # only the first <image> is replaced by the image tokens
+            if IMG_TOKEN in prompt:
+                before_image, after_image = prompt.split(IMG_TOKEN, 1)
+                split_prompts.append((self.split_text(before_image), self.split_text(after_image)))
+            else:
+                split_prompts.append((self.split_text(prompt), None))
+
+        new_texts = list({piece for pieces in split_prompts for part in pieces if part is not None for piece in part
+                          if piece not in self.special_token_ids and piece not in self.text_token_ids})
+        if len(self.text_token_ids) + len(new_texts) > self.max_cached_texts:
+            self.text_token_ids = {}
+        if len(new_texts) > 0:
+            new_token_ids = self.tokenizer(new_texts, add_special_tokens=False)["input_ids"]
+            self.text_token_ids.update(zip(new_texts, new_token_ids))
+
+        def get_ids(pieces):
+            ids = []
+            for piece in pieces:
+                if piece in self.special_token_ids:
+                    ids.append(self.special_token_ids[piece])
+                else:
+                    ids.extend(self.text_token_ids[piece])
+            return ids
+
+        prompt_ids = []
+        for before_image, after_image in split_prompts:
+            if after_image is None:
+                prompt_ids.append(get_ids(before_image))
+            else:
+                prompt_ids.append(get_ids(before_image) + self.image_token_ids + get_ids(after_image))
+        return prompt_ids
+
+    def get_template(self, prompt: str) -> Tuple:
+        # the special tokens decide where the prompt is split, the text in between is the same for all templates
+        return (IMG_TOKEN in prompt, tuple(self.special_token_pattern.findall(prompt)))
+
+    def check_splicing(self, prompts: List[str], templates: List[Tuple], prompt_dict: Dict):
+        # the prompts of templates that were not seen before are compared with their full tokenization
+        new_idxs = [i for i, template in enumerate(templates) if template not in self.use_splicing]
+        if len(new_idxs) == 0:
+            return
+        spliced = self.tokenize([prompts[i] for i in new_idxs])
+        results = {}
+        for i, spliced_ids in zip(new_idxs, spliced):
+            full_ids = prompt_dict['phrase_ids'][i][prompt_dict['phrase_valid'][i]].tolist()
+            results[templates[i]] = results.get(templates[i], True) and spliced_ids == full_ids
+        for template, matches in results.items():
+            self.use_splicing[template] = matches
+            if not matches:
+                print(f"WARNING: Spliced prompt tokens differ from the tokenizer output for the template {template}. "
+                      f"Tokenizing these prompts in full.")
+
+    def get_chat_tokens(self, prompts: List[str]) -> Dict:
+        # replace <image> with image token placeholders
+        prompts_full = [prompt.replace(IMG_TOKEN, self.image_tokens_template, 1) for prompt in prompts]
+        templates = [self.get_template(prompt) for prompt in prompts]
+        if not all(self.use_splicing.get(template, False) for template in templates):
+            prompt_dict = get_chat_tokens(self.tokenizer, prompts_full, self.user_start_token_str, self.assistant_start_token_str)
+            self.check_splicing(prompts, templates, prompt_dict)
+            return prompt_dict
+
+        prompt_ids = self.tokenize(prompts)
+        max_len = max(len(ids) for ids in prompt_ids)
+        prompt_tokenized_ids = torch.full((len(prompt_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(prompt_ids):
+            if self.tokenizer.padding_side == 'left':
+                prompt_tokenized_ids[i, max_len - len(ids):] = torch.tensor(ids)
+            else:
+                prompt_tokenized_ids[i, :len(ids)] = torch.tensor(ids)
+        prompt_tokenized_valid = prompt_tokenized_ids != self.tokenizer.pad_token_id
+
+        # mask user prompt (question) to calculate loss only on assistant tokens (answer)
+        loss_mask = get_assistant_loss_mask(prompt_tokenized_ids, self.user_start_token_ids, self.assistant_start_token_ids)
+
+        return {
+            'phrase_ids': prompt_tokenized_ids,
+            'phrase_valid': prompt_tokenized_valid,
+            'phrase_mask': prompt_tokenized_valid,
+            'language_string': prompts_full,
+            'loss_masking': loss_mask
+        }
 
-    image_tokens_templates = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * num_image_tokens_total + IMG_END_TOKEN
+    def __call__(self, conversations: List[Dict]):
+        prompts_conv, prompts_question = self.get_prompts(conversations)
 
-    prompts_conv = []
-    prompts_question = []
-    # get the custom chat template
-    for idx, conv in enumerate(conversations):
-        assert len(conv) == 2, "For question and answer templates only two turn conversation (user + assistant) is supported. During training is should work but is not checked!!"
-        template_conv = conv_module.get_conv_template('internlm2-chat')
-        template_question = conv_module.get_conv_template('internlm2-chat')
-
-        # add full conversation
-        for conv_part_idx, conv_part in enumerate(conv):
-            content_str = conv_part['content'][0]['text']
-            if conv_part['role'] == 'assistant':
-                template_conv.append_message(template_conv.roles[1], content_str)
-            elif conv_part['role'] == 'user':
-                if conv_part_idx == 0 and IMG_TOKEN not in content_str:
-                    content_str = f"{IMG_TOKEN}\n" + content_str
-                template_conv.append_message(template_conv.roles[0], content_str)
-            else:
-                raise ValueError(f"Role {conv_part['role']} not supported")
-        
-        assert conv[0]['role'] == 'user', "First turn should be user as this should be the question."
-        content_str_user = conv[0]['content'][0]['text']
-        if IMG_TOKEN not in content_str_user:
-            content_str_user = f"{IMG_TOKEN}\n" + content_str_user
-        template_question.append_message(template_question.roles[0], content_str_user)
-        template_question.append_message(template_question.roles[1], None)
-
-        # get the prompt
-        prompt_conv = template_conv.get_prompt()
-        prompt_question = template_question.get_prompt()
-
-        # replace system prompt to reduce tokens and save memory
-        # template_conv.system_template -> '<|im_start|>system\n{system_message}'
-        system_prompt = template_conv.system_template.replace('{system_message}', template_conv.system_message) + template_conv.sep
-        prompt_conv = prompt_conv.replace(system_prompt, '')
-        prompt_question = prompt_question.replace(system_prompt, '')
+        conv_dict = self.get_chat_tokens(prompts_conv)
+        question_dict = self.get_chat_tokens(prompts_question)
 
-        # replace <image> with image token placeholders
-        prompt_conv = prompt_conv.replace(IMG_TOKEN, image_tokens_templates, 1)
-        prompt_question = prompt_question.replace(IMG_TOKEN, image_tokens_templates, 1)
+        return conv_dict, question_dict
 
-        prompts_conv.append(prompt_conv)
-        prompts_question.append(prompt_question)
 
-    # on list of prompts to get the padding right
-    user_start_token_str = template_conv.roles[0]
-    assistant_start_token_str = template_conv.roles[1]
+@lru_cache(maxsize=None)
+def get_chat_template(tokenizer, vocab_size: int, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained') -> ChatTemplate:
+    # one template per tokenizer (and number of tokens, in case special tokens are added later)
+    return ChatTemplate(tokenizer, encoder_variant, num_image_tokens_total, cache_root_dir)
 
-    conv_dict = get_chat_tokens(tokenizer, prompts_conv, user_start_token_str, assistant_start_token_str)
-    question_dict = get_chat_tokens(tokenizer, prompts_question, user_start_token_str, assistant_start_token_str)
 
-    return conv_dict, question_dict
+def get_custom_chat_template(conversations: List[Dict], tokenizer, encoder_variant: str, num_image_tokens_total: int, cache_root_dir: str = 'pretrained') -> Optional[Dict]:
+    # get the custom chat template
+    # for full conversation, question only
+    # https://huggingface.co/docs/transformers/main/en/chat_templating#can-i-use-chat-templates-in-training
+    # this adds special tokens and bring it in the right format for the pretrained LLM
+    chat_template = get_chat_template(tokenizer, len(tokenizer), encoder_variant, num_image_tokens_total, cache_root_dir)
+    return chat_template(conversations)
 
 
 
@@ -203,6 +307,45 @@ def preprocess_image_batch(
     return images_processed
 
 
+def preprocess_image_batch_tensor(
+        images,
+        input_size=448,
+        use_global_img=False,
+        max_num_grid=2,
+    ):
+    """
+    Batched tensor version of preprocess_image_batch. All images of our camera have the same size, so the tile grid
+    is computed once and the whole batch is resized, split into tiles and normalized at once. Runs on the device
+    of the input (CPU in the collate function or GPU after the batch transfer).
+    images: [B, C, H, W] uint8 or float tensor with values in [0, 255]
+    """
+    B, C, H, W = images.shape
+    grid_w, grid_h = get_target_grid(W, H, 1, max_num_grid, input_size)
+
+    images = images.float()
+    # bicubic with antialiasing follows the PIL resize used in dynamic_preprocess, PIL works on uint8 -> round and clamp
+    resized = F.interpolate(images, size=(grid_h * input_size, grid_w * input_size), mode='bicubic', align_corners=False, antialias=True)
+    resized = resized.round_().clamp_(0, 255)
+    # tiles in row-major order like dynamic_preprocess: [B, grid_h * grid_w, C, input_size, input_size]
+    tiles = resized.view(B, C, grid_h, input_size, grid_w, input_size).permute(0, 2, 4, 1, 3, 5)
+    tiles = tiles.reshape(B, grid_h * grid_w, C, input_size, input_size)
+
+    if use_global_img and grid_h * grid_w != 1:
+        thumbnail = F.interpolate(images, size=(input_size, input_size), mode='bicubic', align_corners=False, antialias=True)
+        thumbnail = thumbnail.round_().clamp_(0, 255)
+        tiles = torch.cat((tiles, thumbnail.unsqueeze(1)), dim=1)
+
+    mean = torch.tensor(IMAGENET_MEAN, device=images.device).view(1, 1, 3, 1, 1) * 255.0
+    std = torch.tensor(IMAGENET_STD, device=images.device).view(1, 1, 3, 1, 1) * 255.0
+    pixel_values = (tiles - mean) / std
+
+    images_processed = {
+        'pixel_values': pixel_values,
+        'image_sizes': torch.tensor([[H, W]] * B),
+        }
+    return images_processed
+
+
 def build_transform(input_size):
     MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
     transform = T.Compose([
@@ -228,19 +371,25 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
                 best_ratio = ratio
     return best_ratio
 
-def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
+@lru_cache(maxsize=None)
+def get_target_ratios(min_num=1, max_num=12):
     target_ratios = set(
         (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
         i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return sorted(target_ratios, key=lambda x: x[0] * x[1])
 
+@lru_cache(maxsize=None)
+def get_target_grid(orig_width, orig_height, min_num=1, max_num=12, image_size=448):
+    """Tile grid (columns, rows) that dynamic_preprocess uses for an image of the given size."""
+    aspect_ratio = orig_width / orig_height
+    target_ratios = get_target_ratios(min_num, max_num)
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    return find_closest_aspect_ratio(aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
+    orig_width, orig_height = image.size
+
+    target_aspect_ratio = get_target_grid(orig_width, orig_height, min_num, max_num, image_size)
 
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
@@ -272,4 +421,34 @@ def load_image(image_file, input_size=448, max_num=12):
     images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
     pixel_values = [transform(image) for image in images]
     pixel_values = torch.stack(pixel_values)
-    return pixel_values
\ No newline at end of file
+    return pixel_values
+
+
+if __name__ == "__main__":
+    # parity check of the batched tensor preprocessing against the PIL path on random camera sized images
+    torch.manual_seed(0)
+    # 1024x512 camera with the bottom cut off (see BaseDataset.load_images)
+    noise_images = torch.randint(0, 256, (4, 3, 359, 1024), dtype=torch.uint8)
+    # smooth gradients like in camera images, a swapped or shifted tile shows up here
+    x = torch.linspace(0, 1, 1024).view(1, 1, 1, -1)
+    y = torch.linspace(0, 1, 359).view(1, 1, -1, 1)
+    phase = torch.rand(4, 3, 1, 1) * 6.0
+    smooth_images = ((torch.sin(6.0 * x + phase) * torch.cos(4.0 * y + phase) + 1.0) * 127.5).to(torch.uint8)
+    # max abs diff over all pixels and mean abs diff per tile in uint8 steps, noise is the worst case for the
+    # resize kernels of PIL and torch which differ slightly
+    bounds = {'noise': (32.0, 0.5), 'smooth': (2.0, 0.2)}
+    for name, images in [('noise', noise_images), ('smooth', smooth_images)]:
+        max_bound, tile_mean_bound = bounds[name]
+        for use_global_img in [False, True]:
+            pil = preprocess_image_batch(list(images.float()), input_size=448, use_global_img=use_global_img, max_num_grid=2)
+            batched = preprocess_image_batch_tensor(images, input_size=448, use_global_img=use_global_img, max_num_grid=2)
+            assert pil['pixel_values'].shape == batched['pixel_values'].shape
+            assert torch.equal(pil['image_sizes'], batched['image_sizes'])
+            diff = (pil['pixel_values'] - batched['pixel_values']).abs() * torch.tensor(IMAGENET_STD).view(1, 1, 3, 1, 1) * 255.0
+            tile_mean = diff.mean(dim=(2, 3, 4))
+            print(f"{name}, use_global_img={use_global_img}: max abs diff {diff.max():.2f}, "
+                  f"mean abs diff {diff.mean():.4f}, worst tile mean {tile_mean.max():.4f} (uint8 steps)")
+            assert diff.max() <= max_bound, f"max abs diff {diff.max():.2f} > {max_bound}"
+            worst_image, worst_tile = divmod(tile_mean.argmax().item(), tile_mean.shape[1])
+            assert (tile_mean <= tile_mean_bound).all(), \
+                f"tile {worst_tile} of image {worst_image}: mean abs diff {tile_mean.max():.4f} > {tile_mean_bound}"
@@ -0,0 +1,98 @@
+"""
+Batched waypoint and route geometry used by the datasets.
+All functions work on stacked arrays (points are [..., N, 2], ego matrices [T, 4, 4]) instead of looping over
+single points. tools/benchmark_route_geometry.py compares them with the previous per-point implementation.
+"""
+import numpy as np
+
+
+def get_rotation_matrix(yaw_augmentation):
+    aug_yaw_rad = np.deg2rad(yaw_augmentation)
+    return np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad), np.cos(aug_yaw_rad)]])
+
+
+def augment_points(points, y_augmentation=0.0, yaw_augmentation=0.0):
+    """Moves [..., N, 2] points into the frame of the shifted and rotated (augmented) camera."""
+    rotation_matrix = get_rotation_matrix(yaw_augmentation)
+    translation = np.array([0.0, y_augmentation])
+    # row vector form of rotation_matrix.T @ (point - translation)
+    return (np.asarray(points, dtype=np.float64) - translation) @ rotation_matrix
+
+
+def ego_matrices_to_local(ego_matrices):
+    """[T, 4, 4] world ego matrices -> [T, 2] BEV positions in the frame of the first matrix."""
+    ego_matrices = np.asarray(ego_matrices, dtype=np.float64)
+    origin_translation = ego_matrices[0, :3, 3]
+    origin_rotation = ego_matrices[0, :3, :3]
+    # row vector form of origin_rotation.T @ (position - origin_translation)
+    local = (ego_matrices[:, :3, 3] - origin_translation) @ origin_rotation
+    # Drop the height dimension because we predict waypoints in BEV
+    return local[:, :2]
+
+
+def waypoints_to_matrices(waypoints):
+    """[T, 2] waypoints -> [T, 4, 4] homogeneous matrices with identity rotation."""
+    matrices = np.tile(np.eye(4), (len(waypoints), 1, 1))
+    matrices[:, :2, 3] = waypoints
+    return matrices
+
+
+def get_waypoint_targets(ego_matrices, y_augmentation=0.0, yaw_augmentation=0.0):
+    """
+    Computes all waypoint variants of a sample from the stacked ego matrices of the current and future frames.
+    The first waypoint is the current position (0, 0), the last one is only used for the ego_waypoints.
+    """
+    waypoints_org = ego_matrices_to_local(ego_matrices)
+    waypoints = augment_points(waypoints_org, y_augmentation, yaw_augmentation)
+
+    # 1D waypoints: only consider distance between waypoints, cumsum to get the distance from the start
+    waypoints_1d = np.cumsum(np.linalg.norm(np.diff(waypoints_org, axis=0), axis=1))
+    waypoints_1d = np.stack([waypoints_1d, np.zeros_like(waypoints_1d)], axis=1)
+
+    return {
+        'waypoints': waypoints[1:-1],
+        'waypoints_org': waypoints_org[1:-1],
+        'waypoints_1d': waypoints_1d[:-1].reshape(-1, 2),
+        'ego_waypoints': waypoints_to_matrices(waypoints[:-1]),
+        'ego_waypoints_org': waypoints_to_matrices(waypoints_org[:-1]),
+    }
+
+
+def pad_route(route, num_route_points):
+    """Cuts the route to num_route_points or fills the empty spots by repeating the last point."""
+    route = np.asarray(route)
+    if len(route) < num_route_points:
+        return np.concatenate((route, np.repeat(route[-1:], num_route_points - len(route), axis=0)))
+    return route[:num_route_points]
+
+
+def equal_spacing_route(points, num_points=20):
+    """
+    Resamples [..., N, 2] routes (starting at the ego position) to num_points points with 1 m spacing.
+    Same as np.interp per route, points beyond the end of the route repeat the last point and an empty route
+    repeats the start point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    route = np.concatenate((np.zeros(points.shape[:-2] + (1, points.shape[-1])), points), axis=-2) # Add 0 to front
+    if route.shape[-2] < 2:
+        # no segment to interpolate on, every point is the start of the route
+        return np.repeat(route[..., :1, :], num_points, axis=-2)
+
+    dists = np.linalg.norm(np.diff(route, axis=-2), axis=-1)
+    dists = np.concatenate((np.zeros_like(dists[..., :1]), dists), axis=-1)
+    dists = np.cumsum(dists, axis=-1)
+    dists += np.arange(0, dists.shape[-1])*1e-4 # Prevents dists not being strictly increasing
+
+    x = np.arange(0, num_points, 1, dtype=np.float64)
+    # index of the segment each x falls into, clamped to the first and last segment
+    segment = np.sum(dists[..., None, :] <= x[:, None], axis=-1) - 1
+    segment = np.clip(segment, 0, dists.shape[-1] - 2)
+
+    d0 = np.take_along_axis(dists, segment, axis=-1)
+    d1 = np.take_along_axis(dists, segment + 1, axis=-1)
+    p0 = np.take_along_axis(route, segment[..., None], axis=-2)
+    p1 = np.take_along_axis(route, segment[..., None] + 1, axis=-2)
+
+    # clamp outside of the route like np.interp
+    t = np.clip((x - d0) / (d1 - d0), 0.0, 1.0)[..., None]
+    return p0 + (p1 - p0) * t
@@ -4,7 +4,6 @@ Functions for detecting red lights are adapted from scenario runners
 atomic_criteria.py
 """
 import math
-import carla
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -16,6 +15,11 @@ import shapely
 import itertools
 from copy import deepcopy
 
+try:
+  import carla
+except ImportError:  # only the simulator helpers use carla, e.g. the offline data generation runs without it
+  carla = None
+
 
 def normalize_angle(x):
   x = x % (2 * np.pi)  # force in range [0, 2 pi)
@@ -1,26 +1,9 @@
 # %%
 import os
-import subprocess
-import time
-import ujson
 import shutil
-from tqdm.autonotebook import tqdm
-
-# %%
-def get_num_jobs(job_name, username):
-    len_usrn = len(username)
-    num_running_jobs = int(
-        subprocess.check_output(
-            f"SQUEUE_FORMAT2='username:{len_usrn},name:130' squeue --sort V | grep {username} | grep {job_name} | wc -l",
-            shell=True,
-        ).decode('utf-8').replace('\n', ''))
-    try:
-        with open('max_num_jobs.txt', 'r', encoding='utf-8') as f:
-            max_num_parallel_jobs = int(f.read())
-    except:
-        max_num_parallel_jobs = 1
+import time
 
-    return num_running_jobs, max_num_parallel_jobs
+from job_orchestrator import Orchestrator, SlurmBackend, read_max_num_jobs
 
 # %%
 def bash_file_bench2drive(job, port, tm_port, partition_name):
@@ -63,6 +46,8 @@ export PYTHONPATH=$PYTHONPATH:{cfg["repo_root"]}/Bench2Drive/scenario_runner
 export SCENARIO_RUNNER_ROOT={cfg["repo_root"]}/Bench2Drive/scenario_runner
 
 export SAVE_PATH={viz_path}
+export CHECKPOINT_ENDPOINT={result_file}
+export PROFILE_LATENCY={int(cfg.get("profile_latency", False))}
 
 
 python -u {cfg["repo_root"]}/Bench2Drive/leaderboard/leaderboard/leaderboard_evaluator.py --routes={route} \
@@ -78,96 +63,6 @@ python -u {cfg["repo_root"]}/Bench2Drive/leaderboard/leaderboard/leaderboard_eva
 ''')
 
 
-# %%
-def get_running_jobs():
-    running_jobs = subprocess.check_output(f'squeue --me',shell=True).decode('utf-8').splitlines()
-    running_jobs = set(x.strip().split(" ")[0] for x in running_jobs[1:])
-    return running_jobs
-
-# %%
-def filter_completed(jobs):
-    filtered_jobs = []
-
-    running_jobs = get_running_jobs()
-    for job in jobs:
-
-        # If job is running we keep it in list (other function does killing)
-        if "job_id" in job:
-           if job["job_id"] in running_jobs:
-              filtered_jobs.append(job)
-              continue
-
-        # Keep failed jobs to resubmit
-        result_file = job["result_file"]
-        if os.path.exists(result_file):
-            try:
-                with open(result_file, "r") as f:
-                    evaluation_data = ujson.load(f)
-            except:
-                if job["tries"] > 0:
-                    filtered_jobs.append(job)
-                    continue
-
-
-            progress = evaluation_data['_checkpoint']['progress']
-
-            need_to_resubmit = False
-            if len(progress) < 2 or progress[0] < progress[1]:
-                need_to_resubmit = True
-            else:
-                for record in evaluation_data['_checkpoint']['records']:
-                    if record['status'] == 'Failed - Agent couldn\'t be set up':
-                        need_to_resubmit = True
-                    elif record['status'] == 'Failed':
-                        need_to_resubmit = True
-                    elif record['status'] == 'Failed - Simulation crashed':
-                        need_to_resubmit = True
-                    elif record['status'] == 'Failed - Agent crashed':
-                        need_to_resubmit = True
-
-            if need_to_resubmit and job["tries"] > 0:
-                filtered_jobs.append(job)
-        # Results file doesnt exist
-        elif job["tries"] > 0:
-            filtered_jobs.append(job)
-    return filtered_jobs
-
-# %%
-def kill_dead_jobs(jobs):
-
-    running_jobs = get_running_jobs()
-
-    for job in jobs:
-
-        if "job_id" in job:
-            job_id = job["job_id"]
-
-        elif os.path.exists(job["log_file"]):
-            with open(job["log_file"], "r") as f:
-                job_id = f.readline().strip().replace("JOB ID ", "")
-        
-        else:
-            continue
-
-        if job_id not in running_jobs:
-            continue
-
-        log = job["log_file"]
-        if not os.path.exists(job["log_file"]):
-            continue
-
-        with open(log) as f:
-            lines = f.readlines()
-        if len(lines)==0:
-            continue
-
-        # TODO this needs to be improved, maybe also consider the err file?
-        if any(["Watchdog exception" in line for line in lines]) or \
-            "Engine crash handling finished; re-raising signal 11 for the default handler. Good bye.\n" in lines or \
-            "[91mStopping the route, the agent has crashed:\n" in lines:
-
-            subprocess.Popen(f"scancel {job_id}", shell=True)
-
 configs = [
     {
     "agent": "simlingo",
@@ -182,13 +77,16 @@ configs = [
     "agent_file": "/PATH/TO/REPO/team_code/agent_simlingo.py",
     "team_code": "team_code",
     "agent_config": "not_used",
-    "username": "YOUR_USERNAME"
+    "profile_latency": False, # writes per stage agent timings next to the results (tools/summarize_agent_latency.py)
     }
     ] # TODO: change to your paths and model, you can add multiple configs here, whch get evaluated after each other
 
 
 # %%
-job_queue = []
+# jobs are keyed by their result file, configs with the same agent name but a different checkpoint or out_root
+# are separate jobs, every out_root gets its own journal
+job_queue = {}
+jobs_per_out_root = {}
 for cfg_idx, cfg in enumerate(configs):
     route_path = cfg["route_path"]
     routes = [x for x in os.listdir(route_path) if x[-4:]==".xml"] #########################################
@@ -233,73 +131,51 @@ for cfg_idx, cfg in enumerate(configs):
                 "tries": cfg["tries"]
             }
 
-            job_queue.append(job)
+            if result_file in job_queue:
+                raise ValueError(f"Config {cfg_idx} writes {result_file}, which another config already writes. "
+                                 f"Use a different agent name or out_root.")
+            job_queue[result_file] = job
+            name = os.path.relpath(result_file, cfg["out_root"])
+            jobs_per_out_root.setdefault(cfg["out_root"], {})[name] = job
 
 # %%
-carla_world_ports = set(range(10000, 20000, 50))
-carla_streaming_ports = set(range(20000, 30000, 50))
-carla_tm_ports = set(range(30000, 40000, 50))
-
-# %%
-jobs = len(job_queue)
-progress = tqdm(total = jobs)
-partition_name = "2080-galvani"
-while job_queue:
-    kill_dead_jobs(job_queue)
-    job_queue = filter_completed(job_queue)
-
-    progress.update(jobs - len(job_queue) - progress.n)
-
-    running_jobs = get_running_jobs()
+carla_world_ports = range(10000, 20000, 50)
+carla_tm_ports = range(30000, 40000, 50)
 
+def prepare_job(job):
+    """Writes the job file with ports that no running job uses and clears the visualization of the last attempt."""
+    # jobs that are done from their result file can still shut down CARLA for a while
     used_ports = set()
-    for job in job_queue:
-        if "job_id" in job and job["job_id"] in running_jobs:
-            used_ports.update(job["ports"])
-
-    with open('max_num_jobs.txt', 'r', encoding='utf-8') as f:
-        max_num_parallel_jobs = int(f.read())
+    for other in orchestrators:
+        recently_ended = {attempt["name"] for attempt in other.journal.attempts()
+                          if attempt["ended"] is not None and attempt["ended"] > time.time() - 300}
+        for other_job in other.journal.jobs():
+            if other_job["state"] == "running" or other_job["name"] in recently_ended:
+                used_ports.update(other_job["meta"].get("ports", []))
+    carla_world_port_start = next(port for port in carla_world_ports if port not in used_ports)
+    carla_tm_port_start = next(port for port in carla_tm_ports if port not in used_ports)
+
+    eval_job = job_queue[job["result_file"]]
+    if eval_job["cfg"]["benchmark"].lower() == "bench2drive":
+        bash_file_bench2drive(eval_job, carla_tm_port_start, carla_world_port_start, partition_name)
+    else:
+        raise NotImplementedError(f"Benchmark {eval_job['cfg']['benchmark']} not implemented.")
+
+    shutil.rmtree(eval_job["viz_path"], ignore_errors=True)
+    os.mkdir(eval_job["viz_path"])
+    return {"ports": [carla_world_port_start, carla_tm_port_start]}
 
-    if len(running_jobs) >= max_num_parallel_jobs:
-        time.sleep(5)
-        continue
-
-    for job in job_queue:
-        if job["tries"] <= 0:
-            continue
-
-        if "job_id" in job and job["job_id"] in running_jobs: # Das funktioniert nicht wenn man neu startet...
-            continue
-
-        if os.path.exists(job["log_file"]):
-            with open(job["log_file"], "r") as f:
-                job_id = f.readline().strip().replace("JOB ID ", "")
-                if job_id in running_jobs:
-                    print(f"{job['log_file']} already started.")
-                    continue
-
-        # Need to submit this job
-        # Make bash file:
-        carla_world_port_start = next(iter(carla_world_ports.difference(used_ports)))
-        carla_streaming_port_start = next(iter(carla_streaming_ports.difference(used_ports)))
-        carla_tm_port_start = next(iter(carla_tm_ports.difference(used_ports)))
-
-        if job["cfg"]["benchmark"].lower() == "bench2drive":
-            bash_file_bench2drive(job, carla_tm_port_start, carla_world_port_start, partition_name)
-            job["ports"] = {carla_world_port_start, carla_tm_port_start}
-        else:
-            raise NotImplementedError(f"Benchmark {job['cfg']['benchmark']} not implemented.")
-
-        # submit
-        shutil.rmtree(job["viz_path"])
-        os.mkdir(job["viz_path"])
-        job_id = subprocess.check_output(f'sbatch {job["job_file"]}', shell=True).decode('utf-8').strip().rsplit(' ', maxsplit=1)[-1]
-        
-        job["job_id"] = job_id
-        job["tries"] -= 1
-
-        print(f'submit {job["job_file"]}')
-        print(len(job_queue))
-        break
-
-    time.sleep(10)
\ No newline at end of file
+# %%
+# the journals keep track of the submitted jobs, restarting the script continues the evaluation
+# the out_roots are evaluated after each other, the ports of all journals are taken into account
+# use LocalBackend() to run the routes on this machine
+partition_name = "2080-galvani"
+orchestrators = []
+for out_root, jobs in jobs_per_out_root.items():
+    orchestrator = Orchestrator(os.path.join(out_root, "eval_jobs.sqlite"), SlurmBackend(),
+                                max_jobs=read_max_num_jobs, prepare=prepare_job)
+    for name, job in jobs.items():
+        orchestrator.add(name, job["job_file"], job["result_file"], job["log_file"], job["err_file"], job["tries"])
+    orchestrators.append(orchestrator)
+for orchestrator in orchestrators:
+    orchestrator.run()
@@ -4,13 +4,10 @@ partially taken from https://github.com/autonomousvision/carla_garage/blob/leade
 """
 
 
-import importlib.util
-import json
 import math
 import os
 import pathlib
 import random
-import sys
 import time
 import xml.etree.ElementTree as ET
 from collections import deque
@@ -24,7 +21,7 @@ import torch
 import ujson
 from filterpy.kalman import MerweScaledSigmaPoints
 from filterpy.kalman import UnscentedKalmanFilter as UKF
-from hydra.utils import get_original_cwd, to_absolute_path
+from hydra.utils import get_original_cwd
 from leaderboard.autoagents import autonomous_agent
 from omegaconf import OmegaConf
 from PIL import Image, ImageDraw, ImageFont
@@ -36,8 +33,10 @@ import scenario_logger
 import team_code.transfuser_utils as t_u
 from scenario_logger import ScenarioLogger
 from simlingo_training.utils.custom_types import DrivingInput, LanguageLabel
-from simlingo_training.utils.internvl2_utils import build_transform, dynamic_preprocess
+from simlingo_training.utils.internvl2_utils import load_conversation_module, preprocess_image_batch_tensor
 from team_code.config_simlingo import GlobalConfig
+from team_code.latency_profiler import LatencyProfiler, get_latency_report_path
+from team_code.metric_logger import MetricInfoWriter
 from team_code.nav_planner import LateralPIDController, RoutePlanner
 from team_code.simlingo_utils import (
     get_camera_extrinsics,
@@ -50,6 +49,7 @@ from team_code.simlingo_utils import (
 DEBUG = True # saves images during evaluation (now displays in pygame)
 HD_VIZ = False
 USE_UKF = True
+PROFILE_LATENCY = int(os.environ.get('PROFILE_LATENCY', 0)) == 1 # per stage timings, see team_code/latency_profiler.py
 USE_PYGAME_VIZ = True # 使用pygame实时显示而不是保存文件
 
 # 导入pygame可视化器
@@ -183,6 +183,11 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             ).to(self.device)
         torch.set_default_dtype(default_dtype)
         self.model.load_state_dict(torch.load(self.config_path))
+
+        self.profiler = LatencyProfiler(enabled=PROFILE_LATENCY)
+        # the model forward is split into the vision encoder and the language generation, the rest is the driving pass
+        self.profiler.wrap_method(self.model.vision_model.image_encoder, 'replace_placeholder_tokens', 'vision_encoder')
+        self.profiler.wrap_method(self.model.language_model, 'greedy_sample', 'llm_generate')
         self.iter = self.config_path.split("epoch=")[-1].split("/")[0]
         self.session = self.config_path.split("/")[-4]
         
@@ -242,6 +247,8 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         Path(self.debug_save_path).mkdir(parents=True, exist_ok=True)
         self.save_path_metric = self.debug_save_path + '/metric'
         Path(self.save_path_metric).mkdir(parents=True, exist_ok=True)
+        # appends every step on a background thread, metric_info.json is written in destroy
+        self.metric_info_writer = MetricInfoWriter(self.save_path_metric)
 
         if DEBUG:
             self.save_path_img = self.debug_save_path + '/images'
@@ -308,7 +315,6 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                                                                              self.lat_ref, self.lon_ref)
         self._route_planner.set_route(self._global_plan, True)
         self.initialized = True
-        self.metric_info = {}
 
     def sensors(self):
         sensors = []
@@ -378,6 +384,7 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         if HD_VIZ:
             self.hd_cam_for_viz = input_data['rgb_viz'][1][:, :, :3]
 
+        self.profiler.start('jpeg_roundtrip')
         for camera_pos in self.config.num_cameras:
             rgb_cam = 'rgb_' + str(camera_pos)
             camera = input_data[rgb_cam][1][:, :, :3]
@@ -397,32 +404,27 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
 
         rgb = np.array(rgb)
         self.image_buffer.append(rgb)
+        self.profiler.stop('jpeg_roundtrip')
 
         rgbs = rgb
         image_sizes = None
         
         if 'internvl2' in self.cfg.model.vision_model.variant.lower():
             T, C, H, W = rgbs.shape
-            transform = build_transform(input_size=448)
-            images_processed_tmp = []
-            images_sizes_tmp = []
-            
-            image = Image.fromarray(rgbs.squeeze(0).transpose(1, 2, 0))
-            images = dynamic_preprocess(image, image_size=448, use_thumbnail=self.cfg.model.vision_model.use_global_img, max_num=2)
-            pixel_values = [transform(image) for image in images]
-            pixel_values = torch.stack(pixel_values)
-            images_processed_tmp.append(pixel_values)
-            images_sizes_tmp.append([image.size[1], image.size[0]])
-            
-            images_processed = {
-                    'pixel_values': torch.stack(images_processed_tmp), 
-                    'image_sizes': torch.tensor(images_sizes_tmp)
-                    }  
+            self.profiler.start('image_preprocess')
+            # same preprocessing as in the training collate function, done directly on the GPU
+            images_processed = preprocess_image_batch_tensor(
+                    torch.from_numpy(rgbs).to(self.device),
+                    input_size=448,
+                    use_global_img=self.cfg.model.vision_model.use_global_img,
+                    max_num_grid=2,
+                    )
             processed_image = images_processed['pixel_values']
             num_patches = processed_image.shape[1]
             new_height = processed_image.shape[3]
             new_width = processed_image.shape[4]
             processed_image = processed_image.view(1, self.T, num_patches, C, new_height, new_width)
+            self.profiler.stop('image_preprocess')
             
         else:
             # 获取编码器类型，如果配置不存在则使用默认值
@@ -432,6 +434,7 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                 encoder_type = 'unknown'
             raise NotImplementedError(f"Encoder {encoder_type} not implemented yet. Currently only supports InternVL2.")
         
+        self.profiler.start('localization')
         gps_pos = self._route_planner.convert_gps_to_carla(input_data['gps'][1])
         
         compass = t_u.preprocess_compass(input_data['imu'][1][-1])
@@ -459,6 +462,8 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         speed = round(input_data['speed'][1]['speed'], 1)
 
         waypoint_route = self._route_planner.run_step(np.append(result['gps'], gps_pos[2]))
+        self.profiler.stop('localization')
+        self.profiler.start('prompt')
 
         if len(waypoint_route) > 2:
             target_point, far_command = waypoint_route[1]
@@ -605,19 +610,8 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                         questions.append(conv[i]['content'][0]['text'])
                         conv[i]['content'] = conv[i]['content'][0]['text']
                         
-        cache_dir = f"pretrained/{(self.cfg.model.vision_model.variant.split('/')[1])}"
-        # get absolute path from workspace dir not wokring dir
-        cache_dir = to_absolute_path(cache_dir)
-        model_path = f"{cache_dir}/conversation.py"
-        if not os.path.exists(model_path):
-                from huggingface_hub import snapshot_download
-                snapshot_download(repo_id=self.cfg.model.vision_model.variant, local_dir=cache_dir)
-                
-        #import from file from model_path
-        spec = importlib.util.spec_from_file_location('get_conv_template', model_path)
-        conv_module = importlib.util.module_from_spec(spec)
-        sys.modules['get_conv_template'] = conv_module
-        spec.loader.exec_module(conv_module)
+        # imported once, not every tick
+        conv_module = load_conversation_module(self.cfg.model.vision_model.variant)
         
         if not hasattr(self, 'tmp_config'):
                 self.tmp_config = AutoConfig.from_pretrained(self.cfg.model.vision_model.variant, trust_remote_code=True)
@@ -661,6 +655,8 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                 query = query.replace('<image>', image_tokens, 1)
                 prompt_batch_list.append(query)
                 
+        self.profiler.stop('prompt')
+        self.profiler.start('tokenize')
         prompt_tokenized = self.tokenizer(prompt_batch_list, padding=True, return_tensors="pt", return_offsets_mapping=True, add_special_tokens=False)
         prompt_tokenized_ids = prompt_tokenized["input_ids"]
         prompt_tokenized_char_offsets = prompt_tokenized["offset_mapping"].view(1, -1, 2)
@@ -684,6 +680,7 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         self.DrivingInput["target_point"] = result['target_point'].to(self.device)
         self.DrivingInput["prompt"] = ll
         self.DrivingInput["prompt_inference"] = ll
+        self.profiler.stop('tokenize')
 
         return result
 
@@ -696,20 +693,26 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             control = carla.VehicleControl(steer=0.0, throttle=0.0, brake=1.0)
             self.control = control
             tick_data = self.tick(input_data)
+            # timings of the first tick are not part of a full step
+            self.profiler.reset_step()
             return control
 
+        self.profiler.start('total')
         # Need to run this every step for GPS filtering
         tick_data = self.tick(input_data)
 
         # initialize DrivingInput with dict self.DrivingInput
+        self.profiler.start('model')
         model_input = DrivingInput(**self.DrivingInput)
         pred_speed_wps, pred_route, language = self.model(model_input)
         pred_speed_wps = pred_speed_wps.float() if pred_speed_wps is not None else None
         pred_route = pred_route.float() if pred_route is not None else None
+        self.profiler.stop('model')
 
         # prepare velocity input
         gt_velocity = tick_data['speed']
 
+        self.profiler.start('visualization')
         if DEBUG:
             tvec = None
             rvec = None
@@ -789,7 +792,10 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
                 # 保存到文件
                 image.save(f"{self.save_path_img}/{self.step}.png")
             
+        self.profiler.stop('visualization')
+        self.profiler.start('pid')
         steer, throttle, brake = self.control_pid(pred_route, gt_velocity, pred_speed_wps)
+        self.profiler.stop('pid')
 
         # # 0.1 is just an arbitrary low number to threshold when the car is stopped
         if gt_velocity < 0.1:
@@ -816,13 +822,12 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
         else:
             self.control = control
             
+        self.profiler.start('metric_info')
         metric_info = self.get_metric_info()
-        self.metric_info[self.step] = metric_info
-        if self.save_path_metric is not None and self.step % 1 == 0:
-                # metric info
-                outfile = open(f"{self.save_path_metric}/metric_info.json", 'w')
-                json.dump(self.metric_info, outfile, indent=4)
-                outfile.close()
+        self.metric_info_writer.append(self.step, metric_info)
+        self.profiler.stop('metric_info')
+        self.profiler.stop('total')
+        self.profiler.end_step()
 
         return control
 
@@ -894,6 +899,13 @@ class LingoAgent(autonomous_agent.AutonomousAgent):
             print("🎮 停止pygame可视化...")
             stop_visualization()
 
+        self.metric_info_writer.close()
+        # next to the leaderboard results if the eval script exports the result file, otherwise next to the metric info
+        if os.environ.get('CHECKPOINT_ENDPOINT') is not None:
+            self.profiler.save(get_latency_report_path(os.environ['CHECKPOINT_ENDPOINT']))
+        else:
+            self.profiler.save(f"{self.save_path_metric}/latency.json")
+
         del self.model
         del self.config
         
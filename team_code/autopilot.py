@@ -23,8 +23,10 @@ from privileged_route_planner import PrivilegedRoutePlanner
 from config import GlobalConfig
 import transfuser_utils as t_u
 from scenario_logger import ScenarioLogger
+from sensor_writer import SensorWriter
 from longitudinal_controller import LongitudinalLinearRegressionController
 from kinematic_bicycle_model import KinematicBicycleModel
+import obb_collision
 
 
 def get_entry_point():
@@ -137,6 +139,7 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
       if self.datagen:
         (self.save_path / "measurements").mkdir()
+        self.writer = SensorWriter(self.config.num_writer_threads, self.config.writer_queue_size)
 
       self.lon_logger = ScenarioLogger(
           save_path=self.save_path,
@@ -980,8 +983,7 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
     if ((self.step % self.config.data_save_freq == 0) and (self.save_path is not None) and self.datagen):
       measurements_file = self.save_path / "measurements" / f"{frame:04}.json.gz"
-      with gzip.open(measurements_file, "wt", encoding="utf-8") as f:
-        ujson.dump(data, f, indent=4)
+      self.writer.write_json_gz(measurements_file, data, use_ujson=True)
 
     return data
 
@@ -994,6 +996,10 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
             results (optional): Any additional results to be processed or saved.
         """
     if self.save_path is not None:
+      if self.datagen:
+        # Waits for the sensor data and measurements of the last frames
+        self.writer.close()
+
       self.lon_logger.dump_to_json()
 
       # Save the target speed histogram to a compressed JSON file
@@ -1153,7 +1159,8 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
   def predict_other_actors_bounding_boxes(self, plant, actor_list, ego_vehicle_location, num_future_frames,
                                           near_lane_change):
     """
-        Predict the future bounding boxes of actors for a given number of frames.
+        Predict the future bounding boxes of actors for a given number of frames. All actors and frames are
+        forecasted in one array computation, carla.BoundingBox objects are only created for the visualization.
 
         Args:
             plant (bool): Whether to use PlanT.
@@ -1163,9 +1170,12 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
             near_lane_change (bool): Whether the ego vehicle is near a lane change maneuver.
 
         Returns:
-            dict: A dictionary mapping actor IDs to lists of predicted bounding boxes for each future frame.
+            tuple: A tuple containing:
+                - list: The IDs of the forecasted actors.
+                - numpy.ndarray: The predicted bounding boxes [num actors, num_future_frames] (obb_collision.BOX_DTYPE).
         """
-    predicted_bounding_boxes = {}
+    predicted_actor_ids = []
+    predicted_bounding_boxes = obb_collision.get_boxes(np.zeros((0, num_future_frames, 3)), np.zeros(3), np.zeros(3))
 
     if not plant:
       # Filter out nearby actors within the detection radius, excluding the ego vehicle
@@ -1180,82 +1190,66 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
         previous_controls = [actor.get_control() for actor in nearby_actors]
         previous_actions = np.array([[control.steer, control.throttle, control.brake] for control in previous_controls])
 
-        # Get the current velocities, locations, and headings of the nearby actors
+        # Get the current velocities, locations, headings and extents of the nearby actors
         velocities = np.array([actor.get_velocity().length() for actor in nearby_actors])
-        locations = np.array([[actor.get_location().x,
-                               actor.get_location().y,
-                               actor.get_location().z] for actor in nearby_actors])
-        headings = np.deg2rad(np.array([actor.get_transform().rotation.yaw for actor in nearby_actors]))
-
-        # Initialize arrays to store future locations, headings, and velocities
-        future_locations = np.empty((num_future_frames, len(nearby_actors), 3), dtype="float")
-        future_headings = np.empty((num_future_frames, len(nearby_actors)), dtype="float")
-        future_velocities = np.empty((num_future_frames, len(nearby_actors)), dtype="float")
-
-        # Forecast the future locations, headings, and velocities for the nearby actors
-        for i in range(num_future_frames):
-          locations, headings, velocities = self.vehicle_model.forecast_other_vehicles(
-              locations, headings, velocities, previous_actions)
-          future_locations[i] = locations.copy()
-          future_velocities[i] = velocities.copy()
-          future_headings[i] = headings.copy()
-
-        # Convert future headings to degrees
-        future_headings = np.rad2deg(future_headings)
-
-        # Calculate the predicted bounding boxes for each nearby actor and future frame
-        for actor_idx, actor in enumerate(nearby_actors):
-          predicted_actor_boxes = []
-
-          for i in range(num_future_frames):
-            # Calculate the future location of the actor
-            location = carla.Location(x=future_locations[i, actor_idx, 0].item(),
-                                      y=future_locations[i, actor_idx, 1].item(),
-                                      z=future_locations[i, actor_idx, 2].item())
-
-            # Calculate the future rotation of the actor
-            rotation = carla.Rotation(pitch=0, yaw=future_headings[i, actor_idx], roll=0)
-
-            # Get the extent (dimensions) of the actor's bounding box
-            extent = actor.bounding_box.extent
-            # Otherwise we would increase the extent of the bounding box of the vehicle
-            extent = carla.Vector3D(x=extent.x, y=extent.y, z=extent.z)
-
-            # Adjust the bounding box size based on velocity and lane change maneuver to adjust for
-            # uncertainty during forecasting
-            s = self.config.high_speed_min_extent_x_other_vehicle_lane_change if near_lane_change \
-                else self.config.high_speed_min_extent_x_other_vehicle
-            extent.x *= self.config.slow_speed_extent_factor_ego if future_velocities[
-                i, actor_idx] < self.config.extent_other_vehicles_bbs_speed_threshold else max(
-                    s,
-                    self.config.high_speed_min_extent_x_other_vehicle * float(i) / float(num_future_frames))
-            extent.y *= self.config.slow_speed_extent_factor_ego if future_velocities[
-                i, actor_idx] < self.config.extent_other_vehicles_bbs_speed_threshold else max(
-                    self.config.high_speed_min_extent_y_other_vehicle,
-                    self.config.high_speed_extent_y_factor_other_vehicle * float(i) / float(num_future_frames))
-
-            # Create the bounding box for the future frame
-            bounding_box = carla.BoundingBox(location, extent)
-            bounding_box.rotation = rotation
-
-            # Append the bounding box to the list of predicted bounding boxes for this actor
-            predicted_actor_boxes.append(bounding_box)
-
-          # Store the predicted bounding boxes for this actor in the dictionary
-          predicted_bounding_boxes[actor.id] = predicted_actor_boxes
+        transforms = [actor.get_transform() for actor in nearby_actors]
+        locations = np.array([[transform.location.x, transform.location.y, transform.location.z]
+                              for transform in transforms])
+        headings = np.deg2rad(np.array([transform.rotation.yaw for transform in transforms]))
+        extents = np.array([[actor.bounding_box.extent.x, actor.bounding_box.extent.y, actor.bounding_box.extent.z]
+                            for actor in nearby_actors])
+
+        # Forecast the future locations, headings, and velocities for all nearby actors and frames, [actors, frames]
+        future_locations, future_headings, future_velocities = self.vehicle_model.forecast_other_vehicles_horizon(
+            locations, headings, velocities, previous_actions, num_future_frames)
+
+        # Adjust the bounding box size based on velocity and lane change maneuver to adjust for
+        # uncertainty during forecasting
+        s = self.config.high_speed_min_extent_x_other_vehicle_lane_change if near_lane_change \
+            else self.config.high_speed_min_extent_x_other_vehicle
+        horizon_fraction = np.arange(num_future_frames) / float(num_future_frames)
+        slow = future_velocities < self.config.extent_other_vehicles_bbs_speed_threshold
+        extent_factors = np.ones(future_velocities.shape + (3,))
+        extent_factors[..., 0] = np.where(
+            slow, self.config.slow_speed_extent_factor_ego,
+            np.maximum(s, self.config.high_speed_min_extent_x_other_vehicle * horizon_fraction))
+        extent_factors[..., 1] = np.where(
+            slow, self.config.slow_speed_extent_factor_ego,
+            np.maximum(self.config.high_speed_min_extent_y_other_vehicle,
+                       self.config.high_speed_extent_y_factor_other_vehicle * horizon_fraction))
+
+        future_rotations = np.zeros(future_locations.shape)
+        future_rotations[..., 1] = np.rad2deg(future_headings)
+
+        predicted_actor_ids = [actor.id for actor in nearby_actors]
+        predicted_bounding_boxes = obb_collision.get_boxes(future_locations, extents[:, None] * extent_factors,
+                                                           future_rotations)
 
         if self.visualize == 1:
-          for actor_idx, actors_forecasted_bounding_boxes in predicted_bounding_boxes.items():
-            for bb in actors_forecasted_bounding_boxes:
-              self._world.debug.draw_box(box=bb,
-                                         rotation=bb.rotation,
-                                         thickness=0.1,
-                                         color=self.config.other_vehicles_forecasted_bbs_color,
-                                         life_time=self.config.draw_life_time)
+          self._draw_forecasted_boxes(predicted_bounding_boxes, self.config.other_vehicles_forecasted_bbs_color)
+
+    return predicted_actor_ids, predicted_bounding_boxes
 
-    return predicted_bounding_boxes
+  def _draw_forecasted_boxes(self, boxes, color):
+    """
+        Draw forecasted bounding boxes (obb_collision.BOX_DTYPE) in the simulator.
 
-  def compute_target_speed_wrt_leading_vehicle(self, initial_target_speed, predicted_bounding_boxes, near_lane_change,
+        Args:
+            boxes (numpy.ndarray): The bounding boxes to draw.
+            color (carla.Color): The color of the boxes.
+        """
+    for box in boxes.reshape(-1):
+      bounding_box = carla.BoundingBox(carla.Location(*box['location'].tolist()),
+                                       carla.Vector3D(*box['extent'].tolist()))
+      pitch, yaw, roll = box['rotation'].tolist()
+      bounding_box.rotation = carla.Rotation(pitch=pitch, yaw=yaw, roll=roll)
+      self._world.debug.draw_box(box=bounding_box,
+                                 rotation=bounding_box.rotation,
+                                 thickness=0.1,
+                                 color=color,
+                                 life_time=self.config.draw_life_time)
+
+  def compute_target_speed_wrt_leading_vehicle(self, initial_target_speed, predicted_actor_ids, near_lane_change,
                                                ego_location, rear_vehicle_ids, leading_vehicle_ids,
                                                speed_reduced_by_obj, plant):
     """
@@ -1263,7 +1257,7 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
         Args:
             initial_target_speed (float): The initial target speed for the ego vehicle.
-            predicted_bounding_boxes (dict): A dictionary mapping actor IDs to lists of predicted bounding boxes.
+            predicted_actor_ids (list): The IDs of the actors with predicted bounding boxes.
             near_lane_change (bool): Whether the ego vehicle is near a lane change maneuver.
             ego_location (carla.Location): The current location of the ego vehicle.
             rear_vehicle_ids (list): A list of IDs for vehicles behind the ego vehicle.
@@ -1278,7 +1272,7 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
     target_speed_wrt_leading_vehicle = initial_target_speed
 
     if not plant:
-      for vehicle_id, _ in predicted_bounding_boxes.items():
+      for vehicle_id in predicted_actor_ids:
         if vehicle_id in leading_vehicle_ids and not near_lane_change:
           # Vehicle is in front of the ego vehicle
           ego_speed = self._vehicle.get_velocity().length()
@@ -1302,7 +1296,7 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
             speed_reduced_by_obj = [target_speed_wrt_leading_vehicle, vehicle.type_id, vehicle.id, distance_to_vehicle]
 
       if self.visualize == 1:
-        for vehicle_id in predicted_bounding_boxes.keys():
+        for vehicle_id in predicted_actor_ids:
           # check if vehicle is in front of the ego vehicle
           if vehicle_id in leading_vehicle_ids and not near_lane_change:
             extent = vehicle.bounding_box.extent
@@ -1326,8 +1320,8 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
     return target_speed_wrt_leading_vehicle, speed_reduced_by_obj
 
-  def compute_target_speeds_wrt_all_actors(self, initial_target_speed, ego_bounding_boxes, predicted_bounding_boxes,
-                                           near_lane_change, leading_vehicle_ids, rear_vehicle_ids,
+  def compute_target_speeds_wrt_all_actors(self, initial_target_speed, ego_bounding_boxes, predicted_actor_ids,
+                                           predicted_bounding_boxes, near_lane_change, leading_vehicle_ids, rear_vehicle_ids,
                                            speed_reduced_by_obj, nearby_walkers, nearby_walkers_ids):
     """
         Compute the target speeds for the ego vehicle considering all actors (vehicles, bicycles,
@@ -1336,14 +1330,17 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
         Args:
             initial_target_speed (float): The initial target speed for the ego vehicle.
             ego_bounding_boxes (list): A list of bounding boxes for the ego vehicle at different future frames.
-            predicted_bounding_boxes (dict): A dictionary mapping actor IDs to lists of predicted bounding boxes.
+            predicted_actor_ids (list): The IDs of the actors with predicted bounding boxes.
+            predicted_bounding_boxes (numpy.ndarray): The predicted bounding boxes of these actors
+                [num actors, num frames] (obb_collision.BOX_DTYPE).
             near_lane_change (bool): Whether the ego vehicle is near a lane change maneuver.
             leading_vehicle_ids (list): A list of IDs for vehicles in front of the ego vehicle.
             rear_vehicle_ids (list): A list of IDs for vehicles behind the ego vehicle.
             speed_reduced_by_obj (list or None): A list containing [reduced speed, object type,
                 object ID, distance] for the object that caused the most speed reduction, or None if
                 no speed reduction.
-            nearby_walkers (dict): A list of predicted bounding boxes of nearby pedestrians.
+            nearby_walkers (numpy.ndarray): The predicted bounding boxes of nearby pedestrians
+                [num pedestrians, num frames] (obb_collision.BOX_DTYPE).
             nearby_walkers_ids (list): A list of IDs for nearby pedestrians.
 
         Returns:
@@ -1358,61 +1355,72 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
     normal_color = self.config.ego_vehicle_forecasted_bbs_normal_color
     color = normal_color
 
+    # Check all pairs of (ego frame, actor frame) at once, the ego box of frame i is only compared with the
+    # predicted boxes of frame i
+    num_frames = len(ego_bounding_boxes)
+    checked_vehicle_indices = [
+        vehicle_index for vehicle_index, vehicle_id in enumerate(predicted_actor_ids)
+        if near_lane_change or (vehicle_id not in leading_vehicle_ids and vehicle_id not in rear_vehicle_ids)
+    ]
+    checked_vehicle_ids = [predicted_actor_ids[vehicle_index] for vehicle_index in checked_vehicle_indices]
+    vehicle_intersections = np.zeros((len(checked_vehicle_ids), num_frames), dtype=bool)
+    pedestrian_intersections = np.zeros((len(nearby_walkers_ids), num_frames), dtype=bool)
+    if num_frames > 0:
+      ego_boxes = [box[None] for box in obb_collision.bounding_boxes_to_arrays(ego_bounding_boxes)]
+      if checked_vehicle_ids:
+        vehicle_boxes = obb_collision.get_box_fields(predicted_bounding_boxes[checked_vehicle_indices, :num_frames])
+        vehicle_intersections = obb_collision.check_obb_intersections(*ego_boxes, *vehicle_boxes)
+      if nearby_walkers_ids:
+        pedestrian_boxes = obb_collision.get_box_fields(nearby_walkers[:, :num_frames])
+        pedestrian_intersections = obb_collision.check_obb_intersections(*ego_boxes, *pedestrian_boxes)
+
     # Iterate over the ego vehicle's bounding boxes and predicted bounding boxes of other actors
     for i, ego_bounding_box in enumerate(ego_bounding_boxes):
-      for vehicle_id, bounding_boxes in predicted_bounding_boxes.items():
-        # Skip leading and rear vehicles if not near a lane change
-        if vehicle_id in leading_vehicle_ids and not near_lane_change:
-          continue
-        elif vehicle_id in rear_vehicle_ids and not near_lane_change:
-          continue
-        else:
-          # Check if the ego bounding box intersects with the predicted bounding box of the actor
-          intersects_with_ego = self.check_obb_intersection(ego_bounding_box, bounding_boxes[i])
+      for vehicle_index, vehicle_id in enumerate(checked_vehicle_ids):
+        # Check if the ego bounding box intersects with the predicted bounding box of the actor
+        if vehicle_intersections[vehicle_index, i]:
           ego_speed = self._vehicle.get_velocity().length()
-
-          if intersects_with_ego:
-            blocking_actor = self._world.get_actor(vehicle_id)
-
-            # Handle the case when the blocking actor is a bicycle
-            if "base_type" in blocking_actor.attributes and blocking_actor.attributes["base_type"] == "bicycle":
-              other_speed = blocking_actor.get_velocity().length()
-              distance_to_actor = ego_vehicle_location.distance(blocking_actor.get_location())
-
-              # Compute the target speed for bicycles using the IDM
-              target_speed_bicycle = min(
-                  target_speed_bicycle,
-                  self._compute_target_speed_idm(desired_speed=initial_target_speed,
-                                                 leading_actor_length=blocking_actor.bounding_box.extent.x * 2,
-                                                 ego_speed=ego_speed,
-                                                 leading_actor_speed=other_speed,
-                                                 distance_to_leading_actor=distance_to_actor,
-                                                 s0=self.config.idm_bicycle_minimum_distance,
-                                                 T=self.config.idm_bicycle_desired_time_headway))
-
-              # Update the object causing the most speed reduction
-              if speed_reduced_by_obj is None or speed_reduced_by_obj[0] > target_speed_bicycle:
-                speed_reduced_by_obj = [
-                    target_speed_bicycle, blocking_actor.type_id, blocking_actor.id, distance_to_actor
-                ]
-
-            # Handle the case when the blocking actor is not a bicycle
-            else:
-              self.vehicle_hazard = True  # Set the vehicle hazard flag
-              self.vehicle_affecting_id = vehicle_id  # Store the ID of the vehicle causing the hazard
-              color = hazard_color  # Change the following colors from green to red (no hazard to hazard)
-              target_speed_vehicle = 0  # Set the target speed for vehicles to zero
-              distance_to_actor = blocking_actor.get_location().distance(ego_vehicle_location)
-
-              # Update the object causing the most speed reduction
-              if speed_reduced_by_obj is None or speed_reduced_by_obj[0] > target_speed_vehicle:
-                speed_reduced_by_obj = [
-                    target_speed_vehicle, blocking_actor.type_id, blocking_actor.id, distance_to_actor
-                ]
+          blocking_actor = self._world.get_actor(vehicle_id)
+
+          # Handle the case when the blocking actor is a bicycle
+          if "base_type" in blocking_actor.attributes and blocking_actor.attributes["base_type"] == "bicycle":
+            other_speed = blocking_actor.get_velocity().length()
+            distance_to_actor = ego_vehicle_location.distance(blocking_actor.get_location())
+
+            # Compute the target speed for bicycles using the IDM
+            target_speed_bicycle = min(
+                target_speed_bicycle,
+                self._compute_target_speed_idm(desired_speed=initial_target_speed,
+                                               leading_actor_length=blocking_actor.bounding_box.extent.x * 2,
+                                               ego_speed=ego_speed,
+                                               leading_actor_speed=other_speed,
+                                               distance_to_leading_actor=distance_to_actor,
+                                               s0=self.config.idm_bicycle_minimum_distance,
+                                               T=self.config.idm_bicycle_desired_time_headway))
+
+            # Update the object causing the most speed reduction
+            if speed_reduced_by_obj is None or speed_reduced_by_obj[0] > target_speed_bicycle:
+              speed_reduced_by_obj = [
+                  target_speed_bicycle, blocking_actor.type_id, blocking_actor.id, distance_to_actor
+              ]
+
+          # Handle the case when the blocking actor is not a bicycle
+          else:
+            self.vehicle_hazard = True  # Set the vehicle hazard flag
+            self.vehicle_affecting_id = vehicle_id  # Store the ID of the vehicle causing the hazard
+            color = hazard_color  # Change the following colors from green to red (no hazard to hazard)
+            target_speed_vehicle = 0  # Set the target speed for vehicles to zero
+            distance_to_actor = blocking_actor.get_location().distance(ego_vehicle_location)
+
+            # Update the object causing the most speed reduction
+            if speed_reduced_by_obj is None or speed_reduced_by_obj[0] > target_speed_vehicle:
+              speed_reduced_by_obj = [
+                  target_speed_vehicle, blocking_actor.type_id, blocking_actor.id, distance_to_actor
+              ]
 
       # Iterate over nearby pedestrians and check for intersections with the ego bounding box
-      for pedestrian_bb, pedestrian_id in zip(nearby_walkers, nearby_walkers_ids):
-        if self.check_obb_intersection(ego_bounding_box, pedestrian_bb[i]):
+      for pedestrian_index, pedestrian_id in enumerate(nearby_walkers_ids):
+        if pedestrian_intersections[pedestrian_index, i]:
           color = hazard_color
           ego_speed = self._vehicle.get_velocity().length()
           blocking_actor = self._world.get_actor(pedestrian_id)
@@ -1515,8 +1523,8 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
                                                  initial_target_speed, route_points)
 
     # Predict bounding boxes of other actors (vehicles, bicycles, etc.)
-    predicted_bounding_boxes = self.predict_other_actors_bounding_boxes(plant, vehicle_list, ego_vehicle_location,
-                                                                        num_future_frames, near_lane_change)
+    predicted_actor_ids, predicted_bounding_boxes = self.predict_other_actors_bounding_boxes(
+        plant, vehicle_list, ego_vehicle_location, num_future_frames, near_lane_change)
 
     # Compute the leading and trailing vehicle IDs
     leading_vehicle_ids = self._waypoint_planner.compute_leading_vehicles(vehicle_list, self._vehicle.id)
@@ -1524,12 +1532,12 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
     # Compute the target speed with respect to the leading vehicle
     target_speed_leading, speed_reduced_by_obj = self.compute_target_speed_wrt_leading_vehicle(
-        initial_target_speed, predicted_bounding_boxes, near_lane_change, ego_vehicle_location, trailing_vehicle_ids,
+        initial_target_speed, predicted_actor_ids, near_lane_change, ego_vehicle_location, trailing_vehicle_ids,
         leading_vehicle_ids, speed_reduced_by_obj, plant)
 
     # Compute the target speeds with respect to all actors (vehicles, bicycles, pedestrians)
     target_speed_bicycle, target_speed_pedestrian, target_speed_vehicle, speed_reduced_by_obj = \
-        self.compute_target_speeds_wrt_all_actors(initial_target_speed, ego_bounding_boxes,
+        self.compute_target_speeds_wrt_all_actors(initial_target_speed, ego_bounding_boxes, predicted_actor_ids,
         predicted_bounding_boxes, near_lane_change, leading_vehicle_ids, trailing_vehicle_ids, speed_reduced_by_obj,
         nearby_pedestrians, nearby_pedestrian_ids)
 
@@ -1651,68 +1659,52 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
             number_of_future_frames (int): The number of future frames to forecast.
 
         Returns:
-            tuple: A tuple containing two lists:
-                - list: A list of lists, where each inner list contains the future bounding boxes for a pedestrian.
+            tuple: A tuple containing:
+                - numpy.ndarray: The future bounding boxes [num pedestrians, number_of_future_frames]
+                  (obb_collision.BOX_DTYPE).
                 - list: A list of IDs for the pedestrians whose locations were forecasted.
         """
-    nearby_pedestrians_bbs, nearby_pedestrian_ids = [], []
-
     # Filter pedestrians within the detection radius
     pedestrians = [
         ped for ped in actors.filter("*walker*")
         if ped.get_location().distance(ego_vehicle_location) < self.config.detection_radius
     ]
 
-    # If no pedestrians are found, return empty lists
+    # If no pedestrians are found, return empty arrays
     if not pedestrians:
-      return nearby_pedestrians_bbs, nearby_pedestrian_ids
+      return obb_collision.get_boxes(np.zeros((0, number_of_future_frames, 3)), np.zeros(3), np.zeros(3)), []
 
-    # Extract pedestrian locations, speeds, and directions
+    # Extract pedestrian locations, speeds, directions, extents and rotations
+    transforms = [ped.get_transform() for ped in pedestrians]
     pedestrian_locations = np.array(
-        [[ped.get_location().x, ped.get_location().y, ped.get_location().z] for ped in pedestrians])
+        [[transform.location.x, transform.location.y, transform.location.z] for transform in transforms])
     pedestrian_speeds = np.array([ped.get_velocity().length() for ped in pedestrians])
     pedestrian_speeds = np.maximum(pedestrian_speeds, self.config.min_walker_speed)
     pedestrian_directions = np.array(
         [[ped.get_control().direction.x,
           ped.get_control().direction.y,
           ped.get_control().direction.z] for ped in pedestrians])
+    bounding_boxes = [ped.bounding_box for ped in pedestrians]
+    pedestrian_extents = np.array([[bb.extent.x, bb.extent.y, bb.extent.z] for bb in bounding_boxes])
+    # Ensure a minimum width and length
+    pedestrian_extents[:, :2] = np.maximum(self.config.pedestrian_minimum_extent, pedestrian_extents[:, :2])
+    pedestrian_rotations = np.array([[
+        bb.rotation.pitch + transform.rotation.pitch, bb.rotation.yaw + transform.rotation.yaw,
+        bb.rotation.roll + transform.rotation.roll
+    ] for bb, transform in zip(bounding_boxes, transforms)])
 
     # Calculate future pedestrian locations based on their current locations, speeds, and directions
     future_pedestrian_locations = pedestrian_locations[:, None, :] + np.arange(1, number_of_future_frames + 1)[
         None, :, None] * pedestrian_directions[:, None, :] * pedestrian_speeds[:, None,
                                                                                None] / self.config.bicycle_frame_rate
 
-    # Iterate over pedestrians and calculate their future bounding boxes
-    for i, ped in enumerate(pedestrians):
-      bb, transform = ped.bounding_box, ped.get_transform()
-      rotation = carla.Rotation(pitch=bb.rotation.pitch + transform.rotation.pitch,
-                                yaw=bb.rotation.yaw + transform.rotation.yaw,
-                                roll=bb.rotation.roll + transform.rotation.roll)
-      extent = bb.extent
-      extent.x = max(self.config.pedestrian_minimum_extent, extent.x)  # Ensure a minimum width
-      extent.y = max(self.config.pedestrian_minimum_extent, extent.y)  # Ensure a minimum length
-
-      pedestrian_future_bboxes = []
-      for j in range(number_of_future_frames):
-        location = carla.Location(future_pedestrian_locations[i, j, 0], future_pedestrian_locations[i, j, 1],
-                                  future_pedestrian_locations[i, j, 2])
-
-        bounding_box = carla.BoundingBox(location, extent)
-        bounding_box.rotation = rotation
-        pedestrian_future_bboxes.append(bounding_box)
-
-      nearby_pedestrian_ids.append(ped.id)
-      nearby_pedestrians_bbs.append(pedestrian_future_bboxes)
+    nearby_pedestrian_ids = [ped.id for ped in pedestrians]
+    nearby_pedestrians_bbs = obb_collision.get_boxes(future_pedestrian_locations, pedestrian_extents[:, None],
+                                                     pedestrian_rotations[:, None])
 
     # Visualize the future bounding boxes of pedestrians (if enabled)
     if self.visualize == 1:
-      for bbs in nearby_pedestrians_bbs:
-        for bbox in bbs:
-          self._world.debug.draw_box(box=bbox,
-                                     rotation=bbox.rotation,
-                                     thickness=0.1,
-                                     color=self.config.pedestrian_forecasted_bbs_color,
-                                     life_time=self.config.draw_life_time)
+      self._draw_forecasted_boxes(nearby_pedestrians_bbs, self.config.pedestrian_forecasted_bbs_color)
 
     return nearby_pedestrians_bbs, nearby_pedestrian_ids
 
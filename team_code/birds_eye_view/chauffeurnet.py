@@ -4,16 +4,17 @@ Code adapted from https://github.com/zhejz/carla-roach
 """
 
 import numpy as np
-import carla
 from gym import spaces
 import cv2 as cv
 from collections import deque
 from pathlib import Path
+import functools
 import h5py
 import os
 
 from birds_eye_view.obs_manager import ObsManagerBase
 from birds_eye_view.traffic_light import TrafficLightHandler
+import birds_eye_view.transforms as trans_utils
 
 COLOR_BLACK = (0, 0, 0)
 COLOR_RED = (255, 0, 0)
@@ -31,6 +32,31 @@ COLOR_ALUMINIUM_3 = (136, 138, 133)
 COLOR_ALUMINIUM_5 = (46, 52, 54)
 
 
+# Map layers of the h5 files that are rendered, channels of the raster returned by load_map_raster
+MAP_LAYERS = ('road', 'sidewalk', 'lane_marking_all', 'lane_marking_white_broken')
+# Entries of the history queue that are stop lines, the others are bounding box polygons
+HISTORY_STOPLINES = (2, 3, 4)
+# Polygon of a bounding box (x, y signs of the extent), same corners as carla-roach
+BOX_CORNER_SIGNS = np.array([[-1, -1], [1, -1], [1, 0], [1, 1], [-1, 1]], dtype=np.float64)
+
+
+@functools.lru_cache(maxsize=1)
+def load_map_raster(maps_h5_path):
+  """
+  Loads the MAP_LAYERS of a town as one raster [H, W, len(MAP_LAYERS)] uint8.
+  Cached, so all ObsManagers of a process (e.g. the normal and the augmented one) share the raster of the town.
+  :return: raster, world offset in meters, pixels per meter
+  """
+  with h5py.File(maps_h5_path, 'r', libver='latest', swmr=True) as hf:
+    raster = np.empty(hf[MAP_LAYERS[0]].shape + (len(MAP_LAYERS),), dtype=np.uint8)
+    for channel, layer in enumerate(MAP_LAYERS):
+      raster[..., channel] = hf[layer]
+    world_offset = np.array(hf.attrs['world_offset_in_meters'], dtype=np.float32)
+    pixels_per_meter = float(hf.attrs['pixels_per_meter'])
+  raster.flags.writeable = False
+  return raster, world_offset, pixels_per_meter
+
+
 def tint(color, factor):
   r, g, b = color
   r = int(r + (255 - r) * factor)
@@ -86,41 +112,31 @@ class ObsManager(ObsManagerBase):
 
     # splitting because for Town13 the name is 'Carla/Maps/Town13/Town13' instead of 'Town13'
     maps_h5_path = self._map_dir / (self._world.get_map().name.split('/')[-1] + '.h5')
-    with h5py.File(maps_h5_path, 'r', libver='latest', swmr=True) as hf:
-      self._road = np.array(hf['road'], dtype=np.uint8)
-      self._lane_marking_all = np.array(hf['lane_marking_all'], dtype=np.uint8)
-      self._lane_marking_white_broken = np.array(hf['lane_marking_white_broken'], dtype=np.uint8)
-      # self._shoulder = np.array(hf['shoulder'], dtype=np.uint8)
-      # self._parking = np.array(hf['parking'], dtype=np.uint8)
-      self._sidewalk = np.array(hf['sidewalk'], dtype=np.uint8)
-      # self._lane_marking_yellow_broken = np.array(hf['lane_marking_yellow_broken'], dtype=np.uint8)
-      # self._lane_marking_yellow_solid = np.array(hf['lane_marking_yellow_solid'], dtype=np.uint8)
-      # self._lane_marking_white_solid = np.array(hf['lane_marking_white_solid'], dtype=np.uint8)
-
-      self._world_offset = np.array(hf.attrs['world_offset_in_meters'], dtype=np.float32)
-      # in case they aren't close, print them to know what values they should be
-      if not np.isclose(self._pixels_per_meter, float(hf.attrs['pixels_per_meter'])):
-        print(self._pixels_per_meter, float(hf.attrs['pixels_per_meter']))
-      assert np.isclose(self._pixels_per_meter, float(hf.attrs['pixels_per_meter']))
+    self._map_raster, self._world_offset, pixels_per_meter = load_map_raster(str(maps_h5_path))
+    # in case they aren't close, print them to know what values they should be
+    if not np.isclose(self._pixels_per_meter, pixels_per_meter):
+      print(self._pixels_per_meter, pixels_per_meter)
+    assert np.isclose(self._pixels_per_meter, pixels_per_meter)
 
     self._distance_threshold = np.ceil(self._width / self._pixels_per_meter)
     # dilate road mask, lbc draw road polygon with 10px boarder
     # kernel = np.ones((11, 11), np.uint8)
-    # self._road = cv.dilate(self._road, kernel, iterations=1)
+    # road = cv.dilate(road, kernel, iterations=1)
 
     TrafficLightHandler.reset(self._world)
 
   @staticmethod
   def _get_stops(criteria_stop):
     stop_sign = criteria_stop.target_stop_sign
-    stops = []
+    stops = np.zeros((0, 4, 3), dtype=np.float64)
     if (stop_sign is not None) and (not criteria_stop.stop_completed):
-      bb_loc = carla.Location(stop_sign.trigger_volume.location)
-      bb_ext = carla.Vector3D(stop_sign.trigger_volume.extent)
-      bb_ext.x = max(bb_ext.x, bb_ext.y)
-      bb_ext.y = max(bb_ext.x, bb_ext.y)
+      bb_loc = stop_sign.trigger_volume.location
+      bb_ext = stop_sign.trigger_volume.extent
       trans = stop_sign.get_transform()
-      stops = [(carla.Transform(trans.location, trans.rotation), bb_loc, bb_ext)]
+      stops = np.array([[[trans.location.x, trans.location.y, trans.location.z],
+                         [trans.rotation.pitch, trans.rotation.yaw, trans.rotation.roll],
+                         [bb_loc.x, bb_loc.y, bb_loc.z],
+                         [max(bb_ext.x, bb_ext.y), max(bb_ext.x, bb_ext.y), bb_ext.z]]], dtype=np.float64)
     return stops
 
   def get_road(self):
@@ -132,9 +148,7 @@ class ObsManager(ObsManagerBase):
     ev_rot = ev_transform.rotation
     m_warp = self._get_warp_transform(ev_loc, ev_rot)
     # road_mask, lane_mask
-    road_mask = cv.warpAffine(self._road, m_warp, (self._width, self._width)).astype(bool)
-    lane_mask_all = cv.warpAffine(self._lane_marking_all, m_warp, (self._width, self._width)).astype(bool)
-    lane_mask_broken = cv.warpAffine(self._lane_marking_white_broken, m_warp, (self._width, self._width)).astype(bool)
+    road_mask, _, lane_mask_all, lane_mask_broken = self._get_map_masks(m_warp)
     image = np.zeros([self._width, self._width, 4], dtype=np.float32)
     alpha = 0.33
     image[road_mask] = (40, 40, 40, 0.1)
@@ -150,15 +164,6 @@ class ObsManager(ObsManagerBase):
     ev_rot = ev_transform.rotation
     ev_bbox = self.vehicle.bounding_box
 
-    def is_within_distance(w):
-      c_distance = abs(ev_loc.x - w.location.x) < self._distance_threshold \
-          and abs(ev_loc.y - w.location.y) < self._distance_threshold \
-          and abs(ev_loc.z - w.location.z) < 8.0
-      # Cheap trick to remove the ego bounding box
-      c_ev = abs(ev_loc.x - w.location.x) < self.config.ego_extent_y and abs(ev_loc.y -
-                                                                             w.location.y) < self.config.ego_extent_y
-      return c_distance and (not c_ev)
-
     actors = self._world.get_actors()
     vehicles = list(actors.filter('*vehicle*'))
     walkers = actors.filter('*walker*')
@@ -171,49 +176,27 @@ class ObsManager(ObsManagerBase):
 
     # This style of generating bounding boxes is more ugly than just calling world.get_level_bbs in carla but it has
     # the advantage of not causing segfaults in the carla library :)
-    vehicle_bbox_list = []
-    for vehicle in vehicles:
-      if vehicle.id == self.vehicle.id:
-        continue
-      traffic_transform = vehicle.get_transform()
-
-      # Convert the bounding box to global coordinates
-      bounding_box = carla.BoundingBox(traffic_transform.location + vehicle.bounding_box.location,
-                                       vehicle.bounding_box.extent)
-      # Rotations of the bb are 0.
-      bounding_box.rotation = carla.Rotation(pitch=vehicle.bounding_box.rotation.pitch +
-                                             traffic_transform.rotation.pitch,
-                                             yaw=vehicle.bounding_box.rotation.yaw + traffic_transform.rotation.yaw,
-                                             roll=vehicle.bounding_box.rotation.roll + traffic_transform.rotation.roll)
-
-      vehicle_bbox_list.append(bounding_box)
-
-    walker_bbox_list = []
-    for walker in walkers:
-      walker_transform = walker.get_transform()
-
-      walker_location = walker_transform.location
-      transform = carla.Transform(walker_location)
-      bounding_box = carla.BoundingBox(transform.location, walker.bounding_box.extent)
-      bounding_box.rotation = carla.Rotation(pitch=walker.bounding_box.rotation.pitch + walker_transform.rotation.pitch,
-                                             yaw=walker.bounding_box.rotation.yaw + walker_transform.rotation.yaw,
-                                             roll=walker.bounding_box.rotation.roll + walker_transform.rotation.roll)
-
-      walker_bbox_list.append(bounding_box)
+    vehicles = [vehicle for vehicle in vehicles if vehicle.id != self.vehicle.id]
+    vehicle_bbox_list = self._get_global_bounding_boxes(vehicles)
+    # The walker bounding boxes are centered at the walker location
+    walker_bbox_list = self._get_global_bounding_boxes(walkers, add_bb_location=False)
 
     if self._scale_bbox:
-      vehicles = self._get_surrounding_actors(vehicle_bbox_list, is_within_distance, 1.0)
-      walkers = self._get_surrounding_actors(walker_bbox_list, is_within_distance, 2.0)
+      vehicles = self._get_surrounding_actors(vehicle_bbox_list, ev_loc, 1.0)
+      walkers = self._get_surrounding_actors(walker_bbox_list, ev_loc, 2.0)
     else:
-      vehicles = self._get_surrounding_actors(vehicle_bbox_list, is_within_distance)
-      walkers = self._get_surrounding_actors(walker_bbox_list, is_within_distance)
+      vehicles = self._get_surrounding_actors(vehicle_bbox_list, ev_loc)
+      walkers = self._get_surrounding_actors(walker_bbox_list, ev_loc)
 
     tl_green = TrafficLightHandler.get_stopline_vtx(ev_loc, 0, self._distance_threshold, close_traffic_lights)
     tl_yellow = TrafficLightHandler.get_stopline_vtx(ev_loc, 1, self._distance_threshold, close_traffic_lights)
     tl_red = TrafficLightHandler.get_stopline_vtx(ev_loc, 2, self._distance_threshold, close_traffic_lights)
     stops = self._get_stops(self.criteria_stop)
 
-    self._history_queue.append((vehicles, walkers, tl_green, tl_yellow, tl_red, stops))
+    # The history stores the global polygon corners [N, 5, 3] and stop line end points [N, 2, 3] of every frame
+    self._history_queue.append((self._get_box_corners(vehicles), self._get_box_corners(walkers),
+                                self._get_stopline_points(tl_green), self._get_stopline_points(tl_yellow),
+                                self._get_stopline_points(tl_red), self._get_box_corners(stops)))
 
     m_warp = self._get_warp_transform(ev_loc, ev_rot)
 
@@ -222,15 +205,18 @@ class ObsManager(ObsManagerBase):
         = self._get_history_masks(m_warp)
 
     # road_mask, lane_mask
-    road_mask = cv.warpAffine(self._road, m_warp, (self._width, self._width)).astype(bool)
-    sidewalk_mask = cv.warpAffine(self._sidewalk, m_warp, (self._width, self._width)).astype(bool)
-    lane_mask_all = cv.warpAffine(self._lane_marking_all, m_warp, (self._width, self._width)).astype(bool)
-    lane_mask_broken = cv.warpAffine(self._lane_marking_white_broken, m_warp, (self._width, self._width)).astype(bool)
+    road_mask, sidewalk_mask, lane_mask_all, lane_mask_broken = self._get_map_masks(m_warp)
 
     # render
     if self.visualize:
       # ev_mask
-      ev_mask = self._get_mask_from_actor_list([(ev_transform, ev_bbox.location, ev_bbox.extent)], m_warp)
+      ev_box = np.array([[[ev_transform.location.x, ev_transform.location.y, ev_transform.location.z],
+                          [ev_transform.rotation.pitch, ev_transform.rotation.yaw, ev_transform.rotation.roll],
+                          [ev_bbox.location.x, ev_bbox.location.y, ev_bbox.location.z],
+                          [ev_bbox.extent.x, ev_bbox.extent.y, ev_bbox.extent.z]]], dtype=np.float64)
+      ev_mask = np.zeros([self._width, self._width], dtype=np.uint8)
+      self._draw_polygons(ev_mask, self._warp_points(self._get_box_corners(ev_box), m_warp))
+      ev_mask = ev_mask.astype(bool)
 
       image = np.zeros([self._width, self._width, 3], dtype=np.uint8)
       image[road_mask] = COLOR_ALUMINIUM_5
@@ -280,67 +266,124 @@ class ObsManager(ObsManagerBase):
 
   def _get_history_masks(self, m_warp):
     qsize = len(self._history_queue)
-    vehicle_masks, walker_masks, tl_green_masks, tl_yellow_masks, tl_red_masks, stop_masks = [], [], [], [], [], []
-    for idx in self._history_idx:
-      idx = max(idx, -1 * qsize)
-
-      vehicles, walkers, tl_green, tl_yellow, tl_red, stops = self._history_queue[idx]
-
-      vehicle_masks.append(self._get_mask_from_actor_list(vehicles, m_warp))
-      walker_masks.append(self._get_mask_from_actor_list(walkers, m_warp))
-      tl_green_masks.append(self._get_mask_from_stopline_vtx(tl_green, m_warp))
-      tl_yellow_masks.append(self._get_mask_from_stopline_vtx(tl_yellow, m_warp))
-      tl_red_masks.append(self._get_mask_from_stopline_vtx(tl_red, m_warp))
-      stop_masks.append(self._get_mask_from_actor_list(stops, m_warp))
-
-    return vehicle_masks, walker_masks, tl_green_masks, tl_yellow_masks, tl_red_masks, stop_masks
-
-  def _get_mask_from_stopline_vtx(self, stopline_vtx, m_warp):
-    mask = np.zeros([self._width, self._width], dtype=np.uint8)
-    for sp_locs in stopline_vtx:
-      stopline_in_pixel = np.array([[self._world_to_pixel(x)] for x in sp_locs])
-      stopline_warped = cv.transform(stopline_in_pixel, m_warp)
-      # Rounding to pixel coordinates is required by newer opencv versions
-      pt1 = (stopline_warped[0, 0] + 0.5).astype(int)
-      pt2 = (stopline_warped[1, 0] + 0.5).astype(int)
-      cv.line(mask, tuple(pt1), tuple(pt2), color=1, thickness=6)
-    return mask.astype(bool)
+    frames = [self._history_queue[max(idx, -1 * qsize)] for idx in self._history_idx]
+    # [entry of the history (vehicles, walkers, tl_green, tl_yellow, tl_red, stops), history index, width, width]
+    masks = np.zeros((len(frames[0]), len(frames), self._width, self._width), dtype=np.uint8)
+
+    # The points of all history frames are transformed to pixels in one pass
+    all_points = np.concatenate([points.reshape(-1, 3) for frame in frames for points in frame])
+    all_warped = self._warp_points(all_points, m_warp)
+    start = 0
+    for i, frame in enumerate(frames):
+      for entry, points in enumerate(frame):
+        count = points.shape[0] * points.shape[1]
+        warped = all_warped[start:start + count].reshape(points.shape[:2] + (2,))
+        start += count
+        if entry in HISTORY_STOPLINES:
+          self._draw_stoplines(masks[entry, i], warped)
+        else:
+          self._draw_polygons(masks[entry, i], warped)
+
+    return tuple(list(entry_masks.astype(bool)) for entry_masks in masks)
+
+  def _get_map_masks(self, m_warp):
+    """
+    Warps the map layers into the BEV window, only the crop of the town raster that is visible in the window is
+    warped. Same result as warping the whole raster.
+    :return: road, sidewalk, lane marking all and white broken lane marking masks
+    """
+    # Bounding box of the window in the raster, with 2 px margin for the bilinear interpolation
+    m_inverse = cv.invertAffineTransform(m_warp)
+    window = np.array([[0, 0], [self._width, 0], [0, self._width], [self._width, self._width]], dtype=np.float64)
+    window_in_raster = window @ m_inverse[:, :2].T + m_inverse[:, 2]
+    raster_height, raster_width = self._map_raster.shape[:2]
+    x_min, y_min = np.maximum(np.floor(window_in_raster.min(axis=0)).astype(np.int64) - 2, 0)
+    x_max, y_max = np.minimum(np.ceil(window_in_raster.max(axis=0)).astype(np.int64) + 3, (raster_width, raster_height))
+
+    if x_min >= x_max or y_min >= y_max:
+      return np.zeros((len(MAP_LAYERS), self._width, self._width), dtype=bool)
+
+    m_inverse[:, 2] -= (x_min, y_min)
+    warped = cv.warpAffine(self._map_raster[y_min:y_max, x_min:x_max],
+                           m_inverse, (self._width, self._width),
+                           flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP)
+    return np.moveaxis(warped, -1, 0).astype(bool)
 
-  def _get_mask_from_actor_list(self, actor_list, m_warp):
-    mask = np.zeros([self._width, self._width], dtype=np.uint8)
-    for actor_transform, bb_loc, bb_ext in actor_list:
+  @staticmethod
+  def _get_global_bounding_boxes(actors, add_bb_location=True):
+    """
+    Global bounding boxes of the actors as array [N, 3, 3] with location, rotation (pitch, yaw, roll) and extent.
+    The rotation of the bounding box is added to the one of the actor.
+    """
+    bounding_boxes = np.zeros((len(actors), 3, 3), dtype=np.float64)
+    for i, actor in enumerate(actors):
+      transform = actor.get_transform()
+      bounding_box = actor.bounding_box
+      bounding_boxes[i] = ((transform.location.x, transform.location.y, transform.location.z),
+                           (transform.rotation.pitch + bounding_box.rotation.pitch,
+                            transform.rotation.yaw + bounding_box.rotation.yaw,
+                            transform.rotation.roll + bounding_box.rotation.roll),
+                           (bounding_box.extent.x, bounding_box.extent.y, bounding_box.extent.z))
+      if add_bb_location:
+        bounding_boxes[i, 0] += (bounding_box.location.x, bounding_box.location.y, bounding_box.location.z)
+    return bounding_boxes
+
+  def _get_surrounding_actors(self, bounding_boxes, ev_loc, scale=None):
+    """
+    Boxes [N, 4, 3] (location, rotation, bounding box location, extent) of the bounding boxes close to the ego.
+    """
+    distances = np.abs(bounding_boxes[:, 0] - (ev_loc.x, ev_loc.y, ev_loc.z))
+    is_within_distance = np.all(distances[:, :2] < self._distance_threshold, axis=1) & (distances[:, 2] < 8.0)
+    # Cheap trick to remove the ego bounding box
+    is_ego = np.all(distances[:, :2] < self.config.ego_extent_y, axis=1)
+    bounding_boxes = bounding_boxes[is_within_distance & ~is_ego]
+
+    actors = np.zeros((len(bounding_boxes), 4, 3), dtype=np.float64)
+    actors[:, 0] = bounding_boxes[:, 0]
+    actors[:, 1] = bounding_boxes[:, 1]
+    actors[:, 3] = bounding_boxes[:, 2]
+    if scale is not None:
+      actors[:, 3] *= scale
+      actors[:, 3, :2] = np.maximum(actors[:, 3, :2], 0.8)
+    return actors
 
-      corners = [
-          carla.Location(x=-bb_ext.x, y=-bb_ext.y),
-          carla.Location(x=bb_ext.x, y=-bb_ext.y),
-          carla.Location(x=bb_ext.x, y=0),
-          carla.Location(x=bb_ext.x, y=bb_ext.y),
-          carla.Location(x=-bb_ext.x, y=bb_ext.y)
-      ]
-      corners = [bb_loc + corner for corner in corners]
+  @staticmethod
+  def _get_box_corners(boxes):
+    """
+    Global corners [N, 5, 3] of the polygons of the boxes [N, 4, 3] (location, rotation, bounding box location,
+    extent), for all boxes at once.
+    """
+    corners = np.zeros((len(boxes), len(BOX_CORNER_SIGNS), 3), dtype=np.float64)
+    corners[:, :, :2] = BOX_CORNER_SIGNS * boxes[:, None, 3, :2]
+    corners += boxes[:, None, 2]
+    rotations = trans_utils.carla_rots_to_mats(boxes[:, 1])
+    return np.einsum('nij,nkj->nki', rotations, corners) + boxes[:, None, 0]
 
-      corners = [actor_transform.transform(corner) for corner in corners]
-      corners_in_pixel = np.array([[self._world_to_pixel(corner)] for corner in corners])
-      corners_warped = cv.transform(corners_in_pixel, m_warp)
+  @staticmethod
+  def _get_stopline_points(stopline_vtx):
+    """End points [N, 2, 3] of the stop lines"""
+    points = [[(loc.x, loc.y, loc.z) for loc in sp_locs[:2]] for sp_locs in stopline_vtx]
+    return np.array(points, dtype=np.float64).reshape(-1, 2, 3)
+
+  def _warp_points(self, points, m_warp):
+    """Global points [..., 3] to the pixels [..., 2] of the BEV window"""
+    if points.size == 0:
+      return np.zeros(points.shape[:-1] + (2,), dtype=np.float32)
+    points_in_pixel = self._world_to_pixel_batch(points.reshape(-1, 3))
+    return cv.transform(points_in_pixel[:, None], m_warp).reshape(points.shape[:-1] + (2,))
 
-      cv.fillConvexPoly(mask, np.round(corners_warped).astype(np.int32), 1)
-    return mask.astype(bool)
+  @staticmethod
+  def _draw_polygons(mask, polygons):
+    for polygon in polygons:
+      cv.fillConvexPoly(mask, np.round(polygon).astype(np.int32), 1)
 
   @staticmethod
-  def _get_surrounding_actors(bbox_list, criterium, scale=None):
-    actors = []
-    for bbox in bbox_list:
-      is_within_distance = criterium(bbox)
-      if is_within_distance:
-        bb_loc = carla.Location()
-        bb_ext = carla.Vector3D(bbox.extent)
-        if scale is not None:
-          bb_ext = bb_ext * scale
-          bb_ext.x = max(bb_ext.x, 0.8)
-          bb_ext.y = max(bb_ext.y, 0.8)
-
-        actors.append((carla.Transform(bbox.location, bbox.rotation), bb_loc, bb_ext))
-    return actors
+  def _draw_stoplines(mask, stoplines):
+    for stopline in stoplines:
+      # Rounding to pixel coordinates is required by newer opencv versions
+      pt1 = (stopline[0] + 0.5).astype(int)
+      pt2 = (stopline[1] + 0.5).astype(int)
+      cv.line(mask, tuple(pt1), tuple(pt2), color=1, thickness=6)
 
   def _get_warp_transform(self, ev_loc, ev_rot):
     ev_loc_in_px = self._world_to_pixel(ev_loc)
@@ -368,6 +411,10 @@ class ObsManager(ObsManagerBase):
       p = np.array([x, y], dtype=np.float32)
     return p
 
+  def _world_to_pixel_batch(self, locations):
+    """Converts the world coordinates [N, 3] to pixel coordinates [N, 2], same as _world_to_pixel"""
+    return (self._pixels_per_meter * (locations[:, :2] - self._world_offset)).astype(np.float32)
+
   def _world_to_pixel_width(self, width):
     """Converts the world units to pixel units"""
     return self._pixels_per_meter * width
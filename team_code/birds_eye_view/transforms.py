@@ -75,6 +75,25 @@ def carla_rot_to_mat(carla_rotation):
   return rotation_matrix
 
 
+def carla_rots_to_mats(rotations):
+  """
+    Batched version of carla_rot_to_mat
+
+    :param rotations: np.array [N, 3] pitch, yaw, roll in degrees (order of carla.Rotation)
+    :return: np.array [N, 3, 3] rotation matrices
+  """
+  pitch, yaw, roll = np.deg2rad(np.asarray(rotations, dtype=np.float64)).T
+  cp, sp = np.cos(pitch), np.sin(pitch)
+  cy, sy = np.cos(yaw), np.sin(yaw)
+  cr, sr = np.cos(roll), np.sin(roll)
+
+  rotation_matrices = np.empty((len(pitch), 3, 3), dtype=np.float64)
+  rotation_matrices[:, 0] = np.stack((cy * cp, cy * sp * sr - sy * cr, -cy * sp * cr - sy * sr), axis=1)
+  rotation_matrices[:, 1] = np.stack((sy * cp, sy * sp * sr + cy * cr, -sy * sp * cr + cy * sr), axis=1)
+  rotation_matrices[:, 2] = np.stack((sp, -cp * sr, cp * cr), axis=1)
+  return rotation_matrices
+
+
 def get_loc_rot_vel_in_ev(actor_list, ev_transform):
   location, rotation, absolute_velocity = [], [], []
   for actor in actor_list:
@@ -3,27 +3,32 @@ Config class that contains all the hyperparameters needed to build any model.
 """
 
 import os
-import carla
 import numpy as np
 
+try:
+  import carla
+except ImportError:  # the offline data generation only needs the parameters
+  carla = None
+
 
 class GlobalConfig:
   """
   Config class that contains all the hyperparameters needed to build any model.
   """
-  # Colors used for drawing during debugging
-  future_route_color = carla.Color(0, 1, 0)
-  other_vehicles_forecasted_bbs_color = carla.Color(0, 0, 1, 1)
-  leading_vehicle_color = carla.Color(1, 0, 0, 0)
-  trailing_vehicle_color = carla.Color(1, 1, 1, 0)
-  ego_vehicle_bb_color = carla.Color(0, 0, 0, 1)
-  pedestrian_forecasted_bbs_color = carla.Color(0, 0, 1, 1)
-  red_traffic_light_color = carla.Color(0, 1, 0, 1)
-  green_traffic_light_color = carla.Color(1, 0, 0, 1)
-  cleared_stop_sign_color = carla.Color(0, 1, 0, 1)
-  uncleared_stop_sign_color = carla.Color(1, 0, 0, 1)
-  ego_vehicle_forecasted_bbs_hazard_color = carla.Color(1, 0, 0, 0)
-  ego_vehicle_forecasted_bbs_normal_color = carla.Color(0, 1, 0, 0)
+  # Colors used for drawing during debugging, they need the simulator
+  if carla is not None:
+    future_route_color = carla.Color(0, 1, 0)
+    other_vehicles_forecasted_bbs_color = carla.Color(0, 0, 1, 1)
+    leading_vehicle_color = carla.Color(1, 0, 0, 0)
+    trailing_vehicle_color = carla.Color(1, 1, 1, 0)
+    ego_vehicle_bb_color = carla.Color(0, 0, 0, 1)
+    pedestrian_forecasted_bbs_color = carla.Color(0, 0, 1, 1)
+    red_traffic_light_color = carla.Color(0, 1, 0, 1)
+    green_traffic_light_color = carla.Color(1, 0, 0, 1)
+    cleared_stop_sign_color = carla.Color(0, 1, 0, 1)
+    uncleared_stop_sign_color = carla.Color(1, 0, 0, 1)
+    ego_vehicle_forecasted_bbs_hazard_color = carla.Color(1, 0, 0, 0)
+    ego_vehicle_forecasted_bbs_normal_color = carla.Color(0, 1, 0, 0)
 
   def __init__(self):
     """ base architecture configurations """
@@ -342,6 +347,10 @@ class GlobalConfig:
     # LiDAR compression parameters
     self.point_format = 0  # LARS point format used for storing
     self.point_precision = 0.01  # Precision up to which LiDAR points are stored
+    # Threads that encode and write the sensor data and measurements in the background, 0 writes in the tick
+    self.num_writer_threads = 2
+    # Files that can wait to be written before the tick blocks
+    self.writer_queue_size = 32
 
     # -----------------------------------------------------------------------------
     # Sensor config
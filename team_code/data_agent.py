@@ -7,14 +7,12 @@ import carla
 import random
 import torch
 import numpy as np
-import json
 import os
-import gzip
-import laspy
 from shapely.geometry import Polygon
 from pathlib import Path
 
 from autopilot import AutoPilot
+from sensor_writer import write_json_gz
 import transfuser_utils as t_u
 
 from birds_eye_view.chauffeurnet import ObsManager
@@ -407,43 +405,38 @@ class DataAgent(AutoPilot):
     def save_sensors(self, tick_data):
         frame = self.step // self.config.data_save_freq
 
+        # Encoding and writing happen in the background threads of the writer.
         # CARLA images are already in opencv's BGR format.
-        cv2.imwrite(str(self.save_path / 'rgb' / (f'{frame:04}.jpg')), tick_data['rgb'])
-        cv2.imwrite(str(self.save_path / 'rgb_augmented' / (f'{frame:04}.jpg')), tick_data['rgb_augmented'])
+        self.writer.write_image(self.save_path / 'rgb' / (f'{frame:04}.jpg'), tick_data['rgb'])
+        self.writer.write_image(self.save_path / 'rgb_augmented' / (f'{frame:04}.jpg'), tick_data['rgb_augmented'])
 
         if self.SAVE_TF_LABELS:
-            cv2.imwrite(str(self.save_path / 'semantics' / (f'{frame:04}.png')), tick_data['semantics'])
-            cv2.imwrite(str(self.save_path / 'semantics_augmented' / (f'{frame:04}.png')), tick_data['semantics_augmented'])
+            self.writer.write_image(self.save_path / 'semantics' / (f'{frame:04}.png'), tick_data['semantics'])
+            self.writer.write_image(self.save_path / 'semantics_augmented' / (f'{frame:04}.png'),
+                                    tick_data['semantics_augmented'])
 
-            cv2.imwrite(str(self.save_path / 'depth' / (f'{frame:04}.png')), tick_data['depth'])
-            cv2.imwrite(str(self.save_path / 'depth_augmented' / (f'{frame:04}.png')), tick_data['depth_augmented'])
+            self.writer.write_image(self.save_path / 'depth' / (f'{frame:04}.png'), tick_data['depth'])
+            self.writer.write_image(self.save_path / 'depth_augmented' / (f'{frame:04}.png'), tick_data['depth_augmented'])
 
-            cv2.imwrite(str(self.save_path / 'bev_semantics' / (f'{frame:04}.png')), tick_data['bev_semantics'])
-            cv2.imwrite(str(self.save_path / 'bev_semantics_augmented' / (f'{frame:04}.png')),
+            self.writer.write_image(self.save_path / 'bev_semantics' / (f'{frame:04}.png'), tick_data['bev_semantics'])
+            self.writer.write_image(self.save_path / 'bev_semantics_augmented' / (f'{frame:04}.png'),
                                     tick_data['bev_semantics_augmented'])
 
         # Specialized LiDAR compression format
-        header = laspy.LasHeader(point_format=self.config.point_format)
-        header.offsets = np.min(tick_data['lidar'], axis=0)
-        header.scales = np.array([self.config.point_precision, self.config.point_precision, self.config.point_precision])
+        self.writer.write_laz(self.save_path / 'lidar' / (f'{frame:04}.laz'), tick_data['lidar'], self.config.point_format,
+                              self.config.point_precision)
 
-        with laspy.open(self.save_path / 'lidar' / (f'{frame:04}.laz'), mode='w', header=header) as writer:
-            point_record = laspy.ScaleAwarePointRecord.zeros(tick_data['lidar'].shape[0], header=header)
-            point_record.x = tick_data['lidar'][:, 0]
-            point_record.y = tick_data['lidar'][:, 1]
-            point_record.z = tick_data['lidar'][:, 2]
-
-            writer.write_points(point_record)
-
-        with gzip.open(self.save_path / 'boxes' / (f'{frame:04}.json.gz'), 'wt', encoding='utf-8') as f:
-            json.dump(tick_data['bounding_boxes'], f, indent=4)
+        self.writer.write_json_gz(self.save_path / 'boxes' / (f'{frame:04}.json.gz'), tick_data['bounding_boxes'])
 
     def destroy(self, results=None):
         torch.cuda.empty_cache()
 
         if results is not None and self.save_path is not None:
-            with gzip.open(os.path.join(self.save_path, 'results.json.gz'), 'wt', encoding='utf-8') as f:
-                json.dump(results.__dict__, f, indent=2)
+            if self.datagen:
+                # results.json.gz marks the route as complete, so all frames have to be written before (raises on
+                # writer errors, the route then stays incomplete)
+                self.writer.close()
+            write_json_gz(self.save_path / 'results.json.gz', results.__dict__, indent=2)
 
         super().destroy(results)
         
@@ -61,6 +61,46 @@ class KinematicBicycleModel():
 
     return next_locations, next_headings, next_speeds
 
+  def forecast_other_vehicles_horizon(self, locations, headings, speeds, actions, num_future_frames):
+    """
+        Forecast the future states of other vehicles for all future frames at once. Same result as calling
+        forecast_other_vehicles num_future_frames times, but without a loop over the frames: the actions are kept
+        constant, so the speeds change linearly (until they reach 0) and the headings and locations are
+        cumulative sums.
+
+        Args:
+            locations (numpy.ndarray): Array of (x, y, z) coordinates representing the locations of other vehicles.
+            headings (numpy.ndarray): Array of heading angles (in radians) for other vehicles.
+            speeds (numpy.ndarray): Array of speeds (in m/s) for other vehicles.
+            actions (numpy.ndarray): Array of actions (steer, throttle, brake) for other vehicles.
+            num_future_frames (int): The number of future frames to forecast.
+
+        Returns:
+            tuple: A tuple containing the forecasted locations [N, T, 3], headings [N, T] and speeds [N, T] for
+                other vehicles, frame t is the state after t + 1 steps.
+        """
+    steers, throttles, brakes = actions[:, 0], actions[:, 1], actions[:, 2].astype(np.uint8)
+    wheel_angles = self.steering_gain * steers
+    slip_angles = np.arctan(self.rear_wheel_base / (self.front_wheel_base + self.rear_wheel_base) *
+                            np.tan(wheel_angles))
+    accelerations = np.where(brakes, self.brake_acceleration, throttles * self.throttle_acceleration)
+
+    # Speeds at the start of the steps 0 ... T, once a vehicle stopped it stays at 0
+    steps = np.arange(num_future_frames + 1)
+    step_speeds = np.maximum(0.0, speeds[:, None] + steps[None] * self.time_step * accelerations[:, None])
+    step_speeds[:, 0] = speeds
+
+    step_headings = headings[:, None] + np.concatenate(
+        (np.zeros_like(speeds[:, None]), np.cumsum(step_speeds[:, :-1], axis=1)),
+        axis=1) / self.rear_wheel_base * np.sin(slip_angles)[:, None] * self.time_step
+
+    moving_angles = step_headings[:, :-1] + slip_angles[:, None]
+    future_locations = np.repeat(np.asarray(locations, dtype=np.float64)[:, None, :], num_future_frames, axis=1)
+    future_locations[:, :, 0] += np.cumsum(step_speeds[:, :-1] * np.cos(moving_angles) * self.time_step, axis=1)
+    future_locations[:, :, 1] += np.cumsum(step_speeds[:, :-1] * np.sin(moving_angles) * self.time_step, axis=1)
+
+    return future_locations, step_headings[:, 1:], step_speeds[:, 1:]
+
   def forecast_ego_vehicle(self, location, heading, speed, action):
     """
         Forecast the future state of the ego vehicle based on its current state and action.
@@ -0,0 +1,146 @@
+"""
+Opt-in latency profiler for the closed-loop agent.
+Measures the wall clock time (and the GPU time with CUDA events) of the stages of every agent step and writes
+percentiles per route. The wall time of a stage that only launches GPU work does not include the GPU time,
+the GPU time of such stages is in cuda_ms. Enable it with PROFILE_LATENCY=1, when disabled stage() returns a shared no-op context.
+tools/summarize_agent_latency.py aggregates the reports of an evaluation sweep.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+# 20 Hz simulation
+STEP_BUDGET_MS = 50.0
+PERCENTILES = [50, 90, 99]
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _Stage:
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.profiler.start(self.name)
+
+  def __exit__(self, *args):
+    self.profiler.stop(self.name)
+
+
+class LatencyProfiler:
+  """
+  Usage:
+    with profiler.stage('pid'):
+      ...
+    # or profiler.start('pid') ... profiler.stop('pid')
+    profiler.end_step()
+  A stage that runs several times in one step (e.g. wrapped methods) is summed up for that step.
+  """
+
+  def __init__(self, enabled=False, use_cuda_events=True):
+    self.enabled = enabled
+    self.use_cuda_events = enabled and use_cuda_events and torch.cuda.is_available()
+    self.wall_ms = defaultdict(list)
+    self.cuda_ms = defaultdict(list)
+    self.num_steps = 0
+    self._open = {}
+    self._step_wall_ms = defaultdict(float)
+    self._step_events = defaultdict(list)
+
+  def stage(self, name):
+    if not self.enabled:
+      return _NULL_CONTEXT
+    return _Stage(self, name)
+
+  def start(self, name):
+    if not self.enabled:
+      return
+    start_event = None
+    if self.use_cuda_events:
+      start_event = torch.cuda.Event(enable_timing=True)
+      start_event.record()
+    self._open[name] = (time.perf_counter(), start_event)
+
+  def stop(self, name):
+    if not self.enabled:
+      return
+    start_time, start_event = self._open.pop(name)
+    self._step_wall_ms[name] += (time.perf_counter() - start_time) * 1000.0
+    if start_event is not None:
+      end_event = torch.cuda.Event(enable_timing=True)
+      end_event.record()
+      self._step_events[name].append((start_event, end_event))
+
+  def wrap_method(self, obj, method_name, stage_name):
+    """Times every call of obj.method_name as stage_name (e.g. the vision encoder inside the model forward)."""
+    if not self.enabled:
+      return
+    method = getattr(obj, method_name)
+
+    @functools.wraps(method)
+    def wrapped(*args, **kwargs):
+      with self.stage(stage_name):
+        return method(*args, **kwargs)
+
+    setattr(obj, method_name, wrapped)
+
+  def reset_step(self):
+    """Drops the timings of the current step."""
+    self._open = {}
+    self._step_wall_ms = defaultdict(float)
+    self._step_events = defaultdict(list)
+
+  def end_step(self):
+    if not self.enabled:
+      return
+    for name, wall_ms in self._step_wall_ms.items():
+      self.wall_ms[name].append(wall_ms)
+    if self._step_events:
+      # resolving the events once per step, the control output already synchronized the GPU
+      torch.cuda.synchronize()
+      for name, events in self._step_events.items():
+        self.cuda_ms[name].append(sum(start.elapsed_time(end) for start, end in events))
+    self.reset_step()
+    self.num_steps += 1
+
+  def summary(self):
+    stages = {}
+    for name, wall_ms in self.wall_ms.items():
+      stages[name] = {'count': len(wall_ms), 'wall_ms': get_statistics(wall_ms)}
+      if name in self.cuda_ms:
+        stages[name]['cuda_ms'] = get_statistics(self.cuda_ms[name])
+    summary = {'num_steps': self.num_steps, 'budget_ms': STEP_BUDGET_MS, 'stages': stages}
+    if 'total' in self.wall_ms:
+      summary['over_budget_fraction'] = float(np.mean(np.array(self.wall_ms['total']) > STEP_BUDGET_MS))
+    return summary
+
+  def save(self, path):
+    if not self.enabled or self.num_steps == 0:
+      return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+      json.dump(self.summary(), f, indent=4)
+
+
+def get_statistics(values):
+  values = np.asarray(values)
+  statistics = {'mean': float(values.mean()), 'max': float(values.max())}
+  for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+    statistics[f'p{percentile}'] = float(value)
+  return statistics
+
+
+def get_latency_report_path(result_file):
+  """The report is written next to the leaderboard result file: 001_res.json -> 001_latency.json"""
+  if result_file.endswith('_res.json'):
+    return result_file[:-len('_res.json')] + '_latency.json'
+  return os.path.splitext(result_file)[0] + '_latency.json'
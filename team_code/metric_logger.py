@@ -0,0 +1,129 @@
+"""
+Streams the per-step metric info of the agent (get_metric_info) to disk.
+Every step is appended as one line to metric_info.jsonl by a background thread, so the control loop never waits
+for the disk and the I/O per step does not grow with the route length. close() consolidates the lines into the
+metric_info.json format ({step: metric_info}, indent=4) that the Bench2Drive tools read.
+Routes that crashed before close() only have the .jsonl file, read_metric_info reads both.
+
+Consolidate left over .jsonl files:
+python team_code/metric_logger.py --path <eval save path>
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+
+METRIC_INFO_FILE = 'metric_info.json'
+METRIC_INFO_STREAM_FILE = 'metric_info.jsonl'
+
+
+class MetricInfoWriter:
+  """
+  Appends metric info on a background thread. The queue is bounded, if the disk can not keep up append() blocks
+  instead of buffering the whole route in memory. After an error of the writer thread the writer stays failed, every
+  later append and close raises and no more steps are written, so metric_info never has a silent gap.
+  """
+
+  def __init__(self, save_dir, max_queue_size=1000):
+    self.save_dir = save_dir
+    self.stream_path = os.path.join(save_dir, METRIC_INFO_STREAM_FILE)
+    self.queue = queue.Queue(maxsize=max_queue_size)
+    self.closed = False
+    self._error = None
+    # start a new stream, a left over from a previous run of the same route would mix two runs
+    self.stream = open(self.stream_path, 'w', encoding='utf-8')
+    self.thread = threading.Thread(target=self._write_loop, daemon=True)
+    self.thread.start()
+
+  def append(self, step, metric_info):
+    self._raise_error()
+    self.queue.put((step, metric_info))
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise IOError(f'Writing {self.stream_path} failed, no more steps are written.') from self._error
+
+  def _write_loop(self):
+    while True:
+      item = self.queue.get()
+      items = []
+      # write everything that is waiting in one go
+      while item is not None:
+        items.append(item)
+        try:
+          item = self.queue.get_nowait()
+        except queue.Empty:
+          break
+      # after an error the queue is still drained, so that append() and close() do not block
+      if items and self._error is None:
+        try:
+          self.stream.writelines(json.dumps({'step': step, 'metric_info': metric_info}) + '\n' for step, metric_info in items)
+          self.stream.flush()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+          self._error = e
+      if item is None:
+        return
+
+  def close(self, consolidate=True):
+    """Writes the remaining steps and (optionally) converts the stream into metric_info.json."""
+    if self.closed:
+      self._raise_error()
+      return
+    self.closed = True
+    self.queue.put(None)
+    self.thread.join()
+    self.stream.close()
+    self._raise_error()
+    if consolidate:
+      consolidate_metric_info(self.save_dir)
+
+
+def read_metric_info_stream(stream_path):
+  metric_info = {}
+  with open(stream_path, 'r', encoding='utf-8') as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        # last line of a crashed run might be incomplete
+        break
+      metric_info[str(record['step'])] = record['metric_info']
+  return metric_info
+
+
+def read_metric_info(save_dir):
+  """Returns the metric info of a route in the format of metric_info.json: {str(step): metric_info}."""
+  json_path = os.path.join(save_dir, METRIC_INFO_FILE)
+  if os.path.isfile(json_path):
+    with open(json_path, 'r', encoding='utf-8') as f:
+      return json.load(f)
+  return read_metric_info_stream(os.path.join(save_dir, METRIC_INFO_STREAM_FILE))
+
+
+def consolidate_metric_info(save_dir):
+  stream_path = os.path.join(save_dir, METRIC_INFO_STREAM_FILE)
+  metric_info = read_metric_info_stream(stream_path)
+  json_path = os.path.join(save_dir, METRIC_INFO_FILE)
+  # rename last, so readers never see a half written file
+  with open(json_path + '.tmp', 'w', encoding='utf-8') as f:
+    json.dump(metric_info, f, indent=4)
+  os.replace(json_path + '.tmp', json_path)
+  os.remove(stream_path)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--path', type=str, required=True, help='Folder that is searched recursively for metric_info.jsonl files.')
+  args = parser.parse_args()
+
+  stream_paths = glob.glob(os.path.join(args.path, '**', METRIC_INFO_STREAM_FILE), recursive=True)
+  for stream_path in stream_paths:
+    consolidate_metric_info(os.path.dirname(stream_path))
+  print(f'Consolidated {len(stream_paths)} metric info files')
+
+
+if __name__ == '__main__':
+  main()
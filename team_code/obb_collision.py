@@ -0,0 +1,118 @@
+"""
+Batched separating axis test (SAT) for 3D oriented bounding boxes (OBBs).
+Same test as AutoPilot.check_obb_intersection (15 candidate axes, boxes that only touch do not intersect), but on
+stacked NumPy arrays, so all (ego frame, actor frame) pairs of a step are checked in one call.
+Boxes are given as centers [..., 3], extents [..., 3] (half sizes) and rotations [..., 3] (pitch, yaw, roll in degrees,
+CARLA convention), or as one structured array with BOX_DTYPE (e.g. the forecasts of the AutoPilot).
+Does not depend on carla, bounding_boxes_to_arrays only reads the attributes of carla.BoundingBox.
+tools/benchmark_obb_collision.py checks it against the carla.Vector3D implementation.
+"""
+
+import numpy as np
+
+BOX_DTYPE = np.dtype([('location', np.float64, (3,)), ('extent', np.float64, (3,)), ('rotation', np.float64, (3,))])
+
+
+def get_box_axes(rotations):
+  """
+  Forward, right and up vector (rows) of CARLA rotations, same formulas as carla.Rotation.get_*_vector.
+  rotations: [..., 3] pitch, yaw, roll in degrees
+  returns: [..., 3, 3]
+  """
+  pitch, yaw, roll = np.moveaxis(np.deg2rad(np.asarray(rotations, dtype=np.float64)), -1, 0)
+  cp, sp = np.cos(pitch), np.sin(pitch)
+  cy, sy = np.cos(yaw), np.sin(yaw)
+  cr, sr = np.cos(roll), np.sin(roll)
+  forward = np.stack((cy * cp, sy * cp, sp), axis=-1)
+  right = np.stack((cy * sp * sr - sy * cr, sy * sp * sr + cy * cr, -cp * sr), axis=-1)
+  up = np.stack((-cy * sp * cr - sy * sr, -sy * sp * cr + cy * sr, cp * cr), axis=-1)
+  return np.stack((forward, right, up), axis=-2)
+
+
+def bounding_boxes_to_arrays(bounding_boxes):
+  """
+  Stacks a (nested) list of carla.BoundingBox with global location and rotation.
+  returns: centers, extents, rotations with shape [*list shape, 3]
+  """
+  bounding_boxes = np.asarray(bounding_boxes, dtype=object)
+  flat = bounding_boxes.reshape(-1)
+  boxes = np.array([(bb.location.x, bb.location.y, bb.location.z,
+                     bb.extent.x, bb.extent.y, bb.extent.z,
+                     bb.rotation.pitch, bb.rotation.yaw, bb.rotation.roll) for bb in flat], dtype=np.float64)
+  boxes = boxes.reshape(bounding_boxes.shape + (3, 3))
+  return boxes[..., 0, :], boxes[..., 1, :], boxes[..., 2, :]
+
+
+def get_boxes(locations, extents, rotations):
+  """Structured box array with BOX_DTYPE, the inputs [..., 3] are broadcasted against each other."""
+  shape = np.broadcast_shapes(np.shape(locations)[:-1], np.shape(extents)[:-1], np.shape(rotations)[:-1])
+  boxes = np.empty(shape, dtype=BOX_DTYPE)
+  boxes['location'] = locations
+  boxes['extent'] = extents
+  boxes['rotation'] = rotations
+  return boxes
+
+
+def get_box_fields(boxes):
+  """Inverse of get_boxes: locations, extents, rotations [..., 3]."""
+  return boxes['location'], boxes['extent'], boxes['rotation']
+
+
+def _separating_axis_test(relative_positions, extents1, axes1, extents2, axes2):
+  """Narrow phase on already broadcasted boxes [K, ...]. Returns True where no separating axis exists."""
+  # 3 + 3 face normals and the 9 cross products of the edge directions, [K, 15, 3]
+  cross_axes = np.cross(axes1[:, :, None, :], axes2[:, None, :, :]).reshape(-1, 9, 3)
+  planes = np.concatenate((axes1, axes2, cross_axes), axis=1)
+
+  distances = np.abs(np.einsum('kd,kpd->kp', relative_positions, planes))
+  # projection of the half extents onto every plane: sum_i |e_i * axis_i . plane|
+  radii1 = np.einsum('kpa,ka->kp', np.abs(np.einsum('kad,kpd->kpa', axes1, planes)), extents1)
+  radii2 = np.einsum('kpa,ka->kp', np.abs(np.einsum('kad,kpd->kpa', axes2, planes)), extents2)
+  return ~np.any(distances > radii1 + radii2, axis=1)
+
+
+def check_obb_intersections(centers1, extents1, rotations1, centers2, extents2, rotations2, broad_phase=True):
+  """
+  Checks whether the boxes 1 and 2 intersect, the leading dimensions are broadcasted against each other.
+  E.g. ego boxes [1, T] and actor boxes [A, T] give the frame wise result [A, T],
+  boxes [N, 1] and [1, M] the full intersection matrix [N, M].
+  broad_phase: skips the SAT for pairs whose bounding spheres are apart, which are most pairs in traffic.
+  returns: bool array with the broadcasted shape
+  """
+  centers1, extents1 = np.asarray(centers1, dtype=np.float64), np.asarray(extents1, dtype=np.float64)
+  centers2, extents2 = np.asarray(centers2, dtype=np.float64), np.asarray(extents2, dtype=np.float64)
+  shape = np.broadcast_shapes(centers1.shape[:-1], extents1.shape[:-1], np.shape(rotations1)[:-1],
+                              centers2.shape[:-1], extents2.shape[:-1], np.shape(rotations2)[:-1])
+  intersections = np.zeros(shape, dtype=bool)
+  if intersections.size == 0:
+    return intersections
+
+  relative_positions = np.broadcast_to(centers2 - centers1, shape + (3,))
+  candidates = np.ones(shape, dtype=bool)
+  if broad_phase:
+    radii = np.linalg.norm(extents1, axis=-1) + np.linalg.norm(extents2, axis=-1)
+    candidates = np.linalg.norm(relative_positions, axis=-1) <= radii
+    if not candidates.any():
+      return intersections
+
+  def select(values, trailing_shape):
+    return np.broadcast_to(values, shape + trailing_shape)[candidates]
+
+  # rotations are converted after the broad phase, only for the boxes that are still candidates
+  intersections[candidates] = _separating_axis_test(select(relative_positions, (3,)),
+                                                    select(extents1, (3,)),
+                                                    get_box_axes(select(rotations1, (3,))),
+                                                    select(extents2, (3,)),
+                                                    get_box_axes(select(rotations2, (3,))))
+  return intersections
+
+
+def check_obb_intersection_matrix(centers1, extents1, rotations1, centers2, extents2, rotations2, broad_phase=True):
+  """Intersection matrix [N, M] of the boxes 1 [N, 3] and the boxes 2 [M, 3]."""
+  return check_obb_intersections(np.asarray(centers1)[:, None],
+                                 np.asarray(extents1)[:, None],
+                                 np.asarray(rotations1)[:, None],
+                                 np.asarray(centers2)[None],
+                                 np.asarray(extents2)[None],
+                                 np.asarray(rotations2)[None],
+                                 broad_phase=broad_phase)
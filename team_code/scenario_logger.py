@@ -1,13 +1,25 @@
 """
 Creates log files during evaluation with which we can visualize failures
+The logged steps are appended in gzip compressed chunks to records.jsonl.gz, so memory does not grow with the route
+length and a crash only loses the last chunk. Instead of the route boxes each step stores a reference into the logged
+route, the RDP simplification and the boxes are computed in post-processing. dump_to_json consolidates the chunks into
+records.json.gz, read_records reads both.
+
+Consolidate left over records.jsonl.gz files:
+python team_code/scenario_logger.py --path <eval save path>
 """
 
+import argparse
+import glob
 import os
 import json
 import carla
 import gzip
+import zlib
 import numpy as np
-from rdp import rdp
+
+RECORDS_FILE = "records.json.gz"
+RECORDS_STREAM_FILE = "records.jsonl.gz"
 
 
 class ScenarioLogger:
@@ -15,8 +27,17 @@ class ScenarioLogger:
   Creates log files during evaluation with which we can visualize failures
   """
 
-  def __init__(self, save_path, route_index, logging_freq, log_only, route_only, roi=30, rdp_epsilon=0.5) -> None:
+  def __init__(self,
+               save_path,
+               route_index,
+               logging_freq,
+               log_only,
+               route_only,
+               roi=30,
+               rdp_epsilon=0.5,
+               flush_interval=100) -> None:
     """
+        flush_interval: number of logged steps per chunk that is appended to the records stream
         """
     # logger_settings
     self.logging_freq = logging_freq
@@ -35,12 +56,13 @@ class ScenarioLogger:
     self.ego_vehicle = None
     self.step = 0
 
-    # logging objects
-    self.states = []
-    self.lights = []
-    self.route_boxes = []
-    self.ego_actions = []
-    self.adv_actions = []
+    # logging objects, only the records of the current chunk are kept in memory
+    self.flush_interval = flush_interval
+    self.records_stream_path = os.path.join(self.save_path, RECORDS_STREAM_FILE)
+    self.stream_started = False
+    self.buffer = []
+    self.route = None
+    self.route_id = -1
 
     self.ego_pos = None
     self.ego_yaw = None
@@ -75,10 +97,6 @@ class ScenarioLogger:
     self.tl_state = None
     self.tl_extent = None
 
-    self.route_pos = None
-    self.route_yaw = None
-    self.route_id = None
-    self.route_extent = None
 
   def _initialize_bg_agents(self):
     """
@@ -325,14 +343,8 @@ class ScenarioLogger:
           "extent": [],
       }
 
-    # route
-    self.route_as_boxes(route)
-    route_boxes = {
-        "pos": self.route_pos.tolist(),
-        "yaw": self.route_yaw.tolist(),
-        "id": self.route_id.tolist(),
-        "extent": self.route_extent.tolist(),
-    }
+    # route, the boxes are built in post-processing from [route id, index of the first remaining point]
+    route_ref = self.log_route(route)
 
     # actions
     # ego action logging only if provided
@@ -359,12 +371,10 @@ class ScenarioLogger:
 
     # only save sim state to log every k frames
     if not self.route_only and self.step % self.logging_freq == 0:
-      self.states.append(state)
-      self.lights.append(lights)
-      self.route_boxes.append(route_boxes)
+      record = {"step": self.step, "state": state, "lights": lights, "route": route_ref, "adv_actions": bg_actions}
       if ego_control:
-        self.ego_actions.append(ego_actions)
-      self.adv_actions.append(bg_actions)
+        record["ego_actions"] = ego_actions
+      self.append(record)
 
     # reset logging objects after storing current timestep
     self.ego_pos = None
@@ -398,64 +408,29 @@ class ScenarioLogger:
     self.tl_state = None
     self.tl_extent = None
 
-    self.route_pos = None
-    self.route_yaw = None
-    self.route_id = None
-    self.route_extent = None
+    return state, lights, route_ref, bg_actions
 
-    return state, lights, route_boxes, bg_actions
+  def log_route(self, route):
+    """
+    Returns [route id, start index] of the remaining route. The route is only written to the stream when it is not a
+    suffix of the last logged route, e.g. when the planner did not just pop the passed points.
+    """
+    route = np.array(route)
+    start = 0 if self.route is None else len(self.route) - len(route)
+    if self.route is None or start < 0 or not np.array_equal(self.route[start:], route):
+      self.route = route
+      self.route_id += 1
+      start = 0
+      self.append({"route_id": self.route_id, "points": route.tolist()})
+    return [self.route_id, start]
 
   def route_as_boxes(self, route):
     """
-    route_as_boxes
+    Route boxes of the current step.
     """
-    shortened_route = rdp(route, epsilon=self.rdp_epsilon)
-
-    # convert points to vectors
-    vectors = shortened_route[1:] - shortened_route[:-1]
-    midpoints = shortened_route[:-1] + vectors / 2.
-    norms = np.linalg.norm(vectors, axis=1)
-    angles = np.arctan2(vectors[:, 1], vectors[:, 0])
-
-    route_positions = []
-    route_yaws = []
-    route_ids = []
-    route_extents = []
-    for i, midpoint in enumerate(midpoints):
-      # represent the route element as a bounding box
-      center_bounding_box = carla.Location(midpoint[0], midpoint[1], 0.0)
-      transform = carla.Transform(center_bounding_box)
-
-      # only store route boxes that are near the ego vehicle
-      start_bounding_box = carla.Location(shortened_route[i][0], shortened_route[i][1], 0.0)
-      if 0 < i < 10 and start_bounding_box.distance(self.ego_location) > self.roi:
-        continue
-
-      length_bounding_box = carla.Vector3D(norms[i] / 2., self.ego_vehicle.bounding_box.extent.y,
-                                           self.ego_vehicle.bounding_box.extent.z)
-      bounding_box = carla.BoundingBox(transform.location, length_bounding_box)
-      bounding_box.rotation = carla.Rotation(pitch=0.0, yaw=angles[i] * 180 / np.pi, roll=0.0)
-
-      # shape is batch_size x num_agents x state_dims
-      route_positions.append(np.array([[[center_bounding_box.x, center_bounding_box.y]]]))
-      route_yaws.append(np.array([[[bounding_box.rotation.yaw]]]))
-      route_ids.append(np.array([[[i]]]))
-      route_extents.append(
-          np.array([[[
-              [bounding_box.extent.y, bounding_box.extent.x],
-              [bounding_box.extent.y, -bounding_box.extent.x],
-              [-bounding_box.extent.y, -bounding_box.extent.x],
-              [-bounding_box.extent.y, bounding_box.extent.x],
-          ]]]))
-
-    if self.route_pos is None and len(route_positions) > 0:
-      self.route_pos = np.concatenate(route_positions, axis=1)
-    if self.route_yaw is None and len(route_yaws) > 0:
-      self.route_yaw = np.concatenate(np.radians(route_yaws), axis=1)
-    if self.route_id is None and len(route_ids) > 0:
-      self.route_id = np.concatenate(route_ids, axis=1)
-    if self.route_extent is None and len(route_extents) > 0:
-      self.route_extent = np.concatenate(route_extents, axis=1)
+    shortened_route = rdp(np.asarray(route), self.rdp_epsilon)
+    return route_as_boxes(shortened_route, (self.ego_location.x, self.ego_location.y, self.ego_location.z),
+                          self.ego_vehicle.bounding_box.extent.y, self.roi)
 
   def fetch_bg_actions(self):
     """
@@ -477,12 +452,16 @@ class ScenarioLogger:
     if self.bg_brake is None:
       self.bg_brake = np.concatenate(brakes, axis=1)
 
-  def dump_to_json(self):
+  def append(self, record):
+    self.buffer.append(json.dumps(record))
+    if len(self.buffer) >= self.flush_interval:
+      self.flush()
+
+  def flush(self):
     """
-    dump_to_json
+    Appends the buffered records as one gzip member, a crash can only corrupt the last member.
     """
-    if not self.route_only:
-      self.records_file_path = os.path.join(self.save_path, "records.json.gz")
+    if not self.stream_started:
       if not os.path.exists(self.save_path):
         os.mkdir(os.path.join(self.save_path))
 
@@ -495,24 +474,168 @@ class ScenarioLogger:
           "index": self.route_index,
           "town": town_name,
       }
-      records_dict = {
-          "meta_data": meta_data,
-          "states": [],
-          "lights": [],
-          "route": [],
-          "ego_actions": [],
-          "adv_actions": [],
-      }
+      self.buffer.insert(0, json.dumps({"meta_data": meta_data, "roi": self.roi, "rdp_epsilon": self.rdp_epsilon}))
+
+    if self.buffer:
+      # start a new stream, a left over from a previous run of the same route would mix two runs
+      with open(self.records_stream_path, "ab" if self.stream_started else "wb") as f:
+        f.write(gzip.compress(("\n".join(self.buffer) + "\n").encode("utf-8")))
+      self.stream_started = True
+      self.buffer = []
+
+  def dump_to_json(self):
+    """
+    dump_to_json
+    """
+    if not self.route_only:
+      self.flush()
+      self.records_file_path = consolidate_records(self.save_path)
 
-      for i in range(len(self.states)):
-        records_dict["states"].append(self.states[i])
-        records_dict["lights"].append(self.lights[i])
-        records_dict["route"].append(self.route_boxes[i])
-        records_dict["adv_actions"].append(self.adv_actions[i])
 
-      # ego actions only logged if provided
-      for i in range(len(self.ego_actions)):
-        records_dict["ego_actions"].append(self.ego_actions[i])
+def rdp(points, epsilon):
+  """
+  Ramer-Douglas-Peucker simplification with the same result as the iterative rdp of the rdp package, but the distances
+  of all points of a segment are computed in one NumPy operation instead of a Python loop.
+  """
+  keep = np.ones(len(points), dtype=bool)
+  stack = [(0, len(points) - 1)]
+  while stack:
+    start_index, last_index = stack.pop()
+    if last_index - start_index < 2:
+      continue
+    start, end = points[start_index], points[last_index]
+    inner = points[start_index + 1:last_index]
+    line = end - start
+    if np.all(np.equal(start, end)):
+      distances = np.linalg.norm(inner - start, axis=1)
+    elif points.shape[1] == 2:
+      diff = start - inner
+      distances = np.abs(line[0] * diff[:, 1] - line[1] * diff[:, 0]) / np.linalg.norm(line)
+    else:
+      distances = np.linalg.norm(np.cross(line, start - inner), axis=1) / np.linalg.norm(line)
+
+    index = int(np.argmax(distances))
+    if distances[index] > epsilon:
+      stack.append((start_index, start_index + 1 + index))
+      stack.append((start_index + 1 + index, last_index))
+    else:
+      keep[start_index + 1:last_index] = False
+  return points[keep]
 
-      with gzip.open(self.records_file_path, "wt", encoding="utf-8") as f:
-        json.dump(records_dict, f)
+
+def route_as_boxes(shortened_route, ego_location, ego_extent_y, roi):
+  """
+  Represents the RDP simplified route as boxes, the boxes 1 to 9 are only kept when they start within roi of the ego.
+  Values are rounded to float32 like the carla.Location / Vector3D / Rotation objects the boxes were built with.
+  """
+  # convert points to vectors
+  vectors = shortened_route[1:] - shortened_route[:-1]
+  midpoints = shortened_route[:-1] + vectors / 2.
+  norms = np.linalg.norm(vectors, axis=1)
+  angles = np.arctan2(vectors[:, 1], vectors[:, 0])
+
+  # only store route boxes that are near the ego vehicle
+  starts = np.concatenate((shortened_route[:-1, :2], np.zeros((len(vectors), 1))), axis=1).astype(np.float32)
+  distances = np.linalg.norm(starts - np.array(ego_location, dtype=np.float32), axis=1)
+  ids = np.arange(len(vectors))
+  keep = ~((0 < ids) & (ids < 10) & (distances > roi))
+
+  # shape is batch_size x num_agents x state_dims
+  positions = midpoints[keep, :2].astype(np.float32).astype(np.float64)
+  yaws = np.radians((angles[keep] * 180 / np.pi).astype(np.float32).astype(np.float64))
+  extent_x = (norms[keep] / 2.).astype(np.float32).astype(np.float64)
+  extent_y = np.full_like(extent_x, np.float32(ego_extent_y))
+  extents = np.stack((np.stack((extent_y, extent_x), axis=-1), np.stack((extent_y, -extent_x), axis=-1),
+                      np.stack((-extent_y, -extent_x), axis=-1), np.stack((-extent_y, extent_x), axis=-1)),
+                     axis=1)
+  if len(positions) == 0:
+    return {"pos": [], "yaw": [], "id": [], "extent": []}
+
+  return {
+      "pos": positions[None].tolist(),
+      "yaw": yaws[None, :, None].tolist(),
+      "id": ids[keep][None, :, None].tolist(),
+      "extent": extents[None].tolist(),
+  }
+
+
+def read_records_stream(stream_path):
+  """
+  Reassembles the records of a (possibly incomplete) stream in the format of records.json.gz.
+  """
+  records_dict = {
+      "meta_data": None,
+      "states": [],
+      "lights": [],
+      "route": [],
+      "ego_actions": [],
+      "adv_actions": [],
+  }
+  routes = {}
+  last_route_ref, last_shortened_route = None, None
+  with gzip.open(stream_path, "rt", encoding="utf-8") as f:
+    try:
+      for line in f:
+        record = json.loads(line)
+        if "meta_data" in record:
+          records_dict["meta_data"] = record["meta_data"]
+          roi, rdp_epsilon = record["roi"], record["rdp_epsilon"]
+        elif "route_id" in record:
+          routes[record["route_id"]] = np.array(record["points"])
+        else:
+          state = record["state"]
+          # consecutive steps mostly share the remaining route
+          if record["route"] != last_route_ref:
+            route_id, start = record["route"]
+            last_route_ref, last_shortened_route = record["route"], rdp(routes[route_id][start:], rdp_epsilon)
+          # the ego is the first vehicle in the state
+          ego_location = (state["pos"][0][0][0], state["pos"][0][0][1], state["height"][0][0][0])
+          route_boxes = route_as_boxes(last_shortened_route, ego_location, state["extent"][0][0][0][0], roi)
+
+          records_dict["states"].append(state)
+          records_dict["lights"].append(record["lights"])
+          records_dict["route"].append(route_boxes)
+          records_dict["adv_actions"].append(record["adv_actions"])
+          # ego actions only logged if provided
+          if "ego_actions" in record:
+            records_dict["ego_actions"].append(record["ego_actions"])
+    except (EOFError, zlib.error, gzip.BadGzipFile, json.JSONDecodeError):
+      # last chunk of a crashed run might be incomplete
+      pass
+  return records_dict
+
+
+def read_records(save_path):
+  """Returns the records of a route in the format of records.json.gz."""
+  records_file_path = os.path.join(save_path, RECORDS_FILE)
+  if os.path.isfile(records_file_path):
+    with gzip.open(records_file_path, "rt", encoding="utf-8") as f:
+      return json.load(f)
+  return read_records_stream(os.path.join(save_path, RECORDS_STREAM_FILE))
+
+
+def consolidate_records(save_path):
+  stream_path = os.path.join(save_path, RECORDS_STREAM_FILE)
+  records_dict = read_records_stream(stream_path)
+  records_file_path = os.path.join(save_path, RECORDS_FILE)
+  # rename last, so readers never see a half written file
+  with gzip.open(records_file_path + ".tmp", "wt", encoding="utf-8") as f:
+    json.dump(records_dict, f)
+  os.replace(records_file_path + ".tmp", records_file_path)
+  os.remove(stream_path)
+  return records_file_path
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--path", type=str, required=True, help="Folder that is searched recursively for records streams.")
+  args = parser.parse_args()
+
+  stream_paths = glob.glob(os.path.join(args.path, "**", RECORDS_STREAM_FILE), recursive=True)
+  for stream_path in stream_paths:
+    consolidate_records(os.path.dirname(stream_path))
+  print(f"Consolidated {len(stream_paths)} records files")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,133 @@
+"""
+Background writer for the files of the data collection (camera images, LiDAR, boxes and measurements).
+Encoding and compression run in a small thread pool instead of the simulator tick, cv2, laspy and zlib release the GIL
+while they work. The queue is bounded, so submit blocks when the disk can't keep up (backpressure) instead of growing
+memory. Every file is written to a hidden temporary file next to its target and renamed when complete, so a crash never
+leaves a truncated file under the final name.
+Submitted arrays and dicts are not copied, they must not be modified after submitting them.
+"""
+
+import gzip
+import json
+import os
+import queue
+import threading
+
+import cv2
+import laspy
+import numpy as np
+import ujson
+
+
+def temporary_path(path):
+  """Hidden file in the same directory (same file system for the rename), that keeps the extension of path."""
+  return path.with_name(f'.{path.stem}.tmp{path.suffix}')
+
+
+def write_image(path, image):
+  # Encoded in memory because cv2.imwrite picks the format from the file name
+  success, buffer = cv2.imencode(path.suffix, image)
+  if not success:
+    raise IOError(f'Could not encode {path}')
+  with open(temporary_path(path), 'wb') as f:
+    f.write(buffer.tobytes())
+  os.replace(temporary_path(path), path)
+
+
+def write_json_gz(path, data, indent=4, use_ujson=False):
+  with gzip.open(temporary_path(path), 'wt', encoding='utf-8') as f:
+    if use_ujson:
+      ujson.dump(data, f, indent=indent)
+    else:
+      json.dump(data, f, indent=indent)
+  os.replace(temporary_path(path), path)
+
+
+def write_laz(path, points, point_format, point_precision):
+  """LiDAR points [N, 3] in the compressed LAZ format."""
+  header = laspy.LasHeader(point_format=point_format)
+  header.offsets = np.min(points, axis=0)
+  header.scales = np.array([point_precision, point_precision, point_precision])
+
+  # The temporary file ends with .laz, laspy compresses based on the extension
+  with laspy.open(temporary_path(path), mode='w', header=header) as writer:
+    point_record = laspy.ScaleAwarePointRecord.zeros(points.shape[0], header=header)
+    point_record.x = points[:, 0]
+    point_record.y = points[:, 1]
+    point_record.z = points[:, 2]
+
+    writer.write_points(point_record)
+  os.replace(temporary_path(path), path)
+
+
+class SensorWriter(object):
+  """
+  Bounded pool of writer threads. With num_threads=0 the files are written synchronously in submit.
+  After the first error the writer stays failed: the files still in the queue are dropped, every later submit, flush
+  and close raises and no more files are accepted, so a route with missing files is never completed silently.
+  """
+
+  def __init__(self, num_threads=2, queue_size=32):
+    self.num_threads = num_threads
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._error = None
+    self._threads = []
+    for i in range(num_threads):
+      thread = threading.Thread(target=self._work, name=f'sensor_writer_{i}', daemon=True)
+      thread.start()
+      self._threads.append(thread)
+
+  def _work(self):
+    while True:
+      job = self._queue.get()
+      try:
+        if job is None:
+          return
+        # the queue is still drained after an error, so that flush and close do not block
+        if self._error is None:
+          write_function, args, kwargs = job
+          write_function(*args, **kwargs)
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        if self._error is None:
+          self._error = e
+      finally:
+        self._queue.task_done()
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise IOError('The sensor writer failed, no more files are written.') from self._error
+
+  def submit(self, write_function, *args, **kwargs):
+    """Calls write_function(*args, **kwargs) in a writer thread, blocks while the queue is full."""
+    self._raise_error()
+    if not self._threads:
+      try:
+        write_function(*args, **kwargs)
+      except Exception as e:
+        self._error = e
+        raise
+    else:
+      self._queue.put((write_function, args, kwargs))
+
+  def write_image(self, path, image):
+    self.submit(write_image, path, image)
+
+  def write_json_gz(self, path, data, indent=4, use_ujson=False):
+    self.submit(write_json_gz, path, data, indent=indent, use_ujson=use_ujson)
+
+  def write_laz(self, path, points, point_format, point_precision):
+    self.submit(write_laz, path, points, point_format, point_precision)
+
+  def flush(self):
+    """Waits until all submitted files are written."""
+    self._queue.join()
+    self._raise_error()
+
+  def close(self):
+    """Writes the remaining files and stops the threads."""
+    for _ in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+    self._raise_error()
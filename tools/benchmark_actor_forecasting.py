@@ -0,0 +1,187 @@
+'''
+Checks the batched actor forecasting of the AutoPilot (KinematicBicycleModel.forecast_other_vehicles_horizon and the
+obb_collision.BOX_DTYPE boxes of predict_other_actors_bounding_boxes / forecast_walkers) against the previous
+frame by frame rollout that created one carla.BoundingBox per actor and frame, and benchmarks both.
+Runs without a simulator, the carla types are the mocks of scenario_runner/srunner/tests/carla_mocks.
+Example:
+python tools/benchmark_actor_forecasting.py --actors 10 50 200
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+sys.path.insert(0, os.path.join(ROOT, 'team_code'))
+import carla  # pylint: disable=wrong-import-position
+
+from config import GlobalConfig  # pylint: disable=wrong-import-position
+from kinematic_bicycle_model import KinematicBicycleModel  # pylint: disable=wrong-import-position
+import obb_collision  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--actors', type=int, nargs='+', default=[10, 50, 200], help='Numbers of synthetic actors.')
+parser.add_argument('--frames', type=int, default=40, help='Forecasted frames (20 Hz * 2 s in the AutoPilot).')
+parser.add_argument('--repetitions', type=int, default=5)
+parser.add_argument('--atol', type=float, default=1e-9, help='Allowed absolute difference to the old implementation.')
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous implementation of the AutoPilot ##############
+def forecast_vehicles_reference(config, model, locations, headings, velocities, actions, extents, num_future_frames,
+                                near_lane_change):
+  future_locations = np.empty((num_future_frames, len(locations), 3), dtype='float')
+  future_headings = np.empty((num_future_frames, len(locations)), dtype='float')
+  future_velocities = np.empty((num_future_frames, len(locations)), dtype='float')
+  for i in range(num_future_frames):
+    locations, headings, velocities = model.forecast_other_vehicles(locations, headings, velocities, actions)
+    future_locations[i] = locations.copy()
+    future_velocities[i] = velocities.copy()
+    future_headings[i] = headings.copy()
+  future_headings = np.rad2deg(future_headings)
+
+  predicted_bounding_boxes = []
+  for actor_idx in range(len(extents)):
+    predicted_actor_boxes = []
+    for i in range(num_future_frames):
+      location = carla.Location(x=future_locations[i, actor_idx, 0].item(),
+                                y=future_locations[i, actor_idx, 1].item(),
+                                z=future_locations[i, actor_idx, 2].item())
+      rotation = carla.Rotation(pitch=0, yaw=future_headings[i, actor_idx], roll=0)
+      extent = carla.Vector3D(x=extents[actor_idx, 0], y=extents[actor_idx, 1], z=extents[actor_idx, 2])
+      s = config.high_speed_min_extent_x_other_vehicle_lane_change if near_lane_change \
+          else config.high_speed_min_extent_x_other_vehicle
+      extent.x *= config.slow_speed_extent_factor_ego if future_velocities[
+          i, actor_idx] < config.extent_other_vehicles_bbs_speed_threshold else max(
+              s, config.high_speed_min_extent_x_other_vehicle * float(i) / float(num_future_frames))
+      extent.y *= config.slow_speed_extent_factor_ego if future_velocities[
+          i, actor_idx] < config.extent_other_vehicles_bbs_speed_threshold else max(
+              config.high_speed_min_extent_y_other_vehicle,
+              config.high_speed_extent_y_factor_other_vehicle * float(i) / float(num_future_frames))
+      bounding_box = carla.BoundingBox(location, extent)
+      bounding_box.rotation = rotation
+      predicted_actor_boxes.append(bounding_box)
+    predicted_bounding_boxes.append(predicted_actor_boxes)
+  return predicted_bounding_boxes
+
+
+def forecast_walkers_reference(config, locations, speeds, directions, extents, rotations, num_future_frames):
+  speeds = np.maximum(speeds, config.min_walker_speed)
+  future_locations = locations[:, None, :] + np.arange(1, num_future_frames + 1)[
+      None, :, None] * directions[:, None, :] * speeds[:, None, None] / config.bicycle_frame_rate
+  bounding_boxes = []
+  for i in range(len(locations)):
+    rotation = carla.Rotation(pitch=rotations[i, 0], yaw=rotations[i, 1], roll=rotations[i, 2])
+    extent = carla.Vector3D(max(config.pedestrian_minimum_extent, extents[i, 0]),
+                            max(config.pedestrian_minimum_extent, extents[i, 1]), extents[i, 2])
+    pedestrian_future_bboxes = []
+    for j in range(num_future_frames):
+      location = carla.Location(future_locations[i, j, 0], future_locations[i, j, 1], future_locations[i, j, 2])
+      bounding_box = carla.BoundingBox(location, extent)
+      bounding_box.rotation = rotation
+      pedestrian_future_bboxes.append(bounding_box)
+    bounding_boxes.append(pedestrian_future_bboxes)
+  return bounding_boxes
+
+
+############## batched implementation, same as the AutoPilot ##############
+def forecast_vehicles_batched(config, model, locations, headings, velocities, actions, extents, num_future_frames,
+                              near_lane_change):
+  future_locations, future_headings, future_velocities = model.forecast_other_vehicles_horizon(
+      locations, headings, velocities, actions, num_future_frames)
+  s = config.high_speed_min_extent_x_other_vehicle_lane_change if near_lane_change \
+      else config.high_speed_min_extent_x_other_vehicle
+  horizon_fraction = np.arange(num_future_frames) / float(num_future_frames)
+  slow = future_velocities < config.extent_other_vehicles_bbs_speed_threshold
+  extent_factors = np.ones(future_velocities.shape + (3,))
+  extent_factors[..., 0] = np.where(slow, config.slow_speed_extent_factor_ego,
+                                    np.maximum(s, config.high_speed_min_extent_x_other_vehicle * horizon_fraction))
+  extent_factors[..., 1] = np.where(
+      slow, config.slow_speed_extent_factor_ego,
+      np.maximum(config.high_speed_min_extent_y_other_vehicle,
+                 config.high_speed_extent_y_factor_other_vehicle * horizon_fraction))
+  future_rotations = np.zeros(future_locations.shape)
+  future_rotations[..., 1] = np.rad2deg(future_headings)
+  return obb_collision.get_boxes(future_locations, extents[:, None] * extent_factors, future_rotations)
+
+
+def forecast_walkers_batched(config, locations, speeds, directions, extents, rotations, num_future_frames):
+  speeds = np.maximum(speeds, config.min_walker_speed)
+  extents = extents.copy()
+  extents[:, :2] = np.maximum(config.pedestrian_minimum_extent, extents[:, :2])
+  future_locations = locations[:, None, :] + np.arange(1, num_future_frames + 1)[
+      None, :, None] * directions[:, None, :] * speeds[:, None, None] / config.bicycle_frame_rate
+  return obb_collision.get_boxes(future_locations, extents[:, None], rotations[:, None])
+
+
+def random_vehicles(rng, num_actors):
+  locations = rng.uniform(-50, 50, size=(num_actors, 3))
+  headings = rng.uniform(-np.pi, np.pi, size=num_actors)
+  velocities = rng.uniform(0, 15, size=num_actors)
+  velocities[rng.random(num_actors) < 0.2] = 0.0
+  # previous controls of the traffic manager, braking vehicles come to a stop within the horizon
+  actions = np.stack((rng.uniform(-0.7, 0.7, size=num_actors), rng.uniform(0, 1, size=num_actors),
+                      (rng.random(num_actors) < 0.3).astype(np.float64)),
+                     axis=1)
+  extents = rng.uniform(0.5, 3.0, size=(num_actors, 3))
+  return locations, headings, velocities, actions, extents
+
+
+def random_walkers(rng, num_actors):
+  locations = rng.uniform(-50, 50, size=(num_actors, 3))
+  speeds = rng.uniform(0, 2, size=num_actors)
+  yaw = rng.uniform(-np.pi, np.pi, size=num_actors)
+  directions = np.stack((np.cos(yaw), np.sin(yaw), np.zeros(num_actors)), axis=1)
+  extents = rng.uniform(0.1, 0.5, size=(num_actors, 3))
+  rotations = np.stack((np.zeros(num_actors), np.rad2deg(yaw), np.zeros(num_actors)), axis=1)
+  return locations, speeds, directions, extents, rotations
+
+
+def compare(reference, batched, atol):
+  reference = obb_collision.bounding_boxes_to_arrays(reference)
+  max_diff = 0.0
+  for reference_field, batched_field in zip(reference, obb_collision.get_box_fields(batched)):
+    assert reference_field.shape == batched_field.shape, f'{reference_field.shape} != {batched_field.shape}'
+    max_diff = max(max_diff, float(np.max(np.abs(reference_field - batched_field), initial=0.0)))
+  assert max_diff <= atol, f'max abs difference {max_diff} > {atol}'
+  return max_diff
+
+
+def timed(function, repetitions, *args):
+  start = time.perf_counter()
+  for _ in range(repetitions):
+    output = function(*args)
+  return output, (time.perf_counter() - start) / repetitions
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  config = GlobalConfig()
+  model = KinematicBicycleModel(config)
+
+  for num_actors in args.actors:
+    vehicles = random_vehicles(rng, num_actors)
+    walkers = random_walkers(rng, num_actors)
+    for near_lane_change in (False, True):
+      reference, time_reference = timed(forecast_vehicles_reference, args.repetitions, config, model, *vehicles,
+                                        args.frames, near_lane_change)
+      batched, time_batched = timed(forecast_vehicles_batched, args.repetitions, config, model, *vehicles, args.frames,
+                                    near_lane_change)
+      max_diff = compare(reference, batched, args.atol)
+    print(f'{num_actors:>4} vehicles x {args.frames} frames: per frame {time_reference * 1000:7.2f} ms, '
+          f'batched {time_batched * 1000:5.2f} ms (x{time_reference / time_batched:.0f}), max diff {max_diff:.1e}')
+
+    reference, time_reference = timed(forecast_walkers_reference, args.repetitions, config, *walkers, args.frames)
+    batched, time_batched = timed(forecast_walkers_batched, args.repetitions, config, *walkers, args.frames)
+    max_diff = compare(reference, batched, args.atol)
+    print(f'{num_actors:>4} walkers  x {args.frames} frames: per frame {time_reference * 1000:7.2f} ms, '
+          f'batched {time_batched * 1000:5.2f} ms (x{time_reference / time_batched:.0f}), max diff {max_diff:.1e}')
+
+
+if __name__ == '__main__':
+  main()
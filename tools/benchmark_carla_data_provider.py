@@ -0,0 +1,203 @@
+'''
+Checks the id keyed buffers of the CarlaDataProvider (filled from one world snapshot per tick) against the previous
+implementation, that kept the buffers keyed by actor objects, called is_alive, get_velocity, get_location and
+get_transform on every actor per tick and searched all buffered actors for every get_* call. Benchmarks both and
+counts the carla client calls of one on_carla_tick. Runs without a simulator, the carla types are the mocks of
+scenario_runner/srunner/tests/carla_mocks. The mock getters are plain attribute reads, so the tick times do not
+include the cost of a call into the client library, only the call counts carry over to CARLA.
+Example:
+python tools/benchmark_carla_data_provider.py --actors 500 --ticks 100
+'''
+
+import argparse
+import contextlib
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner'))
+import carla  # pylint: disable=wrong-import-position
+
+from srunner.scenariomanager.carla_data_provider import CarlaDataProvider  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--actors', type=int, default=500, help='Number of registered actors.')
+parser.add_argument('--ticks', type=int, default=100)
+parser.add_argument('--queries', type=int, default=3, help='get_velocity/location/transform calls per actor and tick.')
+parser.add_argument('--destroy_fraction', type=float, default=0.05, help='Actors destroyed during the run.')
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous implementation of the CarlaDataProvider ##############
+class ReferenceDataProvider(object):
+
+  def __init__(self):
+    self.velocity_map = {}
+    self.location_map = {}
+    self.transform_map = {}
+
+  def register_actor(self, actor, transform=None):
+    self.velocity_map[actor] = 0.0
+    self.location_map[actor] = transform.location if transform else None
+    self.transform_map[actor] = transform
+
+  def on_carla_tick(self):
+    for actor in self.velocity_map:
+      if actor is not None and actor.is_alive:
+        self.velocity_map[actor] = math.sqrt(actor.get_velocity().x**2 + actor.get_velocity().y**2)
+    for actor in self.location_map:
+      if actor is not None and actor.is_alive:
+        self.location_map[actor] = actor.get_location()
+    for actor in self.transform_map:
+      if actor is not None and actor.is_alive:
+        self.transform_map[actor] = actor.get_transform()
+
+  @staticmethod
+  def _find(buffer, actor, default):
+    for key in buffer:
+      if key.id == actor.id:
+        return buffer[key]
+    return default
+
+  def get_velocity(self, actor):
+    return self._find(self.velocity_map, actor, 0.0)
+
+  def get_location(self, actor):
+    return self._find(self.location_map, actor, None)
+
+  def get_transform(self, actor):
+    return self._find(self.transform_map, actor, None)
+
+
+# client calls that on_carla_tick can make, is_alive is counted separately since it is a property in CARLA
+CARLA_CALLS = [(carla.Actor, 'get_velocity'), (carla.Actor, 'get_location'), (carla.Actor, 'get_transform'),
+               (carla.ActorSnapshot, 'get_velocity'), (carla.ActorSnapshot, 'get_transform'),
+               (carla.WorldSnapshot, 'find')]
+
+
+@contextlib.contextmanager
+def count_carla_calls(world):
+  '''Counts the calls into the carla API (mocks) while active.'''
+  counts = {'calls': 0}
+
+  def counted(function):
+    def wrapper(*args, **kwargs):
+      counts['calls'] += 1
+      return function(*args, **kwargs)
+    return wrapper
+
+  def is_alive(actor):
+    counts['calls'] += 1
+    return actor.__dict__['is_alive']
+
+  originals = [(cls, name, cls.__dict__[name]) for cls, name in CARLA_CALLS]
+  for cls, name, function in originals:
+    setattr(cls, name, counted(function))
+  # a data descriptor takes precedence over the is_alive attribute of the instances
+  carla.Actor.is_alive = property(is_alive, lambda actor, value: actor.__dict__.__setitem__('is_alive', value))
+  get_snapshot = world.get_snapshot
+  world.get_snapshot = counted(get_snapshot)
+  try:
+    yield counts
+  finally:
+    for cls, name, function in originals:
+      setattr(cls, name, function)
+    del carla.Actor.is_alive
+    world.get_snapshot = get_snapshot
+
+
+def spawn_actors(rng, num_actors):
+  actors = []
+  for actor_id in range(num_actors):
+    actor = carla.Vehicle()
+    actor.id = actor_id
+    x, y = rng.uniform(-500, 500, size=2).tolist()
+    actor.location = carla.Location(x, y, 0.0)
+    actor.transform = carla.Transform(actor.location, carla.Rotation(yaw=rng.uniform(-180, 180)))
+    actors.append(actor)
+  return actors
+
+
+def step_simulation(rng, actors, destroyed):
+  '''Moves all alive actors and destroys some, returns the snapshot of the new tick.'''
+  for actor in actors:
+    if not actor.is_alive:
+      continue
+    vx, vy = rng.uniform(-15, 15, size=2).tolist()
+    actor.velocity = carla.Vector3D(vx, vy, 0.0)
+    actor.location = carla.Location(actor.location.x + 0.05 * vx, actor.location.y + 0.05 * vy, 0.0)
+    actor.transform = carla.Transform(actor.location, actor.transform.rotation)
+  for actor in destroyed:
+    actor.is_alive = False
+  return carla.WorldSnapshot(actors)
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  actors = spawn_actors(rng, args.actors)
+  destroy_ticks = rng.integers(args.ticks, size=int(args.destroy_fraction * args.actors))
+  destroy_actors = rng.choice(args.actors, size=len(destroy_ticks), replace=False)
+
+  world = carla.World()
+  snapshot = carla.WorldSnapshot(actors)
+  # The simulator creates the snapshot once per tick, the provider only reads it
+  world.get_snapshot = lambda: snapshot
+  CarlaDataProvider._world = world  # pylint: disable=protected-access
+  reference = ReferenceDataProvider()
+  for actor in actors:
+    CarlaDataProvider.register_actor(actor, actor.get_transform())
+    reference.register_actor(actor, actor.get_transform())
+
+  time_tick_reference, time_tick = 0.0, 0.0
+  time_get_reference, time_get = 0.0, 0.0
+  for tick in range(args.ticks):
+    snapshot = step_simulation(rng, actors, [actors[i] for i in destroy_actors[destroy_ticks == tick]])
+
+    start = time.perf_counter()
+    reference.on_carla_tick()
+    time_tick_reference += time.perf_counter() - start
+    start = time.perf_counter()
+    CarlaDataProvider.on_carla_tick()
+    time_tick += time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.queries):
+      values_reference = [(reference.get_velocity(actor), reference.get_location(actor), reference.get_transform(actor))
+                          for actor in actors]
+    time_get_reference += time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.queries):
+      values = [(CarlaDataProvider.get_velocity(actor), CarlaDataProvider.get_location(actor),
+                 CarlaDataProvider.get_transform(actor)) for actor in actors]
+    time_get += time.perf_counter() - start
+
+    assert values_reference == values, f'different buffered values in tick {tick}'
+
+    if tick == 0:
+      # ticking again reads the same values, the buffers do not change
+      with count_carla_calls(world) as counts_reference:
+        reference.on_carla_tick()
+      with count_carla_calls(world) as counts:
+        CarlaDataProvider.on_carla_tick()
+
+  CarlaDataProvider._world = None  # pylint: disable=protected-access
+  CarlaDataProvider.cleanup()
+
+  calls = args.ticks * args.queries * args.actors * 3
+  print(f'{args.actors} actors, {args.ticks} ticks, {len(destroy_ticks)} destroyed: identical buffered values')
+  print(f'on_carla_tick: {time_tick_reference * 1000 / args.ticks:7.3f} -> {time_tick * 1000 / args.ticks:6.3f} ms/tick '
+        f'(x{time_tick_reference / time_tick:.2f}, mock getters)')
+  print(f'carla calls:   {counts_reference["calls"]:7d} -> {counts["calls"]:6d} per tick '
+        f'({counts_reference["calls"] / args.actors:.1f} -> {counts["calls"] / args.actors:.1f} per actor)')
+  print(f'get_*:         {time_get_reference * 1e6 / calls:7.3f} -> {time_get * 1e6 / calls:6.3f} us/call '
+        f'(x{time_get_reference / time_get:.0f})')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+'''
+Benchmarks LLM.greedy_sample with and without the key/value cache.
+The prompt length mimics a SimLingo prompt (2 image patches with 256 <IMG_CONTEXT> tokens each + text)
+and the number of generated tokens a commentary answer.
+Example:
+python tools/benchmark_greedy_sample.py --variant OpenGVLab/InternVL2-1B --new_tokens 40
+'''
+
+import argparse
+import time
+
+import torch
+
+from simlingo_training.models.language_model.llm import LLM
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--variant', type=str, default='OpenGVLab/InternVL2-1B', help='Language model variant.')
+parser.add_argument('--lora', action='store_true', default=False, help='Wrap the language model with LoRA.')
+parser.add_argument('--prompt_len', type=int, default=600, help='Number of prompt tokens (image + text).')
+parser.add_argument('--new_tokens', type=int, default=40, help='Number of generated tokens.')
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--repetitions', type=int, default=5)
+parser.add_argument('--dtype', type=str, default='bfloat16', choices=['float32', 'float16', 'bfloat16'])
+
+
+def benchmark(model, input_embeds, attention_mask, new_tokens, use_cache, repetitions):
+  device = input_embeds.device
+  latencies = []
+  for _ in range(repetitions + 1):
+    if device.type == 'cuda':
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    # no eos token -> always generates new_tokens tokens, so both variants do the same amount of work
+    sampled_tokens, _ = model.greedy_sample(
+        input_embeds,
+        max_new_tokens=new_tokens,
+        input_embed_matrix=model.model.embed_tokens.weight,
+        logit_matrix=model.model.get_output_embeddings().weight,
+        attention_mask=attention_mask,
+        use_cache=use_cache,
+    )
+    if device.type == 'cuda':
+      torch.cuda.synchronize()
+    latencies.append(time.perf_counter() - start)
+  # first run is warmup
+  latencies = latencies[1:]
+  return sampled_tokens, sum(latencies) / len(latencies)
+
+
+@torch.no_grad()
+def main():
+  args = parser.parse_args()
+  device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+  dtype = getattr(torch, args.dtype)
+
+  model = LLM(variant=args.variant, lora=args.lora, lora_alpha=64, lora_r=32, lora_dropout=0.0)
+  model = model.to(device=device, dtype=dtype).eval()
+
+  input_embeds = torch.randn((args.batch_size, args.prompt_len, model.hidden_size), device=device, dtype=dtype) * 0.02
+  attention_mask = torch.ones((args.batch_size, args.prompt_len), device=device)
+
+  results = {}
+  for use_cache in [False, True]:
+    tokens, latency = benchmark(model, input_embeds, attention_mask, args.new_tokens, use_cache, args.repetitions)
+    results[use_cache] = tokens
+    tokens_per_second = args.batch_size * args.new_tokens / latency
+    name = 'kv cache' if use_cache else 'full recompute'
+    print(f'{name:>15}: latency {latency * 1000:.1f} ms, {tokens_per_second:.1f} tokens/s, '
+          f'{latency * 1000 / args.new_tokens:.2f} ms/token')
+
+  same = (results[True] == results[False]).float().mean().item()
+  print(f'Fraction of identical tokens: {same:.3f}')
+
+
+if __name__ == '__main__':
+  main()
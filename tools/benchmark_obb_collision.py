@@ -0,0 +1,147 @@
+'''
+Checks the batched separating axis test (team_code/obb_collision.py) against the carla.Vector3D implementation of
+AutoPilot.check_obb_intersection and benchmarks both on the workload of compute_target_speeds_wrt_all_actors
+(ego box of frame i against the predicted boxes of frame i of every actor).
+Runs without a simulator, the carla types are the mocks of scenario_runner/srunner/tests/carla_mocks.
+Example:
+python tools/benchmark_obb_collision.py --pairs 20000 --actors 10 50 200
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scenario_runner', 'srunner', 'tests',
+                                'carla_mocks'))
+import carla  # pylint: disable=wrong-import-position
+
+from team_code import obb_collision  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pairs', type=int, default=20000, help='Number of random box pairs for the equivalence check.')
+parser.add_argument('--actors', type=int, nargs='+', default=[10, 50, 200], help='Numbers of actors to benchmark.')
+parser.add_argument('--frames', type=int, default=40, help='Forecasted frames (20 Hz * 2 s in the AutoPilot).')
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## current implementation of AutoPilot ##############
+def dot_product(vector1, vector2):
+  return vector1.x * vector2.x + vector1.y * vector2.y + vector1.z * vector2.z
+
+
+def cross_product(vector1, vector2):
+  return carla.Vector3D(x=vector1.y * vector2.z - vector1.z * vector2.y,
+                        y=vector1.z * vector2.x - vector1.x * vector2.z,
+                        z=vector1.x * vector2.y - vector1.y * vector2.x)
+
+
+def get_separating_plane(relative_position, plane_normal, obb1, obb2):
+  projection_distance = abs(dot_product(relative_position, plane_normal))
+  obb1_projection = (abs(dot_product(obb1.rotation.get_forward_vector() * obb1.extent.x, plane_normal)) +
+                     abs(dot_product(obb1.rotation.get_right_vector() * obb1.extent.y, plane_normal)) +
+                     abs(dot_product(obb1.rotation.get_up_vector() * obb1.extent.z, plane_normal)))
+  obb2_projection = (abs(dot_product(obb2.rotation.get_forward_vector() * obb2.extent.x, plane_normal)) +
+                     abs(dot_product(obb2.rotation.get_right_vector() * obb2.extent.y, plane_normal)) +
+                     abs(dot_product(obb2.rotation.get_up_vector() * obb2.extent.z, plane_normal)))
+  return projection_distance > obb1_projection + obb2_projection
+
+
+def check_obb_intersection(obb1, obb2):
+  relative_position = obb2.location - obb1.location
+  axes1 = (obb1.rotation.get_forward_vector(), obb1.rotation.get_right_vector(), obb1.rotation.get_up_vector())
+  axes2 = (obb2.rotation.get_forward_vector(), obb2.rotation.get_right_vector(), obb2.rotation.get_up_vector())
+  for axis in axes1 + axes2:
+    if get_separating_plane(relative_position, axis, obb1, obb2):
+      return False
+  for axis1 in axes1:
+    for axis2 in axes2:
+      if get_separating_plane(relative_position, cross_product(axis1, axis2), obb1, obb2):
+        return False
+  return True
+
+
+def random_boxes(rng, shape, spread):
+  '''Vehicle sized boxes, mostly flat like in the simulator, some with pitch and roll.'''
+  centers = rng.uniform(-spread, spread, size=shape + (3,))
+  centers[..., 2] *= 0.1
+  extents = rng.uniform(0.2, 3.0, size=shape + (3,))
+  rotations = np.zeros(shape + (3,))
+  rotations[..., 1] = rng.uniform(-180, 180, size=shape)
+  tilted = rng.random(shape) < 0.3
+  rotations[tilted, 0] = rng.uniform(-20, 20, size=tilted.sum())
+  rotations[tilted, 2] = rng.uniform(-20, 20, size=tilted.sum())
+  # same yaw as another box: parallel axes, the cross products are zero
+  aligned = rng.random(shape) < 0.1
+  rotations[aligned] = 0.0
+  return centers, extents, rotations
+
+
+def to_carla(centers, extents, rotations):
+  boxes = np.empty(centers.shape[:-1], dtype=object)
+  for index in np.ndindex(boxes.shape):
+    box = carla.BoundingBox(carla.Location(*centers[index]), carla.Vector3D(*extents[index]))
+    box.rotation = carla.Rotation(pitch=rotations[index][0], yaw=rotations[index][1], roll=rotations[index][2])
+    boxes[index] = box
+  return boxes
+
+
+def check_equivalence(rng, num_pairs):
+  boxes1 = to_carla(*random_boxes(rng, (num_pairs,), spread=4.0))
+  boxes2 = to_carla(*random_boxes(rng, (num_pairs,), spread=4.0))
+  reference = np.array([check_obb_intersection(box1, box2) for box1, box2 in zip(boxes1, boxes2)])
+
+  arrays1 = obb_collision.bounding_boxes_to_arrays(list(boxes1))
+  arrays2 = obb_collision.bounding_boxes_to_arrays(list(boxes2))
+  for broad_phase in (True, False):
+    batched = obb_collision.check_obb_intersections(*arrays1, *arrays2, broad_phase=broad_phase)
+    mismatches = np.flatnonzero(batched != reference)
+    assert len(mismatches) == 0, f'broad_phase={broad_phase}: {len(mismatches)} mismatches, e.g. pair {mismatches[:5]}'
+
+  # the matrix form has to agree with the pairwise results
+  matrix = obb_collision.check_obb_intersection_matrix(*(array[:300] for array in arrays1),
+                                                       *(array[:200] for array in arrays2))
+  for i, j in zip(*np.nonzero(matrix)):
+    assert check_obb_intersection(boxes1[i], boxes2[j])
+  for i, j in zip(*np.nonzero(~matrix[:50, :50])):
+    assert not check_obb_intersection(boxes1[i], boxes2[j])
+  print(f'{num_pairs} pairs identical ({reference.mean() * 100:.1f}% intersecting), matrix {matrix.shape} consistent')
+
+
+def benchmark(rng, num_actors, num_frames):
+  # ego drives along x, the actors are spread over the detection radius
+  ego_centers, ego_extents, ego_rotations = random_boxes(rng, (num_frames,), spread=1.0)
+  ego_centers[:, 0] = np.arange(num_frames) * 0.5
+  ego_rotations[:] = 0.0
+  ego_boxes = to_carla(ego_centers, ego_extents, ego_rotations)
+  actor_boxes = to_carla(*random_boxes(rng, (num_actors, num_frames), spread=50.0))
+
+  start = time.perf_counter()
+  reference = np.array([[check_obb_intersection(ego_boxes[i], actor_boxes[a, i])
+                         for i in range(num_frames)]
+                        for a in range(num_actors)])
+  time_reference = time.perf_counter() - start
+
+  start = time.perf_counter()
+  ego_arrays = [array[None] for array in obb_collision.bounding_boxes_to_arrays(list(ego_boxes))]
+  actor_arrays = obb_collision.bounding_boxes_to_arrays(actor_boxes.tolist())
+  batched = obb_collision.check_obb_intersections(*ego_arrays, *actor_arrays)
+  time_batched = time.perf_counter() - start
+
+  assert np.array_equal(reference, batched)
+  print(f'{num_actors:>4} actors x {num_frames} frames: carla.Vector3D {time_reference * 1000:8.2f} ms, '
+        f'batched {time_batched * 1000:6.2f} ms (x{time_reference / time_batched:.0f})')
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  check_equivalence(rng, args.pairs)
+  for num_actors in args.actors:
+    benchmark(rng, num_actors, args.frames)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,205 @@
+'''
+Tick cost of the route criteria of scenario_runner (atomic_criteria.py) with the per tick waypoint memo of
+CarlaDataProvider.get_waypoint and the precomputed RouteWindow, compared to the previous behavior where every
+criterion queried the map on its own and checked the route window with CARLA vector operations.
+An ego vehicle drives a route on a synthetic straight road (two driving lanes, parking lane, sidewalk and a
+junction) and leaves its lane a few times, the criteria results and events have to be identical in both modes.
+Runs without a simulator, the carla types are the mocks of scenario_runner/srunner/tests/carla_mocks.
+Example:
+python tools/benchmark_route_criteria.py --ticks 2000
+'''
+
+import argparse
+import math
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner'))
+import carla  # pylint: disable=wrong-import-position
+
+from srunner.scenariomanager.carla_data_provider import CarlaDataProvider  # pylint: disable=wrong-import-position
+from srunner.scenariomanager.scenarioatomics import atomic_criteria  # pylint: disable=wrong-import-position
+from srunner.scenariomanager.timer import GameTime  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--ticks', type=int, default=2000, help='Simulated ticks at 20 Hz.')
+parser.add_argument('--speed', type=float, default=10.0, help='Ego speed (m/s).')
+parser.add_argument('--repetitions', type=int, default=3)
+
+# (y_min, y_max, lane_type, lane_id, yaw) of the lanes across the road, the road runs along x
+LANES = (
+    (-4.5, -3.5, carla.LaneType.Shoulder, 2, 180.0),
+    (-3.5, 0.0, carla.LaneType.Driving, 1, 180.0),
+    (0.0, 3.5, carla.LaneType.Driving, -1, 0.0),
+    (3.5, 6.0, carla.LaneType.Parking, -2, 0.0),
+    (6.0, 9.0, carla.LaneType.Sidewalk, -3, 0.0),
+)
+ROAD_LENGTH = 100.0  # m per road id
+JUNCTION = (400.0, 430.0)  # x range of the junction
+
+
+class LaneWaypoint(object):
+
+  def __init__(self, x, lane):
+    y_min, y_max, self.lane_type, self.lane_id, yaw = lane
+    self.transform = carla.Transform(carla.Location(x, (y_min + y_max) / 2, 0.0), carla.Rotation(yaw=yaw))
+    self.lane_width = y_max - y_min
+    self.road_id = int(x // ROAD_LENGTH)
+    self.is_junction = JUNCTION[0] <= x <= JUNCTION[1] and self.lane_type == carla.LaneType.Driving
+    self.is_intersection = self.is_junction
+    self._lane = lane
+
+  def next(self, distance):
+    direction = 1.0 if self._lane[4] == 0.0 else -1.0
+    return [LaneWaypoint(self.transform.location.x + direction * distance, self._lane)]
+
+
+class LaneMap(object):
+  '''Straight road along x, counts the map queries.'''
+
+  def __init__(self):
+    self.num_queries = 0
+
+  def get_waypoint(self, location, project_to_road=True, lane_type=carla.LaneType.Driving):
+    self.num_queries += 1
+    lanes = [lane for lane in LANES if lane_type == carla.LaneType.Any or lane[2] & lane_type]
+    for lane in lanes:
+      if lane[0] <= location.y < lane[1]:
+        return LaneWaypoint(location.x, lane)
+    if not project_to_road or not lanes:
+      return None
+    closest_lane = min(lanes, key=lambda lane: abs((lane[0] + lane[1]) / 2 - location.y))
+    return LaneWaypoint(location.x, closest_lane)
+
+
+class Timestamp(object):
+
+  def __init__(self, frame, delta_seconds):
+    self.frame = frame
+    self.delta_seconds = delta_seconds
+    self.elapsed_seconds = frame * delta_seconds
+
+
+############## previous per tick route window checks ##############
+class ReferenceRouteWindow(atomic_criteria.RouteWindow):
+
+  def __init__(self, route):
+    super().__init__(route)
+    self._route_transforms, _ = zip(*route)
+
+  def has_passed(self, index, location):
+    route_transform = self._route_transforms[index]
+    wp_dir = route_transform.get_forward_vector()
+    wp_veh = location - route_transform.location
+    return wp_veh.dot(wp_dir) > 0
+
+  def distance_2d(self, index, location):
+    ref_location = self._route_transforms[index].location
+    return math.sqrt(((location.x - ref_location.x)**2) + ((location.y - ref_location.y)**2))
+
+
+def get_waypoint_without_memo(location, project_to_road=True, lane_type=None):
+  if lane_type is None:
+    lane_type = carla.LaneType.Driving
+  return CarlaDataProvider.get_map().get_waypoint(location, project_to_road, lane_type)
+
+
+def ego_lateral_offset(x):
+  '''Lane center with a slow wobble, a drive over the sidewalk and into the opposite lane.'''
+  offset = 1.75 + 0.5 * math.sin(x / 25.0)
+  if 150.0 < x < 180.0:
+    offset += 5.5 * math.sin(math.pi * (x - 150.0) / 30.0)
+  if 600.0 < x < 660.0:
+    offset -= 3.8 * math.sin(math.pi * (x - 600.0) / 60.0)
+  return offset
+
+
+def run(args, reference):
+  CarlaDataProvider.cleanup()
+  GameTime.restart()
+  lane_map = LaneMap()
+  world = carla.World()
+  CarlaDataProvider._world = world  # pylint: disable=protected-access
+  CarlaDataProvider._map = lane_map  # pylint: disable=protected-access
+
+  route_length = int(args.ticks * args.speed / 20.0) + 20
+  route = [(carla.Transform(carla.Location(float(x), 1.75, 0.0), carla.Rotation(yaw=0.0)), None)
+           for x in range(route_length)]
+
+  ego = carla.Vehicle()
+  ego.id = 1
+  ego.bounding_box = carla.BoundingBox(carla.Location(), carla.Vector3D(2.4, 1.0, 0.8))
+  ego.location = carla.Location(0.0, ego_lateral_offset(0.0), 0.0)
+  ego.transform = carla.Transform(ego.location, carla.Rotation(yaw=0.0))
+  world.actors = [ego]
+  CarlaDataProvider.register_actor(ego, ego.transform)
+
+  if reference:
+    atomic_criteria.RouteWindow.get = staticmethod(ReferenceRouteWindow)
+    CarlaDataProvider.get_waypoint = staticmethod(get_waypoint_without_memo)
+  criteria = [
+      atomic_criteria.RouteCompletionTest(ego, route=route),
+      atomic_criteria.OutsideRouteLanesTest(ego, route=route),
+      atomic_criteria.RunningRedLightTest(ego),
+      atomic_criteria.RunningStopTest(ego),
+      atomic_criteria.InRouteTest(ego, route=route, offroad_max=30, terminate_on_failure=True),
+      atomic_criteria.OnSidewalkTest(ego),
+      atomic_criteria.WrongLaneTest(ego),
+  ]
+  lane_map.num_queries = 0
+
+  time_criteria = 0.0
+  for frame in range(1, args.ticks + 1):
+    x = frame * args.speed / 20.0
+    y = ego_lateral_offset(x)
+    yaw = math.degrees(math.atan2(y - ego.location.y, args.speed / 20.0))
+    ego.velocity = carla.Vector3D(args.speed * math.cos(math.radians(yaw)), args.speed * math.sin(math.radians(yaw)))
+    ego.location = carla.Location(x, y, 0.0)
+    ego.transform = carla.Transform(ego.location, carla.Rotation(yaw=yaw))
+    snapshot = carla.WorldSnapshot(world.actors)
+    world.get_snapshot = lambda snapshot=snapshot: snapshot
+
+    GameTime.on_carla_tick(Timestamp(frame, 0.05))
+    CarlaDataProvider.on_carla_tick()
+    start = time.perf_counter()
+    for criterion in criteria:
+      criterion.tick_once()
+    time_criteria += time.perf_counter() - start
+
+  for criterion in criteria:
+    criterion.terminate(criterion.status)
+  results = [(criterion.name, criterion.test_status, criterion.actual_value,
+              [(event.get_type(), event.get_message()) for event in criterion.events]) for criterion in criteria]
+  return results, time_criteria / args.ticks, lane_map.num_queries / args.ticks
+
+
+def main():
+  args = parser.parse_args()
+  route_window_get = atomic_criteria.RouteWindow.get
+  get_waypoint = CarlaDataProvider.get_waypoint
+
+  timings = {}
+  for reference in (True, False):
+    for _ in range(args.repetitions):
+      results, time_per_tick, queries_per_tick = run(args, reference)
+      atomic_criteria.RouteWindow.get = route_window_get
+      CarlaDataProvider.get_waypoint = get_waypoint
+      timings[reference] = min(timings.get(reference, float('inf')), time_per_tick)
+    if reference:
+      reference_results, reference_queries = results, queries_per_tick
+    else:
+      assert results == reference_results, 'different criteria results'
+  CarlaDataProvider.cleanup()
+
+  for name, test_status, actual_value, events in results:
+    print(f'{name:>22}: {test_status:<8} {actual_value:>7} {len(events)} events')
+  print(f'map.get_waypoint per tick: {reference_queries:.2f} -> {queries_per_tick:.2f}')
+  print(f'criteria per tick: {timings[True] * 1e6:.1f} -> {timings[False] * 1e6:.1f} us '
+        f'(x{timings[True] / timings[False]:.2f}), identical results and events')
+
+
+if __name__ == '__main__':
+  main()
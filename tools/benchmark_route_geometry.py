@@ -0,0 +1,170 @@
+'''
+Checks the batched waypoint/route geometry (simlingo_training/utils/route_geometry.py) against the previous
+per-point implementation of BaseDataset and benchmarks both.
+The inputs are random trajectories with the shapes of a training sample (pred_len + 1 ego matrices,
+route with ~100 points, 20 route points).
+Example:
+python tools/benchmark_route_geometry.py --samples 1000
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+from simlingo_training.utils import route_geometry
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', type=int, default=1000, help='Number of random samples.')
+parser.add_argument('--pred_len', type=int, default=11)
+parser.add_argument('--num_route_points', type=int, default=20)
+parser.add_argument('--atol', type=float, default=1e-9, help='Allowed absolute difference to the old implementation.')
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous implementation of BaseDataset ##############
+def get_waypoints_reference(ego_matrices, y_augmentation=0.0, yaw_augmentation=0.0):
+  origin_matrix = np.array(ego_matrices[0])[:3]
+  origin_translation = origin_matrix[:, 3:4]
+  origin_rotation = origin_matrix[:, :3]
+
+  waypoints = []
+  for index in range(len(ego_matrices)):
+    waypoint = np.array(ego_matrices[index])[:3, 3:4]
+    waypoint_ego_frame = origin_rotation.T @ (waypoint - origin_translation)
+    waypoints.append(waypoint_ego_frame[:2, 0])
+
+  waypoints_aug = []
+  aug_yaw_rad = np.deg2rad(yaw_augmentation)
+  rotation_matrix = np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad), np.cos(aug_yaw_rad)]])
+  translation = np.array([[0.0], [y_augmentation]])
+  for waypoint in waypoints:
+    pos = np.expand_dims(waypoint, axis=1)
+    waypoint_aug = rotation_matrix.T @ (pos - translation)
+    waypoints_aug.append(np.squeeze(waypoint_aug))
+  return waypoints_aug
+
+
+def load_waypoints_reference(ego_matrices, aug_translation, aug_rotation):
+  data = {}
+  waypoints = get_waypoints_reference(ego_matrices, aug_translation, aug_rotation)
+  data['waypoints'] = np.array(waypoints[1:-1])
+  waypoints_org = get_waypoints_reference(ego_matrices, 0, 0)
+  data['waypoints_org'] = np.array(waypoints_org[1:-1])
+  waypoints_1d = [np.linalg.norm(waypoints_org[i+1] - waypoints_org[i]) for i in range(len(waypoints_org)-1)]
+  waypoints_1d = np.cumsum(waypoints_1d)
+  waypoints_1d = [[x, 0] for x in waypoints_1d]
+  data['waypoints_1d'] = np.array(waypoints_1d[:-1]).reshape(-1, 2)
+  waypoints = [np.array([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, 0], [0, 0, 0, 1]]) for x, y in waypoints]
+  data['ego_waypoints'] = np.array(waypoints[:-1])
+  waypoints_org = [np.array([[1, 0, 0, x], [0, 1, 0, y], [0, 0, 1, 0], [0, 0, 0, 1]]) for x, y in waypoints_org]
+  data['ego_waypoints_org'] = np.array(waypoints_org[:-1])
+  return data
+
+
+def augment_route_reference(route, y_augmentation=0.0, yaw_augmentation=0.0):
+  aug_yaw_rad = np.deg2rad(yaw_augmentation)
+  rotation_matrix = np.array([[np.cos(aug_yaw_rad), -np.sin(aug_yaw_rad)], [np.sin(aug_yaw_rad), np.cos(aug_yaw_rad)]])
+  translation = np.array([[0.0, y_augmentation]])
+  return (rotation_matrix.T @ (route - translation).T).T
+
+
+def equal_spacing_route_reference(points):
+  route = np.concatenate((np.zeros_like(points[:1]), points))
+  shift = np.roll(route, 1, axis=0)
+  shift[0] = shift[1]
+  dists = np.linalg.norm(route-shift, axis=1)
+  dists = np.cumsum(dists)
+  dists += np.arange(0, len(dists))*1e-4
+  x = np.arange(0, 20, 1)
+  return np.array([np.interp(x, dists, route[:, 0]), np.interp(x, dists, route[:, 1])]).T
+
+
+def load_route_reference(route_original, route_adjusted, aug_translation, aug_rotation, num_route_points):
+  data = {}
+  route = augment_route_reference(route_original, aug_translation, aug_rotation)
+  route_adjusted = np.array(route_adjusted)
+  route_adjusted_org = augment_route_reference(route_adjusted, 0, 0)
+  route_adjusted = augment_route_reference(route_adjusted, aug_translation, aug_rotation)
+  if len(route) < num_route_points:
+    route = np.vstack((np.array(route), np.tile(route[-1], (num_route_points - len(route), 1))))
+  else:
+    route = np.array(route[:num_route_points])
+  data['route'] = equal_spacing_route_reference(route)
+  data['route_adjusted_org'] = equal_spacing_route_reference(route_adjusted_org)
+  data['route_adjusted'] = equal_spacing_route_reference(route_adjusted)
+  return data
+
+
+############## batched implementation, same as BaseDataset ##############
+def load_waypoints_batched(ego_matrices, aug_translation, aug_rotation):
+  return route_geometry.get_waypoint_targets(np.stack(ego_matrices), aug_translation, aug_rotation)
+
+
+def load_route_batched(route_original, route_adjusted, aug_translation, aug_rotation, num_route_points):
+  route = route_geometry.augment_points(route_original, aug_translation, aug_rotation)
+  route = route_geometry.pad_route(route, num_route_points)
+  route_adjusted = np.asarray(route_adjusted, dtype=np.float64)
+  route_adjusted = np.stack((route_geometry.augment_points(route_adjusted, 0, 0),
+                             route_geometry.augment_points(route_adjusted, aug_translation, aug_rotation)))
+  route_adjusted_org, route_adjusted = route_geometry.equal_spacing_route(route_adjusted)
+  return {'route': route_geometry.equal_spacing_route(route),
+          'route_adjusted_org': route_adjusted_org,
+          'route_adjusted': route_adjusted}
+
+
+def random_sample(rng, pred_len):
+  yaw = rng.uniform(-np.pi, np.pi)
+  position = rng.uniform(-500, 500, size=3)
+  ego_matrices = []
+  for _ in range(pred_len + 1):
+    yaw += rng.normal(0, 0.05)
+    position = position + np.array([np.cos(yaw), np.sin(yaw), 0.0]) * rng.uniform(0, 4)
+    matrix = np.eye(4)
+    matrix[:2, :2] = [[np.cos(yaw), -np.sin(yaw)], [np.sin(yaw), np.cos(yaw)]]
+    matrix[:3, 3] = position
+    ego_matrices.append(matrix.tolist())
+
+  # routes as stored in the measurement files: lists of [x, y], 1 m apart, sometimes shorter than num_route_points
+  num_route = rng.integers(2, 120)
+  heading = np.cumsum(rng.normal(0, 0.03, size=num_route))
+  route = np.cumsum(np.stack([np.cos(heading), np.sin(heading)], axis=1), axis=0)
+  route_original = route + rng.normal(0, 0.1, size=route.shape)
+  aug_translation = rng.uniform(-1.5, 1.5) if rng.random() < 0.5 else 0.0
+  aug_rotation = rng.uniform(-20, 20) if aug_translation != 0.0 else 0.0
+  return ego_matrices, route_original.tolist(), route.tolist(), aug_translation, aug_rotation
+
+
+def run(function, samples, num_route_points):
+  start = time.perf_counter()
+  outputs = []
+  for ego_matrices, route_original, route, aug_translation, aug_rotation in samples:
+    data = function[0](ego_matrices, aug_translation, aug_rotation)
+    data.update(function[1](route_original, route, aug_translation, aug_rotation, num_route_points))
+    outputs.append(data)
+  return outputs, time.perf_counter() - start
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  samples = [random_sample(rng, args.pred_len) for _ in range(args.samples)]
+
+  reference, time_reference = run((load_waypoints_reference, load_route_reference), samples, args.num_route_points)
+  batched, time_batched = run((load_waypoints_batched, load_route_batched), samples, args.num_route_points)
+
+  max_diff = {}
+  for data_reference, data_batched in zip(reference, batched):
+    for key, value in data_reference.items():
+      assert value.shape == data_batched[key].shape, f'{key}: shape {value.shape} != {data_batched[key].shape}'
+      max_diff[key] = max(max_diff.get(key, 0.0), float(np.max(np.abs(value - data_batched[key]), initial=0.0)))
+  for key, diff in max_diff.items():
+    print(f'{key:>20}: max abs difference {diff:.2e}')
+  assert all(diff <= args.atol for diff in max_diff.values()), f'Difference larger than {args.atol}'
+
+  print(f'{"per-point":>20}: {time_reference * 1e6 / args.samples:.1f} us/sample')
+  print(f'{"batched":>20}: {time_batched * 1e6 / args.samples:.1f} us/sample')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,170 @@
+'''
+Tick time of DataAgent.save_sensors / AutoPilot.save with the background SensorWriter of team_code/sensor_writer.py,
+compared to the previous synchronous writes (cv2.imwrite, laspy and gzip json.dump in the tick).
+Writes synthetic frames of the size of the data collection (2 cameras, optional TF labels, 360 deg LiDAR, boxes and
+measurements) to a temporary directory, simulates the rest of the tick with --tick_ms of sleeping and checks that both
+produce the same decoded files and that no temporary files are left.
+Example:
+python tools/benchmark_sensor_writer.py --frames 50 --threads 2 --tf_labels
+'''
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import laspy
+import numpy as np
+import ujson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'team_code'))
+from sensor_writer import SensorWriter  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--frames', type=int, default=50)
+parser.add_argument('--threads', type=int, default=2, help='num_writer_threads of the writer.')
+parser.add_argument('--queue_size', type=int, default=32, help='writer_queue_size of the writer.')
+parser.add_argument('--tick_ms', type=float, default=50.0, help='Simulated remaining work per saved tick (ms).')
+parser.add_argument('--tf_labels', action='store_true', help='Also write semantics, depth and BEV (SAVE_TF_LABELS).')
+parser.add_argument('--lidar_points', type=int, default=60000)
+parser.add_argument('--boxes', type=int, default=60)
+parser.add_argument('--seed', type=int, default=0)
+
+POINT_FORMAT = 0
+POINT_PRECISION = 0.01
+IMAGES = {'rgb': '.jpg', 'rgb_augmented': '.jpg'}
+TF_LABELS = {
+    'semantics': '.png',
+    'semantics_augmented': '.png',
+    'depth': '.png',
+    'depth_augmented': '.png',
+    'bev_semantics': '.png',
+    'bev_semantics_augmented': '.png'
+}
+
+
+def synthetic_frame(rng, args):
+  rgb = cv2.GaussianBlur(rng.integers(0, 256, size=(384, 1024, 3), dtype=np.uint8), (7, 7), 0)
+  frame = {'rgb': rgb, 'rgb_augmented': np.roll(rgb, 10, axis=1)}
+  if args.tf_labels:
+    semantics = np.repeat(np.repeat(rng.integers(0, 28, size=(48, 128), dtype=np.uint8), 8, 0), 8, 1)
+    depth = cv2.GaussianBlur(rng.integers(0, 256, size=(384, 1024), dtype=np.uint8), (15, 15), 0)
+    bev = np.repeat(np.repeat(rng.integers(0, 11, size=(32, 32), dtype=np.uint8), 8, 0), 8, 1)
+    frame.update({
+        'semantics': semantics,
+        'semantics_augmented': semantics,
+        'depth': depth,
+        'depth_augmented': depth,
+        'bev_semantics': bev,
+        'bev_semantics_augmented': bev
+    })
+  frame['lidar'] = rng.uniform((-50, -50, -2.5), (50, 50, 5), size=(args.lidar_points, 3))
+  frame['bounding_boxes'] = [{
+      'class': 'car',
+      'extent': rng.uniform(0.5, 3, size=3).tolist(),
+      'position': rng.uniform(-50, 50, size=3).tolist(),
+      'yaw': float(rng.uniform(-np.pi, np.pi)),
+      'num_points': int(rng.integers(0, 500)),
+      'distance': float(rng.uniform(0, 50)),
+      'speed': float(rng.uniform(0, 15)),
+      'id': int(i),
+  } for i in range(args.boxes)]
+  frame['measurements'] = {f'value_{i}': float(rng.uniform(-1, 1)) for i in range(60)}
+  frame['measurements']['route'] = rng.uniform(-50, 50, size=(80, 2)).tolist()
+  return frame
+
+
+############## previous synchronous writes of DataAgent.save_sensors and AutoPilot.save ##############
+def save_synchronous(save_path, frame_id, frame, args):
+  for name, extension in {**IMAGES, **(TF_LABELS if args.tf_labels else {})}.items():
+    cv2.imwrite(str(save_path / name / (f'{frame_id:04}{extension}')), frame[name])
+
+  header = laspy.LasHeader(point_format=POINT_FORMAT)
+  header.offsets = np.min(frame['lidar'], axis=0)
+  header.scales = np.array([POINT_PRECISION, POINT_PRECISION, POINT_PRECISION])
+  with laspy.open(save_path / 'lidar' / (f'{frame_id:04}.laz'), mode='w', header=header) as writer:
+    point_record = laspy.ScaleAwarePointRecord.zeros(frame['lidar'].shape[0], header=header)
+    point_record.x = frame['lidar'][:, 0]
+    point_record.y = frame['lidar'][:, 1]
+    point_record.z = frame['lidar'][:, 2]
+    writer.write_points(point_record)
+
+  with gzip.open(save_path / 'boxes' / (f'{frame_id:04}.json.gz'), 'wt', encoding='utf-8') as f:
+    json.dump(frame['bounding_boxes'], f, indent=4)
+  with gzip.open(save_path / 'measurements' / f'{frame_id:04}.json.gz', 'wt', encoding='utf-8') as f:
+    ujson.dump(frame['measurements'], f, indent=4)
+
+
+def save_with_writer(writer, save_path, frame_id, frame, args):
+  for name, extension in {**IMAGES, **(TF_LABELS if args.tf_labels else {})}.items():
+    writer.write_image(save_path / name / (f'{frame_id:04}{extension}'), frame[name])
+  writer.write_laz(save_path / 'lidar' / (f'{frame_id:04}.laz'), frame['lidar'], POINT_FORMAT, POINT_PRECISION)
+  writer.write_json_gz(save_path / 'boxes' / (f'{frame_id:04}.json.gz'), frame['bounding_boxes'])
+  writer.write_json_gz(save_path / 'measurements' / f'{frame_id:04}.json.gz', frame['measurements'], use_ujson=True)
+
+
+def make_dirs(save_path, args):
+  for name in ['lidar', 'boxes', 'measurements'] + list(IMAGES) + (list(TF_LABELS) if args.tf_labels else []):
+    (save_path / name).mkdir(parents=True)
+
+
+def read_file(path):
+  if path.suffix in ('.jpg', '.png'):
+    return cv2.imread(str(path), cv2.IMREAD_UNCHANGED).tobytes()
+  if path.suffix == '.laz':
+    return np.stack([laspy.read(path).x, laspy.read(path).y, laspy.read(path).z], axis=1).tobytes()
+  with gzip.open(path, 'rt', encoding='utf-8') as f:
+    return f.read()
+
+
+def run(frames, save_path, args, writer=None):
+  '''Returns the time spent in the save calls and the time until the last file is written.'''
+  make_dirs(save_path, args)
+  time_save = 0.0
+  start_run = time.perf_counter()
+  for frame_id, frame in enumerate(frames):
+    start = time.perf_counter()
+    if writer is None:
+      save_synchronous(save_path, frame_id, frame, args)
+    else:
+      save_with_writer(writer, save_path, frame_id, frame, args)
+    time_save += time.perf_counter() - start
+    time.sleep(args.tick_ms / 1000.0)
+  if writer is not None:
+    writer.close()
+  return time_save, time.perf_counter() - start_run
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  # A few distinct frames are enough, they are written under different names
+  frames = [synthetic_frame(rng, args) for _ in range(min(args.frames, 5))]
+  frames = [frames[i % len(frames)] for i in range(args.frames)]
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    reference_path, writer_path = Path(tmp_dir) / 'synchronous', Path(tmp_dir) / 'writer'
+    time_save_reference, time_run_reference = run(frames, reference_path, args)
+    time_save, time_run = run(frames, writer_path, args, SensorWriter(args.threads, args.queue_size))
+
+    reference_files = sorted(path.relative_to(reference_path) for path in reference_path.rglob('*') if path.is_file())
+    files = sorted(path.relative_to(writer_path) for path in writer_path.rglob('*') if path.is_file())
+    assert files == reference_files, 'different or leftover temporary files'
+    for file in files:
+      assert read_file(reference_path / file) == read_file(writer_path / file), f'{file} differs'
+    size = sum((writer_path / file).stat().st_size for file in files)
+
+  print(f'{args.frames} frames, {len(files)} files ({size / 1e6:.1f} MB): identical decoded files')
+  print(f'save calls in the tick: {time_save_reference * 1000 / args.frames:.1f} -> '
+        f'{time_save * 1000 / args.frames:.1f} ms/frame (x{time_save_reference / time_save:.0f}) with {args.threads} '
+        f'writer threads')
+  print(f'total with {args.tick_ms:.0f} ms of other work per tick: {time_run_reference:.2f} -> {time_run:.2f} s')
+
+
+if __name__ == '__main__':
+  main()
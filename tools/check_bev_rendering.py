@@ -0,0 +1,439 @@
+'''
+Regression check of the BEV semantic rendering of team_code/birds_eye_view/chauffeurnet.py against the previous
+implementation (full town raster warped per layer, one carla.Transform based polygon per actor and history frame).
+An ego vehicle drives through a synthetic town raster (or a town of the repo with --town) with vehicles, parked car
+meshes, walkers, traffic light stop lines and a stop sign around it. The semantic classes and all history masks have
+to match, the allowed fraction of different pixels is --tolerance. Also reports the time per frame of both.
+Runs without a simulator, the carla types are the mocks of scenario_runner/srunner/tests/carla_mocks.
+Example:
+python tools/check_bev_rendering.py --frames 200 --history_idx -16 -11 -6 -1
+python tools/check_bev_rendering.py --town Town03 --map_folder maps_2ppm_cv --pixels_per_meter 2.0
+'''
+
+import argparse
+import fnmatch
+import os
+import sys
+import tempfile
+import time
+
+import cv2 as cv
+import h5py
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+sys.path.insert(0, os.path.join(ROOT, 'team_code'))
+import carla  # pylint: disable=wrong-import-position
+
+from birds_eye_view import chauffeurnet  # pylint: disable=wrong-import-position
+from birds_eye_view.traffic_light import TrafficLightHandler  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--frames', type=int, default=200)
+parser.add_argument('--history_idx', type=int, nargs='+', default=[-16, -11, -6, -1])
+parser.add_argument('--width', type=int, default=256, help='width_in_pixels of the BEV.')
+parser.add_argument('--pixels_per_meter', type=float, default=4.0)
+parser.add_argument('--town', default=None, help='Town of the repo instead of the synthetic map, e.g. Town03.')
+parser.add_argument('--map_folder', default='maps', help='Map folder of team_code/birds_eye_view for --town.')
+parser.add_argument('--synthetic_size', type=float, default=1000.0, help='Size of the synthetic town (m).')
+parser.add_argument('--vehicles', type=int, default=80)
+parser.add_argument('--walkers', type=int, default=40)
+parser.add_argument('--tolerance', type=float, default=1e-4, help='Allowed fraction of different pixels.')
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous implementation of the ObsManager ##############
+class ReferenceObsManager(chauffeurnet.ObsManager):
+
+  def attach_ego_vehicle(self, vehicle, criteria_stop):
+    self.vehicle = vehicle
+    self._world = self.vehicle.get_world()
+    self.criteria_stop = criteria_stop
+    maps_h5_path = self._map_dir / (self._world.get_map().name.split('/')[-1] + '.h5')
+    with h5py.File(maps_h5_path, 'r', libver='latest', swmr=True) as hf:
+      self._road = np.array(hf['road'], dtype=np.uint8)
+      self._lane_marking_all = np.array(hf['lane_marking_all'], dtype=np.uint8)
+      self._lane_marking_white_broken = np.array(hf['lane_marking_white_broken'], dtype=np.uint8)
+      self._sidewalk = np.array(hf['sidewalk'], dtype=np.uint8)
+      self._world_offset = np.array(hf.attrs['world_offset_in_meters'], dtype=np.float32)
+    self._distance_threshold = np.ceil(self._width / self._pixels_per_meter)
+
+  def get_observation(self, close_traffic_lights=None):
+    ev_transform = self.vehicle.get_transform()
+    ev_loc = ev_transform.location
+    ev_rot = ev_transform.rotation
+
+    def is_within_distance(w):
+      c_distance = abs(ev_loc.x - w.location.x) < self._distance_threshold \
+          and abs(ev_loc.y - w.location.y) < self._distance_threshold \
+          and abs(ev_loc.z - w.location.z) < 8.0
+      c_ev = abs(ev_loc.x - w.location.x) < self.config.ego_extent_y and abs(ev_loc.y -
+                                                                             w.location.y) < self.config.ego_extent_y
+      return c_distance and (not c_ev)
+
+    actors = self._world.get_actors()
+    vehicles = list(actors.filter('*vehicle*'))
+    walkers = actors.filter('*walker*')
+    static_all = actors.filter('*static*')
+    for static in static_all:
+      if static.type_id == 'static.prop.mesh':
+        if 'mesh_path' in static.attributes:
+          if 'Car' in static.attributes['mesh_path']:
+            vehicles.append(static)
+
+    vehicle_bbox_list = []
+    for vehicle in vehicles:
+      if vehicle.id == self.vehicle.id:
+        continue
+      traffic_transform = vehicle.get_transform()
+      bounding_box = carla.BoundingBox(traffic_transform.location + vehicle.bounding_box.location,
+                                       vehicle.bounding_box.extent)
+      bounding_box.rotation = carla.Rotation(pitch=vehicle.bounding_box.rotation.pitch +
+                                             traffic_transform.rotation.pitch,
+                                             yaw=vehicle.bounding_box.rotation.yaw + traffic_transform.rotation.yaw,
+                                             roll=vehicle.bounding_box.rotation.roll + traffic_transform.rotation.roll)
+      vehicle_bbox_list.append(bounding_box)
+
+    walker_bbox_list = []
+    for walker in walkers:
+      walker_transform = walker.get_transform()
+      walker_location = walker_transform.location
+      transform = carla.Transform(walker_location)
+      bounding_box = carla.BoundingBox(transform.location, walker.bounding_box.extent)
+      bounding_box.rotation = carla.Rotation(pitch=walker.bounding_box.rotation.pitch + walker_transform.rotation.pitch,
+                                             yaw=walker.bounding_box.rotation.yaw + walker_transform.rotation.yaw,
+                                             roll=walker.bounding_box.rotation.roll + walker_transform.rotation.roll)
+      walker_bbox_list.append(bounding_box)
+
+    if self._scale_bbox:
+      vehicles = self._get_surrounding_actors_reference(vehicle_bbox_list, is_within_distance, 1.0)
+      walkers = self._get_surrounding_actors_reference(walker_bbox_list, is_within_distance, 2.0)
+    else:
+      vehicles = self._get_surrounding_actors_reference(vehicle_bbox_list, is_within_distance)
+      walkers = self._get_surrounding_actors_reference(walker_bbox_list, is_within_distance)
+
+    tl_green = TrafficLightHandler.get_stopline_vtx(ev_loc, 0, self._distance_threshold, close_traffic_lights)
+    tl_yellow = TrafficLightHandler.get_stopline_vtx(ev_loc, 1, self._distance_threshold, close_traffic_lights)
+    tl_red = TrafficLightHandler.get_stopline_vtx(ev_loc, 2, self._distance_threshold, close_traffic_lights)
+    stops = self._get_stops_reference(self.criteria_stop)
+
+    self._history_queue.append((vehicles, walkers, tl_green, tl_yellow, tl_red, stops))
+
+    m_warp = self._get_warp_transform(ev_loc, ev_rot)
+    vehicle_masks, walker_masks, tl_green_masks, tl_yellow_masks, tl_red_masks, stop_masks \
+        = self._get_history_masks(m_warp)
+
+    road_mask = cv.warpAffine(self._road, m_warp, (self._width, self._width)).astype(bool)
+    sidewalk_mask = cv.warpAffine(self._sidewalk, m_warp, (self._width, self._width)).astype(bool)
+    lane_mask_all = cv.warpAffine(self._lane_marking_all, m_warp, (self._width, self._width)).astype(bool)
+    lane_mask_broken = cv.warpAffine(self._lane_marking_white_broken, m_warp, (self._width, self._width)).astype(bool)
+
+    c_all = road_mask * 1
+    c_all[sidewalk_mask] = 2
+    c_all[lane_mask_all] = 3
+    c_all[lane_mask_broken] = 4
+    c_all[stop_masks[-1]] = 5
+    c_all[tl_green_masks[-1]] = 6
+    c_all[tl_yellow_masks[-1]] = 7
+    c_all[tl_red_masks[-1]] = 8
+    c_all[vehicle_masks[-1]] = 9
+    c_all[walker_masks[-1]] = 10
+    c_all = np.rot90(c_all, k=-1)
+    return {'bev_semantic_classes': c_all}
+
+  @staticmethod
+  def _get_stops_reference(criteria_stop):
+    stop_sign = criteria_stop.target_stop_sign
+    stops = []
+    if (stop_sign is not None) and (not criteria_stop.stop_completed):
+      bb_loc = carla.Location(stop_sign.trigger_volume.location)
+      bb_ext = carla.Vector3D(stop_sign.trigger_volume.extent)
+      bb_ext.x = max(bb_ext.x, bb_ext.y)
+      bb_ext.y = max(bb_ext.x, bb_ext.y)
+      trans = stop_sign.get_transform()
+      stops = [(carla.Transform(trans.location, trans.rotation), bb_loc, bb_ext)]
+    return stops
+
+  def _get_history_masks(self, m_warp):
+    qsize = len(self._history_queue)
+    vehicle_masks, walker_masks, tl_green_masks, tl_yellow_masks, tl_red_masks, stop_masks = [], [], [], [], [], []
+    for idx in self._history_idx:
+      idx = max(idx, -1 * qsize)
+      vehicles, walkers, tl_green, tl_yellow, tl_red, stops = self._history_queue[idx]
+      vehicle_masks.append(self._get_mask_from_actor_list(vehicles, m_warp))
+      walker_masks.append(self._get_mask_from_actor_list(walkers, m_warp))
+      tl_green_masks.append(self._get_mask_from_stopline_vtx(tl_green, m_warp))
+      tl_yellow_masks.append(self._get_mask_from_stopline_vtx(tl_yellow, m_warp))
+      tl_red_masks.append(self._get_mask_from_stopline_vtx(tl_red, m_warp))
+      stop_masks.append(self._get_mask_from_actor_list(stops, m_warp))
+    return vehicle_masks, walker_masks, tl_green_masks, tl_yellow_masks, tl_red_masks, stop_masks
+
+  def _get_mask_from_stopline_vtx(self, stopline_vtx, m_warp):
+    mask = np.zeros([self._width, self._width], dtype=np.uint8)
+    for sp_locs in stopline_vtx:
+      stopline_in_pixel = np.array([[self._world_to_pixel(x)] for x in sp_locs])
+      stopline_warped = cv.transform(stopline_in_pixel, m_warp)
+      pt1 = (stopline_warped[0, 0] + 0.5).astype(int)
+      pt2 = (stopline_warped[1, 0] + 0.5).astype(int)
+      cv.line(mask, tuple(pt1), tuple(pt2), color=1, thickness=6)
+    return mask.astype(bool)
+
+  def _get_mask_from_actor_list(self, actor_list, m_warp):
+    mask = np.zeros([self._width, self._width], dtype=np.uint8)
+    for actor_transform, bb_loc, bb_ext in actor_list:
+      corners = [
+          carla.Location(x=-bb_ext.x, y=-bb_ext.y),
+          carla.Location(x=bb_ext.x, y=-bb_ext.y),
+          carla.Location(x=bb_ext.x, y=0),
+          carla.Location(x=bb_ext.x, y=bb_ext.y),
+          carla.Location(x=-bb_ext.x, y=bb_ext.y)
+      ]
+      corners = [bb_loc + corner for corner in corners]
+      corners = [actor_transform.transform(corner) for corner in corners]
+      corners_in_pixel = np.array([[self._world_to_pixel(corner)] for corner in corners])
+      corners_warped = cv.transform(corners_in_pixel, m_warp)
+      cv.fillConvexPoly(mask, np.round(corners_warped).astype(np.int32), 1)
+    return mask.astype(bool)
+
+  @staticmethod
+  def _get_surrounding_actors_reference(bbox_list, criterium, scale=None):
+    actors = []
+    for bbox in bbox_list:
+      if criterium(bbox):
+        bb_loc = carla.Location()
+        bb_ext = carla.Vector3D(bbox.extent)
+        if scale is not None:
+          bb_ext = bb_ext * scale
+          bb_ext.x = max(bb_ext.x, 0.8)
+          bb_ext.y = max(bb_ext.y, 0.8)
+        actors.append((carla.Transform(bbox.location, bbox.rotation), bb_loc, bb_ext))
+    return actors
+
+
+############## synthetic town and actors ##############
+def write_synthetic_map(path, size, pixels_per_meter, rng):
+  '''Grid of roads with sidewalks, lane markings and a few curved roads.'''
+  width = int(size * pixels_per_meter)
+  layers = {name: np.zeros((width, width), dtype=np.uint8) for name in chauffeurnet.MAP_LAYERS}
+
+  def draw(name, points, thickness_m, dashed=False):
+    points = np.round(np.asarray(points) * pixels_per_meter).astype(np.int32)
+    if dashed:
+      for start, end in zip(points[::2], points[1::2]):
+        cv.line(layers[name], tuple(start), tuple(end), 1, max(1, int(thickness_m * pixels_per_meter)))
+    else:
+      cv.polylines(layers[name], [points], False, 1, max(1, int(thickness_m * pixels_per_meter)))
+
+  for position in np.arange(50.0, size, 150.0):
+    for horizontal in (True, False):
+      line = np.stack((np.linspace(0, size, 200), np.full(200, position)), axis=1)
+      if not horizontal:
+        line = line[:, ::-1]
+      draw('sidewalk', line, 20.0)
+      draw('road', line, 14.0)
+      draw('lane_marking_all', line, 0.3)
+      draw('lane_marking_white_broken', line + (0.0, 3.5) if horizontal else line + (3.5, 0.0), 0.2, dashed=True)
+  for _ in range(5):
+    center = rng.uniform(0.2 * size, 0.8 * size, size=2)
+    angles = np.linspace(0, 2 * np.pi, 300)
+    circle = center + rng.uniform(40, 120) * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    draw('road', circle, 8.0)
+    draw('lane_marking_all', circle, 0.3)
+
+  with h5py.File(path, 'w') as hf:
+    for name, layer in layers.items():
+      hf.create_dataset(name, data=layer, compression='gzip')
+    hf.attrs['pixels_per_meter'] = pixels_per_meter
+    hf.attrs['width_in_pixels'] = width
+    hf.attrs['width_in_meters'] = size
+    hf.attrs['world_offset_in_meters'] = np.array([-0.5 * size, -0.5 * size], dtype=np.float32)
+
+
+class MockActorList(list):
+
+  def filter(self, pattern):
+    return MockActorList(actor for actor in self if fnmatch.fnmatch(actor.type_id, pattern))
+
+
+class MockMap(object):
+
+  def __init__(self, name):
+    self.name = name
+
+
+class MockWorld(object):
+
+  def __init__(self, map_name):
+    self.actors = MockActorList()
+    self.map = MockMap(map_name)
+
+  def get_map(self):
+    return self.map
+
+  def get_actors(self):
+    return self.actors
+
+
+class MockActor(carla.Actor):
+
+  def __init__(self, world, actor_id, type_id, location, yaw, extent, bb_location=None, pitch=0.0, roll=0.0):
+    super().__init__()
+    self.world = world
+    self.id = actor_id
+    self.type_id = type_id
+    self.bounding_box = carla.BoundingBox(bb_location or carla.Location(), extent)
+    self.set_transform(location, yaw, pitch, roll)
+
+  def set_transform(self, location, yaw, pitch=0.0, roll=0.0):
+    self.location = location
+    self.rotation = carla.Rotation(pitch=pitch, yaw=yaw, roll=roll)
+    self.transform = carla.Transform(self.location, self.rotation)
+
+  def get_world(self):
+    return self.world
+
+
+class MockTrafficLight(object):
+
+  def __init__(self, actor_id, state):
+    self.id = actor_id
+    self.state = state
+
+
+class MockStopCriteria(object):
+
+  def __init__(self, stop_sign):
+    self.target_stop_sign = stop_sign
+    self.stop_completed = False
+
+
+class Config(object):
+  ego_extent_y = 1.0
+
+
+def create_scene(rng, world, center, radius, num_vehicles, num_walkers):
+  ego = MockActor(world, 0, 'vehicle.lincoln.mkz', carla.Location(center[0], center[1], 0.0), 0.0,
+                  carla.Vector3D(2.4, 1.0, 0.8), bb_location=carla.Location(0.1, 0.0, 0.7))
+  world.actors.append(ego)
+  moving = []
+  for i in range(num_vehicles):
+    location = carla.Location(*(center + rng.uniform(-radius, radius, size=2)), rng.uniform(-1.0, 1.0))
+    extent = carla.Vector3D(*rng.uniform((1.0, 0.4, 0.5), (6.0, 1.5, 2.0)))
+    if i % 5 == 0:  # parked vehicles are static car meshes
+      actor = MockActor(world, len(world.actors), 'static.prop.mesh', location, rng.uniform(-180, 180), extent,
+                        bb_location=carla.Location(0.0, 0.0, extent.z))
+      actor.attributes['mesh_path'] = '/Game/Carla/Static/Car/4Wheeled/ParkedVehicles/Sedan.Sedan'
+    else:
+      actor = MockActor(world, len(world.actors), 'vehicle.audi.a2', location, rng.uniform(-180, 180), extent,
+                        bb_location=carla.Location(*rng.uniform(-0.2, 0.2, size=2), extent.z),
+                        pitch=rng.uniform(-5, 5), roll=rng.uniform(-3, 3))
+      moving.append(actor)
+    world.actors.append(actor)
+  for _ in range(num_walkers):
+    location = carla.Location(*(center + rng.uniform(-radius, radius, size=2)), 0.9)
+    walker = MockActor(world, len(world.actors), 'walker.pedestrian.0001', location, rng.uniform(-180, 180),
+                       carla.Vector3D(*rng.uniform((0.1, 0.1, 0.8), (0.4, 0.4, 0.95))))
+    world.actors.append(walker)
+    moving.append(walker)
+  return ego, moving
+
+
+def set_traffic_lights(rng, center, radius):
+  TrafficLightHandler.num_tl = 12
+  TrafficLightHandler.list_tl_actor = [MockTrafficLight(100 + i, i % 3) for i in range(TrafficLightHandler.num_tl)]
+  TrafficLightHandler.list_tv_loc = []
+  TrafficLightHandler.list_stopline_vtx = []
+  for _ in range(TrafficLightHandler.num_tl):
+    tv_loc = center + rng.uniform(-0.5 * radius, 0.5 * radius, size=2)
+    TrafficLightHandler.list_tv_loc.append(carla.Location(tv_loc[0], tv_loc[1], 0.0))
+    lines = []
+    for _ in range(int(rng.integers(1, 4))):
+      start = tv_loc + rng.uniform(-8, 8, size=2)
+      end = start + rng.uniform(-4, 4, size=2)
+      lines.append([carla.Location(start[0], start[1], 0.0), carla.Location(end[0], end[1], 0.0)])
+    TrafficLightHandler.list_stopline_vtx.append(lines)
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  obs_configs = {
+      'width_in_pixels': args.width,
+      'pixels_ev_to_bottom': args.width / 2.0,
+      'pixels_per_meter': args.pixels_per_meter,
+      'history_idx': args.history_idx,
+      'scale_bbox': True,
+      'scale_mask_col': 1.0,
+  }
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    if args.town is None:
+      obs_configs['map_folder'] = tmp_dir
+      map_name = 'Synthetic'
+      write_synthetic_map(os.path.join(tmp_dir, map_name + '.h5'), args.synthetic_size, args.pixels_per_meter, rng)
+      with h5py.File(os.path.join(tmp_dir, map_name + '.h5'), 'r') as hf:
+        world_offset = np.array(hf.attrs['world_offset_in_meters'])
+        town_size = np.array(hf['road'].shape[::-1]) / args.pixels_per_meter
+    else:
+      obs_configs['map_folder'] = args.map_folder
+      map_name = 'Carla/Maps/{0}/{0}'.format(args.town)
+      with h5py.File(os.path.join(ROOT, 'team_code', 'birds_eye_view', args.map_folder, args.town + '.h5'), 'r') as hf:
+        world_offset = np.array(hf.attrs['world_offset_in_meters'])
+        town_size = np.array(hf['road'].shape[::-1]) / float(hf.attrs['pixels_per_meter'])
+
+    # The ego drives along a curve through the town, partly outside of it
+    world = MockWorld(map_name)
+    start = world_offset + town_size * (0.3, 0.3)
+    ego, moving = create_scene(rng, world, start, 0.25 * town_size.min(), args.vehicles, args.walkers)
+    stop_sign = MockActor(world, 999, 'traffic.stop', carla.Location(start[0] + 10.0, start[1] + 3.0, 0.0), 90.0,
+                          carla.Vector3D(0.5, 0.5, 0.5))
+    stop_sign.trigger_volume = carla.BoundingBox(carla.Location(1.5, -2.0, 0.0), carla.Vector3D(2.0, 1.0, 1.0))
+    criteria_stop = MockStopCriteria(stop_sign)
+
+    managers = {
+        'reference': ReferenceObsManager(obs_configs, Config()),
+        'cropped': chauffeurnet.ObsManager(obs_configs, Config())
+    }
+    for manager in managers.values():
+      manager.attach_ego_vehicle(ego, criteria_stop)
+    set_traffic_lights(rng, start, 0.25 * town_size.min())
+
+    timings = {name: 0.0 for name in managers}
+    num_pixels, num_different = 0, 0
+    yaw = 45.0
+    for frame in range(args.frames):
+      yaw += 1.5
+      location = ego.location + carla.Location(x=1.5 * np.cos(np.deg2rad(yaw)), y=1.5 * np.sin(np.deg2rad(yaw)))
+      ego.set_transform(location, yaw, pitch=float(rng.uniform(-2, 2)))
+      for actor in moving:
+        actor.set_transform(actor.location + carla.Location(*rng.uniform(-0.3, 0.3, size=2)),
+                            actor.rotation.yaw + rng.uniform(-3, 3), actor.rotation.pitch, actor.rotation.roll)
+      criteria_stop.stop_completed = frame % 50 > 25
+
+      outputs = {}
+      for name, manager in managers.items():
+        start_time = time.perf_counter()
+        observation = manager.get_observation()
+        timings[name] += time.perf_counter() - start_time
+        m_warp = manager._get_warp_transform(ego.location, ego.rotation)  # pylint: disable=protected-access
+        history_masks = manager._get_history_masks(m_warp)  # pylint: disable=protected-access
+        outputs[name] = [observation['bev_semantic_classes']] + [mask for masks in history_masks for mask in masks]
+
+      for reference, cropped in zip(outputs['reference'], outputs['cropped']):
+        assert reference.shape == cropped.shape
+        num_pixels += reference.size
+        num_different += int(np.count_nonzero(reference != cropped))
+
+  raster_bytes = managers['cropped']._map_raster.nbytes  # pylint: disable=protected-access
+  print(f'{args.frames} frames, history {args.history_idx}: {num_different} of {num_pixels} pixels different '
+        f'({num_different / num_pixels:.2e})')
+  print(f'get_observation: {timings["reference"] * 1000 / args.frames:.2f} -> '
+        f'{timings["cropped"] * 1000 / args.frames:.2f} ms/frame '
+        f'(x{timings["reference"] / timings["cropped"]:.1f}), map raster {raster_bytes / 1e6:.1f} MB per town '
+        f'and process instead of per ObsManager')
+  assert num_different <= args.tolerance * num_pixels, 'rendering differs more than the tolerance'
+
+
+if __name__ == '__main__':
+  main()
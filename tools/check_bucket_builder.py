@@ -0,0 +1,329 @@
+'''
+Checks the incremental bucket builder (dataset_generation/data_buckets/build_buckets.py) against the previous
+DataLoader pass of carla_get_buckets.py, which loaded the measurements and boxes of every sample separately.
+Synthetic routes are generated in a temporary folder, the bucket index has to contain the same samples per bucket as
+the previous buckets_paths.pkl. Then one route is changed, one added and one removed, the update may only process the
+changed and the new route and has to give the same index as a full rebuild. Reports the time of all passes.
+Example:
+python tools/check_bucket_builder.py --routes 40 --num_workers 4
+'''
+
+import argparse
+import glob
+import gzip
+import math
+import os
+import pickle as pkl
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import ujson
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from dataset_generation.data_buckets import build_buckets  # pylint: disable=wrong-import-position
+from simlingo_training.dataloader.sample_index import load_bucket_index  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--routes', type=int, default=40)
+parser.add_argument('--max_frames', type=int, default=80)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--seed', type=int, default=0)
+
+DATA_PATH = 'database/simlingo'
+SCENARIOS = ['ParkingExit', 'parking_lane', 'Accident', 'SignalizedJunctionLeftTurn']
+
+
+############## previous DataLoader pass of carla_get_buckets.py ##############
+HIST_LEN = 3
+PRED_LEN = 11
+SKIP_FIRST_N_FRAMES = 10
+
+
+def load_json_gz(path):
+  with gzip.open(path, 'r') as f:
+    return ujson.load(f)
+
+
+def reference_samples(data_path):
+  samples = []
+  for route_dir in glob.glob(data_path + '/**/data/**/Town*', recursive=True):
+    if not os.path.exists(route_dir + '/rgb'):
+      continue
+    num_seq = len(os.listdir(route_dir + '/rgb'))
+    for seq in range(SKIP_FIRST_N_FRAMES, num_seq - PRED_LEN - HIST_LEN):
+      samples.append((route_dir + '/measurements', seq))
+  return samples
+
+
+def reference_get_waypoints(measurements):
+  origin_matrix = np.array(measurements[0]['ego_matrix'])[:3]
+  origin_translation = origin_matrix[:, 3:4]
+  origin_rotation = origin_matrix[:, :3]
+  waypoints = []
+  for measurement in measurements:
+    waypoint = np.array(measurement['ego_matrix'])[:3, 3:4]
+    waypoints.append((origin_rotation.T @ (waypoint - origin_translation))[:2, 0])
+  return waypoints
+
+
+def reference_getitem(measurement_folder, sample_start):
+  data = {}
+  loaded_boxes = []
+  loaded_measurements = []
+  for i in range(HIST_LEN + PRED_LEN):
+    measurement_file = measurement_folder + f'/{(sample_start + i):04}.json.gz'
+    loaded_measurements.append(load_json_gz(measurement_file))
+    loaded_boxes.append(load_json_gz(measurement_file.replace('measurements', 'boxes')))
+  measurement_file_current = measurement_folder + f'/{(sample_start + HIST_LEN - 1):04}.json.gz'
+  current_boxes = loaded_boxes[HIST_LEN - 1]
+  current_measurement = loaded_measurements[HIST_LEN - 1]
+
+  data['waypoints'] = np.array(reference_get_waypoints(loaded_measurements[HIST_LEN - 1:])[:-1])
+  future_speeds = [measurement['speed'] for measurement in loaded_measurements[HIST_LEN - 1:]]
+  data['label_acceleration_ms2'] = np.diff(future_speeds) / 0.2
+  data['hazards'] = {
+      'vehicle': current_measurement['vehicle_hazard'],
+      'light': current_measurement['light_hazard'],
+      'walker': current_measurement['walker_hazard'],
+      'stop_sign': current_measurement['stop_sign_hazard'],
+  }
+  ego_info = {}
+  for box in current_boxes:
+    if box['class'] == 'ego_info':
+      ego_info = box
+    if box['class'] == 'walker' and current_measurement['walker_affecting_id'] is not None:
+      if box['id'] == current_measurement['walker_affecting_id']:
+        data['walker_affecting'] = box
+    if box['class'] == 'car' and current_measurement['vehicle_affecting_id'] is not None:
+      if box['id'] == current_measurement['vehicle_affecting_id']:
+        data['vehicle_affecting'] = box
+    if 'stop_sign' in box['class'] and box['affects_ego'] and box['distance'] < 15:
+      data['stop_sign_close'] = box
+  if ego_info['distance_to_junction'] is None:
+    ego_info['distance_to_junction'] = 10000
+
+  buckets = []
+  leading_object = current_measurement['speed_reduced_by_obj_type']
+  if leading_object is not None and leading_object.split('.')[0] == 'vehicle' and current_measurement['speed_reduced_by_obj_distance'] < 10:
+    if leading_object not in ('vehicle.bh.crossbike', 'vehicle.diamondback.century', 'vehicle.gazelle.omafiets'):
+      for box in loaded_boxes[HIST_LEN - 1:HIST_LEN - 1 + 4]:
+        if not any('id' in bb and bb['id'] == current_measurement['speed_reduced_by_obj_id'] for bb in box):
+          return measurement_file_current, ['vehicle_dissapears']
+
+  buckets.append(f"speed_limit_{current_measurement['speed_limit']}")
+  for speed in [0.5, 5, 10, 15, 20, 25, 1000000]:
+    if current_measurement['target_speed'] < speed:
+      buckets.append(f'target_speed_{speed}')
+      break
+  lateral_control = np.abs(np.mean(data['waypoints'][:, 1]))
+  for control in [0.1, 1, 2, 5, 1000000]:
+    if lateral_control < control:
+      buckets.append(f'lateral_control_{control}')
+      break
+  distance = np.mean(np.linalg.norm(data['waypoints'][1:] - data['waypoints'][:-1], axis=1))
+  if current_measurement['speed'] < 0.5 and distance > 0.1:
+    buckets.append('start_from_stop_old')
+  if current_measurement['speed'] < 0.5 and current_measurement['target_speed'] > 0.8:
+    buckets.append('start_from_stop')
+  accel = np.mean(data['label_acceleration_ms2'][:4])
+  for acc in [-40, -20, -5, -1, 1, 5, 20, 40, 1000000]:
+    if accel < acc:
+      buckets.append(f'acceleration_{acc}')
+      break
+  if leading_object is not None and current_measurement['speed_reduced_by_obj_distance'] < 30:
+    if leading_object.split('.')[0] == 'vehicle':
+      leading_object = 'vehicle'
+    if leading_object.split('.')[0] == 'walker':
+      leading_object = 'walker'
+    buckets.append(f'leading_object_{leading_object}')
+  red_light = ego_info['traffic_light_state'] == 'Red' and ego_info['distance_to_junction'] < 20
+  if ego_info['distance_to_junction'] < 10:
+    buckets.append('junction')
+  if red_light:
+    buckets.append('red_light')
+  if ego_info['traffic_light_state'] == 'Green' and ego_info['distance_to_junction'] < 20:
+    buckets.append('green_light')
+  if current_measurement['changed_route']:
+    buckets.append('changed_route')
+  for hazard, active in data['hazards'].items():
+    if active:
+      if hazard == 'vehicle' and 'vehicle_affecting' not in data:
+        continue
+      if hazard == 'walker' and 'walker_affecting' not in data:
+        buckets.append('walker_hazard')
+        continue
+      buckets.append(hazard)
+      if hazard == 'vehicle' and np.pi - 0.6 < data['vehicle_affecting']['yaw'] < np.pi + 0.6:
+        if not red_light:
+          buckets.append('vehicle_front')
+      elif hazard == 'vehicle' and abs(data['vehicle_affecting']['yaw']) > 0.5:
+        if not red_light:
+          buckets.append('vehicle_side')
+  if current_measurement['brake'] or current_measurement['control_brake']:
+    buckets.append('brake')
+  if 'stop_sign_close' in data:
+    buckets.append('stop_sign_close')
+  if 'parking_lane' in measurement_file_current and abs(lateral_control) > 0.2:
+    buckets.append('parkinglane')
+  return measurement_file_current, buckets
+
+
+def reference_buckets(data_path):
+  buckets_paths = {}
+  samples = reference_samples(data_path)
+  for measurement_folder, seq in samples:
+    path, buckets = reference_getitem(measurement_folder, seq)
+    for bucket in buckets:
+      buckets_paths.setdefault(bucket, set()).add(path)
+  return {key: sorted(paths) for key, paths in buckets_paths.items()}, len(samples)
+
+
+############## synthetic routes ##############
+def dump_json_gz(path, data):
+  with gzip.open(path, 'wt') as f:
+    ujson.dump(data, f)
+
+
+def write_route(route_dir, rng, num_frames):
+  for folder in ('measurements', 'boxes', 'rgb'):
+    os.makedirs(os.path.join(route_dir, folder), exist_ok=True)
+  x, y, yaw = rng.uniform(-100, 100), rng.uniform(-100, 100), rng.uniform(-math.pi, math.pi)
+  speed = rng.uniform(0, 10)
+  for frame in range(num_frames):
+    speed = float(np.clip(speed + rng.normal(0, 1.5), 0, 20)) if rng.random() > 0.1 else 0.0
+    yaw += rng.normal(0, 0.05)
+    x += speed * 0.2 * math.cos(yaw)
+    y += speed * 0.2 * math.sin(yaw)
+    ego_matrix = [[math.cos(yaw), -math.sin(yaw), 0, x], [math.sin(yaw), math.cos(yaw), 0, y], [0, 0, 1, 0.3],
+                  [0, 0, 0, 1]]
+    leading_type = rng.choice([None, 'vehicle.lincoln.mkz', 'vehicle.bh.crossbike', 'walker.pedestrian.0001',
+                               'static.prop.cone'])
+    measurement = {
+        'ego_matrix': ego_matrix,
+        'speed': speed,
+        'target_speed': float(rng.choice([0.0, 0.5, 4.0, 8.0, 14.0, 22.0, 30.0])),
+        'speed_limit': float(rng.choice([8.33, 13.89, 22.22])),
+        'brake': bool(rng.random() < 0.2),
+        'control_brake': bool(rng.random() < 0.1),
+        'steer': float(rng.normal(0, 0.1)),
+        'throttle': float(rng.random()),
+        'junction': bool(rng.random() < 0.2),
+        'vehicle_hazard': bool(rng.random() < 0.3),
+        'light_hazard': bool(rng.random() < 0.2),
+        'walker_hazard': bool(rng.random() < 0.2),
+        'stop_sign_hazard': bool(rng.random() < 0.1),
+        'walker_affecting_id': [None, 200, 999][rng.integers(3)],
+        'vehicle_affecting_id': [None, 100, 998][rng.integers(3)],
+        'speed_reduced_by_obj_type': leading_type,
+        'speed_reduced_by_obj_distance': float(rng.uniform(0, 40)) if leading_type is not None else None,
+        'speed_reduced_by_obj_id': int(rng.choice([100, 101])) if leading_type is not None else None,
+        'changed_route': bool(rng.random() < 0.05),
+    }
+    boxes = [
+        {'class': 'ego_info', 'distance_to_junction': [None, float(rng.uniform(0, 40))][rng.integers(2)],
+         'traffic_light_state': ['Red', 'Green', 'Yellow', 'None'][rng.integers(4)]},
+        {'class': 'car', 'id': 100, 'yaw': float(rng.choice([math.pi, math.pi + 0.3, 0.2, 1.5, -1.5]))},
+        {'class': 'walker', 'id': 200},
+        {'class': 'stop_sign', 'id': 300, 'affects_ego': bool(rng.random() < 0.5), 'distance': float(rng.uniform(0, 30))},
+        {'class': 'traffic_light', 'id': 400, 'affects_ego': bool(rng.random() < 0.5), 'distance': float(rng.uniform(0, 30))},
+    ]
+    if rng.random() < 0.9:
+      boxes.append({'class': 'car', 'id': 101, 'yaw': float(rng.uniform(-math.pi, math.pi))})
+    dump_json_gz(os.path.join(route_dir, 'measurements', f'{frame:04}.json.gz'), measurement)
+    dump_json_gz(os.path.join(route_dir, 'boxes', f'{frame:04}.json.gz'), boxes)
+    open(os.path.join(route_dir, 'rgb', f'{frame:04}.jpg'), 'wb').close()
+
+
+def route_dir_name(i):
+  return f'{DATA_PATH}/data/simlingo/training_1_scenario/{SCENARIOS[i % len(SCENARIOS)]}/Route{i}/Town12_Rep0_{i}_route0'
+
+
+def index_buckets(bucket_path):
+  '''{key: sorted sample paths} of the bucket index the datasets load.'''
+  index = load_bucket_index('.', bucket_path, 'sample_index')
+  assert index.index_dir.endswith(os.path.join(bucket_path, 'bucket_index')), index.index_dir
+  buckets = {}
+  for key in index.keys():
+    route_ids, frames = index.key_arrays(key)
+    buckets[key] = sorted(f"{str(index.routes[route_id], encoding='utf-8')}/{frame:04}.json.gz"
+                          for route_id, frame in zip(route_ids.tolist(), frames.tolist()))
+  return buckets
+
+
+def compare(reference, num_samples, bucket_path):
+  built = index_buckets(bucket_path)
+  assert sorted(built.keys()) == sorted(reference.keys()), set(built.keys()) ^ set(reference.keys())
+  for key in reference:
+    assert built[key] == reference[key], key
+  with open(f'{bucket_path}/buckets_stats.json', 'r') as f:
+    stats = ujson.load(f)
+  assert stats == {'total': num_samples, **{key: len(paths) for key, paths in reference.items()}}
+
+
+def timed(function, *args, **kwargs):
+  start = time.perf_counter()
+  result = function(*args, **kwargs)
+  return result, time.perf_counter() - start
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  cwd = os.getcwd()
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    os.chdir(tmp_dir)
+    for i in range(args.routes):
+      # a few routes are too short for a sample
+      write_route(route_dir_name(i), rng, int(rng.integers(20, args.max_frames)))
+
+    (reference, num_samples), time_reference = timed(reference_buckets, DATA_PATH)
+    summary, time_full = timed(build_buckets.build_bucket_index, DATA_PATH, 'database/buckets', args.num_workers,
+                               legacy_pkl=True)
+    assert summary['processed'] == args.routes and summary['failed'] == 0, summary
+    compare(reference, num_samples, 'database/buckets')
+    with open('database/buckets/buckets_paths.pkl', 'rb') as f:
+      assert {key: sorted(paths) for key, paths in pkl.load(f).items()} == reference
+    # the buckets of the config that are unions of saved buckets
+    index = load_bucket_index('.', 'database/buckets', 'sample_index')
+    run_id_dict = index.run_id_dict(index.bucket_keys('lateral_control_high'), '.')
+    expected = {path for key in ('lateral_control_2', 'lateral_control_5', 'lateral_control_1000000') for path in reference.get(key, [])}
+    assert {f'{route}/{frame}' for route, frames in run_id_dict.items() for frame in frames} == {f'./{path}' for path in expected}
+    del index
+
+    summary, time_unchanged = timed(build_buckets.build_bucket_index, DATA_PATH, 'database/buckets', args.num_workers)
+    assert summary['processed'] == 0 and summary['unchanged'] == args.routes, summary
+    compare(reference, num_samples, 'database/buckets')
+
+    # change a route, add one and remove one
+    time.sleep(0.01)
+    changed_file = f'{route_dir_name(1)}/measurements/0015.json.gz'
+    measurement = load_json_gz(changed_file)
+    measurement.update({'speed': 0.0, 'target_speed': 30.0, 'changed_route': not measurement['changed_route']})
+    dump_json_gz(changed_file, measurement)
+    write_route(route_dir_name(args.routes), rng, args.max_frames)
+    shutil.rmtree(route_dir_name(2))
+
+    (reference, num_samples), time_reference_update = timed(reference_buckets, DATA_PATH)
+    summary, time_update = timed(build_buckets.build_bucket_index, DATA_PATH, 'database/buckets', args.num_workers)
+    assert summary['processed'] == 2 and summary['unchanged'] == args.routes - 2, summary
+    compare(reference, num_samples, 'database/buckets')
+    summary, _ = timed(build_buckets.build_bucket_index, DATA_PATH, 'database/buckets_full', args.num_workers)
+    assert summary['processed'] == args.routes
+    assert index_buckets('database/buckets') == index_buckets('database/buckets_full')
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(tmp_dir)
+
+  print(f'{args.routes} routes, {num_samples} samples in {len(reference)} buckets: identical buckets and stats')
+  print(f'full pass: {time_reference:.2f} s (per sample loading) -> {time_full:.2f} s (per route, {args.num_workers} workers)')
+  print(f'unchanged data: {time_unchanged:.2f} s, one changed, one new and one removed route: '
+        f'{time_reference_update:.2f} s -> {time_update:.2f} s')
+
+
+if __name__ == '__main__':
+  main()
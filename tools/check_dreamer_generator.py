@@ -0,0 +1,569 @@
+'''
+Checks the dreamer generator of dataset_generation/dreamer_data/dreamer_generator.py, which runs without CARLA on NumPy
+boxes, against the previous implementation on a synthetic route: an ego in a curve with vehicles ahead, oncoming and
+parked, a vehicle that is not visible in some frames, a crossing pedestrian and static objects. The previous one
+re-read all future frames of every frame, looked up the actors with a scan over all boxes, converted every point on
+its own, built carla.BoundingBox objects in an O(T^2) loop and checked the collisions with the 3D separating axis test.
+Both are run with the same random seeds, the generated labels have to be identical. The carla types of the previous
+implementation are the mocks of scenario_runner/srunner/tests/carla_mocks with the float32 storage of carla.
+Example:
+python tools/check_dreamer_generator.py --frames 40
+'''
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+import warnings
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+# The generator works with paths relative to the working directory (database/, viz/ and the templates in data/)
+WORK_DIR = tempfile.mkdtemp(prefix='check_dreamer_')
+os.chdir(WORK_DIR)
+os.symlink(os.path.join(ROOT, 'data'), 'data')
+
+from dataset_generation.dreamer_data import dreamer_generator  # pylint: disable=wrong-import-position
+from dataset_generation.dreamer_data import dreamer_utils  # pylint: disable=wrong-import-position
+from dataset_generation.dreamer_data.kinematic_bicycle_model import KinematicBicycleModel  # pylint: disable=wrong-import-position
+from simlingo_training.utils import transfuser_utils as t_u  # pylint: disable=wrong-import-position
+
+assert 'carla' not in sys.modules, 'the dreamer generator imports carla'
+
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+import carla as carla_mocks  # pylint: disable=wrong-import-position
+
+# forecast_vehicles stores arrays of shape [1] as scalars, which numpy >= 1.25 deprecates
+warnings.filterwarnings('ignore', category=DeprecationWarning)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--frames', type=int, default=40, help='Frames of the synthetic route (4 fps).')
+parser.add_argument('--seed', type=int, default=0)
+
+CURVATURE = 0.01
+ROUTE_DIR = 'database/simlingo/data/simlingo/synthetic/scenario/town/Town12_Rep0_route0_synthetic'
+
+
+############## carla types with float32 storage ##############
+class Vector3D(carla_mocks.Vector3D):
+
+  def __setattr__(self, name, value):
+    super().__setattr__(name, float(np.float32(value)))
+
+
+class Location(Vector3D):
+  pass
+
+
+class Rotation(carla_mocks.Rotation):
+
+  def __setattr__(self, name, value):
+    super().__setattr__(name, float(np.float32(value)))
+
+
+carla = types.SimpleNamespace(Vector3D=Vector3D, Location=Location, Rotation=Rotation,
+                              BoundingBox=carla_mocks.BoundingBox)
+
+
+def to_oriented_boxes(bounding_boxes):
+  return dreamer_utils.OrientedBoxes([[box.location.x, box.location.y, box.location.z] for box in bounding_boxes],
+                                     [box.rotation.yaw for box in bounding_boxes],
+                                     [[box.extent.x, box.extent.y, box.extent.z] for box in bounding_boxes])
+
+
+def to_bounding_boxes(oriented_boxes):
+  bounding_boxes = []
+  for location, yaw, extent in oriented_boxes:
+    bounding_box = carla.BoundingBox(carla.Location(*location), carla.Vector3D(*extent))
+    bounding_box.rotation = carla.Rotation(pitch=0, yaw=yaw, roll=0)
+    bounding_boxes.append(bounding_box)
+  return bounding_boxes
+
+
+class BicycleModel(KinematicBicycleModel):
+  '''
+  The throttle model of forecast_ego_vehicle builds a ragged array from the speed of shape [1], which only numpy < 1.24
+  accepts (the environment pins 1.23). Both generators are run with the speed as scalar.
+  '''
+
+  def forecast_ego_vehicle(self, location, heading, speed, action):
+    return super().forecast_ego_vehicle(location, heading, np.asarray(speed).reshape(()), action)
+
+
+############## previous implementation ##############
+class ReferenceCreator(dreamer_generator.CarlaAlternativeCreator):
+  '''The kernels of the previous generator, the boxes are converted from and to OrientedBoxes at the interfaces.'''
+  save_folder_name = 'dreamer_reference'
+
+  def load_frame(self, path_boxes):
+    # every frame read again from the files
+    self.frame_cache.pop(path_boxes, None)
+    return super().load_frame(path_boxes)
+
+  def get_future_actors(self, ids, ids_walkers, nearby_actors_by_id, future_frames):
+    future_nearby_actors_by_id = {id: [] for id in ids}
+    future_nearby_actors_used_time_stamps_by_id = {id: [] for id in ids}
+    future_nearby_walkers_by_id = {id: [] for id in ids_walkers}
+    future_nearby_walkers_used_time_stamps_by_id = {id: [] for id in ids_walkers}
+
+    for i, future in enumerate([future_frame['boxes'] for future_frame in future_frames]):
+      tmp_actors = []
+      tmp_walkers = []
+      for id in ids + ids_walkers:
+        tmp_box = [box for box in future if 'id' in box and box['id'] == id]
+        if tmp_box:
+          if tmp_box[0]['class'] == 'car':
+            tmp_actors.append(tmp_box[0])
+          elif tmp_box[0]['class'] == 'walker':
+            tmp_walkers.append(tmp_box[0])
+          else:
+            raise ValueError('Unknown class')
+        else:
+          if id in future_nearby_actors_by_id:
+            if len(future_nearby_actors_by_id[id]) > 0:
+              tmp_actors.append(future_nearby_actors_by_id[id][-1])
+              future_nearby_actors_used_time_stamps_by_id[id].append(
+                  future_nearby_actors_used_time_stamps_by_id[id][-1])
+            else:
+              tmp_actors.append(nearby_actors_by_id[id])
+              future_nearby_actors_used_time_stamps_by_id[id].append(0)
+        if id in future_nearby_actors_by_id:
+          future_nearby_actors_by_id[id].append(tmp_actors[-1])
+          if tmp_box:
+            future_nearby_actors_used_time_stamps_by_id[id].append(i)
+        elif id in future_nearby_walkers_by_id and len(tmp_walkers) > 0:
+          future_nearby_walkers_by_id[id].append(tmp_walkers[-1])
+          future_nearby_walkers_used_time_stamps_by_id[id].append(i)
+
+    return future_nearby_actors_by_id, future_nearby_actors_used_time_stamps_by_id, future_nearby_walkers_by_id, \
+        future_nearby_walkers_used_time_stamps_by_id
+
+  def get_bbs(self, actors, future_nearby_actors_by_id, future_nearby_actors_used_time_stamps_by_id, all_ego_positions,
+              all_ego_yaws):
+    all_bbs_by_id = {}
+    for actor in actors:
+      future_actor = future_nearby_actors_by_id[actor['id']]
+      future_nearby_actors_used_time_stamps = [0] + [t + 1 for t in future_nearby_actors_used_time_stamps_by_id[actor['id']]]
+      actor_all_times = [actor] + future_actor
+      all_positions = np.array([actor['position'] for actor in actor_all_times])
+      all_yaws = np.array([actor['yaw'] for actor in actor_all_times])
+      all_positions_global = np.array([
+          t_u.conversion_2d(pos[:2], all_ego_positions[future_nearby_actors_used_time_stamps[t]],
+                            -all_ego_yaws[future_nearby_actors_used_time_stamps[t]])
+          for t, pos in enumerate(all_positions)
+      ])
+      all_positions_local = np.array(
+          [t_u.inverse_conversion_2d(pos, all_ego_positions[0], all_ego_yaws[0]) for pos in all_positions_global])
+
+      all_yaws_global = np.array([yaw + all_ego_yaws[t] for t, yaw in enumerate(all_yaws)])
+      all_yaws_local = np.array([t_u.normalize_angle(yaw - all_ego_yaws[0]) for yaw in all_yaws_global])
+
+      all_bbs = []
+      extent_add_safety = 0
+      if actor['class'] == 'walker':
+        extent_add_safety = 0.5
+
+      for t in range(len(actor_all_times)):
+        location = carla.Location(x=all_positions_local[t][0], y=all_positions_local[t][1], z=all_positions[t][2])
+        rotation = carla.Rotation(pitch=0, yaw=np.rad2deg(all_yaws_local[t]), roll=0)
+        extent = carla.Vector3D(x=actor_all_times[t]['extent'][0] + extent_add_safety,
+                                y=actor_all_times[t]['extent'][1] + extent_add_safety,
+                                z=actor_all_times[t]['extent'][2])
+        bounding_box = carla.BoundingBox(location, extent)
+        bounding_box.rotation = rotation
+        all_bbs.append(bounding_box)
+      all_bbs_by_id[actor['id']] = to_oriented_boxes(all_bbs)
+
+    return all_bbs_by_id
+
+  def forecast_vehicles(self, ego_actor, next_ego_actor_by_id, ego_position, ego_yaw, route=None,
+                        speeds_to_follow=None, desired_throttle=None, brake_probability=None, target_speed=None,
+                        return_final_speed=False, return_gt_speeds=False, use_wps_speed_controller=False):
+    predicted_bounding_boxes = {}
+    self._turn_controller.save_state()
+
+    next_ego_actor = next_ego_actor_by_id[ego_actor['id']]
+    current_actions = np.array([[ego_actor['steer'], ego_actor['throttle'], ego_actor['brake']]])
+    actions_future = np.array([[actor['steer'], actor['throttle'], actor['brake']] for actor in next_ego_actor])
+    all_actions = np.concatenate([current_actions, actions_future])
+    all_locations_global = np.concatenate([
+        np.array([np.array(ego_actor['matrix'])[:3, 3]]),
+        np.array([np.array(actor['matrix'])[:3, 3] for actor in next_ego_actor])
+    ])
+
+    ratio = self.dataset_frame_rate / self.carla_frame_rate
+    interp_times = np.arange(0, len(all_actions), ratio)
+    interp_steers = np.interp(interp_times, np.arange(0, len(all_actions)), all_actions[:, 0])
+    interp_throttles = np.interp(interp_times, np.arange(0, len(all_actions)), all_actions[:, 1])
+    interp_brakes = np.interp(interp_times, np.arange(0, len(all_actions)), all_actions[:, 2])
+    interp_location_global = np.array([
+        np.interp(np.arange(0, len(all_locations_global), ratio), np.arange(0, len(all_locations_global)),
+                  all_locations_global[:, axis]) for axis in range(3)
+    ]).T
+
+    previous_actions = np.array([ego_actor['steer'], ego_actor['throttle'], ego_actor['brake']])
+    velocities = np.array([ego_actor['speed']])
+    locations = np.array(np.asarray(ego_actor['matrix'])[:3, 3])
+    headings = np.array([ego_actor['yaw'] + ego_yaw])
+
+    future_locations = np.zeros((self.num_future_frames_carla_fps, 3), dtype='float')
+    future_headings = np.zeros((self.num_future_frames_carla_fps), dtype='float')
+    future_velocities = np.zeros((self.num_future_frames_carla_fps), dtype='float')
+
+    for i in range(self.num_future_frames_carla_fps):
+      locations, headings, velocities = self.bicycle_model.forecast_ego_vehicle(locations, headings, velocities,
+                                                                                previous_actions)
+      previous_actions = np.array([interp_steers[i], interp_throttles[i], interp_brakes[i]])
+
+      future_locations[i] = locations.copy()
+      future_velocities[i] = velocities.copy()
+      future_headings[i] = headings.copy()
+
+      if route is not None:
+        closest_route_point = np.argmin(np.linalg.norm(locations[:2] - route[:, :2], axis=1)) + 1
+        if closest_route_point >= len(route):
+          route = None
+        else:
+          closest_route_point = min(closest_route_point, len(route) - 1)
+          route_ahead = route[closest_route_point:]
+          steering = self._turn_controller.step(route_ahead, velocities, locations[:2], headings, inference_mode=True)
+          previous_actions[0] = steering
+
+      if use_wps_speed_controller:
+        wps_global = interp_location_global[i:]
+        wps = np.array([t_u.inverse_conversion_2d(wp[:2], locations[:2], headings) for wp in wps_global
+                       ])[::(self.carla_frame_rate // self.dataset_frame_rate)]
+        one_second = self.dataset_frame_rate
+        half_second = one_second // 2
+        if len(wps) >= one_second:
+          desired_speed = np.linalg.norm(wps[half_second - 2] - wps[one_second - 2] - wps[0]) * 2.0
+          throttle, control_brake = self._longitudinal_controller.get_throttle_and_brake(
+              False, desired_speed, velocities[0])
+          previous_actions[1] = throttle
+          previous_actions[2] = control_brake
+
+      if speeds_to_follow is not None:
+        throttle, control_brake = self._longitudinal_controller.get_throttle_and_brake(
+            False, speeds_to_follow[i], velocities[0])
+        previous_actions[1] = throttle
+        previous_actions[2] = control_brake
+
+      if desired_throttle is not None:
+        previous_actions[1] = desired_throttle
+        previous_actions[2] = 0
+
+      if brake_probability is not None:
+        if random.random() < brake_probability:
+          previous_actions[1] = 0
+          previous_actions[2] = 1
+        else:
+          previous_actions[1] = 0
+          previous_actions[2] = 0
+
+      if target_speed is not None:
+        throttle, control_brake = self._longitudinal_controller.get_throttle_and_brake(
+            False, target_speed, velocities[0])
+        previous_actions[1] = throttle
+        previous_actions[2] = control_brake
+
+    future_headings = np.rad2deg(future_headings)
+
+    ego_position = np.array(ego_position)
+    ego_orientation = np.array(ego_yaw)
+    for time_step in range(future_locations.shape[0]):
+      target_point_2d = future_locations[time_step, :2]
+      ego_target_point = t_u.inverse_conversion_2d(target_point_2d, ego_position, ego_orientation).tolist()
+      future_locations[time_step, :2] = ego_target_point
+      future_headings[time_step] -= np.rad2deg(ego_yaw)
+
+      predicted_actor_boxes = []
+      for i in range(self.num_future_frames_carla_fps):
+        location = carla.Location(x=future_locations[i, 0].item(),
+                                  y=future_locations[i, 1].item(),
+                                  z=future_locations[i, 2].item())
+        rotation = carla.Rotation(pitch=0, yaw=future_headings[i], roll=0)
+        extent = ego_actor['extent']
+        extent = carla.Vector3D(x=extent[0], y=extent[1], z=extent[2])
+        bounding_box = carla.BoundingBox(location, extent)
+        bounding_box.rotation = rotation
+        predicted_actor_boxes.append(bounding_box)
+
+      predicted_actor_boxes = predicted_actor_boxes[::(self.carla_frame_rate // self.dataset_frame_rate)]
+      predicted_bounding_boxes[ego_actor['id']] = to_oriented_boxes(predicted_actor_boxes)
+    self._turn_controller.load_state()
+
+    return_tuple = (predicted_bounding_boxes,)
+    if return_final_speed:
+      return_tuple += (round(future_velocities[-1], 1),)
+    if return_gt_speeds:
+      return_tuple += (future_velocities,)
+    if len(return_tuple) == 1:
+      return_tuple = predicted_bounding_boxes
+    return return_tuple
+
+  def get_intersections(self, forecasts_ego, bbs_other_actors):
+    bbs_other_actors = {actor_id: to_bounding_boxes(boxes) for actor_id, boxes in bbs_other_actors.items()}
+    intersection_bb = []
+    intersection_timesteps = []
+    for j, ego_bounding_boxes_route_new_single in enumerate(forecasts_ego):
+      if len(intersection_bb) < j + 1:
+        intersection_bb.append([])
+        intersection_timesteps.append([])
+      for i, ego_bounding_box in enumerate(to_bounding_boxes(ego_bounding_boxes_route_new_single[0])):
+        for bounding_boxes in bbs_other_actors.values():
+          if i >= len(bounding_boxes):
+            continue
+          ego_bounding_box.location.z = 0
+          bounding_boxes[i].location.z = 0
+          if self.check_obb_intersection(ego_bounding_box, bounding_boxes[i]):
+            intersection_bb[j].append(bounding_boxes[i])
+            intersection_timesteps[j].append(i)
+    return [to_oriented_boxes(boxes) for boxes in intersection_bb], intersection_timesteps
+
+  def _dot_product(self, vector1, vector2):
+    return vector1.x * vector2.x + vector1.y * vector2.y + vector1.z * vector2.z
+
+  def cross_product(self, vector1, vector2):
+    x = vector1.y * vector2.z - vector1.z * vector2.y
+    y = vector1.z * vector2.x - vector1.x * vector2.z
+    z = vector1.x * vector2.y - vector1.y * vector2.x
+    return carla.Vector3D(x=x, y=y, z=z)
+
+  def get_separating_plane(self, relative_position, plane_normal, obb1, obb2):
+    projection_distance = abs(self._dot_product(relative_position, plane_normal))
+    obb1_projection = (abs(self._dot_product(obb1.rotation.get_forward_vector() * obb1.extent.x, plane_normal)) +
+                       abs(self._dot_product(obb1.rotation.get_right_vector() * obb1.extent.y, plane_normal)) +
+                       abs(self._dot_product(obb1.rotation.get_up_vector() * obb1.extent.z, plane_normal)))
+    obb2_projection = (abs(self._dot_product(obb2.rotation.get_forward_vector() * obb2.extent.x, plane_normal)) +
+                       abs(self._dot_product(obb2.rotation.get_right_vector() * obb2.extent.y, plane_normal)) +
+                       abs(self._dot_product(obb2.rotation.get_up_vector() * obb2.extent.z, plane_normal)))
+    return projection_distance > obb1_projection + obb2_projection
+
+  def check_obb_intersection(self, obb1, obb2):
+    relative_position = obb2.location - obb1.location
+    axes1 = [obb1.rotation.get_forward_vector(), obb1.rotation.get_right_vector(), obb1.rotation.get_up_vector()]
+    axes2 = [obb2.rotation.get_forward_vector(), obb2.rotation.get_right_vector(), obb2.rotation.get_up_vector()]
+    for axis in axes1 + axes2:
+      if self.get_separating_plane(relative_position, axis, obb1, obb2):
+        return False
+    for axis1 in axes1:
+      for axis2 in axes2:
+        if self.get_separating_plane(relative_position, self.cross_product(axis1, axis2), obb1, obb2):
+          return False
+    return True
+
+
+############## synthetic route ##############
+def pose_on_road(s, lateral=0.0):
+  '''Global position and heading of a point s meters along a left curve, lateral meters to the left.'''
+  heading = CURVATURE * s
+  x = np.sin(heading) / CURVATURE - lateral * np.sin(heading)
+  y = (1 - np.cos(heading)) / CURVATURE + lateral * np.cos(heading)
+  return np.array([x, y]), heading
+
+
+def to_local(point, ego_position, ego_yaw):
+  return t_u.inverse_conversion_2d(np.asarray(point), np.asarray(ego_position), ego_yaw)
+
+
+def actor_box(actor_id, actor_class, s, lateral, heading_offset, extent, speed, ego_position, ego_yaw, **kwargs):
+  position, heading = pose_on_road(s, lateral)
+  local = to_local(position, ego_position, ego_yaw)
+  box = {
+      'class': actor_class,
+      'extent': list(extent),
+      'position': [float(local[0]), float(local[1]), float(extent[2])],
+      'yaw': float(t_u.normalize_angle(heading + heading_offset - ego_yaw)),
+      'speed': float(speed),
+      'distance': float(np.linalg.norm(local)),
+      'id': actor_id,
+  }
+  box.update(kwargs)
+  return box
+
+
+def synthetic_frames(num_frames, rng):
+  '''Boxes and measurements of a route at 4 fps.'''
+  frames = []
+  s = 0.0
+  for k in range(num_frames):
+    speed = 6.0 + 2.0 * np.sin(k / 5.0)
+    ego_position, ego_yaw = pose_on_road(s)
+    matrix = np.eye(4)
+    matrix[:2, :2] = [[np.cos(ego_yaw), -np.sin(ego_yaw)], [np.sin(ego_yaw), np.cos(ego_yaw)]]
+    matrix[:3, 3] = [ego_position[0], ego_position[1], 0.2]
+
+    route = np.array([to_local(pose_on_road(s + j)[0], ego_position, ego_yaw) for j in range(60)])
+    changed_route = 20 <= k < 24
+    route_original = route + [0.0, 0.3] if changed_route else route
+    junction_ahead = k % 9 == 4
+
+    boxes = [{
+        'class': 'ego_car',
+        'extent': [2.44, 1.06, 0.75],
+        'position': [0.0, 0.0, 0.0],
+        'yaw': 0.0,
+        'speed': float(speed),
+        'matrix': matrix.tolist(),
+        'id': 7,
+    }, {
+        'class': 'ego_info',
+        'lane_type_str': 'Driving',
+        'is_in_junction': False,
+        'distance_to_junction': 5.0 if junction_ahead else 30.0,
+        'num_lanes_same_direction': 2,
+        'ego_lane_number': 1,
+        'num_lanes_opposite_direction': 1,
+        'parking_right': False,
+        'parking_left': False,
+        'sidewalk_right': True,
+        'sidewalk_left': True,
+        'left_lanes': [{'type:': 'Driving', 'width': 3.5}, {'type:': 'Shoulder', 'width': 0.5},
+                       {'type:': 'Driving', 'width': 3.5}, {'type:': 'Sidewalk', 'width': 2.0}],
+        'right_lanes': [{'type:': 'Shoulder', 'width': 0.3}, {'type:': 'Sidewalk', 'width': 2.0}],
+        'lane_change': int(k % 4),
+        'traffic_light_state': 'green',
+    }]
+    t = k * 0.25
+    vehicle = {'type_id': 'vehicle.lincoln.mkz_2020', 'color_rgb': [10, 20, 30]}
+    actors = [
+        (101, 'car', s + 18.0 - 2.0 * t, 0.0, 0.0, (2.4, 1.0, 0.8), 4.0, vehicle),
+        (102, 'car', 70.0 - 7.0 * t, 3.5, np.pi, (2.2, 1.0, 0.7), 7.0, vehicle),
+        (104, 'car', 45.0, -5.5, 0.0, (2.0, 0.9, 0.7), 0.0, {'type_id': 'vehicle.mini.cooper_s'}),
+    ]
+    # a vehicle in the right lane that is not detected in some frames
+    if k % 7 not in (3, 4):
+      actors.append((103, 'car', 8.0 + 7.5 * t, -3.5, 0.0, (2.3, 1.0, 0.8), 7.5, vehicle))
+    # a pedestrian that crosses the road
+    walker_lateral = -7.0 + 1.4 * max(t - 2.0, 0.0)
+    if walker_lateral < 7.0:
+      actors.append((201, 'walker', 40.0, walker_lateral, np.pi / 2, (0.3, 0.3, 0.9), 1.4,
+                     {'type_id': 'walker.pedestrian.0001'}))
+    actors += [
+        (301, 'static', 30.0, 0.2, 0.0, (0.2, 0.2, 0.4), 0.0, {'type_id': 'static.prop.trafficcone01'}),
+        (302, 'static', 55.0, 1.0, 0.3, (1.2, 0.3, 0.6), 0.0,
+         {'type_id': 'static.prop.mesh', 'mesh_path': '/Game/Carla/Static/Barrier/Barrier.Barrier'}),
+        (303, 'static', 45.0, 0.5, 0.0, (0.8, 0.8, 0.05), 0.0, {'type_id': 'static.prop.dirtdebris01'}),
+    ]
+    for actor_id, actor_class, actor_s, lateral, heading_offset, extent, actor_speed, kwargs in actors:
+      box = actor_box(actor_id, actor_class, actor_s, lateral, heading_offset, extent, actor_speed, ego_position,
+                      ego_yaw, **kwargs)
+      if box['distance'] < 60:
+        boxes.append(box)
+
+    reduced = k % 5 == 2
+    measurements = {
+        'pos_global': ego_position.tolist(),
+        'theta': float(ego_yaw),
+        'speed': float(speed),
+        'steer': float(rng.uniform(-0.1, 0.1)),
+        'throttle': float(rng.uniform(0.2, 0.7)) if k % 6 else 0.0,
+        'brake': k % 6 == 0,
+        'target_speed': 8.0,
+        'speed_limit': 13.89,
+        'speed_reduced_by_obj_type': 'vehicle.lincoln.mkz_2020' if reduced else None,
+        'speed_reduced_by_obj_distance': 15.0 if reduced else None,
+        'route': route.tolist(),
+        'route_original': route_original.tolist(),
+        'changed_route': changed_route,
+        'target_point': route[20].tolist(),
+        'target_point_next': route[45].tolist(),
+        'command': 5 if k % 11 == 5 else 4,
+        'next_command': 4,
+    }
+    frames.append((boxes, measurements))
+    s += speed * 0.25
+  return frames
+
+
+def write_route(frames):
+  for folder in ('boxes', 'measurements', 'rgb'):
+    os.makedirs(os.path.join(ROUTE_DIR, folder), exist_ok=True)
+  for k, (boxes, measurements) in enumerate(frames):
+    with gzip.open(os.path.join(ROUTE_DIR, 'boxes', f'{k:04}.json.gz'), 'wt', encoding='utf-8') as f:
+      json.dump(boxes, f)
+    with gzip.open(os.path.join(ROUTE_DIR, 'measurements', f'{k:04}.json.gz'), 'wt', encoding='utf-8') as f:
+      json.dump(measurements, f)
+    with open(os.path.join(ROUTE_DIR, 'rgb', f'{k:04}.jpg'), 'wb') as f:
+      f.write(b'')
+  results = {'scores': {'score_composed': 100.0, 'score_route': 100.0, 'score_penalty': 1.0}, 'infractions': {'min_speed_infractions': []}}
+  with gzip.open(os.path.join(ROUTE_DIR, 'results.json.gz'), 'wt', encoding='utf-8') as f:
+    json.dump(results, f)
+
+
+def run(creator_class, seed):
+  creator = creator_class()
+  creator.bicycle_model = BicycleModel(creator.carla_frame_rate)
+  creator.overwrite = True
+  creator.save_viz = False
+  random.seed(seed)
+  np.random.seed(seed)
+  start = time.perf_counter()
+  for path_id in range(len(creator.data_boxes_paths)):
+    creator.process_data(path_id)
+  return time.perf_counter() - start
+
+
+def read_labels(save_folder_name):
+  labels = {}
+  label_dir = os.path.join(ROUTE_DIR.replace('/data/', f'/{save_folder_name}/'), save_folder_name)
+  for file in sorted(os.listdir(label_dir)):
+    with gzip.open(os.path.join(label_dir, file), 'rt', encoding='utf-8') as f:
+      labels[file] = json.load(f)
+  return labels
+
+
+def check_conversions(rng):
+  points = rng.uniform(-100, 100, size=(200, 2))
+  translations = rng.uniform(-1000, 1000, size=(200, 2))
+  yaws = rng.uniform(-np.pi, np.pi, size=200)
+  assert np.array_equal(dreamer_utils.conversion_2d_batch(points, translations, yaws),
+                        np.array([t_u.conversion_2d(p, t, y) for p, t, y in zip(points, translations, yaws)]))
+  assert np.array_equal(dreamer_utils.conversion_2d_batch(points, translations[0], yaws[0]),
+                        np.array([t_u.conversion_2d(p, translations[0], yaws[0]) for p in points]))
+  assert np.array_equal(dreamer_utils.inverse_conversion_2d_batch(points, translations[0], yaws[0]),
+                        np.array([t_u.inverse_conversion_2d(p, translations[0], yaws[0]) for p in points]))
+  angles = rng.uniform(-20, 20, size=1000)
+  assert np.array_equal(dreamer_utils.normalize_angles(angles), np.array([t_u.normalize_angle(a) for a in angles]))
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  try:
+    check_conversions(rng)
+    write_route(synthetic_frames(args.frames, rng))
+    time_reference = run(ReferenceCreator, args.seed)
+    time_new = run(dreamer_generator.CarlaAlternativeCreator, args.seed)
+    reference = read_labels(ReferenceCreator.save_folder_name)
+    labels = read_labels(dreamer_generator.CarlaAlternativeCreator.save_folder_name)
+  finally:
+    os.chdir(ROOT)
+    shutil.rmtree(WORK_DIR)
+
+  assert reference.keys() == labels.keys()
+  for file in reference:
+    assert reference[file] == labels[file], f'{file} differs'
+
+  samples = [sample for frame in labels.values() for samples in frame.values() for sample in samples]
+  modes = {}
+  for sample in samples:
+    modes[sample['mode']] = modes.get(sample['mode'], 0) + 1
+  num_collisions = sum(1 for sample in samples if sample['info'].get('dynamic_crash'))
+  print(f'{len(labels)} of {args.frames} frames labeled, {len(samples)} samples ({num_collisions} with a collision '
+        f'with another actor): identical labels')
+  print('samples by mode: ' + ', '.join(f'{mode} {count}' for mode, count in sorted(modes.items())))
+  print(f'process_data: {time_reference * 1000 / args.frames:.0f} -> {time_new * 1000 / args.frames:.0f} ms/frame')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,199 @@
+'''
+Checks the spatial hash duplicate route filter of dataset_generation/filter_duplicate_routes.py against the previous
+filter, which compared every route with every kept route. A fixture of route folders with exact, near (jittered
+around min_dist) and partial duplicates is filtered by both, the kept routes and the copied files have to match.
+Then both are timed on growing sets of synthetic routes.
+Runs without a simulator, CARLA was only needed for plotting.
+Example:
+python tools/check_duplicate_route_filter.py --sizes 1000 4000 20000 100000
+'''
+
+import argparse
+import filecmp
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from dataset_generation import filter_duplicate_routes  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 20000, 100000])
+parser.add_argument('--max_reference_size', type=int, default=4000, help='The previous filter is quadratic.')
+parser.add_argument('--min_dist', type=float, default=0.2)
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous filter ##############
+def reference_filter_directory(route_dir, main_destination, min_dist):
+  destination = main_destination + '/' + route_dir.split("/")[-2]
+  Path(destination).mkdir(parents=True, exist_ok=True)
+
+  l_routes_idx = []
+  l_waypoints = []
+  for pth in glob.glob(f'{route_dir}/**/*.xml', recursive=True):
+    tree = ET.parse(pth)
+    for route_tree in tree.iter("route"):
+      waypoints = []
+      for waypoint in route_tree.find('waypoints').iter('position'):
+        waypoints.append([waypoint.attrib['x'], waypoint.attrib['y'], waypoint.attrib['z']])
+      l_waypoints.append(np.array(waypoints).astype('float'))
+      l_routes_idx.append(pth.split('/')[-1].split('.')[0])
+
+  kept = reference_filter(l_waypoints, min_dist)
+  for i in kept:
+    shutil.copy(os.path.join(route_dir, l_routes_idx[i] + '.xml'), destination)
+  return kept
+
+
+def reference_filter(l_waypoints, min_dist):
+  saved_wps = []
+  kept = []
+  for i, waypoint in enumerate(l_waypoints):
+    duplicate = False
+    for saved_route in saved_wps:
+      if np.linalg.norm(saved_route[0] - waypoint[0]) < min_dist and np.linalg.norm(saved_route[-1] - waypoint[-1]) < min_dist:
+        duplicate = True
+        break
+    if duplicate:
+      continue
+    saved_wps.append(waypoint)
+    kept.append(i)
+  return kept
+
+
+############## synthetic routes ##############
+class SyntheticRoute():
+
+  def __init__(self, waypoints, route_town='Town13'):
+    self.waypoints = waypoints
+    self.route_town = route_town
+
+
+def synthetic_waypoints(rng, num_routes, min_dist, extent=5000.0):
+  '''Routes with 3-8 waypoints, a third of them are near duplicates of earlier routes.'''
+  routes = []
+  for i in range(num_routes):
+    if i > 0 and rng.random() < 0.35:
+      waypoints = routes[rng.integers(i)].copy()
+      jitter = rng.choice([0.25, 0.5, 0.7, 1.0, 2.0]) * min_dist / np.sqrt(3)
+      waypoints[0] += rng.uniform(-jitter, jitter, 3)
+      waypoints[-1] += rng.uniform(-jitter, jitter, 3)
+      if rng.random() < 0.2:
+        # same start, different end
+        waypoints[-1] += rng.uniform(-50, 50, 3)
+    else:
+      start = rng.uniform(-extent, extent, 3) * np.array([1.0, 1.0, 0.002])
+      steps = rng.normal(0, 60, (int(rng.integers(2, 7)), 3)) * np.array([1.0, 1.0, 0.01])
+      waypoints = np.concatenate((start[None], start + np.cumsum(steps, axis=0)))
+    routes.append(waypoints)
+  return routes
+
+
+def write_route_files(route_dir, rng, waypoints, min_dist):
+  '''One or two routes per xml file, like the route files of the dataset generation.'''
+  os.makedirs(route_dir, exist_ok=True)
+  i = 0
+  file_idx = 0
+  while i < len(waypoints):
+    num_routes = min(int(rng.integers(1, 3)), len(waypoints) - i)
+    root = ET.Element('routes')
+    for route_waypoints in waypoints[i:i + num_routes]:
+      route = ET.SubElement(root, 'route', id=str(i), town='Town13')
+      positions = ET.SubElement(route, 'waypoints')
+      for x, y, z in route_waypoints:
+        ET.SubElement(positions, 'position', x=repr(float(x)), y=repr(float(y)), z=repr(float(z)))
+      scenarios = ET.SubElement(route, 'scenarios')
+      scenario = ET.SubElement(scenarios, 'scenario', name=f'Accident_{i}', type='Accident')
+      x, y, z = route_waypoints[len(route_waypoints) // 2]
+      ET.SubElement(scenario, 'trigger_point', x=repr(float(x)), y=repr(float(y)), z=repr(float(z)), yaw='0.0')
+      i += 1
+    ET.ElementTree(root).write(os.path.join(route_dir, f'{file_idx}.xml'))
+    file_idx += 1
+
+
+def check_fixture(rng, min_dist):
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    main_dir = os.path.join(tmp_dir, 'routes')
+    for name, num_routes in (('Accident', 300), ('ParkingExit', 150), ('allroutes', 20)):
+      write_route_files(f'{main_dir}/{name}', rng, synthetic_waypoints(rng, num_routes, min_dist, extent=300.0), min_dist)
+
+    num_routes = 0
+    num_kept = 0
+    for route_dir in glob.glob(main_dir + '/*/'):
+      if "allroutes" in route_dir:
+        continue
+      reference_kept = reference_filter_directory(route_dir, f'{tmp_dir}/reference', min_dist)
+      _, _, kept_routes, num_dir_routes = filter_duplicate_routes.filter_directory(route_dir, f'{tmp_dir}/filtered', min_dist, None, 32)
+      routes = filter_duplicate_routes.load_routes(route_dir)
+      assert filter_duplicate_routes.filter_routes(routes, min_dist) == reference_kept, route_dir
+      assert [route.route_idx for route in kept_routes] == [routes[i].route_idx for i in reference_kept]
+      num_routes += num_dir_routes
+      num_kept += len(reference_kept)
+
+      # a large Frechet threshold does not change the result, a threshold of 0 keeps every route
+      assert filter_duplicate_routes.filter_routes(routes, min_dist, frechet_dist=1e9) == reference_kept
+      assert filter_duplicate_routes.filter_routes(routes, min_dist, frechet_dist=0.0) == list(range(len(routes)))
+
+    # the script with parallel folders copies the same files
+    sys.argv = ['filter_duplicate_routes.py', '--main_dir', main_dir, '--destination', f'{tmp_dir}/script',
+                '--min_dist', str(min_dist), '--num_workers', '2']
+    filter_duplicate_routes.main()
+    for destination in (f'{tmp_dir}/filtered', f'{tmp_dir}/script'):
+      comparison = filecmp.dircmp(f'{tmp_dir}/reference', destination)
+      assert sorted(os.listdir(f'{tmp_dir}/reference')) == sorted(os.listdir(destination))
+      for sub_dir in comparison.common_dirs:
+        sub_comparison = comparison.subdirs[sub_dir]
+        assert not sub_comparison.left_only and not sub_comparison.right_only and not sub_comparison.diff_files, sub_dir
+  finally:
+    shutil.rmtree(tmp_dir)
+  return num_routes, num_kept
+
+
+def check_paths():
+  '''Two routes with the same start and end but a different path are only duplicates without --frechet_dist.'''
+  straight = np.array([[0.0, 0.0, 0.0], [50.0, 0.0, 0.0], [100.0, 0.0, 0.0]])
+  detour = np.array([[0.05, 0.0, 0.0], [50.0, 40.0, 0.0], [100.0, 0.05, 0.0]])
+  routes = [SyntheticRoute(straight), SyntheticRoute(detour)]
+  assert filter_duplicate_routes.filter_routes(routes, 0.2) == [0]
+  assert filter_duplicate_routes.filter_routes(routes, 0.2, frechet_dist=5.0) == [0, 1]
+  assert filter_duplicate_routes.filter_routes(routes, 0.2, frechet_dist=50.0) == [0]
+  # like the previous filter the town is ignored, the folders that are filtered together contain routes of one town
+  assert filter_duplicate_routes.filter_routes([SyntheticRoute(straight), SyntheticRoute(straight, 'Town12')], 0.2) == [0]
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  num_routes, num_kept = check_fixture(rng, args.min_dist)
+  check_paths()
+  print(f'fixture: {num_kept} of {num_routes} routes kept, identical routes and copied files')
+
+  for size in args.sizes:
+    waypoints = synthetic_waypoints(rng, size, args.min_dist)
+    routes = [SyntheticRoute(route_waypoints) for route_waypoints in waypoints]
+    start = time.perf_counter()
+    kept = filter_duplicate_routes.filter_routes(routes, args.min_dist)
+    time_filter = time.perf_counter() - start
+    start = time.perf_counter()
+    filter_duplicate_routes.filter_routes(routes, args.min_dist, frechet_dist=1.0)
+    time_frechet = time.perf_counter() - start
+    line = f'{size} routes ({len(kept)} kept): spatial hash {time_filter:.2f} s, with Frechet {time_frechet:.2f} s'
+    if size <= args.max_reference_size:
+      start = time.perf_counter()
+      assert reference_filter(waypoints, args.min_dist) == kept
+      line += f', previous {time.perf_counter() - start:.2f} s'
+    print(line)
+
+
+if __name__ == '__main__':
+  main()
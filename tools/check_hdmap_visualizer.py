@@ -0,0 +1,443 @@
+'''
+Checks the columnar HD map format (Bench2Drive/tools/columnar_hdmap.py) and the vectorized Bench2Drive visualizer
+(Bench2Drive/tools/visualize.py) against the previous pickled npz map and the per point drawing loops.
+A synthetic town is converted to the columnar format and back, saved, memory-mapped and spatially queried. Then a
+synthetic route (annotations, camera images, lidar) is rendered by the previous and the new visualizer, all frames
+have to be identical. Also renders the route with several workers into videos and reports the timings.
+Runs without a simulator.
+Example:
+python tools/check_hdmap_visualizer.py --steps 12 --num_workers 4
+'''
+
+import argparse
+import filecmp
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import laspy
+import matplotlib.cm as cm
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'Bench2Drive', 'tools'))
+import columnar_hdmap  # pylint: disable=wrong-import-position
+import visualize  # pylint: disable=wrong-import-position
+from utils import (build_projection_matrix, calculate_cube_vertices, draw_dashed_line, edges, get_forward_vector,  # pylint: disable=wrong-import-position
+                   get_image_point, get_matrix, point_in_canvas_wh, vector_angle, world_to_ego)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--steps', type=int, default=12)
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--lidar_points', type=int, default=30000)
+parser.add_argument('--seed', type=int, default=0)
+
+CAMERAS = {
+    # name: (location in ego, (pitch, roll, yaw) in ego, fov)
+    'CAM_FRONT': ((0.8, 0.0, 1.6), (0.0, 0.0, 0.0), 70),
+    'CAM_FRONT_LEFT': ((0.27, -0.55, 1.6), (0.0, 0.0, -55.0), 70),
+    'CAM_FRONT_RIGHT': ((0.27, 0.55, 1.6), (0.0, 0.0, 55.0), 70),
+    'CAM_BACK': ((-2.0, 0.0, 1.6), (0.0, 0.0, 180.0), 110),
+    'CAM_BACK_LEFT': ((-0.32, -0.55, 1.6), (0.0, 0.0, -110.0), 70),
+    'CAM_BACK_RIGHT': ((-0.32, 0.55, 1.6), (0.0, 0.0, 110.0), 70),
+    'TOP_DOWN': ((0.0, 0.0, 50.0), (-90.0, 0.0, 0.0), 110),
+}
+
+
+############## previous visualizer ##############
+def reference_draw_lanes(img, lanes, K, world2cam):
+  for r_p in lanes:
+    road_type = r_p['Type']
+    road_color = r_p['Color']
+    for point in r_p['Points']:
+      point = np.array([point[0][0], point[0][1], point[0][2], 1])
+      point_camera = np.dot(world2cam, point)
+      point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
+      depth = point_camera[2]
+      point_img = np.dot(K, point_camera)
+      if depth > 0:
+        point_img[0] /= point_img[2]
+        point_img[1] /= point_img[2]
+        point_img = point_img[0:2]
+        if point_in_canvas_wh(point_img):
+          if road_color == 'White':
+            cv2.circle(img, (int(point_img[0]), int(point_img[1])), radius=1, color=(255, 255, 255), thickness=-1)
+            if road_type == 'Center':
+              cv2.circle(img, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 0), thickness=-1)
+          else:
+            cv2.circle(img, (int(point_img[0]), int(point_img[1])), radius=1, color=(0, 255, 255), thickness=-1)
+
+
+def reference_visualize_data(file_path, map_path):
+  save_path = file_path.replace('v0', 'v0-vis')
+  for view, (folder, _) in visualize.VIEWS.items():
+    os.makedirs(os.path.join(save_path, folder), exist_ok=True)
+  cam_map = visualize.cam_map
+  file_count = len(os.listdir(os.path.join(file_path, 'anno')))
+  map_info = dict(np.load(map_path, allow_pickle=True)['arr'])
+
+  for step in range(file_count):
+    with gzip.open(os.path.join(file_path, f'anno/{step:05}.json.gz'), 'rt', encoding='utf-8') as gz_file:
+      anno = json.load(gz_file)
+    bounding_boxes = anno['bounding_boxes']
+    sensors_anno = anno['sensors']
+    for key in ['CAM_FRONT', 'CAM_FRONT_LEFT', 'CAM_FRONT_RIGHT', 'CAM_BACK', 'CAM_BACK_LEFT', 'CAM_BACK_RIGHT']:
+      K = sensors_anno[key]['intrinsic']
+      world2cam = sensors_anno[key]['world2cam']
+      visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
+      for npc in bounding_boxes:
+        if npc['class'] == 'ego_vehicle': continue
+        if npc['distance'] > 75: continue
+        if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue
+        if 'vehicle' in npc['class']:
+          forward_vec = get_forward_vector(sensors_anno[key]['rotation'][2])
+          ray = np.array(npc['location']) - np.array(sensors_anno[key]['location'])
+          color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+          if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray) < 45:
+            verts = np.array(npc['world_cord'])
+            for edge in edges:
+              p1, _ = get_image_point(verts[edge[0]], K, world2cam)
+              p2, _ = get_image_point(verts[edge[1]], K, world2cam)
+              draw_dashed_line(visulize_img, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), color, 2)
+            cv2.putText(visulize_img, npc['class'] + npc['id'], (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+        else:
+          if npc['class'] == 'traffic_sign':
+            npc['extent'][1] = 0.5
+          forward_vec = get_forward_vector(sensors_anno[key]['rotation'][2])
+          ray = np.array(npc['location']) - np.array(sensors_anno[key]['location'])
+          if 'affects_ego' in npc.keys() and str(npc['affects_ego']) == 'True':
+            color = (0, 0, 255)
+          else:
+            color = (255, 255, 255)
+          if forward_vec.dot(ray) > 1 and vector_angle(forward_vec, ray) < 45:
+            if 'world_cord' in npc.keys():
+              if 'dirtdebris' in npc['type_id']:
+                local_verts = calculate_cube_vertices(npc['bbx_loc'], [npc['extent'][1], npc['extent'][0], npc['extent'][2]])
+                verts = []
+                for l_v in local_verts:
+                  g_v = np.dot(np.matrix(npc['world2sign']).I, [l_v[0], l_v[1], l_v[2], 1])
+                  verts.append(g_v.tolist()[0][:-1])
+              else:
+                verts = np.array(npc['world_cord'])
+            else:
+              verts = calculate_cube_vertices(npc['center'], npc['extent'])
+            for edge in edges:
+              p1, _ = get_image_point(verts[edge[0]], K, world2cam)
+              p2, _ = get_image_point(verts[edge[1]], K, world2cam)
+              draw_dashed_line(visulize_img, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), color, 2)
+            cv2.putText(visulize_img, npc['class'], (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+      cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_3d_bbox/{step:05}.jpg'), visulize_img)
+
+    key = 'TOP_DOWN'
+    K = sensors_anno[key]['intrinsic']
+    world2cam = sensors_anno[key]['world2cam']
+    visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
+    road_points = map_info[anno['bounding_boxes'][0]['road_id']]
+    reference_draw_lanes(visulize_img, road_points[anno['bounding_boxes'][0]['lane_id']], K, world2cam)
+    for npc in bounding_boxes:
+      if 'vehicle' in npc['class']:
+        if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue
+        if npc['class'] == 'ego_vehicle':
+          color = (255, 255, 255, 255)
+        else:
+          color = (255, 0, 0, 255)
+        verts = np.array(npc['world_cord'])
+        p1, _ = get_image_point(verts[0], K, world2cam)
+        p2, _ = get_image_point(verts[2], K, world2cam)
+        p3, _ = get_image_point(verts[4], K, world2cam)
+        p4, _ = get_image_point(verts[6], K, world2cam)
+        points = np.array([p1, p2, p4, p3])
+        height, width = visulize_img.shape[:2]
+        blk = np.zeros((height, width, 4), np.uint8)
+        cv2.fillConvexPoly(blk, np.round(points).astype(np.int32), color)
+        if npc['class'] == 'ego_vehicle':
+          visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:, :, :3], 1, 1)
+          cv2.putText(visulize_img, npc['class'], (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0, 0, 0), 1)
+        else:
+          visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:, :, :3], 0.25, 1)
+          cv2.putText(visulize_img, npc['class'], (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+    for npc in bounding_boxes:
+      if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue
+      if 'traffic_sign' in npc['class']:
+        color = (0, 0, 255, 255)
+        if 'world_cord' in npc.keys():
+          verts = np.array(npc['world_cord'])
+        else:
+          verts = calculate_cube_vertices(npc['center'], npc['extent'])
+        p1, _ = get_image_point(verts[0], K, world2cam)
+        p2, _ = get_image_point(verts[2], K, world2cam)
+        p3, _ = get_image_point(verts[4], K, world2cam)
+        p4, _ = get_image_point(verts[6], K, world2cam)
+        points = np.array([p1, p2, p4, p3])
+        height, width = visulize_img.shape[:2]
+        blk = np.zeros((height, width, 4), np.uint8)
+        cv2.fillConvexPoly(blk, np.round(points).astype(np.int32), color)
+        visulize_img = cv2.addWeighted(visulize_img, 1.0, blk[:, :, :3], 0.25, 1)
+        cv2.putText(visulize_img, npc['class'], (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+      if 'traffic_light' in npc['class']:
+        color = (255, 0, 0)
+        verts = calculate_cube_vertices(npc['center'], npc['extent'])
+        for edge in edges:
+          p1, _ = get_image_point(verts[edge[0]], K, world2cam)
+          p2, _ = get_image_point(verts[edge[1]], K, world2cam)
+          cv2.line(visulize_img, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), color, 2)
+        cv2.putText(visulize_img, 'traffic_light', (int(p1[0]) + 2, int(p1[1]) + 2), cv2.FONT_HERSHEY_COMPLEX, 0.5, color, 1)
+    cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_3d_bbox/{step:05}.jpg'), visulize_img)
+
+    key = 'CAM_FRONT'
+    K = sensors_anno[key]['intrinsic']
+    world2cam = sensors_anno[key]['world2cam']
+    road_points = map_info[anno['bounding_boxes'][0]['road_id']]
+    road_seg = np.zeros((900, 1600, 3), dtype=np.uint8)
+    all_road_topology = set()
+    for r_p in road_points[anno['bounding_boxes'][0]['lane_id']]:
+      for r_t in r_p['Topology']:
+        all_road_topology.add(r_t)
+    reference_draw_lanes(road_seg, road_points[anno['bounding_boxes'][0]['lane_id']], K, world2cam)
+    for r_t in all_road_topology:
+      reference_draw_lanes(road_seg, map_info[r_t[0]][r_t[1]], K, world2cam)
+    cv2.imwrite(os.path.join(save_path, f'camera/{cam_map[key]}_landmark/{step:05}.png'), road_seg)
+
+    lidars = laspy.read(os.path.join(file_path, f'lidar/{step:05}.laz')).xyz
+    lidar_image = np.zeros((900, 1600, 3), dtype=np.uint8)
+    header = laspy.LasHeader(point_format=0)
+    header.offsets = np.min(lidars, axis=0)
+    header.scales = np.array([0.001, 0.001, 0.001])
+    point_record = laspy.ScaleAwarePointRecord.zeros(lidars.shape[0], header=header)
+    point_record.x = lidars[:, 1]
+    point_record.y = - lidars[:, 0]
+    point_record.z = lidars[:, 2]
+    range_x = range_y = 85.0
+    x_pixels = (point_record.x + range_x) / (2 * range_x) * (lidar_image.shape[1] - 1)
+    y_pixels = (point_record.y + range_y) / (2 * range_y) * (lidar_image.shape[0] - 1)
+    for x, y in zip(x_pixels, y_pixels):
+      cv2.circle(lidar_image, (int(x), int(y)), radius=2, color=(255, 255, 255), thickness=-1)
+    for npc in bounding_boxes:
+      if npc['class'] not in ['vehicle', 'ego_vehicle']: continue
+      if abs(npc['location'][2] - anno['bounding_boxes'][0]['location'][2]) > 10: continue
+      verts = np.array(npc['world_cord'])
+      color = (0, 255, 0) if npc['class'] == 'ego_vehicle' else (0, 128, 255)
+      for edge in edges:
+        p1 = world_to_ego(verts[edge[0]], anno['bounding_boxes'][0]['world2ego'])
+        p1_x = (p1[0] + range_x) / (2 * range_x) * (lidar_image.shape[1] - 1)
+        p1_y = (p1[1] + range_y) / (2 * range_y) * (lidar_image.shape[0] - 1)
+        p2 = world_to_ego(verts[edge[1]], anno['bounding_boxes'][0]['world2ego'])
+        p2_x = (p2[0] + range_x) / (2 * range_x) * (lidar_image.shape[1] - 1)
+        p2_y = (p2[1] + range_y) / (2 * range_y) * (lidar_image.shape[0] - 1)
+        cv2.line(lidar_image, (int(p1_x), int(p1_y)), (int(p2_x), int(p2_y)), color, 2)
+    cv2.imwrite(os.path.join(save_path, f'lidar/bev/{step:05}.png'), lidar_image)
+
+    for key, name in (('CAM_FRONT', 'front'), ('CAM_BACK', 'back'), ('CAM_FRONT_LEFT', 'front_left')):
+      K = sensors_anno[key]['intrinsic']
+      visulize_img = cv2.imread(os.path.join(file_path, f'camera/{cam_map[key]}/{step:05}.jpg'))
+      ego2cam = np.matrix(sensors_anno[key]['cam2ego']).I.tolist()
+      for lidar in laspy.read(os.path.join(file_path, f'lidar/{step:05}.laz')).xyz:
+        lidar = np.array([lidar[0], lidar[1], lidar[2], 1])
+        point_camera = np.dot(ego2cam, lidar)
+        point_camera = [point_camera[1], -point_camera[2], point_camera[0]]
+        depth = point_camera[2]
+        point_img = np.dot(K, point_camera)
+        if depth > 0:
+          point_img[0] /= point_img[2]
+          point_img[1] /= point_img[2]
+          point_img = point_img[0:2]
+          if point_in_canvas_wh(point_img):
+            color = cm.rainbow(min(depth / 80, 1))
+            color = tuple([int(x * 255) for x in color[:3]])
+            cv2.circle(visulize_img, (int(point_img[0]), int(point_img[1])), radius=2, color=color, thickness=-1)
+      cv2.imwrite(os.path.join(save_path, f'lidar/{name}/{step:05}_{name}.png'), visulize_img)
+
+
+############## synthetic town and route ##############
+def synthetic_lane_marking_dict(rng, num_roads=10, length=200.0, spacing=0.25):
+  '''Parallel roads along x like gen_hdmap.py stores them, road 9 has a lane without successor.'''
+  lane_marking_dict = {}
+  xs = np.arange(-50.0, length - 50.0, spacing)
+  for road_id in range(num_roads):
+    lane_marking_dict[road_id] = {}
+    for lane_id in (-2, -1, 1, 2):
+      y = road_id * 16.0 + lane_id * 3.5
+      z = rng.uniform(-0.2, 0.2)
+      yaw = 0.0 if lane_id < 0 else 180.0
+
+      def points(offset, junction=None):
+        result = []
+        for i, x in enumerate(xs):
+          point = ((float(x), float(y + offset), float(z)), (0.0, 0.0, yaw))
+          result.append(point if junction is None else point + (bool(junction[i]),))
+        return result
+
+      topology = [(road_id + 1, lane_id), (road_id + 2, -lane_id)] if road_id + 2 < num_roads else [None]
+      junction = xs > 100.0
+      lane_marking_dict[road_id][lane_id] = [
+          {'Points': points(0.0, junction), 'Type': 'Center', 'Color': 'White', 'Topology': topology[:],
+           'TopologyType': 'Junction' if lane_id == 2 else 'Normal',
+           'Left': (road_id, lane_id - 1) if lane_id != -2 else (None, None), 'Right': (road_id, lane_id + 1)},
+          {'Points': points(-1.75), 'Type': 'Broken', 'Color': 'White', 'Topology': topology[:]},
+          {'Points': points(1.75), 'Type': 'Solid', 'Color': 'Yellow' if lane_id == 1 else 'White', 'Topology': topology[:]},
+      ]
+    if road_id % 3 == 0:
+      corners = [[float(c) for c in rng.uniform(-5, 5, 3) + [20.0, road_id * 16.0, 0.0]] for _ in range(4)]
+      lane_marking_dict[road_id]['Trigger_Volumes'] = [
+          {'Points': corners, 'Type': 'StopSign' if road_id % 2 else 'TrafficLight', 'ParentActor_Location': [20.0, road_id * 16.0 + 5.0, 0.0]}]
+  return lane_marking_dict
+
+
+def box_corners(location, extent, yaw):
+  corners = np.array(calculate_cube_vertices([0.0, 0.0, 0.0], list(extent)))
+  c, s = np.cos(np.radians(yaw)), np.sin(np.radians(yaw))
+  rotation = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+  return (corners @ rotation.T + np.asarray(location)).tolist()
+
+
+def write_route(route_dir, rng, num_steps, num_lidar_points):
+  for folder in ['anno', 'lidar'] + [f'camera/{name}' for name in visualize.cam_map.values()]:
+    os.makedirs(os.path.join(route_dir, folder), exist_ok=True)
+  for step in range(num_steps):
+    ego_location = np.array([10.0 + 2.0 * step, 16.0 - 3.5 + 0.1 * step, 0.0])
+    ego_yaw = 5.0 * step - 20.0
+    ego2world = np.asarray(get_matrix(ego_location, (0.0, 0.0, ego_yaw)))
+    sensors = {}
+    for key, (location, rotation, fov) in CAMERAS.items():
+      cam2ego = np.asarray(get_matrix(location, rotation))
+      cam2world = ego2world @ cam2ego
+      sensors[key] = {'intrinsic': build_projection_matrix(1600, 900, fov).tolist(), 'world2cam': np.linalg.inv(cam2world).tolist(),
+                      'cam2ego': cam2ego.tolist(), 'location': cam2world[:3, 3].tolist(),
+                      'rotation': [0.0, rotation[0], ego_yaw + rotation[2]]}
+      image = cv2.GaussianBlur(rng.integers(0, 256, (900, 1600, 3), dtype=np.uint8), (9, 9), 0)
+      cv2.imwrite(os.path.join(route_dir, f'camera/{visualize.cam_map[key]}/{step:05}.jpg'), image)
+
+    ego = {'class': 'ego_vehicle', 'id': '0', 'type_id': 'vehicle.lincoln.mkz_2020', 'location': ego_location.tolist(),
+           'extent': [2.4, 1.0, 0.75], 'distance': 0.0, 'road_id': 1 + step % 3, 'lane_id': [-1, -2, 1][step % 3],
+           'world2ego': np.linalg.inv(ego2world).tolist()}
+    ego['world_cord'] = box_corners(ego_location + [0.0, 0.0, 0.75], ego['extent'], ego_yaw)
+    bounding_boxes = [ego]
+    for i in range(40):
+      location = ego_location + np.append(rng.uniform(-60, 60, 2), rng.choice([0.0, 0.0, 0.0, 15.0]))
+      distance = float(np.linalg.norm(location - ego_location))
+      npc_class = rng.choice(['vehicle', 'vehicle', 'walker', 'traffic_sign', 'traffic_light'])
+      extent = [float(v) for v in rng.uniform(0.3, 2.5, 3)]
+      npc = {'class': str(npc_class), 'id': str(i + 1), 'location': location.tolist(), 'extent': extent, 'distance': distance,
+             'center': (location + [0.0, 0.0, extent[2]]).tolist(), 'type_id': f'{npc_class}.synthetic'}
+      if npc_class in ('vehicle', 'walker') or (npc_class == 'traffic_sign' and rng.random() < 0.7):
+        npc['world_cord'] = box_corners(location + [0.0, 0.0, extent[2]], extent, rng.uniform(-180, 180))
+      if npc_class == 'traffic_sign' and 'world_cord' in npc and rng.random() < 0.4:
+        npc['type_id'] = 'static.prop.dirtdebris01'
+        npc['bbx_loc'] = [0.0, 0.0, 0.2]
+        npc['world2sign'] = np.linalg.inv(get_matrix(location, (0.0, 0.0, rng.uniform(-180, 180)))).tolist()
+      if npc_class in ('traffic_sign', 'traffic_light'):
+        npc['affects_ego'] = bool(rng.random() < 0.5)
+      bounding_boxes.append(npc)
+    anno = {'weather': {'cloudiness': 5.0}, 'bounding_boxes': bounding_boxes, 'sensors': sensors}
+    with gzip.open(os.path.join(route_dir, f'anno/{step:05}.json.gz'), 'wt', encoding='utf-8') as f:
+      json.dump(anno, f)
+
+    lidars = np.concatenate((rng.uniform(-70, 70, (num_lidar_points, 2)), rng.uniform(-2.5, 5.0, (num_lidar_points, 1))), axis=1)
+    header = laspy.LasHeader(point_format=0)
+    header.offsets = np.min(lidars, axis=0)
+    header.scales = np.array([0.001, 0.001, 0.001])
+    las = laspy.LasData(header)
+    las.x, las.y, las.z = lidars[:, 0], lidars[:, 1], lidars[:, 2]
+    las.write(os.path.join(route_dir, f'lidar/{step:05}.laz'))
+
+
+############## checks ##############
+def check_map(rng, tmp_dir, lane_marking_dict):
+  hd_map = columnar_hdmap.ColumnarHDMap.from_lane_marking_dict(lane_marking_dict)
+  assert hd_map.to_lane_marking_dict() == lane_marking_dict
+
+  npz_path = os.path.join(tmp_dir, 'maps', 'Town99_HD_map.npz')
+  os.makedirs(os.path.dirname(npz_path))
+  np.savez_compressed(npz_path, arr=np.array(list(lane_marking_dict.items()), dtype=object))
+  sys.argv = ['columnar_hdmap.py', '--npz', npz_path]
+  columnar_hdmap.main()
+  loaded = columnar_hdmap.ColumnarHDMap(columnar_hdmap.columnar_map_dir(npz_path))
+  assert isinstance(loaded.points, np.memmap)
+  assert loaded.to_lane_marking_dict() == lane_marking_dict
+
+  # spatial query against all points
+  for _ in range(50):
+    x, y = rng.uniform(-60, 160), rng.uniform(-20, 160)
+    radius = rng.uniform(0.5, 20)
+    expected = [element for element in range(len(loaded)) if
+                (np.hypot(loaded.element_points(element)[:, 0] - x, loaded.element_points(element)[:, 1] - y) <= radius).any()]
+    assert loaded.elements_near(x, y, radius).tolist() == expected
+  assert loaded.lane_elements(99, 1).tolist() == []
+
+  start = time.perf_counter()
+  dict(np.load(npz_path, allow_pickle=True)['arr'])
+  time_npz = time.perf_counter() - start
+  start = time.perf_counter()
+  columnar_hdmap.ColumnarHDMap(columnar_hdmap.columnar_map_dir(npz_path))
+  time_columnar = time.perf_counter() - start
+  print(f'map: {len(loaded)} elements, {len(loaded.points)} points, roundtrip and spatial queries identical, '
+        f'load npz {time_npz:.3f} s, columnar {time_columnar:.4f} s')
+  return npz_path
+
+
+def compare_dirs(reference_dir, new_dir, views):
+  differences = []
+  for view in views:
+    folder = visualize.VIEWS[view][0]
+    files = sorted(os.listdir(os.path.join(reference_dir, folder)))
+    assert files == sorted(file for file in os.listdir(os.path.join(new_dir, folder)) if not file.endswith('.mp4')), view
+    for file in files:
+      if not filecmp.cmp(os.path.join(reference_dir, folder, file), os.path.join(new_dir, folder, file), shallow=False):
+        reference = cv2.imread(os.path.join(reference_dir, folder, file))
+        new = cv2.imread(os.path.join(new_dir, folder, file))
+        differences.append(f'{folder}/{file}: {int((reference != new).any(axis=2).sum())} pixels')
+  return differences
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    npz_path = check_map(rng, tmp_dir, synthetic_lane_marking_dict(rng))
+    route_dir = os.path.join(tmp_dir, 'v0', 'Accident_Town99_Route0_Weather0')
+    write_route(route_dir, rng, args.steps, args.lidar_points)
+    vis_dir = route_dir.replace('v0', 'v0-vis')
+    all_views = list(visualize.VIEWS.keys())
+
+    random.seed(args.seed)
+    start = time.perf_counter()
+    reference_visualize_data(route_dir, npz_path)
+    time_reference = time.perf_counter() - start
+    reference_dir = os.path.join(tmp_dir, 'reference')
+    shutil.move(vis_dir, reference_dir)
+
+    random.seed(args.seed)
+    start = time.perf_counter()
+    visualize.visualize_data(route_dir, npz_path)
+    time_new = time.perf_counter() - start
+    differences = compare_dirs(reference_dir, vis_dir, all_views)
+    assert not differences, differences
+    print(f'{args.steps} steps, all {len(all_views)} views identical: previous {time_reference / args.steps:.2f} s per step, '
+          f'vectorized {time_new / args.steps:.2f} s per step')
+
+    # parallel with videos, the random box colors differ between the workers
+    shutil.rmtree(vis_dir)
+    start = time.perf_counter()
+    visualize.visualize_data(route_dir, npz_path, num_workers=args.num_workers, video_views=['rgb_top_down_3d_bbox', 'lidar_front'])
+    time_parallel = time.perf_counter() - start
+    deterministic_views = [view for view in all_views if view == 'rgb_top_down_3d_bbox' or not view.endswith('_3d_bbox')]
+    differences = compare_dirs(reference_dir, vis_dir, deterministic_views)
+    assert not differences, differences
+    for view in ('rgb_top_down_3d_bbox', 'lidar_front'):
+      video = cv2.VideoCapture(os.path.join(vis_dir, f'{view}.mp4'))
+      assert int(video.get(cv2.CAP_PROP_FRAME_COUNT)) == args.steps, view
+      video.release()
+    print(f'{args.num_workers} workers with 2 videos: {time_parallel / args.steps:.2f} s per step')
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  main()
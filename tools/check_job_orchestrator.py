@@ -0,0 +1,284 @@
+'''
+Checks the job orchestrator (job_orchestrator.py) of start_eval_simlingo.py and collect_dataset_slurm.py with short
+synthetic jobs instead of CARLA routes. The jobs write leaderboard result files, some of them crash once (exit code,
+crash message in the log while hanging), linger after writing their result or always fail. They are run with the
+local backend and with the Slurm backend against small fake sbatch/squeue/sacct/scancel commands, the orchestrator is
+restarted in between. Every job has to end in the expected state with the expected number of attempts and no more
+than max_jobs jobs may work at the same time. Also runs the same jobs with the previous polling loop (one submission
+per round, fixed sleeps) and reports the makespans.
+Example:
+python tools/check_job_orchestrator.py --jobs 24 --max_jobs 4
+'''
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import job_orchestrator  # pylint: disable=wrong-import-position
+from job_orchestrator import LocalBackend, Orchestrator, SlurmBackend  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--jobs', type=int, default=24)
+parser.add_argument('--max_jobs', type=int, default=4)
+parser.add_argument('--duration', type=float, default=0.5, help='Seconds a job works on its route.')
+parser.add_argument('--reference_sleep', type=float, default=1.0,
+                    help='Sleep of the previous loop after every round (10 s in start_eval_simlingo.py).')
+parser.add_argument('--job', nargs=4, default=None, help=argparse.SUPPRESS)
+
+# kind of every job, in turns
+KINDS = ['ok', 'ok', 'teardown', 'crash_once', 'ok', 'hang_once', 'ok', 'failed']
+MAX_TRIES = 2
+EXPECTED = {
+    # kind: (state, attempts)
+    'ok': ('done', 1),
+    'teardown': ('done', 1),
+    'crash_once': ('done', 2),
+    'hang_once': ('done', 2),
+    'failed': ('failed', MAX_TRIES),
+}
+
+FAKE_SLURM = {
+    # a job id is the pid of a session that runs the job file and stores its exit code
+    'sbatch': '''#!/bin/bash
+job_file="${@: -1}"
+log=$(grep -m1 '^#SBATCH -o' "$job_file" | cut -d' ' -f3)
+err=$(grep -m1 '^#SBATCH -e' "$job_file" | cut -d' ' -f3)
+setsid bash -c "bash '$job_file' > '$log' 2> '$err'; echo \\$? > '$FAKE_SLURM_DIR'/\\$\\$.exit" < /dev/null > /dev/null 2>&1 &
+touch "$FAKE_SLURM_DIR/$!.job"
+echo "$!"
+''',
+    'squeue': '''#!/bin/bash
+for f in "$FAKE_SLURM_DIR"/*.job; do
+  [ -e "$f" ] || continue
+  id=$(basename "$f" .job)
+  if [ ! -e "$FAKE_SLURM_DIR/$id.exit" ] && [ -e /proc/$id ] && ! grep -q ') Z' /proc/$id/stat; then
+    echo "$id"
+  fi
+done
+''',
+    'sacct': '''#!/bin/bash
+for id in $(echo "${@: -1}" | tr ',' ' '); do
+  [ -e "$FAKE_SLURM_DIR/$id.exit" ] && echo "$id|$(cat "$FAKE_SLURM_DIR/$id.exit"):0"
+done
+true
+''',
+    'scancel': '''#!/bin/bash
+kill -TERM -- -"$1" 2> /dev/null
+echo 143 > "$FAKE_SLURM_DIR/$1.exit"
+true
+''',
+}
+
+
+############## synthetic jobs ##############
+def write_result(result_file, status):
+  record = {'route_id': 'RouteScenario_0_rep0', 'status': status, 'scores': {'score_route': 100.0}}
+  with open(result_file, 'w', encoding='utf-8') as f:
+    json.dump({'_checkpoint': {'progress': [1, 1], 'records': [record]}}, f)
+
+
+def run_job(kind, result_file, timeline, duration):
+  '''Body of a synthetic job, called by its job file.'''
+  attempt = sum(1 for _ in open(timeline, encoding='utf-8')) // 2 + 1 if os.path.exists(timeline) else 1
+  with open(timeline, 'a', encoding='utf-8') as f:
+    f.write(f'start {time.time()}\n')
+  time.sleep(duration)
+  if kind == 'crash_once' and attempt == 1:
+    with open(timeline, 'a', encoding='utf-8') as f:
+      f.write(f'end {time.time()}\n')
+    sys.exit(1)
+  if kind == 'hang_once' and attempt == 1:
+    with open(timeline, 'a', encoding='utf-8') as f:
+      f.write(f'end {time.time()}\n')
+    print('Watchdog exception - Timeout of 600.0 seconds occured', flush=True)
+    time.sleep(120)
+  with open(timeline, 'a', encoding='utf-8') as f:
+    f.write(f'end {time.time()}\n')
+  write_result(result_file, 'Failed - Agent crashed' if kind == 'failed' else 'Completed')
+  if kind == 'teardown':
+    time.sleep(3 * duration)
+
+
+def make_jobs(run_dir, num_jobs, duration):
+  jobs = []
+  for i in range(num_jobs):
+    kind = KINDS[i % len(KINDS)]
+    name = f'route_{i:03d}_{kind}'
+    job = {'name': name, 'kind': kind,
+           'job_file': os.path.join(run_dir, 'run', f'{name}.sh'),
+           'result_file': os.path.join(run_dir, 'res', f'{name}_res.json'),
+           'log_file': os.path.join(run_dir, 'out', f'{name}_out.log'),
+           'err_file': os.path.join(run_dir, 'err', f'{name}_err.log'),
+           'timeline': os.path.join(run_dir, 'timeline', f'{name}.txt')}
+    for key in ('job_file', 'result_file', 'log_file', 'err_file', 'timeline'):
+      os.makedirs(os.path.dirname(job[key]), exist_ok=True)
+    with open(job['job_file'], 'w', encoding='utf-8') as f:
+      f.write(f'''#!/bin/bash
+#SBATCH --job-name={name}
+#SBATCH -o {job['log_file']}
+#SBATCH -e {job['err_file']}
+{sys.executable} -u {os.path.abspath(__file__)} --job {kind} {job['result_file']} {job['timeline']} {duration}
+''')
+    jobs.append(job)
+  return jobs
+
+
+def work_intervals(jobs):
+  '''(start, end) of every attempt, without the teardown after the result.'''
+  intervals = []
+  for job in jobs:
+    if not os.path.exists(job['timeline']):
+      continue
+    with open(job['timeline'], encoding='utf-8') as f:
+      events = [line.split() for line in f]
+    starts = [float(t) for event, t in events if event == 'start']
+    ends = [float(t) for event, t in events if event == 'end']
+    intervals += list(zip(starts, ends + [float('inf')] * (len(starts) - len(ends))))
+  return intervals
+
+
+def max_parallel(intervals):
+  events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals], key=lambda e: (e[0], e[1]))
+  parallel = maximum = 0
+  for _, change in events:
+    parallel += change
+    maximum = max(maximum, parallel)
+  return maximum
+
+
+############## previous polling loop ##############
+def reference_run(jobs, max_jobs, sleep, tries):
+  '''The loop of start_eval_simlingo.py: one submission per round, the running jobs are polled after fixed sleeps.'''
+  queue = [dict(job, tries=tries) for job in jobs]
+  processes = {}
+  while queue:
+    # filter_completed
+    remaining = []
+    for job in queue:
+      if job['name'] in processes and processes[job['name']].poll() is None:
+        remaining.append(job)
+        continue
+      if job_orchestrator.result_status(job['result_file']) != 'complete' and job['tries'] > 0:
+        remaining.append(job)
+    queue = remaining
+    # kill_dead_jobs
+    for job in queue:
+      if job['name'] in processes and processes[job['name']].poll() is None and os.path.exists(job['log_file']):
+        with open(job['log_file'], encoding='utf-8') as f:
+          if 'Watchdog exception' in f.read():
+            os.killpg(processes[job['name']].pid, signal.SIGKILL)
+            processes[job['name']].wait()
+    running = [name for name, process in processes.items() if process.poll() is None]
+    if len(running) >= max_jobs:
+      time.sleep(sleep / 2)
+      continue
+    for job in queue:
+      if job['tries'] <= 0 or job['name'] in running:
+        continue
+      with open(job['log_file'], 'wb') as log, open(job['err_file'], 'wb') as err:
+        processes[job['name']] = subprocess.Popen(['bash', job['job_file']], stdout=log, stderr=err, start_new_session=True)
+      job['tries'] -= 1
+      break
+    time.sleep(sleep)
+  for process in processes.values():
+    process.wait()
+
+
+############## checks ##############
+def check_journal(orchestrator, jobs):
+  states = {job['name']: job for job in orchestrator.journal.jobs()}
+  for job in jobs:
+    expected_state, expected_attempts = EXPECTED[job['kind']]
+    assert states[job['name']]['state'] == expected_state, (job['name'], states[job['name']])
+    assert states[job['name']]['attempts'] == expected_attempts, (job['name'], states[job['name']])
+  assert max_parallel(work_intervals(jobs)) <= orchestrator.max_jobs()
+
+
+def check_backend(tmp_dir, name, backend, args, restart_after=None):
+  run_dir = os.path.join(tmp_dir, name)
+  jobs = make_jobs(run_dir, args.jobs, args.duration)
+  journal = os.path.join(run_dir, 'jobs.sqlite')
+
+  def orchestrator_of(backend):
+    orchestrator = Orchestrator(journal, backend, max_jobs=args.max_jobs, backoff=0.2, poll_interval=0.05)
+    for job in jobs:
+      orchestrator.add(job['name'], job['job_file'], job['result_file'], job['log_file'], job['err_file'], MAX_TRIES)
+    return orchestrator
+
+  start = time.time()
+  orchestrator = orchestrator_of(backend)
+  if restart_after is not None:
+    # stop the orchestrator while jobs are running and continue with a new one and a new backend
+    while orchestrator.journal.counts().get('done', 0) < restart_after:
+      orchestrator.step()
+      time.sleep(orchestrator.poll_interval)
+    orchestrator.journal.connection.close()
+    orchestrator = orchestrator_of(type(backend)() if isinstance(backend, LocalBackend) else backend)
+  orchestrator.run()
+  makespan = time.time() - start
+  check_journal(orchestrator, jobs)
+
+  # a restart after everything is done submits nothing
+  submissions = len(orchestrator.journal.attempts())
+  orchestrator_of(backend).run()
+  assert len(orchestrator.journal.attempts()) == submissions
+  return makespan
+
+
+def check_slurm(tmp_dir, args):
+  bin_dir = os.path.join(tmp_dir, 'fake_slurm_bin')
+  state_dir = os.path.join(tmp_dir, 'fake_slurm_state')
+  os.makedirs(bin_dir)
+  os.makedirs(state_dir)
+  for command, script in FAKE_SLURM.items():
+    path = os.path.join(bin_dir, command)
+    with open(path, 'w', encoding='utf-8') as f:
+      f.write(script)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+  os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+  os.environ['FAKE_SLURM_DIR'] = state_dir
+  makespan = check_backend(tmp_dir, 'slurm', SlurmBackend(poll_interval=0.5), args)
+  # the exit code of the crashed attempts comes from sacct
+  exit_codes = [attempt['exit_code'] for attempt in job_orchestrator.JobJournal(os.path.join(tmp_dir, 'slurm', 'jobs.sqlite')).attempts()]
+  assert 1 in exit_codes, exit_codes
+  return makespan
+
+
+def main():
+  args = parser.parse_args()
+  if args.job is not None:
+    kind, result_file, timeline, duration = args.job
+    run_job(kind, result_file, timeline, float(duration))
+    return
+
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    makespan = check_backend(tmp_dir, 'local', LocalBackend(), args, restart_after=args.jobs // 3)
+    print(f'local backend, restarted once: {args.jobs} jobs in {makespan:.1f} s')
+    makespan = check_slurm(tmp_dir, args)
+    print(f'slurm backend (fake commands, squeue every 0.5 s): {args.jobs} jobs in {makespan:.1f} s')
+
+    run_dir = os.path.join(tmp_dir, 'reference')
+    jobs = make_jobs(run_dir, args.jobs, args.duration)
+    start = time.time()
+    reference_run(jobs, args.max_jobs, args.reference_sleep, MAX_TRIES)
+    print(f'previous loop with {args.reference_sleep} s sleeps: {args.jobs} jobs in {time.time() - start:.1f} s')
+  finally:
+    # jobs that hang are killed with their session
+    for path in glob.glob(os.path.join(tmp_dir, 'fake_slurm_state', '*.job')):
+      subprocess.run(['kill', '-KILL', '--', '-' + os.path.basename(path)[:-4]], capture_output=True, check=False)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
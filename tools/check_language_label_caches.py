@@ -0,0 +1,310 @@
+'''
+Checks that the route level caches of the language label generators do not change the labels: results.json.gz, the
+route numbers and the scenarios of the route file (lru caches in dataset_generation/language_labels/utils.py) and the
+measurements that neighbouring frames share (COMsGenerator.load_measurement). The commentary generator labels
+synthetic routes once with the caches and once with every cache bypassed, the commentary files, stats.json and the
+failed paths have to be identical. The VQA generator (drivelm/carla_vqa_generator.py) uses the same route caches of
+utils.py but imports carla, so it is not run here.
+Example:
+python tools/check_language_label_caches.py --routes 6 --frames 40
+'''
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, ROOT)
+
+from dataset_generation.language_labels import utils as label_utils  # pylint: disable=wrong-import-position
+from dataset_generation.language_labels.commentary import carla_commentary_generator  # pylint: disable=wrong-import-position
+from dataset_generation.language_labels.generator_driver import run_generator  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--routes', type=int, default=6, help='Synthetic routes, the last one failed by the expert.')
+parser.add_argument('--frames', type=int, default=40, help='Frames per route.')
+parser.add_argument('--seed', type=int, default=0)
+
+CACHED_FUNCTIONS = ('load_route_scenarios', 'get_route_numbers', 'load_route_results')
+ROUTE_FOLDER = 'training_1_scenario/routes_training/random_weather_seed_1_balanced_150'
+SCENARIO_TYPES = ('Accident', 'ConstructionObstacleTwoWays', 'InvadingTurn', 'HazardAtSideLane', 'ParkingExit')
+SPEED_REDUCED_BY = ('vehicle.lincoln.mkz_2020', 'walker.pedestrian.0001', 'traffic.stop', 'static.prop.trafficwarning')
+
+# only the first entry of every template list is used without augmentation
+TEMPLATES = {
+    'remain_stopped': ['Remain stopped'],
+    'stop_now': ['Stop now'],
+    'maintain_speed': ['Maintain your current speed'],
+    'maintain_reduced_speed': ['Maintain the reduced speed'],
+    'accelerate': ['Accelerate'],
+    'decelerate': ['Decelerate'],
+    'cleared_stop': ['The stop sign was cleared'],
+    'prevent_collision': ['Avoid a collision with'],
+    'cross_path': ['That is crossing your path'],
+    'stay_behind': ['Stay behind'],
+    'drive_closer': ['Drive closer to'],
+    'shift_right': ['Shift slightly to the right'],
+    'wait_gap': ['Wait for a gap'],
+    'gap_big': ['the gap is big enough'],
+    'go_back': ['Go back to the original lane.'],
+    'Accident': ['Go around the accident.'],
+    'ConstructionObstacle': ['Go around the construction site.'],
+    'HazardAtSideLane': ['Go around the hazard on the side lane.'],
+}
+
+
+def route_dir(data_dir, route_file, route_number):
+  return os.path.join(data_dir, 'data', 'simlingo', ROUTE_FOLDER, f'Town12_Rep0_{route_file}_route{route_number}_01_01')
+
+
+def car_box(rng, box_id):
+  return {
+      'class': 'car', 'id': box_id,
+      'position': [float(rng.uniform(2, 40)), float(rng.uniform(-8, 8)), 0.0],
+      'extent': [2.4, 1.0, 0.8],
+      'yaw': float(rng.uniform(-np.pi, np.pi)),
+      'num_points': int(rng.integers(0, 200)),
+      'distance': float(rng.uniform(2, 40)),
+      'speed': float(rng.choice([0.0, rng.uniform(0, 10)])),
+      'brake': float(rng.choice([0.0, 1.0])),
+      'junction_id': int(rng.choice([-1, 7])),
+      'next_junction_id': int(rng.choice([-1, 7, 8])),
+      'is_in_junction': bool(rng.random() < 0.3),
+      'base_type': str(rng.choice(['car', 'truck', 'bicycle'])),
+      'type_id': str(rng.choice(['vehicle.lincoln.mkz_2020', 'vehicle.ford.ambulance', 'vehicle.mini.cooper_s'])),
+      'color_name': str(rng.choice(['red', 'white', 'None'])),
+      'color_rgb': [int(c) for c in rng.integers(0, 255, 3)],
+      'role_name': str(rng.choice(['scenario', 'background'])),
+      'lane_type_str': 'Driving',
+      'same_road_as_ego': bool(rng.random() < 0.5),
+      'lane_relative_to_ego': int(rng.integers(-1, 2)),
+      'traffic_light_state': str(rng.choice(['Red', 'Green'])),
+  }
+
+
+def walker_box(rng, box_id):
+  return {
+      'class': 'walker', 'id': box_id,
+      'position': [float(rng.uniform(2, 20)), float(rng.uniform(-6, 6)), 0.0],
+      'extent': [0.3, 0.3, 0.9],
+      'yaw': float(rng.uniform(-np.pi, np.pi)),
+      'num_points': int(rng.integers(0, 20)),
+      'distance': float(rng.uniform(2, 20)),
+      'speed': float(rng.uniform(0, 2)),
+      'age': str(rng.choice(['adult', 'child'])),
+  }
+
+
+def synthetic_frames(rng, num_frames):
+  '''Ego driving along x with a varying speed, a lane change in the middle and random actors around it.'''
+  frames = []
+  x = 0.0
+  speeds = np.clip(8 + 6 * np.sin(np.arange(num_frames + 3) / rng.uniform(3, 8)) + rng.normal(0, 1, num_frames + 3),
+                   0, 14)
+  speeds[rng.integers(0, num_frames):][:6] = 0.0
+  lane_change = int(rng.integers(10, num_frames))
+  for k in range(num_frames):
+    boxes = [{
+        'class': 'ego_info',
+        'distance_to_junction': None if rng.random() < 0.3 else float(rng.uniform(0, 60)),
+        'is_in_junction': bool(rng.random() < 0.2),
+        'is_intersection': bool(rng.random() < 0.2),
+        'junction_id': int(rng.choice([-1, 7])),
+        'next_junction_id': int(rng.choice([-1, 7])),
+    }, {
+        'class': 'ego_car'
+    }]
+    boxes += [car_box(rng, 100 + i) for i in range(int(rng.integers(0, 4)))]
+    boxes += [walker_box(rng, 200 + i) for i in range(int(rng.integers(0, 2)))]
+    if rng.random() < 0.3:
+      boxes.append({'class': 'traffic_light', 'id': 300, 'affects_ego': bool(rng.random() < 0.7),
+                    'state': str(rng.choice(['Red', 'Green'])), 'distance': float(rng.uniform(5, 50))})
+
+    reduced_by = str(rng.choice(SPEED_REDUCED_BY)) if rng.random() < 0.6 else None
+    if reduced_by is None:
+      reduced_by_id = None
+    elif reduced_by.startswith('vehicle'):
+      reduced_by_id = int(rng.choice([box['id'] for box in boxes if box['class'] == 'car'] or [None]) or -1)
+    elif reduced_by.startswith('walker'):
+      reduced_by_id = int(rng.choice([box['id'] for box in boxes if box['class'] == 'walker'] or [None]) or -1)
+    else:
+      reduced_by_id = None
+    # route_original 3.5 m to the left of the route around the lane change
+    offset = 3.5 if abs(k - lane_change) < 8 else 0.0
+    route = [[float(i), 0.0] for i in range(25)]
+    route_original = [[float(i), offset if i < 12 else 0.0] for i in range(25)]
+    ego_matrix = [[1.0, 0.0, 0.0, x], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]]
+    measurements = {
+        'pos_global': [x, 0.0],
+        'theta': 0.0,
+        'ego_matrix': ego_matrix,
+        'speed': float(speeds[k]),
+        'target_speed': float(speeds[k + 2]),
+        'speed_limit': 13.89,
+        'vehicle_hazard': bool(rng.random() < 0.2),
+        'vehicle_affecting_id': int(rng.choice([100, 101, 102])),
+        'walker_hazard': bool(rng.random() < 0.1),
+        'walker_close_id': int(rng.choice([200, 201])),
+        'changed_route': offset > 0.0,
+        'route': route,
+        'route_original': route_original,
+        'target_point': [float(rng.uniform(5, 40)), 0.0],
+        'command': int(rng.choice([1, 2, 4, 5, 6])),
+        'speed_reduced_by_obj_type': reduced_by,
+        'speed_reduced_by_obj_id': reduced_by_id,
+        'speed_reduced_by_obj_distance': None if reduced_by is None else float(rng.uniform(1, 45)),
+        'stop_sign_hazard': bool(rng.random() < 0.1),
+        'light_hazard': bool(rng.random() < 0.1),
+    }
+    frames.append((boxes, measurements))
+    x += float(speeds[k]) * 0.25
+  return frames
+
+
+def write_fixture(data_dir, rng, num_routes, num_frames):
+  '''Routes of one route file, the templates and the route file itself relative to the working directory.'''
+  os.makedirs('data/augmented_templates')
+  with open('data/augmented_templates/commentary.json', 'w', encoding='utf-8') as f:
+    json.dump(TEMPLATES, f)
+
+  route_file = 1234
+  xml = ['<routes>']
+  for route_number in range(num_routes):
+    xml.append(f'  <route id="{route_number}" town="Town12">')
+    xml.append('    <scenarios>')
+    for i, scenario_type in enumerate(rng.permutation(SCENARIO_TYPES)[:3]):
+      xml.append(f'      <scenario name="{scenario_type}_{i}" type="{scenario_type}">')
+      xml.append(f'        <trigger_point x="{i * 25 - 5:.1f}" y="0.0" z="0.0" yaw="0.0"/>')
+      xml.append('      </scenario>')
+    xml.append('    </scenarios>')
+    xml.append('  </route>')
+
+    directory = route_dir(data_dir, route_file, route_number)
+    for folder in ('boxes', 'measurements', 'rgb'):
+      os.makedirs(os.path.join(directory, folder))
+    for k, (boxes, measurements) in enumerate(synthetic_frames(rng, num_frames)):
+      with gzip.open(os.path.join(directory, 'boxes', f'{k:04}.json.gz'), 'wt', encoding='utf-8') as f:
+        json.dump(boxes, f)
+      with gzip.open(os.path.join(directory, 'measurements', f'{k:04}.json.gz'), 'wt', encoding='utf-8') as f:
+        json.dump(measurements, f)
+      # one frame without image, it is skipped
+      if k != num_frames // 2:
+        with open(os.path.join(directory, 'rgb', f'{k:04}.jpg'), 'wb') as f:
+          f.write(b'')
+
+    failed = route_number == num_routes - 1
+    results = {'scores': {'score_composed': 40.0 if failed else 100.0, 'score_route': 50.0 if failed else 100.0},
+               'infractions': {'collisions_vehicle': ['collision'] if failed else [], 'min_speed_infractions': []}}
+    with gzip.open(os.path.join(directory, 'results.json.gz'), 'wt', encoding='utf-8') as f:
+      json.dump(results, f)
+  xml.append('</routes>')
+
+  os.makedirs(os.path.join('data', 'simlingo', ROUTE_FOLDER))
+  with open(os.path.join('data', 'simlingo', ROUTE_FOLDER, f'{route_file}.xml'), 'w', encoding='utf-8') as f:
+    f.write('\n'.join(xml))
+  # failed frames are appended to <data_dir>/commentary/failed_paths.txt
+  os.makedirs(os.path.join(data_dir, 'commentary'))
+
+
+def generator_args(data_dir, output_dir):
+  return types.SimpleNamespace(target_image_size=[1024, 358], original_image_size=[1024, 512], original_fov=110,
+                               min_x=0, max_x=1024, min_y=0, max_y=358, random_subset_count=-1,
+                               sample_frame_mode='all', sample_uniform_interval=1, save_examples=False,
+                               visualize_projection=False, filter_routes_by_result=True, data_directory=data_dir,
+                               path_keyframes='', output_directory=output_dir, output_examples_directory=output_dir,
+                               skip_existing=True, boxes_glob='data/simlingo/*/*/*/*/boxes/*.json.gz')
+
+
+def read_measurement(path_measurement):
+  '''load_measurement without the cache of the route.'''
+  if not os.path.exists(path_measurement):
+    return None
+  with gzip.open(path_measurement, 'rb') as f:
+    return json.loads(f.read().decode('utf-8'))
+
+
+def run(data_dir, output_dir, seed, cached):
+  originals = {name: getattr(label_utils, name) for name in CACHED_FUNCTIONS}
+  for function in originals.values():
+    function.cache_clear()
+  generator = carla_commentary_generator.COMsGenerator(generator_args(data_dir, output_dir))
+  if not cached:
+    generator.load_measurement = read_measurement
+    for module in (label_utils, carla_commentary_generator):
+      for name, function in originals.items():
+        setattr(module, name, function.__wrapped__)
+
+  random.seed(seed)
+  start = time.perf_counter()
+  try:
+    run_generator(generator, num_workers=1)
+  finally:
+    for module in (label_utils, carla_commentary_generator):
+      for name, function in originals.items():
+        setattr(module, name, function)
+
+  failed_paths_file = os.path.join(data_dir, 'commentary', 'failed_paths.txt')
+  failed_paths = []
+  if os.path.isfile(failed_paths_file):
+    with open(failed_paths_file, 'r', encoding='utf-8') as f:
+      failed_paths = f.read().splitlines()
+    os.remove(failed_paths_file)
+  return time.perf_counter() - start, failed_paths
+
+
+def read_labels(output_dir):
+  labels = {}
+  for directory, _, files in os.walk(output_dir):
+    for file in sorted(files):
+      path = os.path.join(directory, file)
+      if file.endswith('.json.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+          labels[os.path.relpath(path, output_dir)] = json.load(f)
+      else:
+        with open(path, 'r', encoding='utf-8') as f:
+          labels[os.path.relpath(path, output_dir)] = json.load(f)
+  return labels
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  # the generator reads the templates and route files relative to the working directory
+  work_dir = tempfile.mkdtemp(prefix='check_language_label_caches_')
+  os.chdir(work_dir)
+  data_dir = os.path.join(work_dir, 'database')
+  try:
+    write_fixture(data_dir, rng, args.routes, args.frames)
+    time_cached, failed_cached = run(data_dir, os.path.join(work_dir, 'cached'), args.seed, cached=True)
+    time_uncached, failed_uncached = run(data_dir, os.path.join(work_dir, 'uncached'), args.seed, cached=False)
+    cached = read_labels(os.path.join(work_dir, 'cached'))
+    uncached = read_labels(os.path.join(work_dir, 'uncached'))
+  finally:
+    os.chdir(ROOT)
+    shutil.rmtree(work_dir)
+
+  assert cached.keys() == uncached.keys(), 'different frames labeled'
+  for file in cached:
+    assert cached[file] == uncached[file], f'{file} differs'
+  assert failed_cached == failed_uncached, 'different failed frames'
+  stats = cached['stats.json']
+  assert stats['total_frames'] > 0, 'no frame labeled'
+
+  num_frames = args.routes * args.frames
+  print(f"{stats['total_frames']} of {num_frames} frames labeled, {len(failed_cached)} failed, "
+        f"{stats['num_different_templates']} templates: identical labels")
+  print(f'generator: {time_uncached * 1000 / num_frames:.1f} -> {time_cached * 1000 / num_frames:.1f} ms/frame '
+        f'(without -> with caches)')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,243 @@
+'''
+Checks that the packed parking slots with the grid index (leaderboard/utils/parking_slots.py) select and spawn the
+same parked vehicles as the previous list based implementation of RouteScenario on parked_vehicles.py and
+benchmarks both. The reference runs the previous methods unchanged, including the removal from the list while
+iterating over it, on the carla mocks of scenario_runner/srunner/tests/carla_mocks. Random routes through the towns
+are driven with one spawn call per tick, a few slots are occupied by scenarios, the locations and meshes of the
+spawned vehicles have to be identical in every tick. No simulator needed.
+Example:
+python tools/check_parked_vehicles.py --routes 5
+'''
+
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'leaderboard'))
+from leaderboard.utils import parking_slots  # pylint: disable=wrong-import-position
+
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+import carla as carla_mocks  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--routes', type=int, default=5, help='Random routes per town.')
+parser.add_argument('--route_length', type=int, default=3000, help='Route points, 1 m apart.')
+parser.add_argument('--tick_distance', type=float, default=2.0, help='Distance the ego drives per tick (m).')
+parser.add_argument('--seed', type=int, default=0)
+
+PARKED_VEHICLES_INIT_THRESHOLD = 450
+
+
+############## previous implementation of RouteScenario ##############
+class SpawnedSlots(object):
+  '''Client of CarlaDataProvider, records the location and mesh of every spawned parked vehicle.'''
+
+  def __init__(self):
+    self.spawned = []
+
+  def apply_batch_sync(self, batch):
+    responses = []
+    for mesh, transform in batch:
+      self.spawned.append(((transform.location.x, transform.location.y, transform.location.z), mesh))
+      responses.append(SimpleNamespace(error=None, actor_id=len(self.spawned)))
+    return responses
+
+
+carla = SimpleNamespace(Location=carla_mocks.Location, Rotation=carla_mocks.Rotation, Transform=carla_mocks.Transform,
+                        command=SimpleNamespace(SpawnActor=lambda blueprint, transform:
+                                                (blueprint.attributes['mesh_path'], transform)))
+
+
+class CarlaDataProvider(object):
+  client = SpawnedSlots()
+
+  @staticmethod
+  def get_location(actor):
+    return actor
+
+  @staticmethod
+  def get_world():
+    return carla_mocks.World()
+
+  @staticmethod
+  def get_client():
+    return CarlaDataProvider.client
+
+
+class ReferenceRouteScenario(object):
+  '''
+  _get_parking_slots and spawn_parked_vehicles of the previous RouteScenario, unchanged. The previous code filtered the
+  list of parked_vehicles.py itself, so later routes of the same town in one process started from the slots the
+  earlier routes left. Every route gets its own copy of the town list here, like the packed slots.
+  '''
+  PARKED_VEHICLES_INIT_THRESHOLD = PARKED_VEHICLES_INIT_THRESHOLD
+
+  def __init__(self, town, town_slots, route, occupied_parking_locations):
+    self.route = [(carla.Transform(location=carla.Location(*location)), None) for location in route]
+    self.map = SimpleNamespace(name=f'Carla/Maps/{town}')
+    self.list_scenarios = []
+    self.occupied_parking_locations = [carla.Location(*location) for location in occupied_parking_locations]
+    self.available_parking_locations = []
+    self._parked_ids = []
+    self.parked_vehicles = SimpleNamespace(**{town: list(town_slots)})
+
+  def _get_parking_slots(self, max_distance=100, route_step=10):
+    """Spawn parked vehicles."""
+    parked_vehicles = self.parked_vehicles
+
+    def is_close(slot_location):
+      for i in range(0, len(self.route), route_step):
+        route_transform = self.route[i][0]
+        if route_transform.location.distance(slot_location) < max_distance:
+          return True
+      return False
+
+    min_x, min_y = float('inf'), float('inf')
+    max_x, max_y = float('-inf'), float('-inf')
+    for route_transform, _ in self.route:
+      min_x = min(min_x, route_transform.location.x - max_distance)
+      min_y = min(min_y, route_transform.location.y - max_distance)
+      max_x = max(max_x, route_transform.location.x + max_distance)
+      max_y = max(max_y, route_transform.location.y + max_distance)
+
+    # Occupied parking locations
+    occupied_parking_locations = []
+    for scenario in self.list_scenarios:
+      occupied_parking_locations.extend(scenario.get_parking_slots())
+
+    available_parking_locations = []
+    map_name = self.map.name.split('/')[-1]
+    available_parking_locations = getattr(parked_vehicles, map_name, [])
+
+    # Exclude parking slots that are too far from the route
+    for slot in available_parking_locations:
+      slot_transform = carla.Transform(
+          location=carla.Location(slot["location"][0], slot["location"][1], slot["location"][2]),
+          rotation=carla.Rotation(slot["rotation"][0], slot["rotation"][1], slot["rotation"][2])
+      )
+
+      in_area = (min_x < slot_transform.location.x < max_x) and (min_y < slot_transform.location.y < max_y)
+      close_to_route = is_close(slot_transform.location)
+      if not in_area or not close_to_route:
+        available_parking_locations.remove(slot)
+        continue
+
+    self.available_parking_locations = available_parking_locations
+
+  def spawn_parked_vehicles(self, ego_vehicle, max_scenario_distance=10):
+    """Spawn parked vehicles."""
+    def is_close(slot_location, ego_location):
+      return slot_location.distance(ego_location) < self.PARKED_VEHICLES_INIT_THRESHOLD
+    def is_free(slot_location):
+      for occupied_slot in self.occupied_parking_locations:
+        if slot_location.distance(occupied_slot) < max_scenario_distance:
+          return False
+      return True
+
+    new_parked_vehicles = []
+
+    ego_location = CarlaDataProvider.get_location(ego_vehicle)
+    if ego_location is None:
+      return
+
+    for slot in self.available_parking_locations:
+      slot_transform = carla.Transform(
+          location=carla.Location(slot["location"][0], slot["location"][1], slot["location"][2]),
+          rotation=carla.Rotation(slot["rotation"][0], slot["rotation"][1], slot["rotation"][2])
+      )
+
+      # Add all vehicles that are close to the ego and in a free space
+      if is_close(slot_transform.location, ego_location) and is_free(slot_transform.location):
+        mesh_bp = CarlaDataProvider.get_world().get_blueprint_library().filter("static.prop.mesh")[0]
+        mesh_bp.set_attribute("mesh_path", slot["mesh"])
+        mesh_bp.set_attribute("scale", "0.9")
+        new_parked_vehicles.append(carla.command.SpawnActor(mesh_bp, slot_transform))
+        self.available_parking_locations.remove(slot)
+
+    # Add the actors to _parked_ids
+    for response in CarlaDataProvider.get_client().apply_batch_sync(new_parked_vehicles):
+      if not response.error:
+        self._parked_ids.append(response.actor_id)
+
+
+def random_route(rng, slots, length):
+  '''Smooth random drive that starts at a random parking slot.'''
+  start = np.array(slots[rng.integers(len(slots))]['location'])
+  heading = np.cumsum(rng.normal(0, 0.02, size=length)) + rng.uniform(-np.pi, np.pi)
+  route = start + np.cumsum(np.stack((np.cos(heading), np.sin(heading), np.zeros(length)), axis=1), axis=0)
+  return [tuple(location) for location in route.tolist()]
+
+
+def check_route(rng, town, town_slots, packed, route, tick_distance):
+  occupied = [tuple(town_slots[index]['location']) for index in rng.integers(len(town_slots), size=10)]
+  occupied += [route[index] for index in rng.integers(len(route), size=3)]
+
+  reference = ReferenceRouteScenario(town, town_slots, route, occupied)
+  start = time.perf_counter()
+  reference._get_parking_slots()  # pylint: disable=protected-access
+  time_init_reference = time.perf_counter() - start
+  start = time.perf_counter()
+  available = packed.select_route_slots(route)
+  time_init = time.perf_counter() - start
+  assert [(tuple(slot['location']), slot['mesh']) for slot in reference.available_parking_locations] == \
+      [(location, mesh) for location, _, mesh in map(packed.get_slot, np.flatnonzero(available))]
+
+  ticks = route[::max(1, int(tick_distance))]
+  num_spawned = 0
+  time_spawn_reference, time_spawn = 0.0, 0.0
+  for ego_location in ticks:
+    CarlaDataProvider.client = SpawnedSlots()
+    start = time.perf_counter()
+    reference.spawn_parked_vehicles(carla.Location(*ego_location))
+    time_spawn_reference += time.perf_counter() - start
+    new_reference = CarlaDataProvider.client.spawned
+
+    start = time.perf_counter()
+    new = packed.select_spawn_slots(ego_location, PARKED_VEHICLES_INIT_THRESHOLD, available, occupied)
+    available[new] = False
+    time_spawn += time.perf_counter() - start
+
+    new = [(location, mesh) for location, _, mesh in map(packed.get_slot, new)]
+    assert new_reference == new, f'different parked vehicles spawned: {new_reference} != {new}'
+    num_spawned += len(new)
+
+  return {
+      'spawned': num_spawned,
+      'ticks': len(ticks),
+      'init_ms': (time_init_reference * 1000, time_init * 1000),
+      'spawn_ms_per_tick': (time_spawn_reference * 1000 / len(ticks), time_spawn * 1000 / len(ticks)),
+  }
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+
+  start = time.perf_counter()
+  source = parking_slots.load_source_module()
+  print(f'Import of parked_vehicles.py: {(time.perf_counter() - start) * 1000:.0f} ms')
+
+  for town, town_slots in sorted(vars(source).items()):
+    if not town.startswith('Town'):
+      continue
+    start = time.perf_counter()
+    packed = parking_slots.load_parking_slots(town)
+    print(f'{town}: {len(packed)} slots, packed file loaded in {(time.perf_counter() - start) * 1000:.0f} ms')
+    for slot, (location, rotation, mesh) in zip(town_slots, map(packed.get_slot, range(len(packed)))):
+      assert tuple(slot['location']) == location and tuple(slot['rotation']) == rotation and slot['mesh'] == mesh
+
+    for _ in range(args.routes):
+      route = random_route(rng, town_slots, args.route_length)
+      result = check_route(rng, town, town_slots, packed, route, args.tick_distance)
+      print(f'  {result["spawned"]:>4} parked vehicles identical in {result["ticks"]} ticks, '
+            f'init {result["init_ms"][0]:7.1f} -> {result["init_ms"][1]:5.1f} ms, '
+            f'spawn {result["spawn_ms_per_tick"][0]:6.2f} -> {result["spawn_ms_per_tick"][1]:5.3f} ms/tick')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,654 @@
+'''
+Checks the incremental result parser (tools/result_parser_new.py) against the previous serial parser.
+A synthetic evaluation (routes xml and one *_res.json per route, like a Bench2Drive run) is parsed by the previous and
+the new parser, results.csv has to be identical. Then a few result files are changed and one is written partially,
+the next run may only parse those files and has to match the previous parser again. The abilities computed offline
+from the summaries have to match ability_benchmark.compute_ability on the records merged by merge_route_json.py. They
+are skipped if the junction cache misses routes, and with --offline the missing junction completions are estimated
+from the route waypoints (a straight part, then a turn or not) and listed as estimated.
+Reports the timings of the previous parser, a full and an incremental run. Runs without a simulator.
+Example:
+python tools/check_result_parser.py --routes 2000 --num_workers 4
+'''
+
+import argparse
+import csv
+import glob
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+
+import numpy as np
+import ujson
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+import result_parser_new  # pylint: disable=wrong-import-position
+from result_parser_new import PENALTY_VALUE_DICT, outside_route_lanes_penalty  # pylint: disable=wrong-import-position
+from ability_benchmark import Ability, compute_ability, estimate_junction_completions  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--routes', type=int, default=2000)
+parser.add_argument('--changed', type=int, default=20, help='Result files changed before the incremental run.')
+parser.add_argument('--num_workers', type=int, default=4)
+parser.add_argument('--seed', type=int, default=0)
+
+TOWNS = ['Town01', 'Town03', 'Town05', 'Town12', 'Town13']
+SCENARIOS = ['Accident', 'HazardAtSideLane', 'HighwayExit', 'InvadingTurn', 'YieldToEmergencyVehicle',
+             'SignalizedJunctionLeftTurn', 'PedestrianCrossing', 'T_Junction', 'ParkingCutIn']
+STATUSES = ['Completed', 'Perfect', 'Failed - Agent got blocked', 'Failed - TickRuntime', 'Failed - Agent crashed']
+
+
+############## previous parser ##############
+def reference_main(args):
+
+  
+  infraction_names = [
+                    "collisions_layout",
+                    "collisions_pedestrian",
+                    "collisions_vehicle",
+                    "red_light",
+                    "stop_infraction",
+                    "outside_route_lanes",
+                    "min_speed_infractions",
+                    "yield_emergency_vehicle_infractions",
+                    "scenario_timeouts",
+                    "route_dev",
+                    "vehicle_blocked",
+                    "route_timeout"
+  ]
+  labels = [
+        "Avg. driving score",
+        "Avg. route completion",
+        "Avg. infraction penalty",
+        "Collisions with pedestrians",
+        "Collisions with vehicles",
+        "Collisions with layout",
+        "Red lights infractions",
+        "Stop sign infractions",
+        "Off-road infractions",
+        "Route deviations",
+        "Route timeouts",
+        "Agent blocked",
+        "Yield emergency vehicles infractions",
+        "Scenario timeouts",
+        "Min speed infractions"
+  ]
+
+  total_score_labels = []
+
+  driving_scores = []
+  route_completions = []
+  infraction_scores = []
+  normalized_driving_scores = []
+  normalized_infraction_scores = []
+  route_ids = []
+  duration_games = []
+  route_lengths = []
+  scenario_names = []
+  weather_ids = []
+  status = []
+  individual_infractions = []
+
+  total_km_driven = 0.0
+  total_driven_hours = 0.0
+  total_number_of_routes = 0
+  total_infractions = {}
+  total_infractions_per_km = {}
+
+  root = ET.parse(args.xml).getroot()
+
+  # build route matching dict
+  route_matching = {}
+  for route in root.iter('route'):
+    route_matching[route.attrib["id"]] = {'town': route.attrib["town"]}
+
+#   filenames = []
+  filenames = glob.glob(f"{args.results}/**/*_res.json", recursive=True)
+#   for foldername, _, files in os.walk(args.results):
+#     paths = []
+#     for filename in files:
+#       if filename.endswith('.json'):
+#         paths.append(os.path.join(foldername, filename))
+#     filenames += paths
+
+  abort = False
+  # aggregate files
+  for f in filenames:
+    with open(f, encoding='utf-8') as json_file:
+      evaluation_data = ujson.load(json_file)
+
+      if len(total_infractions) == 0:
+        for infraction_name in infraction_names:
+          total_infractions[infraction_name] = 0
+
+      for record in evaluation_data['_checkpoint']['records']:
+        if record['scores']['score_route'] <= 1e-7:
+          print('Warning: There is a route where the agent did not start to drive.' + ' Route ID: ' +
+                record['route_id'],
+                file=sys.stderr)
+        if record['status'] == 'Failed - Agent couldn\'t be set up':
+          print('Error: There is at least one route where the agent could not be set up.' + ' Route ID: ' +
+                record['route_id'],
+                file=sys.stderr)
+          abort = True
+        if record['status'] == 'Failed':
+          print('Error: There is at least one route that failed.' + ' Route ID: ' + record['route_id'],
+                file=sys.stderr)
+          abort = True
+        if record['status'] == 'Failed - Simulation crashed':
+          print('Error: There is at least one route where the simulation crashed.' + ' Route ID: ' +
+                record['route_id'],
+                file=sys.stderr)
+          abort = True
+        if record['status'] == 'Failed - Agent crashed':
+          print('Error: There is at least one route where the agent crashed.' + ' Route ID: ' + record['route_id'],
+                file=sys.stderr)
+          abort = True
+
+        percentage_of_route_completed = record['scores']['score_route'] / 100.0
+        route_length_km = record['meta']['route_length'] / 1000.0
+        driven_km = percentage_of_route_completed * route_length_km
+        route_time_hours = record['meta']['duration_game'] / 3600.0  # conversion from seconds to hours
+        total_driven_hours += route_time_hours
+        total_km_driven += driven_km
+        if route_time_hours > 0.0:
+          avg_speed_km_h = driven_km / route_time_hours
+        else:
+          avg_speed_km_h = 0.0
+
+        total_number_of_routes += 1
+        local_infractions = {}
+        for infraction_name in infraction_names:
+          local_infractions[infraction_name] = 0
+          if infraction_name == 'outside_route_lanes':
+            if len(record['infractions'][infraction_name]) > 0:
+              meters_off_road = re.findall(r'\d+\.\d+', record['infractions'][infraction_name][0])[0]
+              km_off_road = float(meters_off_road) / 1000.0
+              total_infractions[infraction_name] += km_off_road
+              local_infractions[infraction_name] += km_off_road
+          elif infraction_name == 'min_speed_infractions':
+            if len(record['infractions'][infraction_name]) == 0:
+              total_infractions[infraction_name] += 0
+              local_infractions[infraction_name] += 0
+            else:
+              perc_speed_of_traffic = []
+              for min_speed_inf in record['infractions'][infraction_name]:
+                pattern = r"(\d+(\.\d+)?)%"
+                min_speed_section = float(re.findall(pattern, min_speed_inf)[0][0]) / 100.0
+                # clip to 0 to 1
+                min_speed_section = min(1.0, max(0.0, min_speed_section))
+                perc_speed_of_traffic.append(min_speed_section)
+              avg_min_speed = np.mean(perc_speed_of_traffic)
+              # We log percentage of route where the min speed was violated.
+              total_infractions[infraction_name] += 1.0 - avg_min_speed
+              local_infractions[infraction_name] += 1.0 - avg_min_speed
+
+          else:
+            num_infraction = len(record['infractions'][infraction_name])
+            total_infractions[infraction_name] += num_infraction
+            local_infractions[infraction_name] += num_infraction
+
+        # Compute normalized driving score.
+        score_penalty = 1.0
+        score_route = record['scores']['score_route']
+
+        # Standard infractions
+        for inf_name in local_infractions:
+          if inf_name in PENALTY_VALUE_DICT:
+            if driven_km > 0.0:
+                score_penalty *= math.pow(PENALTY_VALUE_DICT[inf_name], (local_infractions[inf_name] / driven_km))
+
+        # Special infraction min speed
+        # if len(record['infractions']['min_speed_infractions']) > 0:
+        #   for min_speed_inf in record['infractions']['min_speed_infractions']:
+        #     pattern = r"(\d+(\.\d+)?)%"
+            
+        #     min_speed_section = float(re.findall(pattern, min_speed_inf)[0][0])
+        #     # clip to 0 to 1
+        #     min_speed_section = min(1.0, max(0.0, min_speed_section))
+        #     score_penalty *= min_speed_penalty(min_speed_section)
+
+        # Special infraction outside route lanes
+        if len(record['infractions']['outside_route_lanes']) > 0:
+          for outside_route_lanes in record['infractions']['outside_route_lanes']:
+            outside_route_lanes_perc = float(re.findall(r'\d+\.\d+', outside_route_lanes)[1])
+            score_penalty *= outside_route_lanes_penalty(outside_route_lanes_perc)
+
+        normalied_ds = score_route * score_penalty
+
+        normalized_driving_scores.append(normalied_ds)
+        normalized_infraction_scores.append(score_penalty)
+
+        driving_scores.append(record['scores']['score_composed'])
+        route_completions.append(score_route)
+        infraction_scores.append(record['scores']['score_penalty'])
+        route_ids.append(record['route_id'])
+        duration_games.append(record['meta']['duration_game'])
+        route_lengths.append(record['meta']['route_length'])
+        if 'scenario_name' in record:
+          scenario_names.append(record['scenario_name'])
+        else:
+          scenario_names.append('N/A')
+        if 'weather_id' in record:
+          weather_ids.append(record['weather_id'])
+        else:
+          weather_ids.append('N/A')
+        status.append(record['status'])
+        individual_infractions.append(local_infractions)
+
+      total_score_labels = labels[:]
+      total_score_labels.append('Avg. speed km/h')
+      total_score_labels.append('Avg. Normalized DS')
+      total_score_labels.append('Avg. Normalized IS')
+
+  for key, value in total_infractions.items():
+    if key == 'min_speed_infractions':
+      # Since this infraction is a percentage, we put it in rage [0.0, 100.0]
+      total_infractions_per_km[key] = (value / total_number_of_routes) * 100.0
+    else:
+      total_infractions_per_km[key] = value / total_km_driven
+      if key == 'outside_route_lanes':
+        # Since this infraction is a percentage, we put it in rage [0.0, 100.0]
+        total_infractions_per_km[key] = total_infractions_per_km[key] * 100.0
+
+  avg_km_h_speed = total_km_driven / total_driven_hours
+
+
+  if total_number_of_routes % len(route_matching) != 0:
+    print('Error: The number of completed routes (' + str(total_number_of_routes) +
+          ') is not a multiple of the total routes (' + str(len(route_matching)) +
+          '). Check if there are missing results.',
+          file=sys.stderr)
+    abort = True
+
+  if abort and args.strict:
+    print('Don not create result file because not all routes were completed successfully and strict is set.',
+          file=sys.stderr)
+    sys.exit()
+
+  total_score_values = np.zeros(18)
+
+  for idx, value in enumerate(total_score_labels):
+    if value == 'Avg. driving score':
+      total_score_values[idx] = np.sum(driving_scores) / len(driving_scores)
+    elif value == 'Avg. route completion':
+      total_score_values[idx] = np.sum(route_completions) / len(route_completions)
+    elif value == 'Avg. infraction penalty':
+      total_score_values[idx] = np.sum(infraction_scores) / len(infraction_scores)
+    elif value == 'Collisions with pedestrians':
+      total_score_values[idx] = total_infractions_per_km['collisions_pedestrian']
+    elif value == 'Collisions with vehicles':
+      total_score_values[idx] = total_infractions_per_km['collisions_vehicle']
+    elif value == 'Collisions with layout':
+      total_score_values[idx] = total_infractions_per_km['collisions_layout']
+    elif value == 'Red lights infractions':
+      total_score_values[idx] = total_infractions_per_km['red_light']
+    elif value == 'Stop sign infractions':
+      total_score_values[idx] = total_infractions_per_km['stop_infraction']
+    elif value == 'Off-road infractions':
+      total_score_values[idx] = total_infractions_per_km['outside_route_lanes']
+    elif value == 'Route deviations':
+      total_score_values[idx] = total_infractions_per_km['route_dev']
+    elif value == 'Route timeouts':
+      total_score_values[idx] = total_infractions_per_km['route_timeout']
+    elif value == 'Agent blocked':
+      total_score_values[idx] = total_infractions_per_km['vehicle_blocked']
+    elif value == 'Yield emergency vehicles infractions':
+      total_score_values[idx] = total_infractions_per_km['yield_emergency_vehicle_infractions']
+    elif value == 'Scenario timeouts':
+      total_score_values[idx] = total_infractions_per_km['scenario_timeouts']
+    elif value == 'Min speed infractions':
+      total_score_values[idx] = total_infractions_per_km['min_speed_infractions']
+    elif value == 'Avg. speed km/h':
+      total_score_values[idx] = avg_km_h_speed
+    elif value == 'Avg. Normalized DS':
+      total_score_values[idx] = np.sum(normalized_driving_scores) / len(normalized_driving_scores)
+    elif value == 'Avg. Normalized IS':
+      total_score_values[idx] = np.sum(normalized_infraction_scores) / len(normalized_infraction_scores)
+
+  # dict to extract unique identity of route in case of repetitions
+  route_to_id = {}
+  for route_id in route_ids:
+    route_to_id[route_id] = str(re.search('_(\\d+)_', route_id).group(1))
+
+  # build table of relevant information
+  total_score_info = [{"label": label, "value": value} for label, value in zip(total_score_labels, total_score_values)]
+  route_scenarios = [{"route": route_id,
+                      "town": route_matching[route_to_id[route_id]]["town"],
+                      "scenario": scenario_names[idx],
+                      "weather": weather_ids[idx],
+                      "duration": duration_games[idx],
+                      "length": route_lengths[idx],
+                      "status": status[idx],
+                      "DS": driving_scores[idx],
+                      "RC": route_completions[idx],
+                      "NDS": normalized_driving_scores[idx],
+                      "infractions": [(key, item)
+                                      for key, item in individual_infractions[idx].items()]}
+                     for idx, route_id in enumerate(route_ids)]
+
+
+
+  # compute aggregated statistics and table for each filter
+  filters = ["route", "town", "status","town","weather","scenario"]
+  evaluation_filtered = {}
+
+  for filter in filters:
+    subcategories = np.unique(np.array([scenario[filter] for scenario in route_scenarios]))
+    route_scenarios_per_subcategory = {}
+    evaluation_per_subcategory = {}
+    for subcategory in subcategories:
+      route_scenarios_per_subcategory[subcategory] = []
+      evaluation_per_subcategory[subcategory] = {}
+    for scenario in route_scenarios:
+      route_scenarios_per_subcategory[scenario[filter]].append(scenario)
+    for subcategory in subcategories:
+      scores = np.array([scenario["DS"] for scenario in route_scenarios_per_subcategory[subcategory]])
+      completions = np.array([scenario["RC"] for scenario in route_scenarios_per_subcategory[subcategory]])
+      n_scores = np.array([scenario["NDS"] for scenario in route_scenarios_per_subcategory[subcategory]])
+      durations = np.array([scenario["duration"] for scenario in route_scenarios_per_subcategory[subcategory]])
+      lengths = np.array([scenario["length"] for scenario in route_scenarios_per_subcategory[subcategory]])
+
+      infractions = np.array([[infraction[1] for infraction in scenario["infractions"]]
+                              for scenario in route_scenarios_per_subcategory[subcategory]])
+
+      scores_combined = (scores.mean(), scores.std())
+      completions_combined = (completions.mean(), completions.std())
+      n_scores_combined = (n_scores.mean(), n_scores.std())
+
+      durations_combined = (durations.mean(), durations.std())
+      lengths_combined = (lengths.mean(), lengths.std())
+      infractions_combined = [(mean, std) for mean, std in zip(infractions.mean(axis=0), infractions.std(axis=0))]
+
+      evaluation_per_subcategory[subcategory] = {"DS": scores_combined,
+                                                 "RC": completions_combined,
+                                                 "NDS": n_scores_combined,
+                                                 "duration": durations_combined,
+                                                 "length": lengths_combined,
+                                                 "infractions": infractions_combined}
+    evaluation_filtered[filter] = evaluation_per_subcategory
+
+  # write output csv file
+  if not os.path.isdir(args.results):
+    os.mkdir(args.save_dir)
+  with open(os.path.join(args.results, 'results.csv'), 'w') as f:  # Make file object first
+    csv_writer_object = csv.writer(f)  # Make csv writer object
+    # writerow writes one row of data given as list object
+    for info in total_score_info:
+      csv_writer_object.writerow([item for _, item in info.items()])
+    csv_writer_object.writerow([""])
+
+    for filter in filters:
+      infractions_types = []
+      for infraction in route_scenarios[0]["infractions"]:
+        infractions_types.append(infraction[0] + " mean")
+        infractions_types.append(infraction[0] + " std")
+
+      # route aggregation table has additional columns
+      if filter == "route":
+        csv_writer_object.writerow(
+          [filter, "town", "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std",
+           "duration mean", "duration std", "length mean", "length std"] +
+          infractions_types)
+      else:
+        csv_writer_object.writerow(
+          [filter, "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std", "duration mean", "duration std",
+           "length mean", "length std"] +
+          infractions_types)
+
+      try:
+        sorted_keys = sorted(evaluation_filtered[filter].keys(),
+                             key=lambda fil: int(re.search('_(\\d+)_', fil).group(1)))
+      except AttributeError:
+        sorted_keys = sorted(evaluation_filtered[filter].keys())
+
+      for key in sorted_keys:
+        item = evaluation_filtered[filter][key]
+        infractions_output = []
+        for infraction in item["infractions"]:
+          infractions_output.append(infraction[0])
+          infractions_output.append(infraction[1])
+        if filter == "route":
+          csv_writer_object.writerow([key,
+                                      route_matching[route_to_id[key]]["town"],
+                                      item["DS"][0], item["DS"][1],
+                                      item["RC"][0], item["RC"][1],
+                                      item["NDS"][0], item["NDS"][1],
+                                      item["duration"][0], item["duration"][1],
+                                      item["length"][0], item["length"][1]] +
+                                     infractions_output)
+        else:
+          csv_writer_object.writerow([key,
+                                      item["DS"][0], item["DS"][1],
+                                      item["RC"][0], item["RC"][1],
+                                      item["NDS"][0], item["NDS"][1],
+                                      item["duration"][0], item["duration"][1],
+                                      item["length"][0], item["length"][1]] +
+                                     infractions_output)
+      csv_writer_object.writerow([""])
+
+
+############## synthetic evaluation ##############
+def synthetic_record(rng, route_id, scenario):
+  status = STATUSES[rng.choice(len(STATUSES), p=[0.45, 0.2, 0.2, 0.1, 0.05])]
+  infractions = {infraction_name: [] for infraction_name in result_parser_new.INFRACTION_NAMES}
+  for infraction_name in ('collisions_layout', 'collisions_pedestrian', 'collisions_vehicle', 'red_light', 'stop_infraction',
+                          'yield_emergency_vehicle_infractions', 'scenario_timeouts'):
+    for _ in range(rng.poisson(0.15)):
+      infractions[infraction_name].append(f'Agent {infraction_name} at (x={rng.uniform(-100, 100):.3f}, y={rng.uniform(-100, 100):.3f})')
+  if rng.random() < 0.2:
+    infractions['outside_route_lanes'].append(f'Agent went outside its route lanes for about {rng.uniform(0.5, 300):.3f} meters '
+                                              f'({rng.uniform(0.1, 30):.2f}% of the completed route)')
+  for _ in range(rng.poisson(0.5)):
+    infractions['min_speed_infractions'].append(f'Average agent speed is {rng.uniform(5, 120):.1f}% of the average speed of the '
+                                                f'vehicles in the surrounding.')
+  if status == 'Failed - Agent got blocked':
+    infractions['vehicle_blocked'].append('Agent got blocked at (x=1.0, y=2.0, z=0.0)')
+  score_route = 100.0 if status in ('Completed', 'Perfect') else float(rng.choice([0.0, rng.uniform(0, 100)]))
+  score_penalty = float(rng.uniform(0.2, 1.0)) if any(infractions.values()) else 1.0
+  return {
+      'index': route_id,
+      'route_id': f'RouteScenario_{route_id}_rep0',
+      'status': status,
+      'num_infractions': sum(len(value) for value in infractions.values()),
+      'infractions': infractions,
+      'scores': {'score_route': score_route, 'score_penalty': score_penalty, 'score_composed': score_route * score_penalty},
+      'meta': {'route_length': float(rng.uniform(200, 2000)), 'duration_game': float(rng.uniform(30, 400)),
+               'duration_system': float(rng.uniform(30, 4000))},
+      'scenario_name': f'{scenario}_{route_id}',
+      'weather_id': f'W{rng.integers(1, 21)}',
+  }
+
+
+def write_route_waypoints(route, rng):
+  '''
+  Waypoints 2 m apart: a straight part with the trigger point, then a left turn with a radius of 8 m (or straight on)
+  and another straight part. Returns the junction completion the estimate has to find.
+  '''
+  straight = 2.0 * rng.integers(5, 15)
+  positions = [(x, 0.0) for x in np.arange(0.0, straight + 1.0, 2.0)]
+  turn = rng.random() < 0.7
+  if turn:
+    angles = np.arange(0.25, np.pi / 2, 0.25).tolist() + [np.pi / 2]
+    positions += [(straight + 8.0 * math.sin(angle), 8.0 - 8.0 * math.cos(angle)) for angle in angles]
+    positions += [(straight + 8.0, 8.0 + y) for y in np.arange(2.0, 40.0, 2.0)]
+  else:
+    positions += [(x, 0.0) for x in np.arange(straight + 2.0, straight + 60.0, 2.0)]
+  waypoints = ET.SubElement(route, 'waypoints')
+  for x, y in positions:
+    ET.SubElement(waypoints, 'position', x=str(x), y=str(y), z='0.0')
+  ET.SubElement(route.find('scenarios').find('scenario'), 'trigger_point', x='4.0', y='0.0', yaw='0.0', z='0.0')
+  length = float(np.linalg.norm(np.diff(np.array(positions), axis=0), axis=1).sum())
+  junction = straight if turn else 4.0
+  return min((junction + 8.0) / length, 1.0)
+
+
+def write_evaluation(tmp_dir, rng, num_routes):
+  '''
+  Routes xml, one result file per route in a folder per agent run, a junction cache with all Traffic_Signs routes, one
+  with half of them and the expected estimates.
+  '''
+  root = ET.Element('routes')
+  routes = []
+  junction_completions = {}
+  partial_completions = {}
+  estimates = {}
+  for route_id in range(num_routes):
+    scenario = SCENARIOS[route_id % len(SCENARIOS)]
+    route = ET.SubElement(root, 'route', id=str(route_id), town=TOWNS[rng.integers(len(TOWNS))])
+    scenarios = ET.SubElement(route, 'scenarios')
+    ET.SubElement(scenarios, 'scenario', name=f'{scenario}_{route_id}', type=scenario)
+    routes.append(route)
+    estimate = write_route_waypoints(route, rng)
+    if scenario in Ability['Traffic_Signs']:
+      estimates[str(route_id)] = estimate
+      junction_completions[str(route_id)] = float(rng.uniform(0.2, 0.9))
+      if rng.random() < 0.5:
+        partial_completions[str(route_id)] = junction_completions[str(route_id)]
+  xml_path = os.path.join(tmp_dir, 'routes.xml')
+  ET.ElementTree(root).write(xml_path)
+  junction_caches = []
+  for name, completions in (('junctions.json', junction_completions), ('junctions_partial.json', partial_completions)):
+    junction_caches.append(os.path.join(tmp_dir, name))
+    with open(junction_caches[-1], 'w', encoding='utf-8') as f:
+      json.dump(completions, f)
+
+  results = os.path.join(tmp_dir, 'res')
+  for route_id in range(num_routes):
+    write_result_file(results, route_id, synthetic_record(rng, route_id, SCENARIOS[route_id % len(SCENARIOS)]))
+  return xml_path, results, junction_caches, estimates
+
+
+def write_result_file(results, route_id, record):
+  route_dir = os.path.join(results, f'{route_id // 100}')
+  os.makedirs(route_dir, exist_ok=True)
+  with open(os.path.join(route_dir, f'{route_id}_res.json'), 'w', encoding='utf-8') as f:
+    json.dump({'_checkpoint': {'records': [record], 'progress': [1, 1]}, 'entry_status': 'Finished'}, f)
+
+
+def run_reference(xml_path, results):
+  start = time.perf_counter()
+  reference_main(SimpleNamespace(xml=xml_path, results=results, save_dir=results, strict=False))
+  duration = time.perf_counter() - start
+  with open(os.path.join(results, 'results.csv'), encoding='utf-8') as f:
+    return f.read(), duration
+
+
+def run_parser(xml_path, results, num_workers, junction_cache, offline=False):
+  sys.argv = ['result_parser_new.py', '--xml', xml_path, '--results', results, '--num_workers', str(num_workers),
+              '--ability', '--junction_cache', junction_cache] + (['--offline'] if offline else [])
+  result_parser_new.args = result_parser_new.parser.parse_args()
+  start = time.perf_counter()
+  result_parser_new.main()
+  duration = time.perf_counter() - start
+  with open(os.path.join(results, 'results.csv'), encoding='utf-8') as f:
+    return f.read(), duration
+
+
+def merged_records(results):
+  '''Records like Bench2Drive/tools/merge_route_json.py.'''
+  records = []
+  for f in glob.glob(f'{results}/**/*_res.json', recursive=True):
+    with open(f, encoding='utf-8') as json_file:
+      for record in json.load(json_file)['_checkpoint']['records']:
+        if record['status'] == 'Failed - Agent crashed':
+          continue
+        record.pop('index')
+        records.append(record)
+  return sorted(records, key=lambda d: d['route_id'], reverse=True)
+
+
+def check_outputs(xml_path, results, junction_cache, estimates, offline=False):
+  '''The tables of the new parser agree with each other and the abilities with ability_benchmark.py.'''
+  table = np.load(os.path.join(results, 'results_table.npz'), allow_pickle=False)
+  with open(os.path.join(results, 'results_routes.csv'), encoding='utf-8') as f:
+    rows = list(csv.reader(f))
+  assert rows[0] == list(table.keys())
+  assert len(rows) - 1 == len(table['route_id']) == len(glob.glob(f'{results}/**/*_res.json', recursive=True))
+  assert [row[0] for row in rows[1:]] == table['route_id'].tolist()
+
+  routes = sorted(ET.parse(xml_path).getroot().findall('route'), key=lambda x: x.get('town'))
+  with open(junction_cache, encoding='utf-8') as f:
+    junction_completions = json.load(f)
+  estimated = sorted((route_id for route_id in estimates if route_id not in junction_completions), key=int)
+  if offline:
+    estimated_completions = estimate_junction_completions(routes)
+    assert estimated_completions.keys() == estimates.keys()
+    assert all(math.isclose(estimated_completions[route_id], estimate) for route_id, estimate in estimates.items())
+    junction_completions.update({route_id: estimated_completions[route_id] for route_id in estimated})
+  ability_res, success_statistic, _ = compute_ability(merged_records(results), routes, junction_completions)
+  with open(os.path.join(results, 'results_ability.json'), encoding='utf-8') as f:
+    parsed_ability = json.load(f)
+  success = parsed_ability.pop('success')
+  if offline:
+    assert parsed_ability.pop('estimated_junction_completions') == estimated
+  assert 'estimated_junction_completions' not in parsed_ability
+  parsed_ability['crashed'] = [tuple(crashed) for crashed in parsed_ability['crashed']]
+  assert parsed_ability == ability_res, (parsed_ability, ability_res)
+  assert success == {scenario: statis[0] / statis[1] for scenario, statis in success_statistic.items()}
+
+
+def change_results(results, rng, num_changed, num_routes):
+  '''Rewrites some result files and writes one of them partially, like a run that is still writing.'''
+  changed = rng.choice(num_routes, num_changed, replace=False)
+  for route_id in changed[:-1].tolist():
+    write_result_file(results, route_id, synthetic_record(rng, route_id, SCENARIOS[route_id % len(SCENARIOS)]))
+  path = os.path.join(results, f'{changed[-1] // 100}', f'{changed[-1]}_res.json')
+  with open(path, encoding='utf-8') as f:
+    content = f.read()
+  with open(path, 'w', encoding='utf-8') as f:
+    f.write(content[:len(content) // 2])
+  return path, content
+
+
+def main():
+  args = parser.parse_args()
+  rng = np.random.default_rng(args.seed)
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    xml_path, results, (junction_cache, partial_cache), estimates = write_evaluation(tmp_dir, rng, args.routes)
+
+    reference, time_reference = run_reference(xml_path, results)
+    # routes missing in the junction cache, the abilities are skipped without --offline
+    parsed, time_full = run_parser(xml_path, results, args.num_workers, partial_cache)
+    assert parsed == reference
+    assert not os.path.exists(os.path.join(results, 'results_ability.json'))
+    parsed, time_cached = run_parser(xml_path, results, args.num_workers, junction_cache)
+    assert parsed == reference
+    check_outputs(xml_path, results, junction_cache, estimates)
+    print(f'{args.routes} routes: identical results.csv and abilities, previous {time_reference:.2f} s, '
+          f'new {time_full:.2f} s, unchanged rerun {time_cached:.2f} s')
+
+    # the partially written file is skipped and not cached, the other changes are parsed
+    partial_path, content = change_results(results, rng, args.changed, args.routes)
+    parsed, time_incremental = run_parser(xml_path, results, args.num_workers, partial_cache, offline=True)
+    state = result_parser_new.load_state(os.path.join(results, result_parser_new.STATE_FILE))
+    assert os.path.relpath(partial_path, results) not in state
+    os.rename(partial_path, partial_path + '.partial')
+    reference, _ = run_reference(xml_path, results)
+    assert parsed == reference
+    check_outputs(xml_path, results, partial_cache, estimates, offline=True)
+    os.rename(partial_path + '.partial', partial_path)
+
+    with open(partial_path, 'w', encoding='utf-8') as f:
+      f.write(content)
+    parsed, time_finished = run_parser(xml_path, results, args.num_workers, junction_cache)
+    reference, _ = run_reference(xml_path, results)
+    assert parsed == reference
+    check_outputs(xml_path, results, junction_cache, estimates)
+    print(f'{args.changed} changed files: incremental run {time_incremental:.2f} s, after finishing the partial file '
+          f'{time_finished:.2f} s, identical results.csv and abilities')
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  main()
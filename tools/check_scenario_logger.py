@@ -0,0 +1,253 @@
+'''
+Checks the streaming ScenarioLogger of team_code/scenario_logger.py against the previous logger, which kept every
+logged step in memory, computed the RDP simplified route boxes in every step and wrote records.json.gz only in
+dump_to_json. An ego drives along a synthetic route with background vehicles, the consolidated records have to match
+(route boxes up to float32 rounding, the previous boxes were carla objects) and a stream that is cut in the middle
+of a chunk has to give a prefix of the records. Reports the peak memory and the time per logged step of both.
+Runs without a simulator, the carla types are the mocks of scenario_runner/srunner/tests/carla_mocks.
+Example:
+python tools/check_scenario_logger.py --steps 300 --vehicles 30
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from rdp import rdp
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'scenario_runner', 'srunner', 'tests', 'carla_mocks'))
+sys.path.insert(0, os.path.join(ROOT, 'team_code'))
+import carla  # pylint: disable=wrong-import-position
+
+import scenario_logger  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--steps', type=int, default=300, help='Simulated steps at 20 Hz.')
+parser.add_argument('--logging_freq', type=int, default=1)
+parser.add_argument('--vehicles', type=int, default=30)
+parser.add_argument('--flush_interval', type=int, default=100)
+parser.add_argument('--seed', type=int, default=0)
+
+
+############## previous in memory logger ##############
+class ReferenceScenarioLogger(scenario_logger.ScenarioLogger):
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.records = []
+
+  def log_route(self, route):
+    return self.reference_route_as_boxes(route)
+
+  def append(self, record):
+    self.records.append(record)
+
+  def dump_to_json(self):
+    records_dict = {
+        'meta_data': {
+            'index': self.route_index,
+            'town': self.world.get_map().name
+        },
+        'states': [record['state'] for record in self.records],
+        'lights': [record['lights'] for record in self.records],
+        'route': [record['route'] for record in self.records],
+        'ego_actions': [record['ego_actions'] for record in self.records if 'ego_actions' in record],
+        'adv_actions': [record['adv_actions'] for record in self.records],
+    }
+    return records_dict
+
+  def reference_route_as_boxes(self, route):
+    shortened_route = rdp(route, epsilon=self.rdp_epsilon)
+
+    # convert points to vectors
+    vectors = shortened_route[1:] - shortened_route[:-1]
+    midpoints = shortened_route[:-1] + vectors / 2.
+    norms = np.linalg.norm(vectors, axis=1)
+    angles = np.arctan2(vectors[:, 1], vectors[:, 0])
+
+    route_positions = []
+    route_yaws = []
+    route_ids = []
+    route_extents = []
+    for i, midpoint in enumerate(midpoints):
+      # represent the route element as a bounding box
+      center_bounding_box = carla.Location(midpoint[0], midpoint[1], 0.0)
+      transform = carla.Transform(center_bounding_box)
+
+      # only store route boxes that are near the ego vehicle
+      start_bounding_box = carla.Location(shortened_route[i][0], shortened_route[i][1], 0.0)
+      if 0 < i < 10 and start_bounding_box.distance(self.ego_location) > self.roi:
+        continue
+
+      length_bounding_box = carla.Vector3D(norms[i] / 2., self.ego_vehicle.bounding_box.extent.y,
+                                           self.ego_vehicle.bounding_box.extent.z)
+      bounding_box = carla.BoundingBox(transform.location, length_bounding_box)
+      bounding_box.rotation = carla.Rotation(pitch=0.0, yaw=angles[i] * 180 / np.pi, roll=0.0)
+
+      route_positions.append(np.array([[[center_bounding_box.x, center_bounding_box.y]]]))
+      route_yaws.append(np.array([[[bounding_box.rotation.yaw]]]))
+      route_ids.append(np.array([[[i]]]))
+      route_extents.append(
+          np.array([[[
+              [bounding_box.extent.y, bounding_box.extent.x],
+              [bounding_box.extent.y, -bounding_box.extent.x],
+              [-bounding_box.extent.y, -bounding_box.extent.x],
+              [-bounding_box.extent.y, bounding_box.extent.x],
+          ]]]))
+
+    return {
+        'pos': np.concatenate(route_positions, axis=1).tolist(),
+        'yaw': np.concatenate(np.radians(route_yaws), axis=1).tolist(),
+        'id': np.concatenate(route_ids, axis=1).tolist(),
+        'extent': np.concatenate(route_extents, axis=1).tolist(),
+    }
+
+
+class MockActorList(list):
+
+  def filter(self, pattern):
+    return MockActorList(actor for actor in self if pattern.strip('*') in actor.type_id)
+
+
+class MockMap(object):
+  name = 'Carla/Maps/Town12/Town12'
+
+
+class MockWorld(object):
+
+  def __init__(self):
+    self.actors = MockActorList()
+
+  def get_map(self):
+    return MockMap()
+
+  def get_actors(self):
+    return self.actors
+
+
+def make_vehicle(actor_id, extent, color='10,20,30'):
+  vehicle = carla.Vehicle()
+  vehicle.id = actor_id
+  vehicle.type_id = 'vehicle.lincoln.mkz_2020'
+  vehicle.attributes['color'] = color
+  vehicle.bounding_box = carla.BoundingBox(carla.Location(), carla.Vector3D(*extent))
+  return vehicle
+
+
+def move(vehicle, x, y, yaw, speed):
+  vehicle.location = carla.Location(x, y, 0.3)
+  vehicle.rotation = carla.Rotation(pitch=0.5, yaw=yaw, roll=0.1)
+  vehicle.transform = carla.Transform(vehicle.location, vehicle.rotation)
+  vehicle.velocity = carla.Vector3D(speed * np.cos(np.radians(yaw)), speed * np.sin(np.radians(yaw)), 0.0)
+
+
+def synthetic_route(rng, length):
+  '''Dense route (1 point per meter) of straight segments and curves, like the ones of the route planner.'''
+  headings = np.cumsum(np.where(rng.random(length) < 0.02, rng.normal(0, 0.6, length), 0.0))
+  headings = np.convolve(headings, np.ones(15) / 15, mode='same')
+  return np.cumsum(np.stack((np.cos(headings), np.sin(headings)), axis=1), axis=0)
+
+
+def run(logger_class, save_path, route, args):
+  rng = np.random.default_rng(args.seed + 1)
+  world = MockWorld()
+  ego = make_vehicle(0, (2.45, 1.06, 0.75))
+  others = [make_vehicle(i + 1, rng.uniform((1.5, 0.8, 0.6), (3.0, 1.3, 1.5))) for i in range(args.vehicles)]
+  world.actors.extend([ego] + others)
+  offsets = rng.uniform(-20, 20, size=(args.vehicles, 2))
+
+  logger = logger_class(save_path=save_path, route_index='0', logging_freq=args.logging_freq, log_only=True,
+                        route_only=False, roi=30, flush_interval=args.flush_interval)
+  logger.ego_vehicle = ego
+  logger.world = world
+  control = carla.Control()
+  control.throttle = 0.5
+
+  start = time.perf_counter()
+  for step in range(args.steps):
+    progress = step * 0.5
+    index = int(progress)
+    heading = np.degrees(np.arctan2(*(route[index + 1] - route[index])[::-1]))
+    move(ego, *route[index], heading, 10.0)
+    for i, vehicle in enumerate(others):
+      # the background vehicles drive through the region of interest and back
+      offset = offsets[i] * np.cos(step / 200.0 + i)
+      move(vehicle, route[index][0] + offset[0], route[index][1] + offset[1], heading + i, 8.0)
+    # the planner pops passed points every few steps
+    remaining_route = route[(index // 3) * 3:]
+    logger.log_step(remaining_route, ego_control=control if step % 7 else None)
+  return logger, time.perf_counter() - start
+
+
+def compare_routes(reference, streamed):
+  for key in ('pos', 'yaw', 'extent'):
+    assert np.allclose(np.array(reference[key]), np.array(streamed[key]), rtol=1e-6, atol=1e-4), key
+  assert reference['id'] == streamed['id']
+
+
+def compare_records(reference, streamed):
+  for key in ('meta_data', 'states', 'lights', 'ego_actions', 'adv_actions'):
+    assert reference[key] == streamed[key], key
+  assert len(reference['route']) == len(streamed['route'])
+  for reference_route, streamed_route in zip(reference['route'], streamed['route']):
+    compare_routes(reference_route, streamed_route)
+
+
+def main():
+  args = parser.parse_args()
+  route = synthetic_route(np.random.default_rng(args.seed), int(args.steps * 0.5) + 100)
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    tracemalloc.start()
+    reference_logger, time_reference = run(ReferenceScenarioLogger, tmp_dir, route, args)
+    reference = reference_logger.dump_to_json()
+    _, peak_reference = tracemalloc.get_traced_memory()
+    del reference_logger
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    logger, time_streamed = run(scenario_logger.ScenarioLogger, tmp_dir, route, args)
+    _, peak_streamed = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # a crash in the middle of writing a chunk
+    stream_path = os.path.join(tmp_dir, scenario_logger.RECORDS_STREAM_FILE)
+    crashed_path = os.path.join(tmp_dir, 'crashed.jsonl.gz')
+    shutil.copy(stream_path, crashed_path)
+    with open(crashed_path, 'r+b') as f:
+      f.truncate(int(os.path.getsize(crashed_path) * 0.7))
+    crashed = scenario_logger.read_records_stream(crashed_path)
+    os.remove(crashed_path)
+
+    start = time.perf_counter()
+    logger.dump_to_json()
+    time_dump = time.perf_counter() - start
+    assert not os.path.exists(stream_path)
+    streamed = scenario_logger.read_records(tmp_dir)
+    size = os.path.getsize(os.path.join(tmp_dir, scenario_logger.RECORDS_FILE))
+
+  compare_records(reference, streamed)
+  num_crashed = len(crashed['states'])
+  assert 0 < num_crashed < len(reference['states'])
+  # ego actions are only logged with an ego control
+  prefix = {key: value[:num_crashed] if isinstance(value, list) else value for key, value in reference.items()}
+  prefix['ego_actions'] = reference['ego_actions'][:len(crashed['ego_actions'])]
+  assert len(crashed['ego_actions']) == len([step for step in range(num_crashed) if step % 7])
+  compare_records(prefix, crashed)
+
+  num_logged = len(reference['states'])
+  print(f'{num_logged} logged steps with {args.vehicles} vehicles ({size / 1e6:.1f} MB records.json.gz): '
+        f'identical records, the cut stream gives the first {num_crashed}')
+  print(f'peak memory: {peak_reference / 1e6:.1f} -> {peak_streamed / 1e6:.1f} MB')
+  print(f'log_step: {time_reference * 1000 / args.steps:.2f} -> {time_streamed * 1000 / args.steps:.2f} ms/step, '
+        f'post-processing in dump_to_json {time_dump:.1f} s')
+
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,19 @@
 '''
 File that aggregates results of a carla evaluation run into a csv file.
+Every *_res.json file is parsed once: the summaries of its route records are cached in a state file
+({results}/results_state.json) together with the mtime and size of the file, so later runs (e.g. while a Slurm sweep
+is still writing results) only parse new and changed files, in parallel. Files that can not be read yet are skipped
+and parsed in the next run. All tables are computed from the cached summaries and written atomically:
+  results.csv             aggregated scores and the tables per route, town, status, weather and scenario
+  results_routes.csv      one row per route record
+  results_table.npz       the same table as columns (plain numpy arrays, loads without pickle)
+  results_breakdown.csv   infractions per type and per scenario type
+  results_ability.json    Bench2Drive abilities and success rates per scenario (--ability), computed offline like
+                          Bench2Drive/tools/ability_benchmark.py from its junction completion cache. With --offline
+                          the missing completions are estimated from the routes xml and listed in
+                          estimated_junction_completions
+Example:
+python tools/result_parser_new.py --xml leaderboard/data/bench2drive220.xml --results eval_results/Bench2Drive/simlingo/bench2drive/1/res --ability --junction_cache leaderboard/data/bench2drive220_junctions.json
 '''
 
 import os
@@ -7,12 +21,18 @@ import glob
 import argparse
 import re
 import csv
+import json
+import multiprocessing
 import sys
 import xml.etree.ElementTree as ET
 import numpy as np
+import tqdm
 import ujson
 import math
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Bench2Drive', 'tools'))
+from ability_benchmark import Ability, compute_ability, estimate_junction_completions  # pylint: disable=wrong-import-position
+
 scale_factor = 0.2
 PENALTY_VALUE_DICT = {
     # Traffic events that substract a set amount of points.
@@ -24,17 +44,81 @@ PENALTY_VALUE_DICT = {
     'yield_emergency_vehicle_infractions': 0.7 * scale_factor,
     'stop_infraction': 0.8 * scale_factor,
 }
+INFRACTION_NAMES = [
+    "collisions_layout",
+    "collisions_pedestrian",
+    "collisions_vehicle",
+    "red_light",
+    "stop_infraction",
+    "outside_route_lanes",
+    "min_speed_infractions",
+    "yield_emergency_vehicle_infractions",
+    "scenario_timeouts",
+    "route_dev",
+    "vehicle_blocked",
+    "route_timeout"
+]
+LABELS = [
+    "Avg. driving score",
+    "Avg. route completion",
+    "Avg. infraction penalty",
+    "Collisions with pedestrians",
+    "Collisions with vehicles",
+    "Collisions with layout",
+    "Red lights infractions",
+    "Stop sign infractions",
+    "Off-road infractions",
+    "Route deviations",
+    "Route timeouts",
+    "Agent blocked",
+    "Yield emergency vehicles infractions",
+    "Scenario timeouts",
+    "Min speed infractions"
+]
+LABEL_INFRACTIONS = {
+    'Collisions with pedestrians': 'collisions_pedestrian',
+    'Collisions with vehicles': 'collisions_vehicle',
+    'Collisions with layout': 'collisions_layout',
+    'Red lights infractions': 'red_light',
+    'Stop sign infractions': 'stop_infraction',
+    'Off-road infractions': 'outside_route_lanes',
+    'Route deviations': 'route_dev',
+    'Route timeouts': 'route_timeout',
+    'Agent blocked': 'vehicle_blocked',
+    'Yield emergency vehicles infractions': 'yield_emergency_vehicle_infractions',
+    'Scenario timeouts': 'scenario_timeouts',
+    'Min speed infractions': 'min_speed_infractions',
+}
+FILTERS = ["route", "town", "status", "town", "weather", "scenario"]
+STATUS_ERRORS = {
+    'Failed - Agent couldn\'t be set up': 'Error: There is at least one route where the agent could not be set up.',
+    'Failed': 'Error: There is at least one route that failed.',
+    'Failed - Simulation crashed': 'Error: There is at least one route where the simulation crashed.',
+    'Failed - Agent crashed': 'Error: There is at least one route where the agent crashed.',
+}
+# bumped when the summaries change, older state files are parsed again
+STATE_VERSION = 1
+STATE_FILE = 'results_state.json'
 
 # available arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('--xml', type=str, default='leaderboard/data/routes_validation.xml', help='Routes file.')
-parser.add_argument('--results', type=str, default='eval/simlingo_base/routes_validation/1/res', help='Folder with json files to be parsed')
+parser.add_argument('--results', type=str, nargs='+', default=['eval/simlingo_base/routes_validation/1/res'],
+                    help='Folders with json files to be parsed, each one gets its own tables.')
 parser.add_argument('--strict',
                     action='store_true',
                     default=False,
                     help='If set only creates the results file if all routes finished correctly.')
+parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count())
+parser.add_argument('--rebuild', action='store_true', default=False, help='Parse all files again.')
+parser.add_argument('--ability', action='store_true', default=False,
+                    help='Also compute the Bench2Drive abilities of the routes in --xml.')
+parser.add_argument('--junction_cache', type=str, default='',
+                    help='Junction completions of ability_benchmark.py --junction_cache, needed for Traffic_Signs.')
+parser.add_argument('--offline', action='store_true', default=False,
+                    help='Estimate the junction completions missing in --junction_cache from the routes xml. Not the '
+                    'official metric, the estimated routes are listed in results_ability.json.')
 
-# args = parser.parse_args()
 
 def min_speed_penalty(percentage):
   score_penalty = (1 - (1 - 0.7) * (1 - percentage / 100))
@@ -44,208 +128,165 @@ def outside_route_lanes_penalty(percentage):
   score_penalty = (1 - (1 - 0.0) * percentage / 100)
   return score_penalty
 
-def main():
-
-  
-  infraction_names = [
-                    "collisions_layout",
-                    "collisions_pedestrian",
-                    "collisions_vehicle",
-                    "red_light",
-                    "stop_infraction",
-                    "outside_route_lanes",
-                    "min_speed_infractions",
-                    "yield_emergency_vehicle_infractions",
-                    "scenario_timeouts",
-                    "route_dev",
-                    "vehicle_blocked",
-                    "route_timeout"
-  ]
-  labels = [
-        "Avg. driving score",
-        "Avg. route completion",
-        "Avg. infraction penalty",
-        "Collisions with pedestrians",
-        "Collisions with vehicles",
-        "Collisions with layout",
-        "Red lights infractions",
-        "Stop sign infractions",
-        "Off-road infractions",
-        "Route deviations",
-        "Route timeouts",
-        "Agent blocked",
-        "Yield emergency vehicles infractions",
-        "Scenario timeouts",
-        "Min speed infractions"
-  ]
-
-  total_score_labels = []
-
-  driving_scores = []
-  route_completions = []
-  infraction_scores = []
-  normalized_driving_scores = []
-  normalized_infraction_scores = []
-  route_ids = []
-  duration_games = []
-  route_lengths = []
-  scenario_names = []
-  weather_ids = []
-  status = []
-  individual_infractions = []
-
-  total_km_driven = 0.0
-  total_driven_hours = 0.0
-  total_number_of_routes = 0
-  total_infractions = {}
-  total_infractions_per_km = {}
-
-  root = ET.parse(args.xml).getroot()
 
-  # build route matching dict
-  route_matching = {}
-  for route in root.iter('route'):
-    route_matching[route.attrib["id"]] = {'town': route.attrib["town"]}
-
-#   filenames = []
-  filenames = glob.glob(f"{args.results}/**/*_res.json", recursive=True)
-#   for foldername, _, files in os.walk(args.results):
-#     paths = []
-#     for filename in files:
-#       if filename.endswith('.json'):
-#         paths.append(os.path.join(foldername, filename))
-#     filenames += paths
-
-  abort = False
-  # aggregate files
-  for f in filenames:
-    with open(f, encoding='utf-8') as json_file:
+def summarize_record(record):
+  '''Everything the tables need of one route record.'''
+  errors = []
+  if record['scores']['score_route'] <= 1e-7:
+    errors.append('Warning: There is a route where the agent did not start to drive.' + ' Route ID: ' + record['route_id'])
+  if record['status'] in STATUS_ERRORS:
+    errors.append(STATUS_ERRORS[record['status']] + ' Route ID: ' + record['route_id'])
+
+  percentage_of_route_completed = record['scores']['score_route'] / 100.0
+  route_length_km = record['meta']['route_length'] / 1000.0
+  driven_km = percentage_of_route_completed * route_length_km
+  route_time_hours = record['meta']['duration_game'] / 3600.0  # conversion from seconds to hours
+
+  local_infractions = {}
+  for infraction_name in INFRACTION_NAMES:
+    local_infractions[infraction_name] = 0
+    if infraction_name == 'outside_route_lanes':
+      if len(record['infractions'][infraction_name]) > 0:
+        meters_off_road = re.findall(r'\d+\.\d+', record['infractions'][infraction_name][0])[0]
+        km_off_road = float(meters_off_road) / 1000.0
+        local_infractions[infraction_name] += km_off_road
+    elif infraction_name == 'min_speed_infractions':
+      if len(record['infractions'][infraction_name]) > 0:
+        perc_speed_of_traffic = []
+        for min_speed_inf in record['infractions'][infraction_name]:
+          pattern = r"(\d+(\.\d+)?)%"
+          min_speed_section = float(re.findall(pattern, min_speed_inf)[0][0]) / 100.0
+          # clip to 0 to 1
+          min_speed_section = min(1.0, max(0.0, min_speed_section))
+          perc_speed_of_traffic.append(min_speed_section)
+        avg_min_speed = np.mean(perc_speed_of_traffic)
+        # We log percentage of route where the min speed was violated.
+        local_infractions[infraction_name] += float(1.0 - avg_min_speed)
+    else:
+      local_infractions[infraction_name] += len(record['infractions'][infraction_name])
+
+  # Compute normalized driving score.
+  score_penalty = 1.0
+  score_route = record['scores']['score_route']
+  # Standard infractions
+  for inf_name in local_infractions:
+    if inf_name in PENALTY_VALUE_DICT:
+      if driven_km > 0.0:
+        score_penalty *= math.pow(PENALTY_VALUE_DICT[inf_name], (local_infractions[inf_name] / driven_km))
+  # Special infraction outside route lanes
+  for outside_route_lanes in record['infractions']['outside_route_lanes']:
+    outside_route_lanes_perc = float(re.findall(r'\d+\.\d+', outside_route_lanes)[1])
+    score_penalty *= outside_route_lanes_penalty(outside_route_lanes_perc)
+
+  return {
+      'route_id': record['route_id'],
+      'status': record['status'],
+      'scenario_name': record.get('scenario_name', 'N/A'),
+      'weather_id': record.get('weather_id', 'N/A'),
+      'scores': record['scores'],
+      'meta': {'route_length': record['meta']['route_length'], 'duration_game': record['meta']['duration_game']},
+      # the infraction events are kept for the ability and the breakdowns
+      'infractions': record['infractions'],
+      'infraction_values': local_infractions,
+      'driven_km': driven_km,
+      'hours': route_time_hours,
+      'normalized_ds': score_route * score_penalty,
+      'normalized_is': score_penalty,
+      'errors': errors,
+  }
+
+
+def parse_result_file(task):
+  '''Summaries of the records of one result file, None if it can not be read (yet).'''
+  path, stats = task
+  try:
+    with open(path, encoding='utf-8') as json_file:
       evaluation_data = ujson.load(json_file)
-
-      if len(total_infractions) == 0:
-        for infraction_name in infraction_names:
-          total_infractions[infraction_name] = 0
-
-      for record in evaluation_data['_checkpoint']['records']:
-        if record['scores']['score_route'] <= 1e-7:
-          print('Warning: There is a route where the agent did not start to drive.' + ' Route ID: ' +
-                record['route_id'],
-                file=sys.stderr)
-        if record['status'] == 'Failed - Agent couldn\'t be set up':
-          print('Error: There is at least one route where the agent could not be set up.' + ' Route ID: ' +
-                record['route_id'],
-                file=sys.stderr)
-          abort = True
-        if record['status'] == 'Failed':
-          print('Error: There is at least one route that failed.' + ' Route ID: ' + record['route_id'],
-                file=sys.stderr)
-          abort = True
-        if record['status'] == 'Failed - Simulation crashed':
-          print('Error: There is at least one route where the simulation crashed.' + ' Route ID: ' +
-                record['route_id'],
-                file=sys.stderr)
-          abort = True
-        if record['status'] == 'Failed - Agent crashed':
-          print('Error: There is at least one route where the agent crashed.' + ' Route ID: ' + record['route_id'],
-                file=sys.stderr)
-          abort = True
-
-        percentage_of_route_completed = record['scores']['score_route'] / 100.0
-        route_length_km = record['meta']['route_length'] / 1000.0
-        driven_km = percentage_of_route_completed * route_length_km
-        route_time_hours = record['meta']['duration_game'] / 3600.0  # conversion from seconds to hours
-        total_driven_hours += route_time_hours
-        total_km_driven += driven_km
-        if route_time_hours > 0.0:
-          avg_speed_km_h = driven_km / route_time_hours
-        else:
-          avg_speed_km_h = 0.0
-
-        total_number_of_routes += 1
-        local_infractions = {}
-        for infraction_name in infraction_names:
-          local_infractions[infraction_name] = 0
-          if infraction_name == 'outside_route_lanes':
-            if len(record['infractions'][infraction_name]) > 0:
-              meters_off_road = re.findall(r'\d+\.\d+', record['infractions'][infraction_name][0])[0]
-              km_off_road = float(meters_off_road) / 1000.0
-              total_infractions[infraction_name] += km_off_road
-              local_infractions[infraction_name] += km_off_road
-          elif infraction_name == 'min_speed_infractions':
-            if len(record['infractions'][infraction_name]) == 0:
-              total_infractions[infraction_name] += 0
-              local_infractions[infraction_name] += 0
-            else:
-              perc_speed_of_traffic = []
-              for min_speed_inf in record['infractions'][infraction_name]:
-                pattern = r"(\d+(\.\d+)?)%"
-                min_speed_section = float(re.findall(pattern, min_speed_inf)[0][0]) / 100.0
-                # clip to 0 to 1
-                min_speed_section = min(1.0, max(0.0, min_speed_section))
-                perc_speed_of_traffic.append(min_speed_section)
-              avg_min_speed = np.mean(perc_speed_of_traffic)
-              # We log percentage of route where the min speed was violated.
-              total_infractions[infraction_name] += 1.0 - avg_min_speed
-              local_infractions[infraction_name] += 1.0 - avg_min_speed
-
-          else:
-            num_infraction = len(record['infractions'][infraction_name])
-            total_infractions[infraction_name] += num_infraction
-            local_infractions[infraction_name] += num_infraction
-
-        # Compute normalized driving score.
-        score_penalty = 1.0
-        score_route = record['scores']['score_route']
-
-        # Standard infractions
-        for inf_name in local_infractions:
-          if inf_name in PENALTY_VALUE_DICT:
-            if driven_km > 0.0:
-                score_penalty *= math.pow(PENALTY_VALUE_DICT[inf_name], (local_infractions[inf_name] / driven_km))
-
-        # Special infraction min speed
-        # if len(record['infractions']['min_speed_infractions']) > 0:
-        #   for min_speed_inf in record['infractions']['min_speed_infractions']:
-        #     pattern = r"(\d+(\.\d+)?)%"
-            
-        #     min_speed_section = float(re.findall(pattern, min_speed_inf)[0][0])
-        #     # clip to 0 to 1
-        #     min_speed_section = min(1.0, max(0.0, min_speed_section))
-        #     score_penalty *= min_speed_penalty(min_speed_section)
-
-        # Special infraction outside route lanes
-        if len(record['infractions']['outside_route_lanes']) > 0:
-          for outside_route_lanes in record['infractions']['outside_route_lanes']:
-            outside_route_lanes_perc = float(re.findall(r'\d+\.\d+', outside_route_lanes)[1])
-            score_penalty *= outside_route_lanes_penalty(outside_route_lanes_perc)
-
-        normalied_ds = score_route * score_penalty
-
-        normalized_driving_scores.append(normalied_ds)
-        normalized_infraction_scores.append(score_penalty)
-
-        driving_scores.append(record['scores']['score_composed'])
-        route_completions.append(score_route)
-        infraction_scores.append(record['scores']['score_penalty'])
-        route_ids.append(record['route_id'])
-        duration_games.append(record['meta']['duration_game'])
-        route_lengths.append(record['meta']['route_length'])
-        if 'scenario_name' in record:
-          scenario_names.append(record['scenario_name'])
-        else:
-          scenario_names.append('N/A')
-        if 'weather_id' in record:
-          weather_ids.append(record['weather_id'])
+    summaries = [summarize_record(record) for record in evaluation_data['_checkpoint']['records']]
+  except (OSError, ValueError, KeyError, IndexError, TypeError):
+    return path, stats, None
+  return path, stats, summaries
+
+
+def file_stats(path):
+  stat = os.stat(path)
+  return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_state(state_path):
+  try:
+    with open(state_path, encoding='utf-8') as f:
+      state = ujson.load(f)
+  except (OSError, ValueError):
+    return {}
+  if state.get('version') != STATE_VERSION:
+    return {}
+  return state['files']
+
+
+def atomic_write(path, write, mode='w'):
+  '''Writes to a temporary file next to path and replaces path with it.'''
+  tmp_path = f'{path}.tmp_{os.getpid()}'
+  with open(tmp_path, mode, **({'encoding': 'utf-8', 'newline': ''} if mode == 'w' else {})) as f:
+    write(f)
+  os.replace(tmp_path, path)
+
+
+def update_state(results, num_workers, rebuild=False):
+  '''Parses new and changed result files, returns the summaries of all files in glob order.'''
+  state_path = os.path.join(results, STATE_FILE)
+  cached = {} if rebuild else load_state(state_path)
+  filenames = glob.glob(f"{results}/**/*_res.json", recursive=True)
+
+  relative_paths = [os.path.relpath(f, results) for f in filenames]
+  files = {}
+  to_parse = []
+  for f, relative_path in zip(filenames, relative_paths):
+    try:
+      stats = file_stats(f)
+    except OSError:
+      continue
+    if relative_path in cached and cached[relative_path]['stats'] == stats:
+      files[relative_path] = cached[relative_path]
+    else:
+      to_parse.append((f, stats))
+
+  unreadable = []
+  if to_parse:
+    with multiprocessing.Pool(processes=max(1, min(num_workers, len(to_parse)))) as pool:
+      for f, stats, summaries in tqdm.tqdm(pool.imap_unordered(parse_result_file, to_parse, chunksize=8),
+                                           total=len(to_parse), desc='parsing'):
+        if summaries is None:
+          unreadable.append(f)
         else:
-          weather_ids.append('N/A')
-        status.append(record['status'])
-        individual_infractions.append(local_infractions)
+          files[os.path.relpath(f, results)] = {'stats': stats, 'records': summaries}
+  print(f'{results}: {len(filenames)} result files, {len(to_parse)} parsed, {len(unreadable)} not readable yet')
+  for f in unreadable:
+    print(f'Warning: Could not read {f}, it is parsed again in the next run.', file=sys.stderr)
+
+  if to_parse or files.keys() != cached.keys():
+    atomic_write(state_path, lambda f: ujson.dump({'version': STATE_VERSION, 'files': files}, f))
+  return [summary for relative_path in relative_paths if relative_path in files
+          for summary in files[relative_path]['records']]
 
-      total_score_labels = labels[:]
-      total_score_labels.append('Avg. speed km/h')
-      total_score_labels.append('Avg. Normalized DS')
-      total_score_labels.append('Avg. Normalized IS')
 
+def aggregate(summaries, route_matching):
+  '''The total scores and the route scenarios of results.csv, returns also whether a route did not finish correctly.'''
+  abort = False
+  total_km_driven = 0.0
+  total_driven_hours = 0.0
+  total_infractions = {infraction_name: 0 for infraction_name in INFRACTION_NAMES}
+  for summary in summaries:
+    for error in summary['errors']:
+      print(error, file=sys.stderr)
+      abort = abort or error.startswith('Error')
+    total_driven_hours += summary['hours']
+    total_km_driven += summary['driven_km']
+    for infraction_name in INFRACTION_NAMES:
+      total_infractions[infraction_name] += summary['infraction_values'][infraction_name]
+
+  total_number_of_routes = len(summaries)
+  total_infractions_per_km = {}
   for key, value in total_infractions.items():
     if key == 'min_speed_infractions':
       # Since this infraction is a percentage, we put it in rage [0.0, 100.0]
@@ -258,7 +299,6 @@ def main():
 
   avg_km_h_speed = total_km_driven / total_driven_hours
 
-
   if total_number_of_routes % len(route_matching) != 0:
     print('Error: The number of completed routes (' + str(total_number_of_routes) +
           ') is not a multiple of the total routes (' + str(len(route_matching)) +
@@ -266,13 +306,14 @@ def main():
           file=sys.stderr)
     abort = True
 
-  if abort and args.strict:
-    print('Don not create result file because not all routes were completed successfully and strict is set.',
-          file=sys.stderr)
-    sys.exit()
+  driving_scores = [summary['scores']['score_composed'] for summary in summaries]
+  route_completions = [summary['scores']['score_route'] for summary in summaries]
+  infraction_scores = [summary['scores']['score_penalty'] for summary in summaries]
+  normalized_driving_scores = [summary['normalized_ds'] for summary in summaries]
+  normalized_infraction_scores = [summary['normalized_is'] for summary in summaries]
 
+  total_score_labels = LABELS + ['Avg. speed km/h', 'Avg. Normalized DS', 'Avg. Normalized IS']
   total_score_values = np.zeros(18)
-
   for idx, value in enumerate(total_score_labels):
     if value == 'Avg. driving score':
       total_score_values[idx] = np.sum(driving_scores) / len(driving_scores)
@@ -280,30 +321,8 @@ def main():
       total_score_values[idx] = np.sum(route_completions) / len(route_completions)
     elif value == 'Avg. infraction penalty':
       total_score_values[idx] = np.sum(infraction_scores) / len(infraction_scores)
-    elif value == 'Collisions with pedestrians':
-      total_score_values[idx] = total_infractions_per_km['collisions_pedestrian']
-    elif value == 'Collisions with vehicles':
-      total_score_values[idx] = total_infractions_per_km['collisions_vehicle']
-    elif value == 'Collisions with layout':
-      total_score_values[idx] = total_infractions_per_km['collisions_layout']
-    elif value == 'Red lights infractions':
-      total_score_values[idx] = total_infractions_per_km['red_light']
-    elif value == 'Stop sign infractions':
-      total_score_values[idx] = total_infractions_per_km['stop_infraction']
-    elif value == 'Off-road infractions':
-      total_score_values[idx] = total_infractions_per_km['outside_route_lanes']
-    elif value == 'Route deviations':
-      total_score_values[idx] = total_infractions_per_km['route_dev']
-    elif value == 'Route timeouts':
-      total_score_values[idx] = total_infractions_per_km['route_timeout']
-    elif value == 'Agent blocked':
-      total_score_values[idx] = total_infractions_per_km['vehicle_blocked']
-    elif value == 'Yield emergency vehicles infractions':
-      total_score_values[idx] = total_infractions_per_km['yield_emergency_vehicle_infractions']
-    elif value == 'Scenario timeouts':
-      total_score_values[idx] = total_infractions_per_km['scenario_timeouts']
-    elif value == 'Min speed infractions':
-      total_score_values[idx] = total_infractions_per_km['min_speed_infractions']
+    elif value in LABEL_INFRACTIONS:
+      total_score_values[idx] = total_infractions_per_km[LABEL_INFRACTIONS[value]]
     elif value == 'Avg. speed km/h':
       total_score_values[idx] = avg_km_h_speed
     elif value == 'Avg. Normalized DS':
@@ -311,141 +330,232 @@ def main():
     elif value == 'Avg. Normalized IS':
       total_score_values[idx] = np.sum(normalized_infraction_scores) / len(normalized_infraction_scores)
 
-  # dict to extract unique identity of route in case of repetitions
-  route_to_id = {}
-  for route_id in route_ids:
-    route_to_id[route_id] = str(re.search('_(\\d+)_', route_id).group(1))
-
   # build table of relevant information
   total_score_info = [{"label": label, "value": value} for label, value in zip(total_score_labels, total_score_values)]
-  route_scenarios = [{"route": route_id,
-                      "town": route_matching[route_to_id[route_id]]["town"],
-                      "scenario": scenario_names[idx],
-                      "weather": weather_ids[idx],
-                      "duration": duration_games[idx],
-                      "length": route_lengths[idx],
-                      "status": status[idx],
-                      "DS": driving_scores[idx],
-                      "RC": route_completions[idx],
-                      "NDS": normalized_driving_scores[idx],
-                      "infractions": [(key, item)
-                                      for key, item in individual_infractions[idx].items()]}
-                     for idx, route_id in enumerate(route_ids)]
-
-
-
-  # compute aggregated statistics and table for each filter
-  filters = ["route", "town", "status","town","weather","scenario"]
+  route_scenarios = [{"route": summary['route_id'],
+                      "town": route_matching[route_town_id(summary['route_id'])]["town"],
+                      "scenario": summary['scenario_name'],
+                      "weather": summary['weather_id'],
+                      "duration": summary['meta']['duration_game'],
+                      "length": summary['meta']['route_length'],
+                      "status": summary['status'],
+                      "DS": summary['scores']['score_composed'],
+                      "RC": summary['scores']['score_route'],
+                      "NDS": summary['normalized_ds'],
+                      "infractions": [(key, summary['infraction_values'][key]) for key in INFRACTION_NAMES]}
+                     for summary in summaries]
+  return total_score_info, route_scenarios, total_infractions, total_infractions_per_km, abort
+
+
+def route_town_id(route_id):
+  '''Unique identity of a route in case of repetitions.'''
+  return str(re.search('_(\\d+)_', route_id).group(1))
+
+
+def evaluate_filters(route_scenarios):
+  '''Aggregated statistics for each filter.'''
+  # columns of all routes, the statistics of a subcategory index its rows in the order of the routes
+  columns = {key: np.array([scenario[key] for scenario in route_scenarios]) for key in ("DS", "RC", "NDS", "duration", "length")}
+  infractions = np.array([[infraction[1] for infraction in scenario["infractions"]] for scenario in route_scenarios])
   evaluation_filtered = {}
-
-  for filter in filters:
+  for filter in FILTERS:
     subcategories = np.unique(np.array([scenario[filter] for scenario in route_scenarios]))
-    route_scenarios_per_subcategory = {}
+    rows_per_subcategory = {subcategory: [] for subcategory in subcategories}
     evaluation_per_subcategory = {}
+    for idx, scenario in enumerate(route_scenarios):
+      rows_per_subcategory[scenario[filter]].append(idx)
     for subcategory in subcategories:
-      route_scenarios_per_subcategory[subcategory] = []
-      evaluation_per_subcategory[subcategory] = {}
-    for scenario in route_scenarios:
-      route_scenarios_per_subcategory[scenario[filter]].append(scenario)
-    for subcategory in subcategories:
-      scores = np.array([scenario["DS"] for scenario in route_scenarios_per_subcategory[subcategory]])
-      completions = np.array([scenario["RC"] for scenario in route_scenarios_per_subcategory[subcategory]])
-      n_scores = np.array([scenario["NDS"] for scenario in route_scenarios_per_subcategory[subcategory]])
-      durations = np.array([scenario["duration"] for scenario in route_scenarios_per_subcategory[subcategory]])
-      lengths = np.array([scenario["length"] for scenario in route_scenarios_per_subcategory[subcategory]])
-
-      infractions = np.array([[infraction[1] for infraction in scenario["infractions"]]
-                              for scenario in route_scenarios_per_subcategory[subcategory]])
-
-      scores_combined = (scores.mean(), scores.std())
-      completions_combined = (completions.mean(), completions.std())
-      n_scores_combined = (n_scores.mean(), n_scores.std())
-
-      durations_combined = (durations.mean(), durations.std())
-      lengths_combined = (lengths.mean(), lengths.std())
-      infractions_combined = [(mean, std) for mean, std in zip(infractions.mean(axis=0), infractions.std(axis=0))]
-
-      evaluation_per_subcategory[subcategory] = {"DS": scores_combined,
-                                                 "RC": completions_combined,
-                                                 "NDS": n_scores_combined,
-                                                 "duration": durations_combined,
-                                                 "length": lengths_combined,
-                                                 "infractions": infractions_combined}
+      rows = np.array(rows_per_subcategory[subcategory])
+      if len(rows) == 1:
+        # mean and std of a single route (every route of the route filter) without the numpy reductions
+        evaluation = {key: (np.float64(column[rows[0]]), np.float64(0.0)) for key, column in columns.items()}
+        evaluation["infractions"] = [(mean, np.float64(0.0)) for mean in infractions[rows[0]].astype(np.float64)]
+      else:
+        evaluation = {key: (column[rows].mean(), column[rows].std()) for key, column in columns.items()}
+        evaluation["infractions"] = [(mean, std) for mean, std in zip(infractions[rows].mean(axis=0), infractions[rows].std(axis=0))]
+      evaluation_per_subcategory[subcategory] = evaluation
     evaluation_filtered[filter] = evaluation_per_subcategory
-
-  # write output csv file
-  if not os.path.isdir(args.results):
-    os.mkdir(args.save_dir)
-  with open(os.path.join(args.results, 'results.csv'), 'w') as f:  # Make file object first
-    csv_writer_object = csv.writer(f)  # Make csv writer object
-    # writerow writes one row of data given as list object
-    for info in total_score_info:
-      csv_writer_object.writerow([item for _, item in info.items()])
+  return evaluation_filtered
+
+
+def write_results_csv(f, total_score_info, route_scenarios, evaluation_filtered, route_matching):
+  csv_writer_object = csv.writer(f)
+  for info in total_score_info:
+    csv_writer_object.writerow([item for _, item in info.items()])
+  csv_writer_object.writerow([""])
+
+  infractions_types = []
+  for infraction in route_scenarios[0]["infractions"]:
+    infractions_types.append(infraction[0] + " mean")
+    infractions_types.append(infraction[0] + " std")
+  for filter in FILTERS:
+    # route aggregation table has additional columns
+    if filter == "route":
+      csv_writer_object.writerow(
+        [filter, "town", "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std",
+         "duration mean", "duration std", "length mean", "length std"] +
+        infractions_types)
+    else:
+      csv_writer_object.writerow(
+        [filter, "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std", "duration mean", "duration std",
+         "length mean", "length std"] +
+        infractions_types)
+
+    try:
+      sorted_keys = sorted(evaluation_filtered[filter].keys(),
+                           key=lambda fil: int(re.search('_(\\d+)_', fil).group(1)))
+    except AttributeError:
+      sorted_keys = sorted(evaluation_filtered[filter].keys())
+
+    for key in sorted_keys:
+      item = evaluation_filtered[filter][key]
+      infractions_output = []
+      for infraction in item["infractions"]:
+        infractions_output.append(infraction[0])
+        infractions_output.append(infraction[1])
+      row = [key]
+      if filter == "route":
+        row.append(route_matching[route_town_id(key)]["town"])
+      csv_writer_object.writerow(row + [item["DS"][0], item["DS"][1],
+                                        item["RC"][0], item["RC"][1],
+                                        item["NDS"][0], item["NDS"][1],
+                                        item["duration"][0], item["duration"][1],
+                                        item["length"][0], item["length"][1]] +
+                                 infractions_output)
     csv_writer_object.writerow([""])
 
-    for filter in filters:
-      infractions_types = []
-      for infraction in route_scenarios[0]["infractions"]:
-        infractions_types.append(infraction[0] + " mean")
-        infractions_types.append(infraction[0] + " std")
 
-      # route aggregation table has additional columns
-      if filter == "route":
-        csv_writer_object.writerow(
-          [filter, "town", "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std",
-           "duration mean", "duration std", "length mean", "length std"] +
-          infractions_types)
-      else:
-        csv_writer_object.writerow(
-          [filter, "DS mean", "DS std", "RC mean", "RC std", "NDS mean", "NDS std", "duration mean", "duration std",
-           "length mean", "length std"] +
-          infractions_types)
-
-      try:
-        sorted_keys = sorted(evaluation_filtered[filter].keys(),
-                             key=lambda fil: int(re.search('_(\\d+)_', fil).group(1)))
-      except AttributeError:
-        sorted_keys = sorted(evaluation_filtered[filter].keys())
-
-      for key in sorted_keys:
-        item = evaluation_filtered[filter][key]
-        infractions_output = []
-        for infraction in item["infractions"]:
-          infractions_output.append(infraction[0])
-          infractions_output.append(infraction[1])
-        if filter == "route":
-          csv_writer_object.writerow([key,
-                                      route_matching[route_to_id[key]]["town"],
-                                      item["DS"][0], item["DS"][1],
-                                      item["RC"][0], item["RC"][1],
-                                      item["NDS"][0], item["NDS"][1],
-                                      item["duration"][0], item["duration"][1],
-                                      item["length"][0], item["length"][1]] +
-                                     infractions_output)
-        else:
-          csv_writer_object.writerow([key,
-                                      item["DS"][0], item["DS"][1],
-                                      item["RC"][0], item["RC"][1],
-                                      item["NDS"][0], item["NDS"][1],
-                                      item["duration"][0], item["duration"][1],
-                                      item["length"][0], item["length"][1]] +
-                                     infractions_output)
-      csv_writer_object.writerow([""])
+def is_success(summary):
+  '''Success criterion of Bench2Drive: completed without infractions, min speed infractions do not count.'''
+  return summary['status'] in ('Completed', 'Perfect') and not any(
+      len(value) > 0 for infraction, value in summary['infractions'].items() if infraction != 'min_speed_infractions')
+
+
+def route_table(summaries, route_matching):
+  '''One row per route record as columns.'''
+  columns = {
+      'route_id': np.array([summary['route_id'] for summary in summaries], dtype=np.str_),
+      'town': np.array([route_matching[route_town_id(summary['route_id'])]['town'] for summary in summaries], dtype=np.str_),
+      'scenario': np.array([str(summary['scenario_name']) for summary in summaries], dtype=np.str_),
+      'scenario_type': np.array([route_matching[route_town_id(summary['route_id'])]['scenario_type'] for summary in summaries],
+                                dtype=np.str_),
+      'weather': np.array([str(summary['weather_id']) for summary in summaries], dtype=np.str_),
+      'status': np.array([summary['status'] for summary in summaries], dtype=np.str_),
+      'DS': np.array([summary['scores']['score_composed'] for summary in summaries], dtype=np.float64),
+      'RC': np.array([summary['scores']['score_route'] for summary in summaries], dtype=np.float64),
+      'IS': np.array([summary['scores']['score_penalty'] for summary in summaries], dtype=np.float64),
+      'NDS': np.array([summary['normalized_ds'] for summary in summaries], dtype=np.float64),
+      'NIS': np.array([summary['normalized_is'] for summary in summaries], dtype=np.float64),
+      'success': np.array([is_success(summary) for summary in summaries], dtype=bool),
+      'duration': np.array([summary['meta']['duration_game'] for summary in summaries], dtype=np.float64),
+      'length': np.array([summary['meta']['route_length'] for summary in summaries], dtype=np.float64),
+      'driven_km': np.array([summary['driven_km'] for summary in summaries], dtype=np.float64),
+  }
+  for infraction_name in INFRACTION_NAMES:
+    columns[infraction_name] = np.array([summary['infraction_values'][infraction_name] for summary in summaries], dtype=np.float64)
+  return columns
+
+
+def write_table_csv(f, columns):
+  csv_writer_object = csv.writer(f)
+  csv_writer_object.writerow(list(columns.keys()))
+  for row in zip(*[column.tolist() for column in columns.values()]):
+    csv_writer_object.writerow(row)
+
+
+def write_breakdown_csv(f, columns, total_infractions, total_infractions_per_km):
+  '''Infractions per type and the scores and infractions per scenario type.'''
+  csv_writer_object = csv.writer(f)
+  csv_writer_object.writerow(['infraction', 'total', 'per km', 'routes', 'events'])
+  for infraction_name in INFRACTION_NAMES:
+    csv_writer_object.writerow([infraction_name, total_infractions[infraction_name], total_infractions_per_km[infraction_name],
+                                int((columns[infraction_name] > 0).sum()), int(columns[f'{infraction_name}_events'].sum())])
+  csv_writer_object.writerow([""])
+
+  csv_writer_object.writerow(['scenario type', 'routes', 'success rate', 'DS mean', 'RC mean', 'NDS mean'] + INFRACTION_NAMES)
+  for scenario_type in np.unique(columns['scenario_type']):
+    mask = columns['scenario_type'] == scenario_type
+    csv_writer_object.writerow([scenario_type, int(mask.sum()), columns['success'][mask].mean(), columns['DS'][mask].mean(),
+                                columns['RC'][mask].mean(), columns['NDS'][mask].mean()] +
+                               [columns[infraction_name][mask].sum() for infraction_name in INFRACTION_NAMES])
+  csv_writer_object.writerow([""])
+
+
+def ability_results(summaries, xml_path, junction_cache, offline=False):
+  '''
+  Ability results of ability_benchmark.py from the summaries, None if junction completions are missing. With offline
+  the missing ones are estimated from the routes xml and listed in estimated_junction_completions.
+  '''
+  # the records of Bench2Drive/tools/merge_route_json.py
+  records = sorted([summary for summary in summaries if summary['status'] != 'Failed - Agent crashed'],
+                   key=lambda d: d['route_id'], reverse=True)
+  routes = sorted(ET.parse(xml_path).getroot().findall('route'), key=lambda x: x.get('town'))
+  junction_completions = {}
+  if junction_cache:
+    with open(junction_cache, encoding='utf-8') as f:
+      junction_completions = json.load(f)
+  missing = [route.get('id') for route in routes if route.find('scenarios').find('scenario').get('type') in Ability['Traffic_Signs']
+             and route.get('id') not in junction_completions]
+  if missing and not offline:
+    print(f'Warning: No junction completion of {len(missing)} Traffic_Signs routes, run Bench2Drive/tools/ability_benchmark.py '
+          f'once with --junction_cache to create them (or estimate them with --offline). Skipping the abilities.', file=sys.stderr)
+    return None
+  if missing:
+    print(f'Warning: Estimating the junction completion of {len(missing)} Traffic_Signs routes from the routes xml, '
+          f'the abilities are not the official Bench2Drive numbers.', file=sys.stderr)
+    estimates = estimate_junction_completions(routes)
+    junction_completions = {**junction_completions, **{route_id: estimates[route_id] for route_id in missing}}
+  ability_res, success_statistic, _ = compute_ability(records, routes, junction_completions)
+  ability_res['success'] = {scenario: float(statis[0]) / float(statis[1]) for scenario, statis in success_statistic.items()}
+  if offline:
+    ability_res['estimated_junction_completions'] = sorted(missing, key=int)
+  return ability_res
+
+
+def parse_results(results, route_matching):
+  summaries = update_state(results, args.num_workers, rebuild=args.rebuild)
+  if not summaries:
+    print(f'No results in {results}', file=sys.stderr)
+    return
+  total_score_info, route_scenarios, total_infractions, total_infractions_per_km, abort = aggregate(summaries, route_matching)
+  if abort and args.strict:
+    print('Don not create result file because not all routes were completed successfully and strict is set.',
+          file=sys.stderr)
+    return
+  evaluation_filtered = evaluate_filters(route_scenarios)
+
+  columns = route_table(summaries, route_matching)
+  atomic_write(os.path.join(results, 'results.csv'),
+               lambda f: write_results_csv(f, total_score_info, route_scenarios, evaluation_filtered, route_matching))
+  atomic_write(os.path.join(results, 'results_routes.csv'), lambda f: write_table_csv(f, columns))
+  atomic_write(os.path.join(results, 'results_table.npz'), lambda f: np.savez(f, **columns), mode='wb')
+  for infraction_name in INFRACTION_NAMES:
+    columns[f'{infraction_name}_events'] = np.array([len(summary['infractions'].get(infraction_name, [])) for summary in summaries])
+  atomic_write(os.path.join(results, 'results_breakdown.csv'),
+               lambda f: write_breakdown_csv(f, columns, total_infractions, total_infractions_per_km))
+
+  if args.ability:
+    ability_res = ability_results(summaries, args.xml, args.junction_cache, args.offline)
+    if ability_res is not None:
+      atomic_write(os.path.join(results, 'results_ability.json'), lambda f: json.dump(ability_res, f, indent=4))
+      estimated = ability_res.get('estimated_junction_completions')
+      label = f' (junction completions of {len(estimated)} Traffic_Signs routes estimated)' if estimated else ''
+      print(f"{results}: ability mean {ability_res['mean']}{label}")
+
+
+def main():
+  root = ET.parse(args.xml).getroot()
+  # build route matching dict
+  route_matching = {}
+  for route in root.iter('route'):
+    scenario = route.find('scenarios/scenario')
+    route_matching[route.attrib["id"]] = {'town': route.attrib["town"],
+                                          'scenario_type': 'N/A' if scenario is None else scenario.get('type')}
+
+  for results in args.results:
+    parse_results(results, route_matching)
+
 
 if __name__ == '__main__':
-    global args
-    args = parser.parse_args()
-    args.save_dir = args.results
-
-    main()
-
-    folders=[]
-    folders = glob.glob('eval/cvpr/*')
-    for folder in folders:
-        print(folder)
-        args.results=folder
-        args.save_dir = args.results
-        try:
-            main()
-        except:
-            pass
\ No newline at end of file
+  args = parser.parse_args()
+  main()
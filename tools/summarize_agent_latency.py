@@ -0,0 +1,104 @@
+'''
+Summarizes the per-route latency reports (team_code/latency_profiler.py, written with PROFILE_LATENCY=1)
+of an evaluation sweep. Prints per stage the step-weighted mean and the median over routes of the per-route
+percentiles. With --baseline the relative change to a previous sweep is printed to spot latency regressions.
+Example:
+python tools/summarize_agent_latency.py --path eval_results/Bench2Drive/simlingo --baseline eval_results_old/Bench2Drive/simlingo
+'''
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, required=True, help='Folder that is searched recursively for latency reports.')
+parser.add_argument('--baseline', type=str, default=None, help='Folder of a previous sweep to compare with.')
+parser.add_argument('--timer', type=str, default='wall_ms', choices=['wall_ms', 'cuda_ms'])
+parser.add_argument('--out', type=str, default=None, help='Optional json file for the summary.')
+
+
+def load_reports(path):
+  files = glob.glob(os.path.join(path, '**', '*_latency.json'), recursive=True)
+  files += glob.glob(os.path.join(path, '**', 'latency.json'), recursive=True)
+  reports = []
+  for file in sorted(set(files)):
+    with open(file, 'r', encoding='utf-8') as f:
+      reports.append(json.load(f))
+  return reports
+
+
+def summarize(reports, timer):
+  per_stage = {}
+  for report in reports:
+    for stage, values in report['stages'].items():
+      if timer not in values:
+        continue
+      per_stage.setdefault(stage, []).append((values['count'], values[timer]))
+
+  summary = {}
+  for stage, routes in per_stage.items():
+    counts = np.array([count for count, _ in routes])
+    summary[stage] = {
+        'routes': len(routes),
+        'steps': int(counts.sum()),
+        'mean': float(np.average([values['mean'] for _, values in routes], weights=counts)),
+        'p50': float(np.median([values['p50'] for _, values in routes])),
+        'p90': float(np.median([values['p90'] for _, values in routes])),
+        'p99': float(np.median([values['p99'] for _, values in routes])),
+        'max': float(max(values['max'] for _, values in routes)),
+    }
+
+  over_budget = [(report['num_steps'], report['over_budget_fraction']) for report in reports if 'over_budget_fraction' in report]
+  if over_budget and 'total' in summary:
+    steps = np.array([num_steps for num_steps, _ in over_budget])
+    summary['total']['over_budget_fraction'] = float(np.average([fraction for _, fraction in over_budget], weights=steps))
+  return summary
+
+
+def print_summary(summary, baseline=None):
+  # slowest stages first, total on top
+  stages = sorted(summary, key=lambda stage: (stage != 'total', -summary[stage]['mean']))
+  header = f'{"stage":>18} {"routes":>7} {"mean":>9} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}'
+  if baseline is not None:
+    header += f' {"mean vs baseline":>17}'
+  print(header + '   [ms]')
+  for stage in stages:
+    values = summary[stage]
+    line = (f'{stage:>18} {values["routes"]:>7} {values["mean"]:>9.2f} {values["p50"]:>9.2f} {values["p90"]:>9.2f} '
+            f'{values["p99"]:>9.2f} {values["max"]:>9.2f}')
+    if baseline is not None:
+      if stage in baseline and baseline[stage]['mean'] > 0:
+        line += f' {100.0 * (values["mean"] / baseline[stage]["mean"] - 1.0):>+16.1f}%'
+      else:
+        line += f' {"-":>17}'
+    print(line)
+  if 'over_budget_fraction' in summary.get('total', {}):
+    print(f'Steps over the 50 ms budget: {100.0 * summary["total"]["over_budget_fraction"]:.1f}%')
+
+
+def main():
+  args = parser.parse_args()
+  reports = load_reports(args.path)
+  print(f'Found {len(reports)} latency reports')
+  if len(reports) == 0:
+    return
+  summary = summarize(reports, args.timer)
+
+  baseline = None
+  if args.baseline is not None:
+    baseline_reports = load_reports(args.baseline)
+    print(f'Found {len(baseline_reports)} baseline latency reports')
+    baseline = summarize(baseline_reports, args.timer) if len(baseline_reports) > 0 else None
+
+  print_summary(summary, baseline)
+
+  if args.out is not None:
+    with open(args.out, 'w', encoding='utf-8') as f:
+      json.dump({'summary': summary, 'baseline': baseline}, f, indent=4)
+
+
+if __name__ == '__main__':
+  main()